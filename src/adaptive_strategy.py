@@ -0,0 +1,271 @@
+import collections
+import json
+import math
+import os
+import shutil
+import threading
+import zlib
+
+from memory_scheduler import get_available_memory
+
+
+# Model of every diff tool: bytes of both inputs handled per second, stored bytes per byte of the modified
+# file which is new (literal) or found within the original (match), the length of the smallest match the tool
+# can use, memory needed per byte of the original and whether the tool compresses its own output.
+# The numbers are starting points, the decision log of a benchmark run holds everything which is needed to tune them.
+ToolModel = collections.namedtuple("ToolModel", ["throughput", "literal_factor", "match_cost", "granularity",
+                                                 "memory_factor", "compresses_output", "required_programs"])
+
+
+def rsync_granularity(size):
+    # Block size of the built-in rsync engine, roughly the square root of the file size
+    return max(700, min(128 * 1024, int(math.sqrt(size))))
+
+
+tool_models = {
+    "bsdiff": ToolModel(2 * 1024 * 1024, 1.0, 0.01, lambda size: 8, 17, True, ["bsdiff"]),
+    "xdelta": ToolModel(40 * 1024 * 1024, 1.1, 0.02, lambda size: 16, 2, True, ["xdelta3"]),
+    "rsync": ToolModel(30 * 1024 * 1024, 1.0, 0.01, rsync_granularity, 1, False, []),
+    "cdc": ToolModel(60 * 1024 * 1024, 1.0, 0.005, lambda size: 8 * 1024, 1, False, []),
+}
+
+# A second of diffing is worth this many bytes of patch size when the candidates are compared
+seconds_cost_in_bytes = 256 * 1024
+# A delta has to be clearly smaller than a copy of the target, otherwise the copy is stored
+copy_margin = 0.95
+# External tools are stopped once they take this much longer than the model expects
+deadline_factor = 4
+minimum_deadline = 30
+
+sample_count = 4
+sample_size = 16 * 1024
+similarity_windows = 64
+window_size = 32
+# Windows of the original are hashed where they start at a multiple of window_size. Of a large original only
+# every n-th of them is kept, so at most this many hashes are held, and every region of the modified file holds
+# enough windows that a few of them meet the kept ones.
+maximum_window_samples = 1024 * 1024
+windows_per_region = 8
+original_block_size = 4 * 1024 * 1024
+window_multipliers = [0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93]
+# Samples with more bits per byte are already compressed or encrypted
+compressed_entropy = 7.5
+
+copy_strategy = "copy"
+
+FileProfile = collections.namedtuple("FileProfile", ["size", "original_size", "entropy", "compressibility",
+                                                     "similarity"])
+
+
+def read_samples(file_path, size):
+    # Samples are spread evenly over the file, so a changed header does not decide on its own.
+    # Samples of a small file would overlap and make it look more compressible than it is, it is read as a whole.
+    samples = []
+    with open(file_path, "rb") as file_handler:
+        if size <= sample_count * sample_size:
+            return file_handler.read()
+        for index in range(sample_count):
+            file_handler.seek(max(0, size - sample_size) * index // max(1, sample_count - 1))
+            samples.append(file_handler.read(sample_size))
+    return b"".join(samples)
+
+
+def calculate_entropy(data):
+    if not data:
+        return 0.0
+    entropy = 0.0
+    for count in collections.Counter(data).values():
+        probability = count / len(data)
+        entropy -= probability * math.log2(probability)
+    return entropy
+
+
+def hash_windows(data, offset):
+    # Hashes the windows of data which start at offset and every window_size bytes after it. The result is mixed
+    # once more, so its low bits can decide which windows are kept.
+    # NumPy is only needed to estimate the similarity, therefore it is imported on demand
+    import numpy as np
+
+    count = (len(data) - offset) // window_size
+    if count <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    words = np.frombuffer(data, dtype="<u8", count=count * window_size // 8, offset=offset).reshape(count, -1)
+    hashes = (words * np.array(window_multipliers, dtype=np.uint64)).sum(axis=1, dtype=np.uint64)
+    hashes ^= hashes >> np.uint64(31)
+    hashes *= np.uint64(window_multipliers[0])
+    hashes ^= hashes >> np.uint64(29)
+    return hashes
+
+
+def get_sample_step(original_size):
+    sample_step = 1
+    while original_size // window_size > maximum_window_samples * sample_step:
+        sample_step *= 2
+    return sample_step
+
+
+def hash_original_windows(original_version_file, sample_step):
+    # The original is read once front to back, the blocks are a multiple of window_size long
+    import numpy as np
+
+    samples = []
+    with open(original_version_file, "rb") as file_handler:
+        block = file_handler.read(original_block_size)
+        while len(block) >= window_size:
+            hashes = hash_windows(block, 0)
+            samples.append(hashes[(hashes & np.uint64(sample_step - 1)) == 0])
+            block = file_handler.read(original_block_size)
+    return np.unique(np.concatenate(samples)) if samples else np.zeros(0, dtype=np.uint64)
+
+
+def estimate_similarity(original_version_file, modified_version_file, original_size, size):
+    # Share of short regions of the modified file which occur anywhere within the original file. A region is
+    # compared at every offset, so one of its windows lies on the grid of the hashed windows of the original.
+    # Windows with hardly any information would match everywhere, so they are left out.
+    import numpy as np
+
+    if original_size < window_size or size < window_size:
+        return 0.0
+
+    sample_step = get_sample_step(original_size)
+    original_hashes = hash_original_windows(original_version_file, sample_step)
+    if len(original_hashes) == 0:
+        return 0.0
+    region_size = min(size, window_size * (sample_step * windows_per_region + 1))
+    regions = similarity_windows if size > region_size else 1
+    matches = 0
+    windows = 0
+    with open(modified_version_file, "rb") as modified_handler:
+        for index in range(regions):
+            modified_handler.seek((size - region_size) * (2 * index + 1) // (2 * regions))
+            region = modified_handler.read(region_size)
+            informative = False
+            found = False
+            for offset in range(min(window_size, len(region) - window_size + 1)):
+                hashes = hash_windows(region, offset)
+                positions = np.nonzero((hashes & np.uint64(sample_step - 1)) == 0)[0]
+                # The hashes of the original are sorted, so every lookup is a binary search
+                found_positions = np.searchsorted(original_hashes, hashes[positions])
+                known = original_hashes[np.minimum(found_positions, len(original_hashes) - 1)] == hashes[positions]
+                for position, is_known in zip(positions, known):
+                    start = offset + int(position) * window_size
+                    if len(set(region[start:start + window_size])) < 8:
+                        continue
+                    informative = True
+                    found = found or bool(is_known)
+            windows += informative
+            matches += found
+
+    return matches / windows if windows else 0.5
+
+
+def profile_files(original_version_file, modified_version_file):
+    size = os.path.getsize(modified_version_file)
+    original_size = os.path.getsize(original_version_file)
+    sample = read_samples(modified_version_file, size)
+    compressibility = len(zlib.compress(sample, 1)) / len(sample) if sample else 1.0
+    return FileProfile(size=size,
+                       original_size=original_size,
+                       entropy=calculate_entropy(sample),
+                       compressibility=min(1.0, compressibility),
+                       similarity=estimate_similarity(original_version_file, modified_version_file, original_size,
+                                                      size))
+
+
+def estimate_tool(model, profile, compressed_patches):
+    # Literals of tools which do not compress them are only compressed if the whole patch is
+    literal_cost = profile.compressibility * model.literal_factor
+    if not model.compresses_output and not compressed_patches:
+        literal_cost = 1.0
+    # The similarity holds for short windows. A match of a tool is as long as its granularity and only
+    # survives if none of its windows was edited, so coarse tools lose much more to scattered edits.
+    similarity = profile.similarity ** (model.granularity(profile.size) / window_size)
+    expected_bytes = profile.size * ((1 - similarity) * min(1.0, literal_cost) + similarity * model.match_cost)
+    expected_seconds = (profile.size + profile.original_size) / model.throughput
+    return int(expected_bytes), expected_seconds
+
+
+class StrategySelector:
+    # Chooses a diff tool or a plain copy for every file. Every decision is appended to the decision log
+    # together with the profile of the file, the estimates and what really happened.
+    def __init__(self, tools=None, compressed_patches=False, jobs=None, decision_log_path=None):
+        if tools is None:
+            tools = [tool for tool, model in tool_models.items()
+                     if all(shutil.which(program) for program in model.required_programs)]
+        self.tools = tools
+        self.compressed_patches = compressed_patches
+        self.memory_per_job = None
+        available_memory = get_available_memory()
+        if available_memory:
+            self.memory_per_job = available_memory // (jobs or os.cpu_count() or 1)
+
+        self.decision_log_path = decision_log_path
+        self.decision_log = open(decision_log_path, "a") if decision_log_path else None
+        self.lock = threading.Lock()
+        self.chosen_strategies = collections.Counter()
+        self.outcomes = collections.Counter()
+
+    def stored_copy_bytes(self, profile):
+        if self.compressed_patches:
+            return int(profile.size * profile.compressibility)
+        return profile.size
+
+    def stored_patch_bytes(self, tool, patch_bytes, compressibility):
+        # Raw literals shrink once the patch is compressed, tools with own compression stay as they are
+        if self.compressed_patches and not tool_models[tool].compresses_output:
+            return int(patch_bytes * compressibility)
+        return patch_bytes
+
+    def choose(self, original_version_file, modified_version_file):
+        profile = profile_files(original_version_file, modified_version_file)
+        copy_bytes = self.stored_copy_bytes(profile)
+
+        candidates = {}
+        for tool in self.tools:
+            model = tool_models[tool]
+            if self.memory_per_job and profile.original_size * model.memory_factor > self.memory_per_job:
+                continue
+            expected_bytes, expected_seconds = estimate_tool(model, profile, self.compressed_patches)
+            candidates[tool] = {"expected_bytes": expected_bytes, "expected_seconds": round(expected_seconds, 3),
+                                "score": expected_bytes + expected_seconds * seconds_cost_in_bytes}
+
+        # Compressed content without any similarity can not be diffed into anything smaller
+        strategy = copy_strategy
+        if candidates and not (profile.entropy > compressed_entropy and profile.similarity == 0):
+            tool = min(candidates, key=lambda candidate: candidates[candidate]["score"])
+            if candidates[tool]["expected_bytes"] < copy_bytes * copy_margin:
+                strategy = tool
+
+        deadline = None
+        if strategy != copy_strategy:
+            deadline = max(minimum_deadline, deadline_factor * candidates[strategy]["expected_seconds"])
+
+        return {
+            "file": modified_version_file,
+            "profile": profile._asdict(),
+            "candidates": candidates,
+            "copy_bytes": copy_bytes,
+            "strategy": strategy,
+            "deadline": deadline,
+        }
+
+    def record(self, decision, outcome, **values):
+        record = dict(decision, outcome=outcome, **values)
+        with self.lock:
+            self.chosen_strategies[decision["strategy"]] += 1
+            self.outcomes[outcome] += 1
+            if self.decision_log is not None:
+                self.decision_log.write(json.dumps(record, sort_keys=True) + "\n")
+                self.decision_log.flush()
+
+    def stats(self):
+        return {
+            "tools": self.tools,
+            "chosen_strategies": dict(self.chosen_strategies),
+            "outcomes": dict(self.outcomes),
+            "decision_log": self.decision_log_path,
+        }
+
+    def close(self):
+        if self.decision_log is not None:
+            self.decision_log.close()
@@ -0,0 +1,228 @@
+import collections
+import os
+import re
+
+
+apply_plan_name = "apply_plan.txt"
+
+# Every operation of an update. Paths are written like within the file lists, directories relative to the root.
+# written_bytes is the size of the file which is written and read_bytes everything which is read to write it.
+PlanOperation = collections.namedtuple("PlanOperation", ["operation", "path", "source_path", "written_bytes",
+                                                         "read_bytes"])
+
+# Operations of one group run in parallel as long as they follow each other within the plan,
+# directories are created and removed one after another. Copies and derived files read files which may be
+# patched or renamed later on, so they finish before anything else is written. Removes and renames run
+# alongside the new and patched files, a path which was touched within a step already starts the next one.
+parallel_groups = {"copy": "rebuild", "derive": "rebuild", "move": "write", "remove": "write",
+                   "new": "write", "patch": "write"}
+
+
+def get_directory_depth(directory):
+    return len([part for part in directory.split("/") if part])
+
+
+def get_parent_directories(file):
+    # All directories above a file, "/a//b/c" lies within "/a", "/a/b" and nothing else
+    parts = [part for part in file.split("/") if part][:-1]
+    return ["/" + "/".join(parts[:length]) for length in range(1, len(parts) + 1)]
+
+
+def normalize_path(path):
+    return "/" + "/".join(part for part in path.split("/") if part)
+
+
+def compile_apply_plan(new_files, modified_files, deleted_files, moved_files, derived_files,
+                       created_directories, removed_directories, file_sizes=None):
+    # Orders all operations so that every operation finds what it needs:
+    #   removes of files which turn into a directory
+    #   mkdir from the top down, every target directory exists before anything is written into it. Files which
+    #   are renamed away from a path that turns into a directory are moved right before its mkdir.
+    #   copies and derived files, which need their sources as they are within the original version
+    #   renames and removes of files within directories which are replaced by a file
+    #   rmdir of directories which are replaced by a file, from the bottom up
+    #   all other renames and removes together with the new and patched files
+    #   rmdir of all other directories which are gone within the modified version, from the bottom up
+    if file_sizes is None:
+        file_sizes = {}
+
+    def sizes(file):
+        return file_sizes.get(file, (0, 0))
+
+    source_usage = collections.Counter(source_file for _, source_file in moved_files + derived_files)
+    deleted_file_set = set(deleted_files)
+    renamed_sources = set(source_file for _, source_file in moved_files
+                          if source_usage[source_file] == 1 and source_file in deleted_file_set)
+
+    # Renamed files are written together with the new and patched files, after the replaced directories are gone
+    written_paths = set(normalize_path(file) for file in new_files + modified_files)
+    written_paths |= set(normalize_path(file) for file, source_file in moved_files if source_file in renamed_sources)
+    replaced_directories = set(directory for directory in removed_directories if directory in written_paths)
+    replaced_directories |= set(directory for directory in removed_directories
+                                if any(directory.startswith(replaced_directory + "/")
+                                       for replaced_directory in replaced_directories))
+    created_directory_set = set(created_directories)
+
+    def is_within_replaced_directory(file):
+        return any(directory in replaced_directories for directory in get_parent_directories(file))
+
+    # Sources of copies and derived files stay until they were read
+    early_removes = set(file for file in deleted_files
+                        if source_usage[file] == 0 and normalize_path(file) in created_directory_set)
+    removes = [file for file in deleted_files if file not in renamed_sources and file not in early_removes]
+    renames = [(file, source_file) for file, source_file in moved_files if source_file in renamed_sources]
+    vacating_renames = dict((normalize_path(source_file), (file, source_file)) for file, source_file in renames
+                            if normalize_path(source_file) in created_directory_set)
+    early_renames = set(file for file, _ in vacating_renames.values())
+
+    plan = []
+    for file in deleted_files:
+        if file in early_removes:
+            plan.append(PlanOperation("remove", file, "", 0, 0))
+    made_directories = set()
+    for directory in sorted(created_directories, key=lambda directory: (get_directory_depth(directory), directory)):
+        if directory in made_directories:
+            continue
+        if directory in vacating_renames:
+            file, source_file = vacating_renames[directory]
+            # The target directory of the rename may be new as well, as long as it does not lie within the path
+            # which is vacated
+            for parent_directory in get_parent_directories(file):
+                if parent_directory in created_directory_set and parent_directory not in made_directories and \
+                        parent_directory != directory and not parent_directory.startswith(directory + "/"):
+                    plan.append(PlanOperation("mkdir", parent_directory, "", 0, 0))
+                    made_directories.add(parent_directory)
+            plan.append(PlanOperation("move", file, source_file, 0, 0))
+        plan.append(PlanOperation("mkdir", directory, "", 0, 0))
+        made_directories.add(directory)
+    for file, source_file in moved_files:
+        if source_file not in renamed_sources:
+            plan.append(PlanOperation("copy", file, source_file, *sizes(file)))
+    for file, source_file in derived_files:
+        plan.append(PlanOperation("derive", file, source_file, *sizes(file)))
+    for file, source_file in renames:
+        if file not in early_renames and is_within_replaced_directory(source_file):
+            plan.append(PlanOperation("move", file, source_file, 0, 0))
+    for file in removes:
+        if is_within_replaced_directory(file):
+            plan.append(PlanOperation("remove", file, "", 0, 0))
+    for directory in sorted(replaced_directories, key=lambda directory: (-get_directory_depth(directory), directory)):
+        plan.append(PlanOperation("rmdir", directory, "", 0, 0))
+    for file, source_file in renames:
+        if file not in early_renames and not is_within_replaced_directory(source_file):
+            plan.append(PlanOperation("move", file, source_file, 0, 0))
+    for file in removes:
+        if not is_within_replaced_directory(file):
+            plan.append(PlanOperation("remove", file, "", 0, 0))
+    for file in new_files:
+        plan.append(PlanOperation("new", file, "", *sizes(file)))
+    for file in modified_files:
+        plan.append(PlanOperation("patch", file, "", *sizes(file)))
+    for directory in sorted(set(removed_directories) - replaced_directories,
+                            key=lambda directory: (-get_directory_depth(directory), directory)):
+        plan.append(PlanOperation("rmdir", directory, "", 0, 0))
+    return plan
+
+
+def find_directory_changes(original_directories, modified_directories):
+    # Both lists come from tree snapshots, the root itself is never created or removed
+    original_directories = set(directory for directory in original_directories if directory)
+    modified_directories = set(directory for directory in modified_directories if directory)
+    return sorted(modified_directories - original_directories), sorted(original_directories - modified_directories)
+
+
+def find_directory_changes_of_update(original_snapshot, new_files, deleted_files, moved_files, derived_files):
+    # Without a plan within the patch only the original version is known. Directories are created for every
+    # written file and removed once no file is left within them, just like the empty directories were
+    # swept out of the original version before.
+    original_directories = set(directory for directory in original_snapshot.directories if directory)
+    source_usage = collections.Counter(source_file for _, source_file in moved_files + derived_files)
+    deleted_file_set = set(deleted_files)
+    removed_files = set(normalize_path(file) for file in deleted_files)
+    removed_files |= set(normalize_path(source_file) for _, source_file in moved_files
+                         if source_usage[source_file] == 1 and source_file in deleted_file_set)
+
+    remaining_files = set(normalize_path(name_path[1] + "/" + name_path[0])
+                          for name_path in original_snapshot.file_list()) - removed_files
+    written_files = list(new_files) + [file for file, _ in moved_files + derived_files]
+    remaining_files |= set(normalize_path(file) for file in written_files)
+
+    used_directories = set()
+    for file in remaining_files:
+        used_directories.update(get_parent_directories(file))
+
+    created_directories = sorted(used_directories - original_directories)
+    removed_directories = sorted(original_directories - used_directories)
+    return created_directories, removed_directories
+
+
+def save_apply_plan(plan, plan_path):
+    with open(plan_path, "w") as file_handler:
+        for operation in plan:
+            row = " | ".join([operation.operation, operation.path, operation.source_path,
+                              str(operation.written_bytes), str(operation.read_bytes)]) + "\n"
+            file_handler.write(row)
+
+
+def parse_apply_plan(file_handler):
+    plan = []
+    for line in file_handler:
+        operation, path, source_path, written_bytes, read_bytes = re.split(r" \| ", line.rstrip("\n"))
+        plan.append(PlanOperation(operation, path, source_path, int(written_bytes), int(read_bytes)))
+    return plan
+
+
+def read_apply_plan(plan_path):
+    if not os.path.isfile(plan_path):
+        return None
+    with open(plan_path, "r") as file_handler:
+        return parse_apply_plan(file_handler)
+
+
+def get_operation_paths(operation):
+    # Paths an operation changes and paths it only reads, several operations may read the same file at once
+    changed_paths = set([normalize_path(operation.path)])
+    read_paths = set()
+    if operation.operation == "move":
+        changed_paths.add(normalize_path(operation.source_path))
+    elif operation.source_path:
+        read_paths.add(normalize_path(operation.source_path))
+    return changed_paths, read_paths
+
+
+def group_apply_plan(plan):
+    # Consecutive operations of the same parallel group form one step, every other operation is a step of its own.
+    # A path which is removed or renamed away and written again within the same group is written in the next
+    # step, so the remove never runs after the write.
+    steps = []
+    step_changed_paths, step_read_paths = set(), set()
+    for operation in plan:
+        group = parallel_groups.get(operation.operation)
+        changed_paths, read_paths = get_operation_paths(operation)
+        if group is not None and steps and steps[-1][0] == group and \
+                not changed_paths & (step_changed_paths | step_read_paths) and not read_paths & step_changed_paths:
+            steps[-1][1].append(operation)
+            step_changed_paths |= changed_paths
+            step_read_paths |= read_paths
+        else:
+            steps.append((group, [operation]))
+            step_changed_paths, step_read_paths = changed_paths, read_paths
+    return steps
+
+
+def summarize_apply_plan(plan):
+    operations = collections.Counter(operation.operation for operation in plan)
+    return {
+        "operations": dict(operations),
+        "number_of_operations": len(plan),
+        "written_bytes": sum(operation.written_bytes for operation in plan),
+        "read_bytes": sum(operation.read_bytes for operation in plan),
+    }
+
+
+def print_apply_plan_summary(plan):
+    summary = summarize_apply_plan(plan)
+    print("The plan holds {} operations: {}".format(summary["number_of_operations"], ", ".join(
+        "{} {}".format(count, operation) for operation, count in sorted(summary["operations"].items()))))
+    print("Projected I/O: {} bytes read, {} bytes written".format(summary["read_bytes"], summary["written_bytes"]))
+    return summary
@@ -0,0 +1,826 @@
+import bisect
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tarfile
+import tempfile
+import zipfile
+import zlib
+
+from file_fingerprints import calculate_file_hash
+
+
+# Layout of an archive patch file:
+#   header:   magic | length of the metadata
+#   metadata: JSON document with the archive format, the compression parameters and the list of operations
+#   payload:  literal data and member deltas referenced by the operations
+#
+# The operations rebuild the stream of the modified archive in order. For tar.gz archives this is the
+# uncompressed tar stream which is compressed again with the recorded parameters, for zip archives and
+# for the fallback it is the archive file itself.
+archive_magic = b"ARCPATCH"
+header_format = ">8sQ"
+
+tar_block_size = 512
+tar_extension_types = (tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK, tarfile.XHDTYPE, tarfile.XGLTYPE,
+                       tarfile.SOLARIS_XHDTYPE)
+zip_local_header_format = "<4s22sHH"
+
+# Members smaller than this are stored as they are, a diff would not pay off the process start
+minimum_member_delta_size = 4096
+copy_buffer_size = 1024 * 1024
+
+
+def is_archive_patch_file(patch_file):
+    with open(patch_file, "rb") as file_handler:
+        return file_handler.read(len(archive_magic)) == archive_magic
+
+
+def detect_archive_format(file_path):
+    if zipfile.is_zipfile(file_path):
+        return "zip"
+    with open(file_path, "rb") as file_handler:
+        if file_handler.read(2) == b"\x1f\x8b":
+            return "tar.gz"
+    return None
+
+
+def split_member_name(name):
+    # Members are described like the entries of iterate_through_directory so the tree-diff logic can be reused
+    directory, _, file_name = name.rpartition("/")
+    return file_name, "/" + directory + "/" if directory else "/"
+
+
+class StreamReader:
+    def __init__(self, file_handler):
+        self.file_handler = file_handler
+        self.position = 0
+
+    def read(self, size):
+        data = self.file_handler.read(size)
+        self.position += len(data)
+        return data
+
+    def read_exact(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise ValueError("Archive ended unexpectedly")
+            data += chunk
+        return data
+
+    def iterate(self, size):
+        while size > 0:
+            chunk = self.read(min(copy_buffer_size, size))
+            if not chunk:
+                raise ValueError("Archive ended unexpectedly")
+            size -= len(chunk)
+            yield chunk
+
+
+def parse_pax_headers(data):
+    headers = {}
+    position = 0
+    while position < len(data):
+        space = data.find(b" ", position)
+        if space < 0:
+            break
+        length = int(data[position:space])
+        if length <= 0:
+            break
+        key, _, value = data[space + 1:position + length - 1].partition(b"=")
+        headers[key.decode("utf-8", "surrogateescape")] = value.decode("utf-8", "surrogateescape")
+        position += length
+    return headers
+
+
+def iterate_tar_stream(reader):
+    # Walks through an uncompressed tar stream without extracting it. Yields ("raw", data) for headers,
+    # padding and the end of the archive and ("member", name, size) for member data. The member data has
+    # to be read from the reader by the caller before the next item is requested.
+    long_name = None
+    pax_headers = {}
+    while True:
+        block = reader.read(tar_block_size)
+        if len(block) < tar_block_size or block == b"\0" * tar_block_size:
+            yield "raw", block
+            chunk = reader.read(copy_buffer_size)
+            while chunk:
+                yield "raw", chunk
+                chunk = reader.read(copy_buffer_size)
+            return
+
+        info = tarfile.TarInfo.frombuf(block, "utf-8", "surrogateescape")
+        size = int(pax_headers.get("size", info.size))
+        padding = -size % tar_block_size
+
+        if info.type in tar_extension_types:
+            data = reader.read_exact(size + padding)
+            if info.type == tarfile.GNUTYPE_LONGNAME:
+                long_name = data[:size].rstrip(b"\0").decode("utf-8", "surrogateescape")
+            elif info.type == tarfile.XHDTYPE:
+                pax_headers = parse_pax_headers(data[:size])
+            yield "raw", block + data
+            continue
+        if info.type == tarfile.GNUTYPE_SPARSE:
+            raise ValueError("Sparse tar members are not supported")
+
+        name = pax_headers.get("path", long_name or info.name)
+        long_name = None
+        pax_headers = {}
+        yield "raw", block
+
+        if info.isreg() or info.type not in tarfile.SUPPORTED_TYPES:
+            data_end = reader.position + size
+            yield "member", name, size
+            if reader.position != data_end:
+                raise ValueError("Member {} was not read completely".format(name))
+            yield "raw", reader.read_exact(padding)
+
+
+def iterate_member_blocks(reader, size):
+    # Blocks of a fixed size, so the blocks of a member within both versions can be compared by their hashes
+    while size > 0:
+        block = reader.read_exact(min(copy_buffer_size, size))
+        size -= len(block)
+        yield block
+
+
+def index_tar_stream(reader):
+    # List of (name, offset of the member data, size, hashes of its blocks) in the order of the archive
+    members = []
+    for item in iterate_tar_stream(reader):
+        if item[0] == "member":
+            data_offset = reader.position
+            block_hashes = [hashlib.sha256(block).digest() for block in iterate_member_blocks(reader, item[2])]
+            members.append((item[1], data_offset, item[2], block_hashes))
+    return members
+
+
+class DeflateLevelFinder:
+    # Reads a raw deflate stream from the current position and compresses its content again with every
+    # level at the same time. A level drops out as soon as its output differs. read hands out the
+    # decompressed data, so a tar stream can be indexed within the same pass.
+    def __init__(self, file_handler, preferred_level, length=None):
+        self.file_handler = file_handler
+        self.length = length
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        levels = [preferred_level] + [level for level in range(1, 10) if level != preferred_level]
+        self.candidates = dict((level, zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 8,
+                                                        zlib.Z_DEFAULT_STRATEGY))
+                               for level in levels)
+        self.compared = dict((level, 0) for level in levels)
+        self.raw_data = bytearray()
+        self.raw_offset = 0
+        self.deflate_length = 0
+        self.pending_data = bytearray()
+
+    def decompress_chunk(self):
+        chunk_size = copy_buffer_size if self.length is None else min(copy_buffer_size,
+                                                                      self.length - self.deflate_length)
+        chunk = self.file_handler.read(chunk_size)
+        if not chunk:
+            raise ValueError("Deflate stream ended unexpectedly")
+        data = self.decompressor.decompress(chunk)
+        used = len(chunk) - len(self.decompressor.unused_data)
+        self.deflate_length += used
+        if not self.candidates:
+            return data
+        self.raw_data += chunk[:used]
+
+        for level in list(self.candidates):
+            output = self.candidates[level].compress(data)
+            if self.decompressor.eof:
+                output += self.candidates[level].flush()
+            start = self.compared[level] - self.raw_offset
+            if bytes(self.raw_data[start:start + len(output)]) != output:
+                del self.candidates[level]
+            else:
+                self.compared[level] += len(output)
+
+        if self.candidates:
+            consumed = min(self.compared.get(level) for level in self.candidates)
+            del self.raw_data[:consumed - self.raw_offset]
+            self.raw_offset = consumed
+        else:
+            self.raw_data = bytearray()
+        return data
+
+    def read(self, size):
+        while len(self.pending_data) < size and not self.decompressor.eof:
+            self.pending_data += self.decompress_chunk()
+        data = bytes(self.pending_data[:size])
+        del self.pending_data[:size]
+        return data
+
+    def finish(self):
+        # Returns the first level which reproduces the stream bit by bit (or None) and the length of the
+        # deflate stream, which is only known once the stream was read to its end
+        while self.candidates and not self.decompressor.eof:
+            self.decompress_chunk()
+        for level in self.candidates:
+            if self.compared[level] == self.deflate_length:
+                return level, self.deflate_length
+        return None, None
+
+
+def find_deflate_level(file_handler, preferred_level, length=None):
+    return DeflateLevelFinder(file_handler, preferred_level, length).finish()
+
+
+def read_gzip_header(file_handler, file_path):
+    header = file_handler.read(10)
+    if len(header) < 10 or header[:3] != b"\x1f\x8b\x08":
+        raise ValueError("{} is not a gzip file".format(file_path))
+    flags = header[3]
+    if flags & 0x04:
+        extra = file_handler.read(2)
+        header += extra + file_handler.read(struct.unpack("<H", extra)[0])
+    for flag in (0x08, 0x10):
+        if flags & flag:
+            while True:
+                character = file_handler.read(1)
+                header += character
+                if character in (b"\0", b""):
+                    break
+    if flags & 0x02:
+        header += file_handler.read(2)
+    return header
+
+
+def read_tar_gz_layout(file_path):
+    # Decompresses the archive once and returns the raw gzip header and trailer, the compression level which
+    # reproduces the deflate stream and the members of the tar stream
+    with open(file_path, "rb") as file_handler:
+        header = read_gzip_header(file_handler, file_path)
+        # The extra flags hint at the level: 2 for the best and 4 for the fastest compression
+        preferred_level = {2: 9, 4: 1}.get(header[8], 6)
+        level_finder = DeflateLevelFinder(file_handler, preferred_level)
+        members = index_tar_stream(StreamReader(level_finder))
+        level, deflate_length = level_finder.finish()
+        if level is None:
+            return header, None, None, members
+
+        file_handler.seek(len(header) + deflate_length)
+        trailer = file_handler.read(8)
+        if len(trailer) != 8 or file_handler.read(1):
+            # Multi-member gzip files and trailing data can not be rebuilt
+            return header, None, None, members
+
+    return header, trailer, level, members
+
+
+class ArchivePatchWriter:
+    def __init__(self, patch_file):
+        self.patch_file = patch_file
+        self.payload_file = patch_file + ".payload"
+        self.payload_handler = open(self.payload_file, "wb")
+        self.operations = []
+
+    def payload_offset(self):
+        return self.payload_handler.tell()
+
+    def add_literal(self, data):
+        if not data:
+            return
+        offset = self.payload_offset()
+        self.payload_handler.write(data)
+        previous = self.operations[-1] if self.operations else None
+        if previous is not None and previous[0] == "literal" and previous[1] + previous[2] == offset:
+            previous[2] += len(data)
+        else:
+            self.operations.append(["literal", offset, len(data)])
+
+    def add_literal_file(self, file_path):
+        with open(file_path, "rb") as file_handler:
+            chunk = file_handler.read(copy_buffer_size)
+            while chunk:
+                self.add_literal(chunk)
+                chunk = file_handler.read(copy_buffer_size)
+
+    def add_copy(self, offset, length):
+        if not length:
+            return
+        previous = self.operations[-1] if self.operations else None
+        if previous is not None and previous[0] == "copy" and previous[1] + previous[2] == offset:
+            previous[2] += length
+        else:
+            self.operations.append(["copy", offset, length])
+
+    def add_payload(self, file_path):
+        offset = self.payload_offset()
+        with open(file_path, "rb") as file_handler:
+            shutil.copyfileobj(file_handler, self.payload_handler, copy_buffer_size)
+        return offset, self.payload_offset() - offset
+
+    def add_delta(self, source_offset, source_length, patch_file, target_length):
+        payload_offset, payload_length = self.add_payload(patch_file)
+        self.operations.append(["delta", source_offset, source_length, payload_offset, payload_length, target_length])
+
+    def add_member_delta(self, member_name, patch_file, target_length, level):
+        payload_offset, payload_length = self.add_payload(patch_file)
+        self.operations.append(["member_delta", member_name, payload_offset, payload_length, target_length, level])
+
+    def finish(self, metadata):
+        self.payload_handler.close()
+        metadata["operations"] = self.operations
+        encoded_metadata = json.dumps(metadata).encode("utf-8")
+        with open(self.patch_file, "wb") as file_handler:
+            file_handler.write(struct.pack(header_format, archive_magic, len(encoded_metadata)))
+            file_handler.write(encoded_metadata)
+            with open(self.payload_file, "rb") as payload_handler:
+                shutil.copyfileobj(payload_handler, file_handler, copy_buffer_size)
+        os.remove(self.payload_file)
+
+    def abort(self):
+        self.payload_handler.close()
+        os.remove(self.payload_file)
+
+
+class SeekableSource:
+    # Ranges of a plain file are read wherever they are
+    def __init__(self, file_handler):
+        self.file_handler = file_handler
+
+    def iterate_range(self, offset, length):
+        self.file_handler.seek(offset)
+        return StreamReader(self.file_handler).iterate(length)
+
+
+class ForwardSource:
+    # Reads a stream which can not seek, like the tar stream within a gzip file, exactly once from its start.
+    # The ranges are given in the order in which they are read. A range which lies behind a range read
+    # before is written into a spill file while the stream passes it, so the spill file only holds the
+    # ranges which are read out of the order of the stream and stays empty if the order is kept.
+    def __init__(self, file_handler, ranges, spill_file):
+        self.reader = StreamReader(file_handler)
+        spilled_ranges = []
+        position = 0
+        for offset, length in ranges:
+            if length and offset < position:
+                spilled_ranges.append((offset, min(offset + length, position)))
+            position = max(position, offset + length)
+
+        # Overlapping ranges are merged, every merged range has its place within the spill file
+        self.spilled_ranges = []
+        spill_size = 0
+        for start, end in sorted(spilled_ranges):
+            if self.spilled_ranges and start <= self.spilled_ranges[-1][1]:
+                previous_start, previous_end, spill_offset = self.spilled_ranges[-1]
+                if end > previous_end:
+                    self.spilled_ranges[-1] = (previous_start, end, spill_offset)
+                    spill_size += end - previous_end
+            else:
+                self.spilled_ranges.append((start, end, spill_size))
+                spill_size += end - start
+        self.range_starts = [start for start, _, _ in self.spilled_ranges]
+        self.capture_index = 0
+        self.spill_size = spill_size
+        self.spill_handler = open(spill_file, "w+b") if self.spilled_ranges else None
+
+    def capture(self, start, data):
+        # Writes the parts of the data which are needed again later on into the spill file
+        end = start + len(data)
+        while self.capture_index < len(self.spilled_ranges) and self.spilled_ranges[self.capture_index][1] <= start:
+            self.capture_index += 1
+        index = self.capture_index
+        while index < len(self.spilled_ranges) and self.spilled_ranges[index][0] < end:
+            range_start, range_end, spill_offset = self.spilled_ranges[index]
+            overlap_start, overlap_end = max(start, range_start), min(end, range_end)
+            os.pwrite(self.spill_handler.fileno(), data[overlap_start - start:overlap_end - start],
+                      spill_offset + overlap_start - range_start)
+            index += 1
+
+    def read(self, size):
+        start = self.reader.position
+        data = self.reader.read(size)
+        if self.spill_handler is not None:
+            self.capture(start, data)
+        return data
+
+    def iterate_range(self, offset, length):
+        end = offset + length
+        if offset < self.reader.position:
+            # This part was passed already, it was captured on the way
+            spilled_end = min(end, self.reader.position)
+            range_start, _, spill_offset = self.spilled_ranges[bisect.bisect_right(self.range_starts, offset) - 1]
+            self.spill_handler.seek(spill_offset + offset - range_start)
+            for chunk in StreamReader(self.spill_handler).iterate(spilled_end - offset):
+                yield chunk
+            offset = spilled_end
+
+        while self.reader.position < offset:
+            if not self.read(min(copy_buffer_size, offset - self.reader.position)):
+                raise ValueError("Archive ended unexpectedly")
+        while self.reader.position < end:
+            chunk = self.read(min(copy_buffer_size, end - self.reader.position))
+            if not chunk:
+                raise ValueError("Archive ended unexpectedly")
+            yield chunk
+
+    def close(self):
+        if self.spill_handler is not None:
+            self.spill_handler.close()
+
+
+def get_source_ranges(operations):
+    # Ranges of the original which the operations read, in the order in which they are read
+    return [(operation[1], operation[2]) for operation in operations if operation[0] in ("copy", "delta")]
+
+
+def read_original_tar(original_version_file, modified_index, work_directory):
+    # Reads the tar stream of the original once. Returns its members and, for every member which gets a delta,
+    # the part of the member which has to be kept: blocks in front of the first block which differs from the
+    # modified member are the same within both versions and are taken from the modified member later on, the
+    # rest of the member is written into a spill file. Unchanged members are never written anywhere, so the
+    # spill files hold at most the changed members and not the whole archive.
+    members = []
+    spilled_members = {}
+    with gzip.open(original_version_file, "rb") as file_handler:
+        reader = StreamReader(file_handler)
+        for item in iterate_tar_stream(reader):
+            if item[0] != "member":
+                continue
+            name, size = item[1], item[2]
+            data_offset = reader.position
+            modified_member = modified_index.get(name)
+            is_delta_source = modified_member is not None and modified_member[2] >= minimum_member_delta_size
+            spilled_members.pop(name, None)
+
+            block_hashes = []
+            spill_handler = None
+            try:
+                for block in iterate_member_blocks(reader, size):
+                    block_hash = hashlib.sha256(block).digest()
+                    if is_delta_source and spill_handler is None and \
+                            modified_member[3][len(block_hashes):len(block_hashes) + 1] != [block_hash]:
+                        spill_file = "{}/original_{}".format(work_directory, len(members))
+                        spill_handler = open(spill_file, "wb")
+                        spilled_members[name] = (len(block_hashes) * copy_buffer_size, spill_file)
+                    if spill_handler is not None:
+                        spill_handler.write(block)
+                    block_hashes.append(block_hash)
+            finally:
+                if spill_handler is not None:
+                    spill_handler.close()
+
+            if is_delta_source and name not in spilled_members and block_hashes != modified_member[3]:
+                # The original member is the beginning of the modified member, nothing of it has to be kept
+                spill_file = "{}/original_{}".format(work_directory, len(members))
+                open(spill_file, "wb").close()
+                spilled_members[name] = (size, spill_file)
+            members.append((name, data_offset, size, block_hashes))
+    return members, spilled_members
+
+
+def write_original_member(modified_member_file, prefix_length, spill_file, original_member_file):
+    with open(original_member_file, "wb") as output, open(modified_member_file, "rb") as modified_handler, \
+            open(spill_file, "rb") as spill_handler:
+        for chunk in StreamReader(modified_handler).iterate(prefix_length):
+            output.write(chunk)
+        shutil.copyfileobj(spill_handler, output, copy_buffer_size)
+
+
+def copy_stream_range(source_handler, offset, length, destination_file):
+    source_handler.seek(offset)
+    with open(destination_file, "wb") as destination_handler:
+        reader = StreamReader(source_handler)
+        for chunk in reader.iterate(length):
+            destination_handler.write(chunk)
+
+
+def create_member_delta(original_member_file, modified_member_file, work_directory, diff_function):
+    # Returns the path of the delta or None if the delta is not smaller than the member itself
+    patch_member_file = work_directory + "/member.patch"
+    result = diff_function(original_member_file, modified_member_file, patch_member_file)
+    if result > 0 or not os.path.exists(patch_member_file) or \
+            os.path.getsize(patch_member_file) >= os.path.getsize(modified_member_file):
+        return None
+    return patch_member_file
+
+
+def create_tar_gz_operations(original_version_file, modified_version_file, modified_members, writer, work_directory,
+                             diff_function):
+    # Only creating an archive patch needs the creator, the applier must not load it, therefore it is imported on demand
+    from patch_file_creator import detect_all_new_modified_and_deleted_files
+
+    modified_index = dict((member[0], member) for member in modified_members)
+    original_members, spilled_members = read_original_tar(original_version_file, modified_index, work_directory)
+
+    # Members are matched by their path with the same logic which is used for directories
+    modified_files, new_files, deleted_files = detect_all_new_modified_and_deleted_files(
+        original_version_file_list=[split_member_name(member[0]) for member in original_members],
+        modified_version_file_list=[split_member_name(member[0]) for member in modified_members])
+    print("Members added: {}, members in both versions: {}, members deleted: {}".format(len(new_files),
+                                                                                      len(modified_files),
+                                                                                      len(deleted_files)))
+
+    original_index = dict((member[0], member) for member in original_members)
+    with gzip.open(modified_version_file, "rb") as modified_handler:
+        reader = StreamReader(modified_handler)
+        member_number = 0
+        for item in iterate_tar_stream(reader):
+            if item[0] == "raw":
+                writer.add_literal(item[1])
+                continue
+
+            name, size = item[1], item[2]
+            block_hashes = modified_members[member_number][3]
+            member_number += 1
+            original_member = original_index.get(name)
+            spilled_member = spilled_members.get(name)
+
+            if original_member is not None and original_member[3] == block_hashes:
+                for _ in reader.iterate(size):
+                    pass
+                writer.add_copy(original_member[1], size)
+            elif spilled_member is not None and size >= minimum_member_delta_size and \
+                    original_member[3][:spilled_member[0] // copy_buffer_size] == \
+                    block_hashes[:spilled_member[0] // copy_buffer_size]:
+                modified_member_file = work_directory + "/member.modified"
+                original_member_file = work_directory + "/member.original"
+                with open(modified_member_file, "wb") as member_handler:
+                    for chunk in reader.iterate(size):
+                        member_handler.write(chunk)
+                write_original_member(modified_member_file, spilled_member[0], spilled_member[1],
+                                      original_member_file)
+
+                patch_member_file = create_member_delta(original_member_file, modified_member_file, work_directory,
+                                                        diff_function)
+                if patch_member_file is None:
+                    writer.add_literal_file(modified_member_file)
+                else:
+                    writer.add_delta(original_member[1], original_member[2], patch_member_file, size)
+            else:
+                for chunk in reader.iterate(size):
+                    writer.add_literal(chunk)
+
+
+def read_zip_member_range(file_handler, info):
+    # Start and end of the compressed data of a member within the archive file
+    file_handler.seek(info.header_offset)
+    signature, _, name_length, extra_length = struct.unpack(zip_local_header_format, file_handler.read(30))
+    if signature != b"PK\x03\x04":
+        raise ValueError("Local header of {} is damaged".format(info.filename))
+    data_start = info.header_offset + 30 + name_length + extra_length
+    return data_start, data_start + info.compress_size
+
+
+def hash_file_range(file_handler, start, end):
+    range_hash = hashlib.sha256()
+    file_handler.seek(start)
+    for chunk in StreamReader(file_handler).iterate(end - start):
+        range_hash.update(chunk)
+    return range_hash.hexdigest()
+
+
+def create_zip_operations(original_version_file, modified_version_file, writer, work_directory, diff_function):
+    from patch_file_creator import detect_all_new_modified_and_deleted_files
+
+    with zipfile.ZipFile(original_version_file) as original_zip, zipfile.ZipFile(modified_version_file) as modified_zip, \
+            open(original_version_file, "rb") as original_handler, open(modified_version_file, "rb") as modified_handler:
+        original_infos = original_zip.infolist()
+        modified_infos = sorted(modified_zip.infolist(), key=lambda info: info.header_offset)
+
+        modified_files, new_files, deleted_files = detect_all_new_modified_and_deleted_files(
+            original_version_file_list=[split_member_name(info.filename) for info in original_infos],
+            modified_version_file_list=[split_member_name(info.filename) for info in modified_infos])
+        print("Members added: {}, members in both versions: {}, members deleted: {}".format(len(new_files),
+                                                                                          len(modified_files),
+                                                                                          len(deleted_files)))
+
+        original_index = dict((info.filename, info) for info in original_infos)
+        position = 0
+        for info in modified_infos:
+            data_start, data_end = read_zip_member_range(modified_handler, info)
+            if data_start < position:
+                raise ValueError("Members of {} overlap".format(modified_version_file))
+
+            # Local header and everything in front of it is stored as it is
+            modified_handler.seek(position)
+            for chunk in StreamReader(modified_handler).iterate(data_start - position):
+                writer.add_literal(chunk)
+            position = data_end
+
+            original_info = original_index.get(info.filename)
+            if original_info is not None and original_info.CRC == info.CRC and \
+                    original_info.compress_type == info.compress_type and original_info.compress_size == info.compress_size:
+                original_start, original_end = read_zip_member_range(original_handler, original_info)
+                if hash_file_range(original_handler, original_start, original_end) == \
+                        hash_file_range(modified_handler, data_start, data_end):
+                    writer.add_copy(original_start, original_end - original_start)
+                    continue
+
+            patch_member_file = None
+            level = None
+            if original_info is not None and info.file_size >= minimum_member_delta_size and \
+                    info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                # The delta is built between the uncompressed members, the compressed data has to be reproducible
+                if info.compress_type == zipfile.ZIP_DEFLATED:
+                    # Bits 1 and 2 of the flags hint at the level which was used
+                    preferred_level = {0: 6, 1: 9}.get((info.flag_bits >> 1) & 0x03, 1)
+                    modified_handler.seek(data_start)
+                    level, _ = find_deflate_level(modified_handler, preferred_level, data_end - data_start)
+                if info.compress_type == zipfile.ZIP_STORED or level is not None:
+                    original_member_file = work_directory + "/member.original"
+                    modified_member_file = work_directory + "/member.modified"
+                    with original_zip.open(original_info) as member_handler, open(original_member_file, "wb") as output:
+                        shutil.copyfileobj(member_handler, output, copy_buffer_size)
+                    with modified_zip.open(info) as member_handler, open(modified_member_file, "wb") as output:
+                        shutil.copyfileobj(member_handler, output, copy_buffer_size)
+                    patch_member_file = create_member_delta(original_member_file, modified_member_file, work_directory,
+                                                            diff_function)
+
+            if patch_member_file is not None:
+                writer.add_member_delta(original_info.filename, patch_member_file, info.file_size, level)
+            else:
+                # Fallback: the compressed data of the member is stored as it is
+                modified_handler.seek(data_start)
+                for chunk in StreamReader(modified_handler).iterate(data_end - data_start):
+                    writer.add_literal(chunk)
+
+        # Data descriptors, central directory and end of central directory record
+        modified_handler.seek(position)
+        chunk = modified_handler.read(copy_buffer_size)
+        while chunk:
+            writer.add_literal(chunk)
+            chunk = modified_handler.read(copy_buffer_size)
+
+
+def create_archive_patch_file(original_version_file, modified_version_file, patch_file, diff_function):
+    archive_format = detect_archive_format(modified_version_file)
+    if archive_format != detect_archive_format(original_version_file):
+        archive_format = None
+
+    metadata = {
+        "format": "raw",
+        "size": os.path.getsize(modified_version_file),
+        "hash": calculate_file_hash(modified_version_file)
+    }
+
+    work_directory = tempfile.mkdtemp(prefix="archive_", dir=os.path.dirname(os.path.abspath(patch_file)))
+    writer = ArchivePatchWriter(patch_file)
+    try:
+        if archive_format == "tar.gz":
+            header, trailer, level, modified_members = read_tar_gz_layout(modified_version_file)
+            if level is None:
+                print("Compression of {} can not be reproduced!".format(modified_version_file))
+                archive_format = None
+            else:
+                print("Archive is a tar.gz file compressed with level {}".format(level))
+                metadata.update({"format": archive_format, "gzip_header": header.hex(), "gzip_trailer": trailer.hex(),
+                                 "level": level})
+                create_tar_gz_operations(original_version_file, modified_version_file, modified_members, writer,
+                                         work_directory, diff_function)
+        elif archive_format == "zip":
+            print("Archive is a zip file")
+            metadata["format"] = archive_format
+            create_zip_operations(original_version_file, modified_version_file, writer, work_directory, diff_function)
+
+        if archive_format is None:
+            # Fallback: the compressed archive is diffed as a whole
+            print("Archive members can not be diffed, the compressed archive is diffed instead!")
+            patch_member_file = create_member_delta(original_version_file, modified_version_file, work_directory,
+                                                    diff_function)
+            if patch_member_file is None:
+                writer.add_literal_file(modified_version_file)
+            else:
+                writer.add_delta(0, os.path.getsize(original_version_file), patch_member_file, metadata["size"])
+
+        writer.finish(metadata)
+    except Exception:
+        writer.abort()
+        raise
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    return 0
+
+
+class HashingWriter:
+    # Writes the rebuilt archive and calculates its hash on the fly, optionally compressing it first
+    def __init__(self, file_handler, level=None):
+        self.file_handler = file_handler
+        self.file_hash = hashlib.sha256()
+        self.compressor = None
+        if level is not None:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 8, zlib.Z_DEFAULT_STRATEGY)
+
+    def write_raw(self, data):
+        self.file_hash.update(data)
+        self.file_handler.write(data)
+
+    def write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.write_raw(data)
+
+    def flush_compressor(self):
+        if self.compressor is not None:
+            self.write_raw(self.compressor.flush())
+            self.compressor = None
+
+
+def write_file(file_path, writer, compressor=None):
+    with open(file_path, "rb") as file_handler:
+        chunk = file_handler.read(copy_buffer_size)
+        while chunk:
+            writer.write(compressor.compress(chunk) if compressor is not None else chunk)
+            chunk = file_handler.read(copy_buffer_size)
+    if compressor is not None:
+        writer.write(compressor.flush())
+
+
+def apply_archive_operations(operations, source, original_version_file, patch_handler, payload_start, writer,
+                             work_directory, apply_function):
+    for operation in operations:
+        kind = operation[0]
+        if kind == "literal":
+            patch_handler.seek(payload_start + operation[1])
+            for chunk in StreamReader(patch_handler).iterate(operation[2]):
+                writer.write(chunk)
+        elif kind == "copy":
+            for chunk in source.iterate_range(operation[1], operation[2]):
+                writer.write(chunk)
+        elif kind in ("delta", "member_delta"):
+            original_member_file = work_directory + "/member.original"
+            patch_member_file = work_directory + "/member.patch"
+            output_member_file = work_directory + "/member.output"
+
+            if kind == "delta":
+                _, source_offset, source_length, payload_offset, payload_length, target_length = operation
+                with open(original_member_file, "wb") as output:
+                    for chunk in source.iterate_range(source_offset, source_length):
+                        output.write(chunk)
+                compressor = None
+            else:
+                _, member_name, payload_offset, payload_length, target_length, level = operation
+                with zipfile.ZipFile(original_version_file) as original_zip, \
+                        original_zip.open(member_name) as member_handler, open(original_member_file, "wb") as output:
+                    shutil.copyfileobj(member_handler, output, copy_buffer_size)
+                compressor = None
+                if level is not None:
+                    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+            copy_stream_range(patch_handler, payload_start + payload_offset, payload_length, patch_member_file)
+            if apply_function(original_member_file, patch_member_file, output_member_file) > 0:
+                raise ValueError("Delta of a member could not be applied")
+            if os.path.getsize(output_member_file) != target_length:
+                raise ValueError("Member has the wrong size after patching")
+            write_file(output_member_file, writer, compressor)
+        else:
+            raise ValueError("Unknown operation {} within the archive patch".format(kind))
+
+
+def apply_archive_patch_file(original_version_file, patch_file, output_file, apply_function):
+    temporary_output_file = output_file + ".archive.tmp"
+    work_directory = tempfile.mkdtemp(prefix="archive_", dir=os.path.dirname(os.path.abspath(output_file)))
+    try:
+        with open(patch_file, "rb") as patch_handler, open(temporary_output_file, "wb") as output_handler:
+            magic, metadata_length = struct.unpack(header_format, patch_handler.read(struct.calcsize(header_format)))
+            if magic != archive_magic:
+                raise ValueError("{} is not an archive patch file".format(patch_file))
+            metadata = json.loads(patch_handler.read(metadata_length).decode("utf-8"))
+            payload_start = struct.calcsize(header_format) + metadata_length
+
+            if metadata["format"] == "tar.gz":
+                # The tar stream is rebuilt from the uncompressed original, which is decompressed once front to back,
+                # and compressed again on the fly
+                writer = HashingWriter(output_handler, metadata["level"])
+                writer.write_raw(bytes.fromhex(metadata["gzip_header"]))
+                with gzip.open(original_version_file, "rb") as original_handler:
+                    source = ForwardSource(original_handler, get_source_ranges(metadata["operations"]),
+                                           work_directory + "/original.spill")
+                    try:
+                        apply_archive_operations(metadata["operations"], source, original_version_file,
+                                                 patch_handler, payload_start, writer, work_directory, apply_function)
+                    finally:
+                        source.close()
+                writer.flush_compressor()
+                writer.write_raw(bytes.fromhex(metadata["gzip_trailer"]))
+            else:
+                writer = HashingWriter(output_handler)
+                with open(original_version_file, "rb") as source_handler:
+                    apply_archive_operations(metadata["operations"], SeekableSource(source_handler),
+                                             original_version_file, patch_handler, payload_start, writer,
+                                             work_directory, apply_function)
+
+        # A different zlib version may compress differently, the result is only accepted if it is bit-identical
+        if writer.file_hash.hexdigest() != metadata["hash"]:
+            print("Rebuilt archive differs from the modified version!")
+            os.remove(temporary_output_file)
+            return 1
+    except ValueError as error:
+        print("Archive patch {} could not be applied: {}".format(patch_file, error))
+        if os.path.exists(temporary_output_file):
+            os.remove(temporary_output_file)
+        return 1
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    os.replace(temporary_output_file, output_file)
+    return 0
@@ -0,0 +1,255 @@
+import asyncio
+import contextlib
+import os
+import time
+
+from instrumentation import JobControl, current_job
+from update_api import ApplicationResult, ArgumentError, apply_patch, create_patch, routed_output
+
+
+# External tools are driven with asyncio.create_subprocess_exec, the same calls as within the creator and the applier
+diff_commands = {
+    "bsdiff": lambda original_file, modified_file, patch_file: ["bsdiff", original_file, modified_file, patch_file],
+    "xdelta": lambda original_file, modified_file, patch_file: ["xdelta3", "-s", original_file, modified_file,
+                                                                patch_file],
+}
+patch_commands = {
+    "bspatch": lambda original_file, patch_file, output_file: ["bspatch", original_file, output_file, patch_file],
+    "xdelta": lambda original_file, patch_file, output_file: ["xdelta3", "-fd", "-s", original_file, patch_file,
+                                                              output_file],
+}
+# Engines which run within this process, they get a thread of their own
+built_in_tools = ["rsync", "cdc", "text"]
+
+
+async def run_in_thread(function, *args):
+    # A cancelled task can not stop its thread, so it waits for it. Nothing the thread does outlives the task.
+    future = asyncio.ensure_future(asyncio.to_thread(function, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        with contextlib.suppress(Exception):
+            await future
+        raise
+
+
+class AsyncPatchEngine:
+    # Runs many patch jobs within one event loop. At most max_processes external tools run at once,
+    # at most max_jobs whole patches are created or applied at once and submit waits as long as
+    # max_pending jobs were not finished yet, so a producer can not queue up unlimited work.
+    def __init__(self, max_processes=None, max_jobs=None, max_pending=None):
+        self.max_processes = max_processes or os.cpu_count() or 1
+        self.process_slots = asyncio.Semaphore(self.max_processes)
+        self.job_slots = asyncio.Semaphore(max_jobs or self.max_processes)
+        self.pending_slots = asyncio.Semaphore(max_pending or 4 * self.max_processes)
+        self.started_processes = 0
+        self.killed_processes = 0
+        self.cancelled_jobs = 0
+
+    async def submit(self, coroutine):
+        await self.pending_slots.acquire()
+        task = asyncio.ensure_future(coroutine)
+        task.add_done_callback(lambda _: self.pending_slots.release())
+        return task
+
+    async def run_process(self, command, timeout=None):
+        async with self.process_slots:
+            process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.DEVNULL,
+                                                           stderr=asyncio.subprocess.PIPE)
+            self.started_processes += 1
+            try:
+                _, error_output = await asyncio.wait_for(process.communicate(), timeout)
+            except BaseException:
+                # Cancelled or too slow, the tool must not keep on writing after its job was given up
+                if process.returncode is None:
+                    process.kill()
+                    self.killed_processes += 1
+                    await process.wait()
+                raise
+        if process.returncode != 0 and error_output:
+            print(error_output.decode("utf-8", "replace").strip())
+        return process.returncode
+
+    async def create_diff(self, original_file, modified_file, patch_file, tool="bsdiff", timeout=None):
+        if tool in diff_commands:
+            command = diff_commands[tool](original_file, modified_file, patch_file)
+        elif tool in built_in_tools:
+            from patch_file_creator import create_diff_file
+            return await run_in_thread(create_diff_file, original_file, modified_file, patch_file, tool)
+        else:
+            raise ValueError("{} can not create a single diff".format(tool))
+
+        try:
+            return await self.run_process(command, timeout)
+        except asyncio.TimeoutError:
+            print("Diff of {} took longer than {} seconds and was aborted!".format(modified_file, timeout))
+            return 1
+
+    async def apply_diff(self, original_file, patch_file, output_file, tool="bspatch", expected_hash=None,
+                         timeout=None):
+        # Same steps as update_original_file: the tool writes into a temporary file next to the output,
+        # which replaces the output once it was verified
+        from file_fingerprints import calculate_file_hash
+        from file_placement import create_output_file, finish_output_file
+        from patch_file_applier import apply_patch_file, read_patch_header, resolve_patch_tool
+
+        tool = resolve_patch_tool(tool, read_patch_header(patch_file), patch_file)
+        if tool is None:
+            return 1
+
+        temporary_file = create_output_file(output_file)
+        mode_path = output_file if os.path.exists(output_file) else original_file
+        return_value = 1
+        try:
+            if tool in patch_commands:
+                return_value = await self.run_process(patch_commands[tool](original_file, patch_file,
+                                                                           temporary_file), timeout)
+            else:
+                return_value = await run_in_thread(apply_patch_file, original_file, patch_file, temporary_file, tool)
+            if return_value == 0 and expected_hash is not None and \
+                    await run_in_thread(calculate_file_hash, temporary_file) != expected_hash:
+                print("The hash of {} does not match the hash within the patch!".format(output_file))
+                return_value = 1
+        except asyncio.TimeoutError:
+            print("Patching {} took longer than {} seconds and was aborted!".format(output_file, timeout))
+            return_value = 1
+        finally:
+            finish_output_file(temporary_file, output_file, return_value == 0, mode_path)
+
+        if return_value > 0:
+            print("Patch failed for the following file: {}".format(output_file))
+        else:
+            print("Patch applied for the following file: {}".format(output_file))
+        return return_value
+
+    async def run_job(self, function, *args, **kwargs):
+        # Runs a call of the library within a thread. Cancelling the task kills every external process
+        # of the job and no further one is started, the job stops with JobCancelled.
+        job = JobControl()
+
+        def run():
+            current_job.set(job)
+            return function(*args, **kwargs)
+
+        async with self.job_slots:
+            future = asyncio.ensure_future(asyncio.to_thread(run))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                job.cancel()
+                self.cancelled_jobs += 1
+                with contextlib.suppress(Exception):
+                    await future
+                raise
+
+    async def create_patch(self, original_version_path, modified_version_path, patch_path, output=None,
+                           **options):
+        # Options are the same as for update_api.create_patch
+        return await self.run_job(create_patch, original_version_path, modified_version_path, patch_path,
+                                  output=output, **options)
+
+    @contextlib.asynccontextmanager
+    async def open_patch_file(self, patch_source, file):
+        # Entries of containers and archives are written into a temporary file, which may take a while
+        context = patch_source.patch_file(file)
+        patch_file = await run_in_thread(context.__enter__)
+        try:
+            yield patch_file
+        finally:
+            await run_in_thread(context.__exit__, None, None, None)
+
+    async def apply_operation(self, operation, original_version_path, patch_source, tool, timeout, file_slots):
+        from patch_file_applier import apply_plan_operation
+
+        async with file_slots:
+            if operation.operation in ("patch", "derive"):
+                source_file = operation.source_path if operation.operation == "derive" else operation.path
+                async with self.open_patch_file(patch_source, operation.path) as patch_file:
+                    return await self.apply_diff(original_file=original_version_path + "/" + source_file,
+                                                 patch_file=patch_file,
+                                                 output_file=original_version_path + "/" + operation.path,
+                                                 tool=tool,
+                                                 expected_hash=patch_source.target_hash(operation.path),
+                                                 timeout=timeout)
+            # Files which are only moved, copied or removed do not need a tool
+            return await run_in_thread(apply_plan_operation, operation, original_version_path, patch_source, tool,
+                                       timeout)
+
+    async def apply_patch(self, original_version_path, patch_path, tool="bspatch", compress=False, jobs=None,
+                          deadline=None, modified_version_path=None, output=None, resumable=False):
+        # Runs the plan of a patch like patch_file_applier.py does, but every patched file is one task of
+        # this loop. The modified version is only compared with the result if it is given.
+        # The files are written into the original version right away. Staging, the journal and the rollback
+        # of a resumable update belong to the applier, such an update runs as one job of this engine instead.
+        # An update which was interrupted before is always resumed that way, it is never applied over.
+        from apply_plan import group_apply_plan, print_apply_plan_summary
+        from patch_file_applier import apply_directory_operation, get_apply_plan, get_resumable_paths, \
+            is_patch_url, locate_compressed_patch, open_patch_source, verify_directory_trees
+
+        if resumable or os.path.exists(get_resumable_paths(original_version_path)[0]):
+            if modified_version_path is None:
+                raise ArgumentError("A resumable update of {} needs the modified version! Processing stops!".format(
+                    original_version_path), 2)
+            # Options which are not given keep the defaults of the applier
+            options = dict((name, value) for name, value in [("jobs", jobs), ("deadline", deadline)]
+                           if value is not None)
+            return await self.run_job(apply_patch, original_version_path, modified_version_path, patch_path,
+                                      output=output, check=False, tool=tool, compress=compress, resumable=True,
+                                      **options)
+
+        with routed_output(output):
+            async with self.job_slots:
+                compressed_patch_archive = None
+                if compress:
+                    patch_path, compressed_patch_archive = await run_in_thread(locate_compressed_patch, patch_path)
+                patch_source = await run_in_thread(open_patch_source, patch_path, compressed_patch_archive)
+                try:
+                    file_lists = await run_in_thread(patch_source.read_file_lists)
+                    apply_plan = await run_in_thread(get_apply_plan, patch_source, original_version_path,
+                                                     *file_lists)
+                    stats = {"apply_plan_of_the_application": print_apply_plan_summary(apply_plan)}
+                    if is_patch_url(patch_path):
+                        await run_in_thread(patch_source.prefetch_plan, apply_plan)
+
+                    start_time = time.perf_counter()
+                    failed_files = []
+                    file_slots = asyncio.Semaphore(jobs or self.max_processes)
+                    for group, operations in group_apply_plan(apply_plan):
+                        if group is None:
+                            for operation in operations:
+                                await run_in_thread(apply_directory_operation, operation, original_version_path)
+                            continue
+                        results = await asyncio.gather(*(self.apply_operation(operation, original_version_path,
+                                                                              patch_source, tool, deadline,
+                                                                              file_slots)
+                                                         for operation in operations))
+                        failed_files += [original_version_path + "/" + operation.path
+                                         for operation, result in zip(operations, results) if result > 0]
+                    needed_time = time.perf_counter() - start_time
+                finally:
+                    patch_source.close()
+
+                stats["time_needed_to_apply_patch_file"] = "{} seconds".format(int(needed_time))
+                stats["seconds_needed_to_apply_patch_file"] = round(needed_time, 6)
+                print("Number of files which were not patched successfully: {}".format(len(failed_files)))
+
+                mismatching_files = []
+                if modified_version_path is not None and not failed_files:
+                    mismatching_files = await run_in_thread(verify_directory_trees, original_version_path,
+                                                            modified_version_path, jobs)
+        return ApplicationResult(original_version_path, failed_files, mismatching_files, stats)
+
+    def stats(self):
+        return {
+            "started_processes": self.started_processes,
+            "killed_processes": self.killed_processes,
+            "cancelled_jobs": self.cancelled_jobs,
+        }
+
+
+async def apply_patches(original_version_paths, patch_paths, **options):
+    # Applies one patch to every original version at once
+    engine = AsyncPatchEngine()
+    tasks = [await engine.submit(engine.apply_patch(original_version_path, patch_path, **options))
+             for original_version_path, patch_path in zip(original_version_paths, patch_paths)]
+    return await asyncio.gather(*tasks)
@@ -0,0 +1,235 @@
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+from file_fingerprints import HashingFileWriter
+
+
+# Layout of a chunk patch file:
+#   header:   magic | size of the modified file
+#   original: b"O" | offset within the original file | length
+#   output:   b"N" | offset within the already rebuilt output | length
+#   literal:  b"L" | length | data
+chunk_magic = b"CDCPATCH"
+header_format = ">8sQ"
+reference_format = ">QI"
+literal_format = ">I"
+
+minimum_chunk_size = 2 * 1024
+average_chunk_size = 8 * 1024
+maximum_chunk_size = 64 * 1024
+read_buffer_size = 4 * 1024 * 1024
+
+# Normalized chunking: a stricter mask below the average size and a looser one above it.
+# Only the upper bits are used because they depend on the whole 64 byte window of the gear hash.
+hash_window = 64
+strict_mask = np.uint64(((1 << 15) - 1) << (64 - 15))
+loose_mask = np.uint64(((1 << 11) - 1) << (64 - 11))
+
+
+def create_gear_table():
+    # Fixed pseudo random values so that chunk boundaries are identical on every machine
+    values = []
+    for index in range(256):
+        values.append(int.from_bytes(hashlib.sha256(b"gear" + bytes([index])).digest()[:8], "big"))
+    return np.array(values, dtype=np.uint64)
+
+
+gear_table = create_gear_table()
+
+
+def calculate_gear_hashes(data):
+    # h(i) = sum over j < 64 of gear(x(i - j)) << j, built by doubling the covered window six times
+    hashes = gear_table[np.frombuffer(data, dtype=np.uint8)]
+    window = 1
+    while window < hash_window:
+        shifted = np.zeros_like(hashes)
+        shifted[window:] = hashes[:-window] << np.uint64(window)
+        hashes = hashes + shifted
+        window *= 2
+    return hashes
+
+
+def calculate_chunk_hash(data):
+    return hashlib.blake2b(data, digest_size=20).digest()
+
+
+def find_cut_point(chunk_start, data_end, strict_positions, loose_positions, end_of_file):
+    # Returns the end of the chunk which starts at chunk_start or None if more data is needed
+    strict_start = chunk_start + minimum_chunk_size
+    loose_start = chunk_start + average_chunk_size
+    chunk_limit = chunk_start + maximum_chunk_size
+
+    index = np.searchsorted(strict_positions, strict_start)
+    if index < len(strict_positions) and strict_positions[index] < min(loose_start, data_end):
+        return int(strict_positions[index]) + 1
+
+    index = np.searchsorted(loose_positions, loose_start)
+    if index < len(loose_positions) and loose_positions[index] < min(chunk_limit, data_end):
+        return int(loose_positions[index]) + 1
+
+    if chunk_limit <= data_end:
+        return chunk_limit
+    if end_of_file:
+        return data_end if data_end > chunk_start else None
+    return None
+
+
+def iterate_chunks(file_path):
+    # Streams the file and yields (offset, length, hash) for every content-defined chunk.
+    # Only one read buffer plus the unfinished chunk is kept in memory.
+    with open(file_path, "rb") as file_handler:
+        pending = b""
+        pending_start = 0
+        context = b""
+        end_of_file = False
+
+        while not end_of_file:
+            buffer = file_handler.read(read_buffer_size)
+            end_of_file = len(buffer) < read_buffer_size
+            if not buffer and not pending:
+                break
+
+            hashes = calculate_gear_hashes(context + buffer)[len(context):]
+            buffer_start = pending_start + len(pending)
+            strict_positions = np.nonzero((hashes & strict_mask) == 0)[0] + buffer_start
+            loose_positions = np.nonzero((hashes & loose_mask) == 0)[0] + buffer_start
+
+            pending += buffer
+            data_end = pending_start + len(pending)
+            context = (context + buffer[-(hash_window - 1):])[-(hash_window - 1):]
+
+            consumed = 0
+            while True:
+                cut_point = find_cut_point(pending_start + consumed, data_end, strict_positions, loose_positions,
+                                           end_of_file)
+                if cut_point is None:
+                    break
+                length = cut_point - pending_start - consumed
+                chunk = pending[consumed:consumed + length]
+                yield pending_start + consumed, length, calculate_chunk_hash(chunk)
+                consumed += length
+
+            pending = pending[consumed:]
+            pending_start += consumed
+
+
+def create_chunk_index(file_path):
+    chunk_index = {}
+    for offset, length, chunk_hash in iterate_chunks(file_path):
+        chunk_index.setdefault(chunk_hash, (offset, length))
+    return chunk_index
+
+
+class ChunkPatchWriter:
+    def __init__(self, file_handler):
+        self.file_handler = file_handler
+        self.pending_reference = None
+
+    def flush(self):
+        if self.pending_reference is not None:
+            kind, offset, length = self.pending_reference
+            self.file_handler.write(kind + struct.pack(reference_format, offset, length))
+            self.pending_reference = None
+
+    def write_reference(self, kind, offset, length):
+        # Adjacent references into the same file are merged into a single instruction
+        if self.pending_reference is not None:
+            pending_kind, pending_offset, pending_length = self.pending_reference
+            if pending_kind == kind and pending_offset + pending_length == offset and pending_length + length < 2 ** 32:
+                self.pending_reference = (kind, pending_offset, pending_length + length)
+                return
+        self.flush()
+        self.pending_reference = (kind, offset, length)
+
+    def write_literal(self, data):
+        self.flush()
+        self.file_handler.write(b"L" + struct.pack(literal_format, len(data)))
+        self.file_handler.write(data)
+
+
+def create_chunk_patch_file(original_version_file, modified_version_file, patch_file):
+    chunk_index = create_chunk_index(original_version_file)
+    written_chunks = {}
+
+    with open(modified_version_file, "rb") as modified_handler, open(patch_file, "wb") as patch_handler:
+        patch_handler.write(struct.pack(header_format, chunk_magic, os.fstat(modified_handler.fileno()).st_size))
+        writer = ChunkPatchWriter(patch_handler)
+
+        for offset, length, chunk_hash in iterate_chunks(modified_version_file):
+            if chunk_hash in chunk_index:
+                original_offset, _ = chunk_index[chunk_hash]
+                writer.write_reference(b"O", original_offset, length)
+            elif chunk_hash in written_chunks:
+                # Chunks which occur several times within the modified file are only stored once
+                writer.write_reference(b"N", written_chunks[chunk_hash], length)
+            else:
+                modified_handler.seek(offset)
+                writer.write_literal(modified_handler.read(length))
+                written_chunks[chunk_hash] = offset
+        writer.flush()
+
+    return 0
+
+
+def copy_following_bytes(source_handler, length, destination_handler):
+    while length > 0:
+        data = source_handler.read(min(read_buffer_size, length))
+        if not data:
+            raise ValueError("Chunk patch references data beyond the end of the file")
+        destination_handler.write(data)
+        length -= len(data)
+
+
+def copy_bytes(source_handler, offset, length, destination_handler):
+    source_handler.seek(offset)
+    copy_following_bytes(source_handler, length, destination_handler)
+
+
+def apply_chunk_patch(original_handler, patch_handler, output_handler):
+    magic, modified_size = struct.unpack(header_format, patch_handler.read(struct.calcsize(header_format)))
+    if magic != chunk_magic:
+        raise ValueError("Given data is not a chunk patch")
+
+    reference_size = struct.calcsize(reference_format)
+    literal_size = struct.calcsize(literal_format)
+    written = 0
+    instruction = patch_handler.read(1)
+    while instruction:
+        if instruction == b"O":
+            offset, length = struct.unpack(reference_format, patch_handler.read(reference_size))
+            copy_bytes(original_handler, offset, length, output_handler)
+        elif instruction == b"N":
+            offset, length = struct.unpack(reference_format, patch_handler.read(reference_size))
+            output_handler.flush()
+            with open(output_handler.name, "rb") as rebuilt_handler:
+                copy_bytes(rebuilt_handler, offset, length, output_handler)
+        elif instruction == b"L":
+            # Literals follow their length directly, so the patch is only ever read front to back
+            length, = struct.unpack(literal_format, patch_handler.read(literal_size))
+            copy_following_bytes(patch_handler, length, output_handler)
+        else:
+            raise ValueError("Unknown instruction {} within the chunk patch".format(instruction))
+        written += length
+        instruction = patch_handler.read(1)
+
+    if written != modified_size:
+        raise ValueError("Chunk patch produced {} bytes instead of {} bytes".format(written, modified_size))
+
+
+def apply_chunk_patch_file(original_version_file, patch_file, output_file, output_hash=None):
+    with open(patch_file, "rb") as patch_handler:
+        return apply_chunk_patch_stream_file(original_version_file, patch_handler, output_file, output_hash)
+
+
+def apply_chunk_patch_stream_file(original_version_file, patch_handler, output_file, output_hash=None):
+    # The applier passes a temporary output of the placement layer, which replaces the destination once the
+    # result was verified and is removed if the patch fails, so the result is written straight into it
+    with open(original_version_file, "rb") as original_handler, open(output_file, "wb") as output_handler:
+        # The hash of the result is calculated while it is written
+        if output_hash is not None:
+            output_handler = HashingFileWriter(output_handler, output_hash)
+        apply_chunk_patch(original_handler, patch_handler, output_handler)
+    return 0
@@ -0,0 +1,279 @@
+import bz2
+import collections
+import io
+import lzma
+import os
+import threading
+import time
+import zlib
+
+from instrumentation import file_span
+
+# zstd and brotli are optional, the codecs of the standard library are always available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+stream_buffer_size = 1024 * 1024
+sample_size = 256 * 1024
+
+# Entries whose sample does not shrink below this ratio are stored without compression
+incompressible_ratio = 0.95
+# Codecs whose sample is at most this much larger than the smallest one compete on decompression speed
+size_tolerance = 1.03
+
+Codec = collections.namedtuple("Codec", ["name", "identifier", "default_level", "minimum_level", "maximum_level",
+                                         "create_compressor", "create_decompressor"])
+
+
+class IdentityCompressor:
+    def compress(self, data):
+        return bytes(data)
+
+    def flush(self):
+        return b""
+
+
+class IdentityDecompressor:
+    def decompress(self, data):
+        return bytes(data)
+
+
+class ZstandardDecompressor:
+    # A zstd decompressobj can only decode a single frame, which is exactly what every entry holds
+    def __init__(self):
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+
+class BrotliCompressor:
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(bytes(data))
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+class BrotliDecompressor:
+    def __init__(self):
+        self.decompressor = brotli.Decompressor()
+
+    def decompress(self, data):
+        return self.decompressor.process(bytes(data))
+
+
+def create_codecs():
+    codecs = [
+        Codec("none", 0, 0, 0, 0, lambda level: IdentityCompressor(), IdentityDecompressor),
+        Codec("zlib", 1, 6, 0, 9, lambda level: zlib.compressobj(level), zlib.decompressobj),
+        Codec("lzma", 2, 6, 0, 9, lambda level: lzma.LZMACompressor(preset=level), lzma.LZMADecompressor),
+        Codec("bz2", 3, 9, 1, 9, lambda level: bz2.BZ2Compressor(level), bz2.BZ2Decompressor),
+    ]
+    if zstandard is not None:
+        codecs.append(Codec("zstd", 4, 3, 1, 22, lambda level: zstandard.ZstdCompressor(level=level).compressobj(),
+                            ZstandardDecompressor))
+    if brotli is not None:
+        codecs.append(Codec("brotli", 5, 5, 0, 11, BrotliCompressor, BrotliDecompressor))
+    return codecs
+
+
+codecs = create_codecs()
+codecs_by_name = dict((codec.name, codec) for codec in codecs)
+codecs_by_identifier = dict((codec.identifier, codec) for codec in codecs)
+available_codecs = [codec.name for codec in codecs]
+
+
+def get_codec(identifier):
+    if identifier not in codecs_by_identifier:
+        raise ValueError("Codec {} is not available on this machine".format(identifier))
+    return codecs_by_identifier[identifier]
+
+
+def create_compressor(codec, level=None):
+    # Every codec has its own range of levels, a level outside of it is clamped
+    if level is None:
+        level = codec.default_level
+    return codec.create_compressor(max(codec.minimum_level, min(codec.maximum_level, level)))
+
+
+def compress_data(codec, data, level=None):
+    compressor = create_compressor(codec, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_data(codec, data):
+    return codec.create_decompressor().decompress(data)
+
+
+def read_sample(file_path):
+    # The sample is taken from the middle of the file, headers at the start are often not representative
+    with open(file_path, "rb") as file_handler:
+        size = os.fstat(file_handler.fileno()).st_size
+        file_handler.seek(max(0, size // 2 - sample_size // 2))
+        return file_handler.read(sample_size)
+
+
+def select_codec(sample, level=None):
+    # Every codec compresses the sample once. The smallest result wins, unless another codec comes close
+    # to it and decompresses faster, because the patch is decompressed on every device which applies it.
+    if not sample:
+        return codecs_by_name["none"]
+
+    trials = []
+    for codec in codecs:
+        if codec.name == "none":
+            continue
+        compressed_sample = compress_data(codec, sample, level)
+        start_time = time.perf_counter()
+        decompress_data(codec, compressed_sample)
+        trials.append((len(compressed_sample), time.perf_counter() - start_time, codec))
+
+    smallest_size = min(size for size, _, _ in trials)
+    if smallest_size > len(sample) * incompressible_ratio:
+        return codecs_by_name["none"]
+
+    candidates = [trial for trial in trials if trial[0] <= smallest_size * size_tolerance]
+    return min(candidates, key=lambda trial: trial[1])[2]
+
+
+def compress_stream(codec, source_handler, destination_handler, level=None):
+    compressor = create_compressor(codec, level)
+    data = source_handler.read(stream_buffer_size)
+    while data:
+        destination_handler.write(compressor.compress(data))
+        data = source_handler.read(stream_buffer_size)
+    destination_handler.write(compressor.flush())
+
+
+class DecompressingReader(io.RawIOBase):
+    # Readable stream which decompresses an entry on the fly, so that it can be handed to everything
+    # which reads a patch from a file handler. finished_callback receives the decompressed bytes and the
+    # seconds spent once the reader is closed.
+    def __init__(self, source_handler, codec, finished_callback=None):
+        self.source_handler = source_handler
+        self.finished_callback = finished_callback
+        self.decompressor = codec.create_decompressor()
+        self.buffer = b""
+        self.buffer_offset = 0
+        self.end_of_source = False
+        self.decompressed_bytes = 0
+        self.seconds = 0.0
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while self.buffer_offset == len(self.buffer) and not self.end_of_source:
+            data = self.source_handler.read(stream_buffer_size)
+            if not data:
+                self.end_of_source = True
+                break
+            start_time = time.perf_counter()
+            self.buffer = self.decompressor.decompress(data)
+            self.buffer_offset = 0
+            self.seconds += time.perf_counter() - start_time
+
+        length = min(len(target), len(self.buffer) - self.buffer_offset)
+        target[:length] = self.buffer[self.buffer_offset:self.buffer_offset + length]
+        self.buffer_offset += length
+        self.decompressed_bytes += length
+        return length
+
+    def close(self):
+        if not self.closed and self.finished_callback is not None:
+            self.finished_callback(self.decompressed_bytes, self.seconds)
+        self.source_handler.close()
+        self.buffer = b""
+        super().close()
+
+
+class PatchCompressor:
+    # Compresses the entries of a patch right after they were created. Entries are compressed in place,
+    # the chosen codec and the original size are remembered for the patch container.
+    def __init__(self, codec_name="auto", level=None):
+        self.codec_name = codec_name
+        self.level = level
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.seconds = 0.0
+
+    def compress_file(self, source_file, destination_file=None):
+        if destination_file is None:
+            destination_file = source_file
+
+        start_time = time.perf_counter()
+        with file_span("compress", file=source_file) as compress_span:
+            if self.codec_name == "auto":
+                codec = select_codec(read_sample(source_file), self.level)
+            else:
+                codec = codecs_by_name[self.codec_name]
+
+            uncompressed_size = os.path.getsize(source_file)
+            if codec.name != "none":
+                temporary_file = destination_file + ".compressed.tmp"
+                with open(source_file, "rb") as source_handler, open(temporary_file, "wb") as destination_handler:
+                    compress_stream(codec, source_handler, destination_handler, self.level)
+
+                # Entries which do not get smaller are stored as they are
+                if os.path.getsize(temporary_file) < uncompressed_size:
+                    os.replace(temporary_file, destination_file)
+                else:
+                    os.remove(temporary_file)
+                    codec = codecs_by_name["none"]
+
+            if codec.name == "none" and source_file != destination_file:
+                with open(source_file, "rb") as source_handler, open(destination_file, "wb") as destination_handler:
+                    compress_stream(codec, source_handler, destination_handler)
+
+            compress_span.set(codec=codec.name, uncompressed_bytes=uncompressed_size)
+            compress_span.record_size("compressed_bytes", destination_file)
+
+        with self.lock:
+            self.entries[destination_file] = (codec, uncompressed_size)
+            self.seconds += time.perf_counter() - start_time
+
+    def entry_codec(self, file_path):
+        return self.entries.get(file_path)
+
+    def register_entry(self, file_path, codec_name, uncompressed_size):
+        # Entries which were compressed by an earlier, interrupted run
+        with self.lock:
+            self.entries[file_path] = (codecs_by_name[codec_name], uncompressed_size)
+
+    def entry_record(self, file_path):
+        if file_path not in self.entries:
+            return {}
+        codec, uncompressed_size = self.entries[file_path]
+        return {"codec": codec.name, "uncompressed_size": uncompressed_size}
+
+    def stats(self):
+        uncompressed_size = 0
+        compressed_size = 0
+        entries_per_codec = collections.Counter()
+        for file_path, (codec, size) in self.entries.items():
+            uncompressed_size += size
+            compressed_size += os.path.getsize(file_path)
+            entries_per_codec[codec.name] += 1
+
+        return {
+            "codec": self.codec_name,
+            "level": self.level,
+            "entries_per_codec": dict(entries_per_codec),
+            "size_before_compression": "{} bytes".format(uncompressed_size),
+            "size_after_compression": "{} bytes".format(compressed_size),
+            "compression_ratio": "{} / {} = {}".format(uncompressed_size, compressed_size,
+                                                       uncompressed_size / compressed_size if compressed_size else 0),
+            "time_needed_to_compress": "{} seconds".format(round(self.seconds, 3))
+        }
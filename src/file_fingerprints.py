@@ -0,0 +1,110 @@
+import hashlib
+import json
+import mmap
+import os
+
+
+hash_chunk_size = 1024 * 1024
+
+
+def load_fingerprint_cache(cache_path):
+    if cache_path is None or not os.path.isfile(cache_path):
+        return {}
+
+    try:
+        with open(cache_path, "r") as file_handler:
+            return json.load(file_handler)
+    except ValueError:
+        print("Fingerprint cache {} is damaged and will be rebuilt!".format(cache_path))
+        return {}
+
+
+def save_fingerprint_cache(fingerprint_cache, cache_path):
+    if cache_path is None:
+        return
+
+    # Files which were deleted or renamed since they were hashed can never be hit again
+    for cache_key in [cache_key for cache_key in fingerprint_cache if not os.path.exists(cache_key)]:
+        del fingerprint_cache[cache_key]
+
+    cache_directory = os.path.dirname(cache_path)
+    if cache_directory and not os.path.exists(cache_directory):
+        os.makedirs(cache_directory)
+
+    # Write into a temporary file first so an interrupted run never leaves a truncated cache behind
+    temporary_path = cache_path + ".tmp"
+    with open(temporary_path, "w") as file_handler:
+        json.dump(fingerprint_cache, file_handler)
+    os.replace(temporary_path, cache_path)
+
+
+def update_hash_from_file(file_hash, file_path):
+    with open(file_path, "rb") as file_handler:
+        chunk = file_handler.read(hash_chunk_size)
+        while chunk:
+            file_hash.update(chunk)
+            chunk = file_handler.read(hash_chunk_size)
+    return file_hash
+
+
+def calculate_file_hash(file_path):
+    return update_hash_from_file(hashlib.sha256(), file_path).hexdigest()
+
+
+def calculate_mapped_file_hash(file_path):
+    # The whole file is hashed straight from the page cache without copying it into Python first
+    with open(file_path, "rb") as file_handler:
+        if os.fstat(file_handler.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(file_handler.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return hashlib.sha256(data).hexdigest()
+
+
+class HashingFileWriter:
+    # Hashes everything which is written to the file, so the result can be verified without reading it again
+    def __init__(self, file_handler, file_hash):
+        self.file_handler = file_handler
+        self.file_hash = file_hash
+        self.name = file_handler.name
+
+    def write(self, data):
+        self.file_hash.update(data)
+        return self.file_handler.write(data)
+
+    def flush(self):
+        self.file_handler.flush()
+
+
+def get_file_fingerprint(file_path, fingerprint_cache, file_stat=None):
+    if file_stat is None:
+        file_stat = os.stat(file_path)
+
+    # A cached hash is only reused as long as path, size, mtime and inode are unchanged
+    cache_key = os.path.abspath(file_path)
+    stat_key = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+    cached_entry = fingerprint_cache.get(cache_key)
+    if cached_entry is not None and cached_entry[:3] == stat_key:
+        return cached_entry[3]
+
+    file_hash = calculate_file_hash(file_path)
+    fingerprint_cache[cache_key] = stat_key + [file_hash]
+    return file_hash
+
+
+def are_files_equal(original_file_path, modified_file_path, fingerprint_cache, original_file_stat=None,
+                    modified_file_stat=None):
+    # Stats of a tree snapshot save the stat calls
+    if original_file_stat is None:
+        original_file_stat = os.stat(original_file_path)
+    if modified_file_stat is None:
+        modified_file_stat = os.stat(modified_file_path)
+
+    # Cheap checks first: different sizes can never be equal, the same inode always is
+    if original_file_stat.st_size != modified_file_stat.st_size:
+        return False
+    if original_file_stat.st_dev == modified_file_stat.st_dev and original_file_stat.st_ino == modified_file_stat.st_ino:
+        return True
+
+    original_file_hash = get_file_fingerprint(original_file_path, fingerprint_cache, original_file_stat)
+    modified_file_hash = get_file_fingerprint(modified_file_path, fingerprint_cache, modified_file_stat)
+    return original_file_hash == modified_file_hash
@@ -0,0 +1,174 @@
+import collections
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+
+from file_fingerprints import HashingFileWriter, update_hash_from_file
+
+
+copy_buffer_size = 1024 * 1024
+
+# ioctl which makes the destination share all extents of the source, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# Ways a file can get to its destination, from the cheapest to the most expensive one. rename and reflink
+# copy nothing, copy_file_range copies within the kernel, copy and stream move every byte through this
+# process and patched files are written by the patch tool.
+placement_methods = ["rename", "reflink", "copy_file_range", "copy", "stream", "patched"]
+
+# Errors which only mean that the file system or the kernel does not offer a method
+unsupported_errors = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EBADF,
+                      errno.EPERM}
+
+
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Read once while only one thread runs, setting the umask is not thread-safe
+process_umask = get_umask()
+
+placement_counts = collections.Counter()
+placement_bytes = collections.Counter()
+placement_lock = threading.Lock()
+
+
+def record_placement(method, size):
+    with placement_lock:
+        placement_counts[method] += 1
+        placement_bytes[method] += size
+
+
+def reset_placement_stats():
+    # Every application reports only the files it placed itself, the counters start again when it starts
+    with placement_lock:
+        placement_counts.clear()
+        placement_bytes.clear()
+
+
+def placement_stats():
+    return dict((method, {"files": placement_counts[method], "bytes": placement_bytes[method]})
+                for method in placement_methods if placement_counts[method])
+
+
+def create_temporary_file(destination_path):
+    # The temporary file lies next to its destination, so it can replace it with a rename.
+    # mkstemp only allows the owner to read it, placed files get the usual permissions instead.
+    directory, name = os.path.split(destination_path)
+    file_descriptor, temporary_file = tempfile.mkstemp(dir=directory or ".", prefix="." + name + ".",
+                                                       suffix=".tmp")
+    os.fchmod(file_descriptor, 0o666 & ~process_umask)
+    return file_descriptor, temporary_file
+
+
+def remove_temporary_file(temporary_file):
+    if os.path.exists(temporary_file):
+        os.remove(temporary_file)
+
+
+def copy_file_range(source_descriptor, destination_descriptor, size):
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(source_descriptor, destination_descriptor, size - offset)
+        if copied == 0:
+            break
+        offset += copied
+    return offset
+
+
+def copy_descriptor(source_descriptor, destination_descriptor, size):
+    # Tries the methods one after another, a method which failed leaves an empty destination behind
+    try:
+        fcntl.ioctl(destination_descriptor, FICLONE, source_descriptor)
+        return "reflink"
+    except OSError as error:
+        if error.errno not in unsupported_errors:
+            raise
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            if copy_file_range(source_descriptor, destination_descriptor, size) == size:
+                return "copy_file_range"
+        except OSError as error:
+            if error.errno not in unsupported_errors:
+                raise
+        os.ftruncate(destination_descriptor, 0)
+        os.lseek(source_descriptor, 0, os.SEEK_SET)
+        os.lseek(destination_descriptor, 0, os.SEEK_SET)
+
+    with open(source_descriptor, "rb", closefd=False) as source_handler, \
+            open(destination_descriptor, "wb", closefd=False) as destination_handler:
+        shutil.copyfileobj(source_handler, destination_handler, copy_buffer_size)
+    return "copy"
+
+
+def place_file(source_path, destination_path, keep_source=False, output_hash=None):
+    # Puts a file at its destination as cheap as possible and returns the method which was used.
+    # The destination is replaced with a rename, so it is always either the old or the complete new file.
+    size = os.path.getsize(source_path)
+    method = None
+    if not keep_source:
+        try:
+            os.rename(source_path, destination_path)
+            method = "rename"
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+
+    if method is None:
+        file_descriptor, temporary_file = create_temporary_file(destination_path)
+        try:
+            with open(file_descriptor, "r+b") as destination_handler, open(source_path, "rb") as source_handler:
+                method = copy_descriptor(source_handler.fileno(), destination_handler.fileno(), size)
+            shutil.copystat(source_path, temporary_file)
+            os.replace(temporary_file, destination_path)
+        except BaseException:
+            remove_temporary_file(temporary_file)
+            raise
+        if not keep_source:
+            os.remove(source_path)
+
+    # Nothing passed through this process, so the placed file is read once to get its hash
+    if output_hash is not None:
+        update_hash_from_file(output_hash, destination_path)
+    record_placement(method, size)
+    return method
+
+
+def place_stream(source_handler, destination_path, output_hash=None):
+    # Entries of compressed patches only exist as a stream, they are hashed on their way into a temporary
+    # file which replaces the destination once it is complete
+    file_descriptor, temporary_file = create_temporary_file(destination_path)
+    try:
+        with open(file_descriptor, "wb") as file_handler:
+            writer = HashingFileWriter(file_handler, output_hash) if output_hash is not None else file_handler
+            shutil.copyfileobj(source_handler, writer, copy_buffer_size)
+        os.replace(temporary_file, destination_path)
+    except BaseException:
+        remove_temporary_file(temporary_file)
+        raise
+    record_placement("stream", os.path.getsize(destination_path))
+    return "stream"
+
+
+def create_output_file(destination_path):
+    # Patch tools write into this file instead of their destination, which stays intact if they fail
+    file_descriptor, temporary_file = create_temporary_file(destination_path)
+    os.close(file_descriptor)
+    return temporary_file
+
+
+def finish_output_file(temporary_file, destination_path, succeeded, mode_path=None):
+    if not succeeded:
+        remove_temporary_file(temporary_file)
+        return
+    # A patched file keeps the permissions of the file it replaces or was derived from
+    if mode_path is not None and os.path.exists(mode_path):
+        shutil.copymode(mode_path, temporary_file)
+    os.replace(temporary_file, destination_path)
+    record_placement("patched", os.path.getsize(destination_path))
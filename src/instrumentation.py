@@ -0,0 +1,260 @@
+import collections
+import contextvars
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+
+# Version of the layout of the instrumentation within stats.json, raised on every incompatible change
+stats_schema_version = 1
+
+# The tracer is only created when a trace was requested, otherwise every span is the same object which does nothing
+tracer = None
+# Functions which get the command and the peak RSS of every external process, even without a trace
+process_observers = []
+# Control of the job the current code runs for. Worker threads only see it when they run within a copy
+# of the context of the thread which submitted them, see submit_in_context.
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        return False
+
+    def set(self, **values):
+        pass
+
+    def record_size(self, name, path):
+        pass
+
+
+null_span = NullSpan()
+
+
+class Span:
+    def __init__(self, tracer, name, category, values):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.values = values
+        self.start_time = 0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        duration = time.perf_counter_ns() - self.start_time
+        if exception_type is not None:
+            self.values["error"] = exception_type.__name__
+        self.tracer.add_span(self, duration)
+        return False
+
+    def set(self, **values):
+        self.values.update(values)
+
+    def record_size(self, name, path):
+        # Sizes are taken while the span is open, a missing file has no size
+        try:
+            self.values[name] = os.path.getsize(path)
+        except OSError:
+            pass
+
+
+class Tracer:
+    # Collects spans of all threads. Every span becomes a complete event of a Chrome trace, which can be
+    # opened with chrome://tracing or ui.perfetto.dev, and is summed up per phase for stats.json.
+    def __init__(self):
+        self.start_time = time.perf_counter_ns()
+        self.process_id = os.getpid()
+        self.events = []
+        self.thread_names = {}
+        self.lock = threading.Lock()
+
+    def span(self, name, category, values):
+        return Span(self, name, category, values)
+
+    def add_span(self, span, duration):
+        thread = threading.current_thread()
+        with self.lock:
+            self.thread_names[thread.ident] = thread.name
+            self.events.append((span.name, span.category, span.start_time - self.start_time, duration,
+                                thread.ident, span.values))
+
+    def trace_events(self):
+        events = []
+        for thread_id, thread_name in self.thread_names.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": self.process_id, "tid": thread_id,
+                           "args": {"name": thread_name}})
+        for name, category, start_time, duration, thread_id, values in self.events:
+            events.append({"name": name, "cat": category, "ph": "X", "pid": self.process_id, "tid": thread_id,
+                           "ts": start_time / 1000, "dur": duration / 1000, "args": values})
+        return events
+
+    def write_trace(self, trace_path, process_name):
+        events = [{"name": "process_name", "ph": "M", "pid": self.process_id, "args": {"name": process_name}}]
+        with open(trace_path, "w") as file_handler:
+            json.dump({"traceEvents": events + self.trace_events(), "displayTimeUnit": "ms"}, file_handler)
+
+    def stats(self):
+        # Phases are summed up, files and processes are listed one by one
+        phases = collections.OrderedDict()
+        files = []
+        processes = []
+        for name, category, start_time, duration, thread_id, values in self.events:
+            seconds = duration / 1e9
+            if category == "phase":
+                phase = phases.setdefault(name, {"count": 0, "seconds": 0.0})
+                phase["count"] += 1
+                phase["seconds"] += seconds
+            elif category == "file":
+                files.append(dict(values, operation=name, seconds=seconds))
+            elif category == "process":
+                processes.append(dict(values, seconds=seconds))
+        for phase in phases.values():
+            phase["seconds"] = round(phase["seconds"], 6)
+
+        return {
+            "schema_version": stats_schema_version,
+            "seconds_since_start": round((time.perf_counter_ns() - self.start_time) / 1e9, 6),
+            "phases": phases,
+            "files": files,
+            "processes": processes,
+        }
+
+
+def enable_tracing():
+    global tracer
+    tracer = Tracer()
+    return tracer
+
+
+def span(name, category="phase", **values):
+    if tracer is None:
+        return null_span
+    return tracer.span(name, category, values)
+
+
+def file_span(name, **values):
+    if tracer is None:
+        return null_span
+    return tracer.span(name, "file", values)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobControl:
+    # Every external process of a job is registered here, so cancelling the job kills all of them at once
+    # and no further process can be started for it
+    def __init__(self):
+        self.processes = set()
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def start_process(self, command, **popen_arguments):
+        with self.lock:
+            if self.cancelled:
+                raise JobCancelled("The job was cancelled before {} was started".format(command[0]))
+            process = subprocess.Popen(command, **popen_arguments)
+            self.processes.add(process)
+        return process
+
+    def finish_process(self, process):
+        with self.lock:
+            self.processes.discard(process)
+            if self.cancelled:
+                raise JobCancelled("The job was cancelled while {} was running".format(process.args[0]))
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for process in self.processes:
+                process.kill()
+
+
+def start_process(command, **popen_arguments):
+    job = current_job.get()
+    if job is None:
+        return subprocess.Popen(command, **popen_arguments)
+    return job.start_process(command, **popen_arguments)
+
+
+def finish_process(process):
+    job = current_job.get()
+    if job is not None:
+        job.finish_process(process)
+
+
+def submit_in_context(executor, function, *args):
+    # The job control and the output of a job follow their work into the threads of a pool
+    return executor.submit(contextvars.copy_context().run, function, *args)
+
+
+def kill_timed_out_process(process, timed_out):
+    timed_out.set()
+    process.kill()
+
+
+def add_process_observer(observer):
+    process_observers.append(observer)
+
+
+def remove_process_observer(observer):
+    process_observers.remove(observer)
+
+
+def wait_for_process(process, command_span=null_span):
+    # wait4 reports the CPU time and the peak RSS of the process, which process.wait can not do
+    if tracer is None and not process_observers:
+        return process.wait()
+
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is given in kilobytes on Linux and in bytes on macOS
+    peak_rss_bytes = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    command_span.set(exit_code=process.returncode,
+                     cpu_seconds=usage.ru_utime + usage.ru_stime,
+                     peak_rss_bytes=peak_rss_bytes)
+    # Observers come and go with the pools of other threads
+    for observer in list(process_observers):
+        observer(process.args, peak_rss_bytes)
+    return process.returncode
+
+
+def call_process(command, timeout=None):
+    # Same as subprocess.call, but the external tool gets its own span while tracing
+    # and its peak RSS is handed to the observers
+    if tracer is None and not process_observers and current_job.get() is None:
+        return subprocess.call(command, timeout=timeout)
+
+    with span(os.path.basename(command[0]), "process", command=" ".join(command)) as command_span:
+        process = start_process(command)
+        timed_out = threading.Event()
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, kill_timed_out_process, args=(process, timed_out))
+            timer.start()
+        return_value = wait_for_process(process, command_span)
+        if timer is not None:
+            timer.cancel()
+        finish_process(process)
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(command, timeout)
+    return return_value
+
+
+def save_instrumentation(stats, stats_key, trace_path, process_name):
+    if tracer is None:
+        return
+    stats[stats_key] = tracer.stats()
+    if trace_path:
+        tracer.write_trace(trace_path, process_name)
+        print("Trace with {} spans was saved as {}".format(len(tracer.events), trace_path))
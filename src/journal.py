@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+
+from file_fingerprints import calculate_file_hash
+
+
+class Journal:
+    # Append-only log of finished work units. Every line is a single JSON record, so a crash can at most
+    # lose the line which was written at that moment. Later records of a unit replace earlier ones.
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.records = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(journal_path):
+            with open(journal_path, "r") as file_handler:
+                for line in file_handler:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Only the last line can be torn, everything before it is complete
+                        break
+                    self.records[record["unit"]] = record
+        self.file_handler = open(journal_path, "a")
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, unit):
+        return self.records.get(unit)
+
+    def record(self, unit, **values):
+        record = dict(values, unit=unit)
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self.lock:
+            self.records[unit] = record
+            self.file_handler.write(line)
+            self.file_handler.flush()
+            os.fsync(self.file_handler.fileno())
+
+    def close(self):
+        self.file_handler.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.journal_path)
+
+
+def get_input_signature(file_paths):
+    # Inputs which changed since the unit was finished make its output worthless
+    signature = []
+    for file_path in file_paths:
+        file_stat = os.stat(file_path)
+        signature.append([file_stat.st_size, file_stat.st_mtime_ns])
+    return signature
+
+
+def find_finished_unit(journal, unit, input_files, output_file):
+    if journal is None:
+        return None
+
+    record = journal.get(unit)
+    if record is None or record.get("inputs") != get_input_signature(input_files):
+        return None
+    if not os.path.exists(output_file) or calculate_file_hash(output_file) != record["output_hash"]:
+        return None
+    return record
+
+
+def finish_unit(journal, unit, input_files, output_file, **values):
+    if journal is None:
+        return
+    journal.record(unit, inputs=get_input_signature(input_files), output_hash=calculate_file_hash(output_file),
+                   **values)
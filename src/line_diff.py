@@ -0,0 +1,284 @@
+import bisect
+import os
+import struct
+
+from file_fingerprints import HashingFileWriter
+
+
+# Layout of a line patch:
+#   header: magic | number of lines of the original file | size of the original file | size of the modified file
+#   copy:   b"C" | number of lines which are taken over from the original file
+#   skip:   b"S" | number of lines of the original file which are left out
+#   insert: b"I" | length | data of the inserted lines
+# Lines keep their line endings, so CRLF, mixed endings and a missing newline at the end are rebuilt byte by byte.
+line_magic = b"LINEDIF1"
+header_format = ">8sQQQ"
+count_format = ">I"
+literal_format = ">I"
+
+maximum_count = 0xFFFFFFFF
+maximum_literal_size = 64 * 1024 * 1024
+
+# Larger text files and every file with a NUL byte within its first block are left to bsdiff
+maximum_text_size = 16 * 1024 * 1024
+text_sample_size = 8 * 1024
+# Myers explores this many edits between two anchors at most, a region which differs even more is replaced as a whole
+maximum_edit_cost = 1024
+
+
+def is_text_data(data):
+    # Same rule as git: text has no NUL byte within its first block
+    return b"\0" not in data[:text_sample_size]
+
+
+def is_text_file(file_path):
+    if os.path.getsize(file_path) > maximum_text_size:
+        return False
+    with open(file_path, "rb") as file_handler:
+        return is_text_data(file_handler.read(text_sample_size))
+
+
+def are_text_files(original_version_file, modified_version_file):
+    return is_text_file(original_version_file) and is_text_file(modified_version_file)
+
+
+def read_lines(file_path):
+    with open(file_path, "rb") as file_handler:
+        data = file_handler.read()
+    return data, data.splitlines(keepends=True)
+
+
+def number_lines(original_lines, modified_lines):
+    # Equal lines get equal numbers, so the diff compares integers instead of byte strings
+    line_numbers = {}
+    original_numbers = [line_numbers.setdefault(line, len(line_numbers)) for line in original_lines]
+    modified_numbers = [line_numbers.setdefault(line, len(line_numbers)) for line in modified_lines]
+    return original_numbers, modified_numbers
+
+
+def find_unique_anchors(a, b, a_start, a_end, b_start, b_end):
+    # Patience diff: lines which occur exactly once on both sides, in the longest order both sides agree on
+    a_counts = {}
+    for index in range(a_start, a_end):
+        a_counts[a[index]] = a_counts.get(a[index], 0) + 1
+    b_positions = {}
+    for index in range(b_start, b_end):
+        if a_counts.get(b[index]) == 1:
+            b_positions[b[index]] = None if b[index] in b_positions else index
+
+    pairs = [(index, b_positions[a[index]]) for index in range(a_start, a_end)
+             if a_counts[a[index]] == 1 and b_positions.get(a[index]) is not None]
+    if not pairs:
+        return []
+
+    # Longest increasing subsequence of the positions within b, found by patience sorting
+    pile_tops = []
+    pile_pairs = []
+    predecessors = [None] * len(pairs)
+    for pair_index, (_, b_index) in enumerate(pairs):
+        pile = bisect.bisect_left(pile_tops, b_index)
+        if pile == len(pile_tops):
+            pile_tops.append(b_index)
+            pile_pairs.append(pair_index)
+        else:
+            pile_tops[pile] = b_index
+            pile_pairs[pile] = pair_index
+        predecessors[pair_index] = pile_pairs[pile - 1] if pile > 0 else None
+
+    anchors = []
+    pair_index = pile_pairs[-1]
+    while pair_index is not None:
+        anchors.append(pairs[pair_index])
+        pair_index = predecessors[pair_index]
+    anchors.reverse()
+    return anchors
+
+
+def find_myers_matches(a, b, a_start, a_end, b_start, b_end, matches):
+    # Greedy O(ND) algorithm of Myers. Returns False without any match once more than maximum_edit_cost
+    # edits would be needed, the region is replaced as a whole then.
+    n = a_end - a_start
+    m = b_end - b_start
+    furthest = {1: 0}
+    trace = []
+    for cost in range(min(n + m, maximum_edit_cost) + 1):
+        trace.append(dict(furthest))
+        for diagonal in range(-cost, cost + 1, 2):
+            if diagonal == -cost or (diagonal != cost and furthest[diagonal - 1] < furthest[diagonal + 1]):
+                x = furthest[diagonal + 1]
+            else:
+                x = furthest[diagonal - 1] + 1
+            y = x - diagonal
+            while x < n and y < m and a[a_start + x] == b[b_start + y]:
+                x += 1
+                y += 1
+            furthest[diagonal] = x
+            if x >= n and y >= m:
+                # Walks back through the trace and collects the diagonal moves, which are the matching lines
+                for previous_cost in range(cost, -1, -1):
+                    previous = trace[previous_cost]
+                    diagonal = x - y
+                    if diagonal == -previous_cost or (diagonal != previous_cost and
+                                                      previous.get(diagonal - 1, -1) < previous.get(diagonal + 1, -1)):
+                        previous_diagonal = diagonal + 1
+                    else:
+                        previous_diagonal = diagonal - 1
+                    previous_x = previous[previous_diagonal]
+                    previous_y = previous_x - previous_diagonal
+                    while x > previous_x and y > previous_y:
+                        x -= 1
+                        y -= 1
+                        matches.append((a_start + x, b_start + y))
+                    x, y = previous_x, previous_y
+                return True
+    return False
+
+
+def find_matching_lines(a, b):
+    # Pairs of equal lines in ascending order. Common prefixes and suffixes are matched right away,
+    # unique lines split the rest into smaller regions and Myers diffs the regions without unique lines.
+    matches = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        a_start, a_end, b_start, b_end = regions.pop()
+        while a_start < a_end and b_start < b_end and a[a_start] == b[b_start]:
+            matches.append((a_start, b_start))
+            a_start += 1
+            b_start += 1
+        while a_start < a_end and b_start < b_end and a[a_end - 1] == b[b_end - 1]:
+            a_end -= 1
+            b_end -= 1
+            matches.append((a_end, b_end))
+        if a_start == a_end or b_start == b_end:
+            continue
+
+        anchors = find_unique_anchors(a, b, a_start, a_end, b_start, b_end)
+        if anchors:
+            for a_index, b_index in anchors:
+                regions.append((a_start, a_index, b_start, b_index))
+                matches.append((a_index, b_index))
+                a_start, b_start = a_index + 1, b_index + 1
+            regions.append((a_start, a_end, b_start, b_end))
+        else:
+            find_myers_matches(a, b, a_start, a_end, b_start, b_end, matches)
+    matches.sort()
+    return matches
+
+
+class LinePatchWriter:
+    def __init__(self, file_handler):
+        self.file_handler = file_handler
+
+    def write_count(self, instruction, count):
+        while count > 0:
+            step = min(count, maximum_count)
+            self.file_handler.write(instruction + struct.pack(count_format, step))
+            count -= step
+
+    def write_insert(self, data):
+        for start in range(0, len(data), maximum_literal_size):
+            chunk = data[start:start + maximum_literal_size]
+            self.file_handler.write(b"I" + struct.pack(literal_format, len(chunk)))
+            self.file_handler.write(chunk)
+
+
+def create_line_patch(original_lines, modified_lines, original_size, modified_size, file_handler):
+    file_handler.write(struct.pack(header_format, line_magic, len(original_lines), original_size, modified_size))
+    writer = LinePatchWriter(file_handler)
+
+    a, b = number_lines(original_lines, modified_lines)
+
+    # Consecutive matches become a single copy. An empty run behind the last lines writes the tail of both files.
+    runs = []
+    for a_index, b_index in find_matching_lines(a, b):
+        if runs and runs[-1][0] + runs[-1][2] == a_index and runs[-1][1] + runs[-1][2] == b_index:
+            runs[-1][2] += 1
+        else:
+            runs.append([a_index, b_index, 1])
+    runs.append([len(a), len(b), 0])
+
+    original_position = 0
+    modified_position = 0
+    for a_index, b_index, length in runs:
+        writer.write_count(b"S", a_index - original_position)
+        if b_index > modified_position:
+            writer.write_insert(b"".join(modified_lines[modified_position:b_index]))
+        writer.write_count(b"C", length)
+        original_position = a_index + length
+        modified_position = b_index + length
+
+
+def create_line_patch_file(original_version_file, modified_version_file, patch_file):
+    original_data, original_lines = read_lines(original_version_file)
+    modified_data, modified_lines = read_lines(modified_version_file)
+    with open(patch_file, "wb") as file_handler:
+        create_line_patch(original_lines, modified_lines, len(original_data), len(modified_data), file_handler)
+    return 0
+
+
+def read_exactly(patch_handler, length):
+    data = patch_handler.read(length)
+    if len(data) != length:
+        raise ValueError("Line patch ends unexpectedly")
+    return data
+
+
+def apply_line_patch(original_data, patch_handler, file_handler):
+    # The patch is read front to back, so it may come from a stream
+    magic, number_of_lines, original_size, modified_size = struct.unpack(
+        header_format, read_exactly(patch_handler, struct.calcsize(header_format)))
+    if magic != line_magic:
+        raise ValueError("Given data is not a line patch")
+    original_lines = original_data.splitlines(keepends=True)
+    if len(original_data) != original_size or len(original_lines) != number_of_lines:
+        raise ValueError("Line patch was created for another original file")
+
+    # Offsets of every line start, a copy of many lines is a single slice of the original
+    line_offsets = [0]
+    for line in original_lines:
+        line_offsets.append(line_offsets[-1] + len(line))
+
+    count_size = struct.calcsize(count_format)
+    literal_size = struct.calcsize(literal_format)
+    original_position = 0
+    written = 0
+    instruction = patch_handler.read(1)
+    while instruction:
+        if instruction in (b"C", b"S"):
+            count, = struct.unpack(count_format, read_exactly(patch_handler, count_size))
+            if original_position + count > number_of_lines:
+                raise ValueError("Line patch references lines beyond the end of the original file")
+            if instruction == b"C":
+                data = original_data[line_offsets[original_position]:line_offsets[original_position + count]]
+                file_handler.write(data)
+                written += len(data)
+            original_position += count
+        elif instruction == b"I":
+            length, = struct.unpack(literal_format, read_exactly(patch_handler, literal_size))
+            file_handler.write(read_exactly(patch_handler, length))
+            written += length
+        else:
+            raise ValueError("Unknown instruction {} within the line patch".format(instruction))
+        instruction = patch_handler.read(1)
+
+    if written != modified_size:
+        raise ValueError("Line patch produced {} bytes instead of {} bytes".format(written, modified_size))
+
+
+def apply_line_patch_file(original_version_file, patch_file, output_file, output_hash=None):
+    with open(patch_file, "rb") as patch_handler:
+        return apply_line_patch_stream_file(original_version_file, patch_handler, output_file, output_hash)
+
+
+def apply_line_patch_stream_file(original_version_file, patch_handler, output_file, output_hash=None):
+    # The applier passes a temporary output of the placement layer, which replaces the destination once the
+    # result was verified and is removed if the patch fails. The original is read completely before the output
+    # is opened, so both may even be the same file.
+    with open(original_version_file, "rb") as original_handler:
+        original_data = original_handler.read()
+    with open(output_file, "wb") as file_handler:
+        # The hash of the result is calculated while it is written
+        if output_hash is not None:
+            file_handler = HashingFileWriter(file_handler, output_hash)
+        apply_line_patch(original_data, patch_handler, file_handler)
+    return 0
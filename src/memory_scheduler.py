@@ -0,0 +1,248 @@
+import bisect
+import concurrent.futures
+import contextvars
+import itertools
+import os
+import threading
+
+from instrumentation import add_process_observer, remove_process_observer
+
+# Memory a single job needs next to the interpreter, even for the smallest files
+process_memory = 8 * 1024 * 1024
+# xdelta3 only keeps this much of the original in memory, larger originals are read window by window
+xdelta_source_window = 64 * 1024 * 1024
+
+# Memory of a job as a function of the size of the original and the modified file. The numbers come from the
+# data structures of every tool and are corrected by the peak RSS measured for the external tools.
+memory_models = {
+    # Suffix sorting of the original keeps two arrays of 8 bytes per byte next to both files
+    "bsdiff": lambda original_size, modified_size: 17 * original_size + modified_size,
+    # The original and the created file are both held in memory
+    "bspatch": lambda original_size, modified_size: original_size + modified_size,
+    "xdelta": lambda original_size, modified_size: 2 * min(original_size, xdelta_source_window),
+    # The rolling checksum widens every byte of the modified file to 8 bytes, the original is mapped
+    "rsync": lambda original_size, modified_size: original_size + 9 * modified_size,
+    # The gear hash widens every byte of both files to 8 bytes
+    "cdc": lambda original_size, modified_size: 8 * max(original_size, modified_size),
+    # Lines of both text files are held as byte strings next to their numbers, binary files go to bsdiff
+    "text": lambda original_size, modified_size: 17 * original_size + modified_size,
+}
+
+# The tool of the adaptive creator and the automatic applier is only known once the job runs
+any_tool = ["adaptive", "auto"]
+
+# External programs whose peak RSS corrects the model of a tool
+program_tools = {"bsdiff": "bsdiff", "bspatch": "bspatch", "xdelta3": "xdelta"}
+
+# Jobs on smaller inputs mostly measure the interpreter and the program itself, they do not correct the models
+minimum_learning_size = 1024 * 1024
+# The budget leaves room for the page cache and everything else which runs on the machine
+default_budget_share = 0.8
+# The largest waiting job is passed over this many times by smaller ones, afterwards it gets the memory first
+maximum_bypasses = 8
+
+job_context = threading.local()
+
+
+def get_available_memory():
+    # MemAvailable also counts the page cache which can be dropped, the physical memory is only a fallback
+    try:
+        with open("/proc/meminfo") as file_handler:
+            for line in file_handler:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_default_budget():
+    available_memory = get_available_memory()
+    if available_memory is None:
+        return None
+    return int(available_memory * default_budget_share)
+
+
+def get_file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+class MemoryBudget:
+    # Shared by every pool of a run, so that the corrections learned by one phase are used by the next one
+    def __init__(self, budget_bytes=None):
+        self.budget_bytes = budget_bytes
+        self.corrections = {}
+        self.observations = {}
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.delayed_jobs = 0
+        self.oversized_jobs = 0
+        self.peak_reserved_bytes = 0
+
+    def model_bytes(self, tool, original_size, modified_size):
+        return process_memory + memory_models[tool](original_size, modified_size)
+
+    def estimate(self, tool, original_file, modified_file=None):
+        # The size of the modified file is not known while applying, the original stands in for it
+        original_size = get_file_size(original_file)
+        modified_size = get_file_size(modified_file) if modified_file is not None else original_size
+        tools = memory_models if tool in any_tool else [tool]
+        with self.lock:
+            estimate = max(self.model_bytes(model_tool, original_size, modified_size) *
+                           self.corrections.get(model_tool, 1.0) for model_tool in tools)
+        return {"bytes": int(estimate), "original_size": original_size, "modified_size": modified_size}
+
+    def observe_process(self, command, peak_rss_bytes):
+        # Called by the worker thread which ran the program, so the running job tells the sizes of its files.
+        # Pools of other runs may be active at the same time, only their own jobs correct this budget.
+        job = getattr(job_context, "job", None)
+        tool = program_tools.get(os.path.basename(command[0]))
+        if job is None or job.memory_budget is not self or tool is None or not peak_rss_bytes:
+            return
+        original_size, modified_size = job.estimate["original_size"], job.estimate["modified_size"]
+        if max(original_size, modified_size) < minimum_learning_size:
+            return
+
+        # The largest ratio seen so far is kept, an estimate which is too small is what makes a machine swap
+        ratio = peak_rss_bytes / self.model_bytes(tool, original_size, modified_size)
+        with self.lock:
+            self.observations[tool] = self.observations.get(tool, 0) + 1
+            if self.observations[tool] == 1:
+                self.corrections[tool] = ratio
+            else:
+                self.corrections[tool] = max(self.corrections[tool], ratio)
+
+    def stats(self):
+        return {
+            "budget_bytes": self.budget_bytes,
+            "jobs": self.jobs,
+            "delayed_jobs": self.delayed_jobs,
+            "oversized_jobs": self.oversized_jobs,
+            "peak_reserved_bytes": self.peak_reserved_bytes,
+            "corrections": dict((tool, round(correction, 3)) for tool, correction in self.corrections.items()),
+            "observations": dict(self.observations),
+        }
+
+
+class Job:
+    def __init__(self, function, args, estimate, memory_budget):
+        self.function = function
+        self.args = args
+        self.estimate = estimate
+        self.memory_budget = memory_budget
+        self.future = concurrent.futures.Future()
+        # The job runs within the context of the thread which submitted it
+        self.context = contextvars.copy_context()
+        self.bypasses = 0
+        self.delayed = False
+
+
+class MemoryScheduler:
+    # Thread pool which only starts a job once its memory fits into the budget next to all running jobs.
+    # Jobs are held back until the pool is left, so that all of them are known and the largest ones can be
+    # placed first while smaller jobs are packed into the memory which is left around them.
+    def __init__(self, max_workers, memory_budget=None):
+        self.max_workers = max_workers
+        self.memory_budget = memory_budget
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.condition = threading.Condition()
+        self.pending_jobs = []
+        self.order = itertools.count()
+        self.running_jobs = 0
+        self.reserved_bytes = 0
+
+    def __enter__(self):
+        # The budget learns from the peak RSS of the programs only while its jobs run
+        if self.memory_budget is not None:
+            add_process_observer(self.memory_budget.observe_process)
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        try:
+            with self.condition:
+                self.dispatch()
+                while self.pending_jobs or self.running_jobs:
+                    self.condition.wait()
+            self.executor.shutdown(wait=True)
+        finally:
+            if self.memory_budget is not None:
+                remove_process_observer(self.memory_budget.observe_process)
+        return False
+
+    def submit(self, function, *args, memory=None):
+        # memory is the estimate of MemoryBudget.estimate, jobs without one only need a worker
+        if memory is None:
+            memory = {"bytes": 0, "original_size": 0, "modified_size": 0}
+        job = Job(function, args, memory, self.memory_budget)
+        with self.condition:
+            # Largest jobs first, jobs of equal size in the order in which they were submitted
+            bisect.insort(self.pending_jobs, (-memory["bytes"], next(self.order), job))
+        return job.future
+
+    def budget_bytes(self):
+        if self.memory_budget is None:
+            return None
+        return self.memory_budget.budget_bytes
+
+    def fits(self, job):
+        budget_bytes = self.budget_bytes()
+        if budget_bytes is None or self.reserved_bytes + job.estimate["bytes"] <= budget_bytes:
+            return True
+        # A job which is larger than the whole budget runs alone, otherwise it would never run at all
+        return self.running_jobs == 0
+
+    def dispatch(self):
+        # Called with the condition held whenever a worker or memory became free
+        index = 0
+        while index < len(self.pending_jobs) and self.running_jobs < self.max_workers:
+            job = self.pending_jobs[index][2]
+            if self.fits(job):
+                del self.pending_jobs[index]
+                self.start(job)
+                continue
+
+            job.delayed = True
+            if index == 0:
+                # Smaller jobs may use the memory the largest one waits for, but not forever
+                job.bypasses += 1
+                if job.bypasses > maximum_bypasses:
+                    return
+            index += 1
+
+    def start(self, job):
+        self.running_jobs += 1
+        self.reserved_bytes += job.estimate["bytes"]
+        if self.memory_budget is not None:
+            with self.memory_budget.lock:
+                self.memory_budget.jobs += 1
+                self.memory_budget.delayed_jobs += job.delayed
+                self.memory_budget.peak_reserved_bytes = max(self.memory_budget.peak_reserved_bytes,
+                                                             self.reserved_bytes)
+                budget_bytes = self.memory_budget.budget_bytes
+                if budget_bytes is not None and job.estimate["bytes"] > budget_bytes:
+                    self.memory_budget.oversized_jobs += 1
+                    print("A job needs about {} bytes, more than the budget of {} bytes! It runs on its own".format(
+                        job.estimate["bytes"], budget_bytes))
+        self.executor.submit(self.run, job)
+
+    def run(self, job):
+        if job.future.set_running_or_notify_cancel():
+            job_context.job = job
+            try:
+                job.future.set_result(job.context.run(job.function, *job.args))
+            except BaseException as exception:
+                job.future.set_exception(exception)
+            finally:
+                job_context.job = None
+
+        with self.condition:
+            self.running_jobs -= 1
+            self.reserved_bytes -= job.estimate["bytes"]
+            self.dispatch()
+            self.condition.notify_all()
@@ -0,0 +1,167 @@
+import fcntl
+import hashlib
+import heapq
+import json
+import os
+import shutil
+import threading
+import time
+
+from file_fingerprints import get_file_fingerprint
+
+
+delta_kind = "delta"
+tree_kind = "tree"
+
+
+def get_delta_key(original_file_hash, modified_file_hash, tool):
+    return hashlib.sha256("delta\0{}\0{}\0{}".format(original_file_hash, modified_file_hash, tool).encode()).hexdigest()
+
+
+def get_tree_patch_key(source_tree_hash, target_tree_hash, tool):
+    return hashlib.sha256("tree\0{}\0{}\0{}".format(source_tree_hash, target_tree_hash, tool).encode()).hexdigest()
+
+
+class PatchCache:
+    # Content-addressed store for the diffs of single files and for whole patches between two trees.
+    # A diff is keyed by the hashes of both files and the tool, so it is reused by every pair of versions
+    # which share that change. A whole patch is keyed by the tree hashes of both versions and the tool.
+    # The index remembers the size and the last use of every object, the least recently used objects are
+    # removed once the cache is larger than its limit.
+    def __init__(self, cache_path, maximum_bytes=None, fingerprint_cache=None):
+        self.cache_path = cache_path.rstrip("/")
+        self.objects_path = self.cache_path + "/objects"
+        self.index_path = self.cache_path + "/index.json"
+        self.maximum_bytes = maximum_bytes
+        self.fingerprint_cache = fingerprint_cache if fingerprint_cache is not None else {}
+        self.lock = threading.Lock()
+        self.reused_deltas = 0
+        self.stored_deltas = 0
+        self.evicted_objects = 0
+        os.makedirs(self.objects_path, exist_ok=True)
+        self.index = self.read_index()
+
+    def read_index(self):
+        if not os.path.isfile(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, "r") as file_handler:
+                return json.load(file_handler)
+        except ValueError:
+            print("Index of the patch cache {} is damaged and will be rebuilt!".format(self.cache_path))
+            return {}
+
+    def object_path(self, key):
+        return self.objects_path + "/" + key[:2] + "/" + key
+
+    def has_object(self, key):
+        return key in self.index and os.path.isfile(self.object_path(key))
+
+    def fetch(self, key, destination_path):
+        with self.lock:
+            if not self.has_object(key):
+                return False
+            self.index[key]["last_used"] = time.time()
+        # A copy and not a link, tools which write into the destination later on must not change the object
+        shutil.copyfile(self.object_path(key), destination_path)
+        return True
+
+    def store(self, key, source_path, kind, **values):
+        object_path = self.object_path(key)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        # Several runs can store the same object at once, the temporary file keeps every object complete
+        temporary_path = "{}.{}.{}.tmp".format(object_path, os.getpid(), threading.get_ident())
+        shutil.copyfile(source_path, temporary_path)
+        os.replace(temporary_path, object_path)
+        with self.lock:
+            self.index[key] = dict(values, kind=kind, size=os.path.getsize(object_path), last_used=time.time())
+
+    def file_hash(self, file_path):
+        return get_file_fingerprint(file_path, self.fingerprint_cache)
+
+    def fetch_delta(self, original_version_file, modified_version_file, tool, patch_file):
+        key = get_delta_key(self.file_hash(original_version_file), self.file_hash(modified_version_file), tool)
+        if not self.fetch(key, patch_file):
+            return False
+        with self.lock:
+            self.reused_deltas += 1
+        return True
+
+    def store_delta(self, original_version_file, modified_version_file, tool, patch_file):
+        key = get_delta_key(self.file_hash(original_version_file), self.file_hash(modified_version_file), tool)
+        self.store(key, patch_file, delta_kind)
+        with self.lock:
+            self.stored_deltas += 1
+
+    def fetch_tree_patch(self, source_tree_hash, target_tree_hash, tool, patch_file):
+        return self.fetch(get_tree_patch_key(source_tree_hash, target_tree_hash, tool), patch_file)
+
+    def store_tree_patch(self, source_tree_hash, target_tree_hash, tool, patch_file):
+        key = get_tree_patch_key(source_tree_hash, target_tree_hash, tool)
+        self.store(key, patch_file, tree_kind, source=source_tree_hash, target=target_tree_hash, tool=tool)
+        return key
+
+    def find_patch_chain(self, source_tree_hash, target_tree_hash, tool):
+        # Cheapest chain of stored patches from the source to the target tree, every stored patch is an edge
+        # weighted by its size. Returns the keys of the patches in the order in which they are applied.
+        edges = {}
+        with self.lock:
+            for key, entry in self.index.items():
+                if entry["kind"] == tree_kind and entry["tool"] == tool and self.has_object(key):
+                    edges.setdefault(entry["source"], []).append((entry["size"], entry["target"], key))
+
+        queue = [(0, source_tree_hash, [])]
+        visited = set()
+        while queue:
+            size, tree_hash, chain = heapq.heappop(queue)
+            if tree_hash == target_tree_hash:
+                return chain, size
+            if tree_hash in visited:
+                continue
+            visited.add(tree_hash)
+            for patch_size, next_tree_hash, key in edges.get(tree_hash, []):
+                if next_tree_hash not in visited:
+                    heapq.heappush(queue, (size + patch_size, next_tree_hash, chain + [key]))
+        return None, 0
+
+    def tree_patch_entry(self, key):
+        return self.index[key]
+
+    def evict(self):
+        # Least recently used objects go first until the cache fits into its limit again
+        if self.maximum_bytes is None:
+            return
+        total_bytes = sum(entry["size"] for entry in self.index.values())
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]["last_used"]):
+            if total_bytes <= self.maximum_bytes:
+                break
+            if os.path.exists(self.object_path(key)):
+                os.remove(self.object_path(key))
+            total_bytes -= entry["size"]
+            del self.index[key]
+            self.evicted_objects += 1
+
+    def close(self):
+        # Other runs may have used the cache in the meantime, so their index is merged under a lock
+        with open(self.cache_path + "/index.lock", "w") as lock_handler:
+            fcntl.flock(lock_handler, fcntl.LOCK_EX)
+            with self.lock:
+                for key, entry in self.read_index().items():
+                    if key not in self.index or self.index[key]["last_used"] < entry["last_used"]:
+                        self.index[key] = entry
+                self.index = dict((key, entry) for key, entry in self.index.items()
+                                  if os.path.isfile(self.object_path(key)))
+                self.evict()
+                temporary_path = self.index_path + ".tmp"
+                with open(temporary_path, "w") as file_handler:
+                    json.dump(self.index, file_handler)
+                os.replace(temporary_path, self.index_path)
+
+    def stats(self):
+        return {
+            "reused_deltas": self.reused_deltas,
+            "stored_deltas": self.stored_deltas,
+            "evicted_objects": self.evicted_objects,
+            "objects": len(self.index),
+            "cache_bytes": sum(entry["size"] for entry in self.index.values()),
+        }
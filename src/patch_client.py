@@ -0,0 +1,247 @@
+import concurrent.futures
+import contextlib
+import http.client
+import os
+import queue
+import re
+import struct
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from patch_container import PatchContainerReader, header_format
+
+
+# Entries which lie close to each other within the container are fetched with a single range request
+maximum_request_gap = 64 * 1024
+maximum_request_size = 1024 * 1024
+fetch_buffer_size = 256 * 1024
+# A broken connection is opened again and only the missing rest of a range is requested once more
+maximum_attempts = 3
+connection_timeout = 60
+
+# Operations of the plan whose entry carries a payload
+fetched_operations = ["new", "patch", "derive"]
+
+
+class ConnectionPool:
+    # Keeps idle connections to the server open, so every range request after the first one of a worker
+    # reuses its TCP connection
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.path = urllib.parse.quote(parts.path or "/")
+        self.idle_connections = queue.LifoQueue()
+        self.created_connections = 0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        try:
+            connection = self.idle_connections.get_nowait()
+        except queue.Empty:
+            connection = self.connection_class(self.netloc, timeout=connection_timeout)
+            with self.lock:
+                self.created_connections += 1
+        try:
+            yield connection
+        except BaseException:
+            connection.close()
+            raise
+        self.idle_connections.put(connection)
+
+    def close(self):
+        while not self.idle_connections.empty():
+            self.idle_connections.get_nowait().close()
+
+
+def parse_content_range(header):
+    # "bytes 0-27/1234" gives the first and the last byte and the size of the whole file
+    match = re.fullmatch(r"bytes (\d+)-(\d+)/(\d+)", header or "")
+    if match is None:
+        raise ValueError("The server sent an invalid Content-Range: {}".format(header))
+    return int(match.group(1)), int(match.group(2)), int(match.group(3))
+
+
+def group_entries(entries):
+    # Entries are taken in the given order, a new request is started whenever the next entry does not
+    # follow closely behind the last one or the request grew too large
+    requests = []
+    for entry in entries:
+        if requests:
+            last_entry = requests[-1][-1]
+            gap = entry.offset - (last_entry.offset + last_entry.size)
+            request_size = entry.offset + entry.size - requests[-1][0].offset
+            if 0 <= gap <= maximum_request_gap and request_size <= maximum_request_size:
+                requests[-1].append(entry)
+                continue
+        requests.append([entry])
+    return requests
+
+
+class RemotePatchContainer(PatchContainerReader):
+    # Patch container on a server which supports range requests. The header and the index are fetched first,
+    # every entry is only fetched once it is needed. Fetched ranges are written into a sparse file of the size
+    # of the container at their own offsets, so everything else works just like with a local container.
+    # Entries are fetched in the background by a pool of connections while the applier waits for single entries.
+    def __init__(self, url, connections=4):
+        self.url = url
+        self.pool = ConnectionPool(url)
+        self.etag = None
+        # Set once a server without range support sent the whole container
+        self.complete = False
+        self.fetched_bytes = 0
+        self.requests = 0
+        self.waited_seconds = 0.0
+        self.start_time = time.perf_counter()
+        self.finish_time = None
+        self.fetch_events = {}
+        self.fetch_errors = {}
+        self.state_lock = threading.Lock()
+
+        file_descriptor, self.local_path = tempfile.mkstemp(prefix="remote_patch_")
+        self.local_file = os.fdopen(file_descriptor, "r+b")
+        try:
+            header_size = struct.calcsize(header_format)
+            container_size = self.fetch_range(0, header_size)
+            if container_size is not None:
+                _, _, index_offset, index_length = struct.unpack(header_format, os.pread(
+                    self.local_file.fileno(), header_size, 0))
+                self.fetch_range(index_offset, index_offset + index_length)
+            super().__init__(self.local_path)
+        except BaseException:
+            self.local_file.close()
+            os.remove(self.local_path)
+            raise
+
+        # Descriptions of placed files name the server, not the temporary file
+        self.container_path = url
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=connections)
+
+    def fetch_range(self, start, end, entries=()):
+        # Writes the bytes from start to end into the local file. Returns the size of the whole container,
+        # or None if the server ignored the range and sent the whole container, which is complete afterwards.
+        position = start
+        pending_entries = list(entries)
+        for attempt in range(maximum_attempts):
+            headers = {"Range": "bytes={}-{}".format(position, end - 1)}
+            # Ranges of another version of the container would mix two patches
+            if self.etag is not None:
+                headers["If-Range"] = self.etag
+            try:
+                with self.pool.connection() as connection:
+                    connection.request("GET", self.pool.path, headers=headers)
+                    response = connection.getresponse()
+                    with self.state_lock:
+                        self.requests += 1
+                    if response.status == 200:
+                        # A server without range support sends the same version as a whole, another version
+                        # means that the If-Range did not match
+                        if self.etag is not None and response.getheader("ETag") != self.etag:
+                            response.read()
+                            raise ValueError("The container {} changed on the server".format(self.url))
+                        self.etag = response.getheader("ETag")
+                        self.local_file.truncate(0)
+                        self.write_response(response, 0, pending_entries)
+                        self.complete = True
+                        return None
+                    if response.status != 206:
+                        response.read()
+                        raise ValueError("The server answered {} {} for {}".format(response.status, response.reason,
+                                                                                   self.url))
+                    first_byte, _, container_size = parse_content_range(response.getheader("Content-Range"))
+                    if first_byte != position:
+                        response.read()
+                        raise ValueError("The server sent another range than requested for {}".format(self.url))
+                    if self.etag is None:
+                        self.etag = response.getheader("ETag")
+                        self.local_file.truncate(container_size)
+                    position = self.write_response(response, position, pending_entries)
+                if position < end:
+                    raise http.client.IncompleteRead(b"", end - position)
+                return container_size
+            except (OSError, http.client.HTTPException) as error:
+                if attempt + 1 == maximum_attempts:
+                    raise
+                # Every byte which arrived stays written, only the rest of the range is requested again
+                position = getattr(error, "position", position)
+                print("Fetching {} from byte {} failed, it is requested again".format(self.url, position))
+
+    def write_response(self, response, position, pending_entries):
+        # Entries are handed out as soon as their last byte was written, long before the whole range arrived.
+        # A broken response carries the position up to which the data arrived.
+        try:
+            data = response.read(fetch_buffer_size)
+            while data:
+                os.pwrite(self.local_file.fileno(), data, position)
+                position += len(data)
+                with self.state_lock:
+                    self.fetched_bytes += len(data)
+                while pending_entries and pending_entries[0].offset + pending_entries[0].size <= position:
+                    self.fetch_events[pending_entries.pop(0).path].set()
+                data = response.read(fetch_buffer_size)
+        except (OSError, http.client.HTTPException) as error:
+            error.position = position
+            raise
+        return position
+
+    def fetch_entries(self, entries):
+        entries = sorted(entries, key=lambda entry: entry.offset)
+        try:
+            self.fetch_range(entries[0].offset, entries[-1].offset + entries[-1].size, entries)
+        except Exception as error:
+            for entry in entries:
+                self.fetch_errors[entry.path] = error
+                self.fetch_events[entry.path].set()
+        with self.state_lock:
+            self.finish_time = time.perf_counter()
+
+    def prefetch(self, files):
+        # Starts fetching all given entries in this order, entries which were requested before are skipped
+        if self.complete:
+            return
+        entries = []
+        with self.state_lock:
+            for file in files:
+                entry = self.entry(file)
+                if entry.size > 0 and entry.path not in self.fetch_events:
+                    self.fetch_events[entry.path] = threading.Event()
+                    entries.append(entry)
+        for request_entries in group_entries(entries):
+            self.executor.submit(self.fetch_entries, request_entries)
+
+    def prefetch_plan(self, apply_plan):
+        self.prefetch([operation.path for operation in apply_plan if operation.operation in fetched_operations])
+
+    def payload(self, entry):
+        if entry.size > 0 and not self.complete:
+            self.prefetch([entry.path])
+            start_time = time.perf_counter()
+            self.fetch_events[entry.path].wait()
+            with self.state_lock:
+                self.waited_seconds += time.perf_counter() - start_time
+            if entry.path in self.fetch_errors:
+                raise ValueError("Entry {} could not be fetched: {}".format(entry.path,
+                                                                            self.fetch_errors[entry.path]))
+        return super().payload(entry)
+
+    def fetch_stats(self):
+        finish_time = self.finish_time or time.perf_counter()
+        return {
+            "url": self.url,
+            "requests": self.requests,
+            "connections": self.pool.created_connections,
+            "fetched_bytes": self.fetched_bytes,
+            "fetched_entries": len(self.fetch_events),
+            "seconds_fetching": round(finish_time - self.start_time, 6),
+            "seconds_waiting_for_entries": round(self.waited_seconds, 6),
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.pool.close()
+        super().close()
+        self.local_file.close()
+        os.remove(self.local_path)
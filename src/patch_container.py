@@ -0,0 +1,286 @@
+import argparse
+import collections
+import contextlib
+import io
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+from apply_plan import apply_plan_name, parse_apply_plan
+from compression import DecompressingReader, codecs_by_name, get_codec
+from file_placement import place_stream
+
+
+# Layout of a patch container:
+#   header:  magic | number of entries | offset of the index | length of the index
+#   payload: contiguous patch files and new files
+#   index:   one entry per file (operation | codec | path length | source path length | payload offset |
+#            payload size | size after decompression | hash of the target file) followed by the path
+#            and the source path
+# Containers of the first version have no codec and no size after decompression within their index.
+# The plan of the applier is one more entry, readers which do not know it skip it like any other operation.
+container_magic = b"DUPATCH2"
+legacy_container_magic = b"DUPATCH1"
+header_format = ">8sIQQ"
+entry_format = ">BBHHQQQ32s"
+legacy_entry_format = ">BHHQQ32s"
+
+operation_new = 1
+operation_modified = 2
+operation_deleted = 3
+operation_moved = 4
+operation_derived = 5
+operation_plan = 6
+
+copy_buffer_size = 1024 * 1024
+empty_hash = b"\0" * 32
+
+ContainerEntry = collections.namedtuple("ContainerEntry", ["operation", "codec", "path", "source_path", "offset",
+                                                           "size", "uncompressed_size", "target_hash"])
+
+
+def is_patch_container(patch_path):
+    if not os.path.isfile(patch_path):
+        return False
+    with open(patch_path, "rb") as file_handler:
+        return file_handler.read(len(container_magic)) in (container_magic, legacy_container_magic)
+
+
+def encode_path(path):
+    return path.encode("utf-8", "surrogateescape")
+
+
+def decode_path(data):
+    return bytes(data).decode("utf-8", "surrogateescape")
+
+
+class PatchContainerWriter:
+    def __init__(self, container_path):
+        self.file_handler = open(container_path, "wb")
+        self.file_handler.write(b"\0" * struct.calcsize(header_format))
+        self.entries = []
+
+    def add_entry(self, operation, path, source_path="", data_file=None, target_hash=None, codec=None,
+                  uncompressed_size=None):
+        offset = self.file_handler.tell()
+        if data_file is not None:
+            with open(data_file, "rb") as data_handler:
+                shutil.copyfileobj(data_handler, self.file_handler, copy_buffer_size)
+        size = self.file_handler.tell() - offset
+
+        # Payloads which were not compressed are stored as they are
+        if codec is None:
+            codec = codecs_by_name["none"]
+            uncompressed_size = size
+        target_hash = bytes.fromhex(target_hash) if target_hash else empty_hash
+        self.entries.append(ContainerEntry(operation, codec.identifier, path, source_path, offset, size,
+                                           uncompressed_size, target_hash))
+
+    def finish(self):
+        index_offset = self.file_handler.tell()
+        for entry in self.entries:
+            path = encode_path(entry.path)
+            source_path = encode_path(entry.source_path)
+            self.file_handler.write(struct.pack(entry_format, entry.operation, entry.codec, len(path),
+                                                len(source_path), entry.offset, entry.size, entry.uncompressed_size,
+                                                entry.target_hash))
+            self.file_handler.write(path + source_path)
+        index_length = self.file_handler.tell() - index_offset
+
+        self.file_handler.seek(0)
+        self.file_handler.write(struct.pack(header_format, container_magic, len(self.entries), index_offset,
+                                            index_length))
+        self.file_handler.close()
+
+
+class MemoryviewReader(io.RawIOBase):
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        length = min(len(target), len(self.view) - self.position)
+        target[:length] = self.view[self.position:self.position + length]
+        self.position += length
+        return length
+
+    def close(self):
+        # The mapping of the container can only be closed once no slice of it is left
+        self.view.release()
+        super().close()
+
+
+class PatchContainerReader:
+    # Opens a container with mmap. Every entry can be found by its path and its payload is handed out
+    # as a memoryview into the mapping, so nothing is copied until it is written to its destination.
+    streams_patches = True
+
+    def __init__(self, container_path):
+        self.container_path = container_path
+        with open(container_path, "rb") as file_handler:
+            self.data = mmap.mmap(file_handler.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.data)
+        # Every decompressing reader adds its numbers once it is closed, entries are read by several threads
+        self.decompressed_bytes = 0
+        self.decompression_seconds = 0.0
+        self.stats_lock = threading.Lock()
+
+        magic, number_of_entries, index_offset, index_length = struct.unpack_from(header_format, self.view, 0)
+        if magic not in (container_magic, legacy_container_magic):
+            raise ValueError("{} is not a patch container".format(container_path))
+
+        self.entries = []
+        self.entry_index = {}
+        position = index_offset
+        entry_size = struct.calcsize(entry_format if magic == container_magic else legacy_entry_format)
+        for _ in range(number_of_entries):
+            if magic == container_magic:
+                operation, codec, path_length, source_path_length, offset, size, uncompressed_size, target_hash = \
+                    struct.unpack_from(entry_format, self.view, position)
+            else:
+                operation, path_length, source_path_length, offset, size, target_hash = \
+                    struct.unpack_from(legacy_entry_format, self.view, position)
+                codec = codecs_by_name["none"].identifier
+                uncompressed_size = size
+            position += entry_size
+            path = decode_path(self.view[position:position + path_length])
+            position += path_length
+            source_path = decode_path(self.view[position:position + source_path_length])
+            position += source_path_length
+
+            entry = ContainerEntry(operation, codec, path, source_path, offset, size, uncompressed_size,
+                                   target_hash)
+            self.entries.append(entry)
+            self.entry_index[path] = entry
+
+    def entry(self, path):
+        return self.entry_index[path]
+
+    def payload(self, entry):
+        return self.view[entry.offset:entry.offset + entry.size]
+
+    def read_file_lists(self):
+        new_files = [entry.path for entry in self.entries if entry.operation == operation_new]
+        modified_files = [entry.path for entry in self.entries if entry.operation == operation_modified]
+        deleted_files = [entry.path for entry in self.entries if entry.operation == operation_deleted]
+        moved_files = [(entry.path, entry.source_path) for entry in self.entries if entry.operation == operation_moved]
+        derived_files = [(entry.path, entry.source_path) for entry in self.entries
+                         if entry.operation == operation_derived]
+        return new_files, modified_files, deleted_files, moved_files, derived_files
+
+    def read_apply_plan(self):
+        entry = self.entry_index.get(apply_plan_name)
+        if entry is None or entry.operation != operation_plan:
+            return None
+        with self.open_patch(apply_plan_name) as plan_handler:
+            return parse_apply_plan(io.TextIOWrapper(plan_handler))
+
+    def open_patch(self, file):
+        entry = self.entry(file)
+        codec = get_codec(entry.codec)
+        if codec.name == "none":
+            return io.BufferedReader(MemoryviewReader(self.payload(entry)), copy_buffer_size)
+
+        reader = DecompressingReader(MemoryviewReader(self.payload(entry)), codec, self.add_decompression_stats)
+        return io.BufferedReader(reader, copy_buffer_size)
+
+    @contextlib.contextmanager
+    def patch_file(self, file):
+        # External tools need a real file, therefore the payload is written into a temporary file
+        file_descriptor, temporary_file = tempfile.mkstemp(prefix="patch_")
+        try:
+            with os.fdopen(file_descriptor, "wb") as file_handler, self.open_patch(file) as patch_handler:
+                shutil.copyfileobj(patch_handler, file_handler, copy_buffer_size)
+            yield temporary_file
+        finally:
+            os.remove(temporary_file)
+
+    def target_hash(self, file):
+        target_hash = self.entry(file).target_hash
+        return target_hash.hex() if target_hash != empty_hash else None
+
+    def move_new_file(self, file, destination, output_hash=None):
+        with self.open_patch(file) as patch_handler:
+            method = place_stream(patch_handler, destination, output_hash)
+        return self.container_path + ":" + file, method
+
+    def add_decompression_stats(self, decompressed_bytes, seconds):
+        with self.stats_lock:
+            self.decompressed_bytes += decompressed_bytes
+            self.decompression_seconds += seconds
+
+    def decompression_stats(self):
+        with self.stats_lock:
+            return self.decompressed_bytes, self.decompression_seconds
+
+    def close(self):
+        self.view.release()
+        self.data.close()
+
+
+def convert_patch_directory(patch_directory, container_path, target_hashes=None, compressor=None):
+    # The legacy layout is read by the applier, therefore it is imported on demand
+    from patch_file_applier import PatchDirectory
+
+    new_files, modified_files, deleted_files, moved_files, derived_files = \
+        PatchDirectory(patch_directory).read_file_lists()
+
+    # Hashes of the target files are taken from the patch directory unless they are given
+    if target_hashes is None:
+        target_hashes = PatchDirectory(patch_directory).target_hashes
+
+    def add_data_entry(operation, file, source_file=""):
+        data_file = patch_directory + "/" + file
+        # Entries which were compressed while the patch was created carry their codec along
+        codec, uncompressed_size = None, None
+        if compressor is not None and compressor.entry_codec(data_file) is not None:
+            codec, uncompressed_size = compressor.entry_codec(data_file)
+        writer.add_entry(operation, file, source_path=source_file, data_file=data_file,
+                         target_hash=target_hashes.get(file), codec=codec, uncompressed_size=uncompressed_size)
+
+    writer = PatchContainerWriter(container_path)
+    for file in new_files:
+        add_data_entry(operation_new, file)
+    for file in modified_files:
+        add_data_entry(operation_modified, file)
+    for file in deleted_files:
+        writer.add_entry(operation_deleted, file)
+    for file, source_file in moved_files:
+        writer.add_entry(operation_moved, file, source_path=source_file, target_hash=target_hashes.get(file))
+    for file, source_file in derived_files:
+        add_data_entry(operation_derived, file, source_file)
+    if os.path.isfile(patch_directory + "/" + apply_plan_name):
+        writer.add_entry(operation_plan, apply_plan_name, data_file=patch_directory + "/" + apply_plan_name)
+    writer.finish()
+
+    return len(writer.entries)
+
+
+def check_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-p", "--patch_path", required=True,
+                        help="Patch directory in the legacy layout which shall be converted")
+    parser.add_argument("-o", "--container_path", required=True,
+                        help="Path of the patch container which will be created")
+
+    args = parser.parse_args()
+    if not os.path.isdir(args.patch_path):
+        print("The path {} is not a patch directory! Processing stops!".format(args.patch_path))
+        exit(1)
+
+    return args
+
+
+if __name__ == "__main__":
+    args = check_arguments()
+
+    print("Converting {} into a patch container!".format(args.patch_path))
+    number_of_entries = convert_patch_directory(patch_directory=args.patch_path, container_path=args.container_path)
+    print("Patch container {} with {} entries was created!".format(args.container_path, number_of_entries))
@@ -1,25 +1,69 @@
 import argparse
+import concurrent.futures
+import contextlib
+import copy
+import errno
+import hashlib
+import io
 import json
 import os
 import re
 import time
 import shutil
 import subprocess
+import tempfile
+import threading
 import zipfile
 
-supported_tools = ["bspatch", "xdelta", "rsync"]
+from apply_plan import PlanOperation, apply_plan_name, compile_apply_plan, find_directory_changes_of_update, \
+    group_apply_plan, parse_apply_plan, print_apply_plan_summary, read_apply_plan
+from file_fingerprints import HashingFileWriter, calculate_file_hash, calculate_mapped_file_hash, update_hash_from_file
+from file_placement import create_output_file, finish_output_file, place_file, place_stream, placement_stats, \
+    reset_placement_stats
+from instrumentation import call_process, enable_tracing, file_span, finish_process, \
+    save_instrumentation, span, start_process, wait_for_process
+from journal import Journal
+from memory_scheduler import MemoryBudget, MemoryScheduler, get_default_budget
+from patch_container import PatchContainerReader, is_patch_container
+from patch_graph import is_patch_route, read_route
+from segmented_diff import apply_segmented_patch_file, is_segmented_patch_file
+from tree_snapshot import scan_tree
+from update_api import ApplicationResult, ArgumentError
+
+supported_tools = ["bspatch", "xdelta", "rsync", "cdc", "text", "auto"]
+
+# Patches of the adaptive creator mix several tools, "auto" recognizes the tool of every patch by its magic bytes
+patch_magics = [
+    (b"BSDIFF40", "bspatch"),
+    (b"ENDSLEY/BSDIFF43", "bspatch"),
+    (b"\xd6\xc3\xc4", "xdelta"),
+    (b"RSDELTA1", "rsync"),
+    (b"CDCPATCH", "cdc"),
+    (b"LINEDIF1", "text"),
+]
+patch_header_size = max(len(magic) for magic, _ in patch_magics)
+# The text creator diffs every file which is not text with bsdiff, so the tool of every text patch is recognized too
+detected_tools = ["auto", "text"]
+
+# bspatch needs random access to its patch file, all other tools read the patch front to back
+streamed_tools = ["xdelta", "rsync", "cdc", "text"]
+copy_buffer_size = 1024 * 1024
 
 
 def is_path_valid(path_to_check):
     if os.path.exists(path_to_check):
         print("Path: {} exists".format(path_to_check))
         return True
-    else:
-        print("The path {} does not exist! Processing stops!".format(path_to_check))
-        return False
+    return False
 
 
-def check_arguments():
+def get_resumable_paths(original_version_path):
+    # Journal, staged files and backups of a resumable update are stored next to the original version
+    original_version_path = original_version_path.rstrip("/")
+    return original_version_path + ".journal", original_version_path + ".staging", original_version_path + ".backup"
+
+
+def create_argument_parser():
     parser = argparse.ArgumentParser()
 
     # Required Arguments
@@ -28,7 +72,8 @@ def check_arguments():
     parser.add_argument("-m", "--modified_version_path", required=True,
                         help="This path contains the modified version of the directory/file/archive")
     parser.add_argument("-p", "--patch_path", required=True,
-                        help="The created diff file will be saved within this path")
+                        help="The created diff file will be saved within this path. An http:// or https:// URL "
+                             "of a patch container fetches only the entries which are needed from patch_server.py")
 
     # Optional Arguments
     parser.add_argument("-t", "--tool",
@@ -45,8 +90,51 @@ def check_arguments():
                         help="Set this flag if the given patch file/directory is compressed",
                         action='store_true',
                         default=False)
+    parser.add_argument("-n", "--jobs",
+                        help="Number of files which are patched in parallel. Default is the number of CPU cores",
+                        type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument("-d", "--deadline",
+                        help="Maximum number of seconds a single patch may take before it is aborted and marked as failed",
+                        type=float,
+                        default=None)
+    parser.add_argument("-r", "--resumable",
+                        help="Set this flag to stage all changes and record the progress within a journal, so that an "
+                             "interrupted update can be continued by starting it again with the same arguments",
+                        action='store_true',
+                        default=False)
+    parser.add_argument("-u", "--rollback",
+                        help="Set this flag to undo an interrupted update which was started with the resumable flag",
+                        action='store_true',
+                        default=False)
+    parser.add_argument("-v", "--verify_tree",
+                        help="Set this flag to compare the hashes of all files of the patched and the modified version",
+                        action='store_true',
+                        default=False)
+    parser.add_argument("-T", "--trace_path",
+                        help="Record the duration of every phase and every file and save them as a Chrome trace "
+                             "within this path. The summary is added to the JSON-file as well",
+                        default=None)
+    parser.add_argument("-M", "--memory_budget",
+                        help="Memory in MB which all parallel patches may use together. "
+                             "Default is 80 percent of the memory which is available right now",
+                        type=int,
+                        default=None)
+    parser.add_argument("-N", "--dry_run",
+                        help="Set this flag to print the operations of the update and the projected I/O volume "
+                             "without touching the original version",
+                        action='store_true',
+                        default=False)
+    parser.add_argument("-F", "--fetch_connections",
+                        help="Number of connections which fetch the entries of a remote patch container in parallel",
+                        type=int,
+                        default=4)
+
+    return parser
+
 
-    args = parser.parse_args()
+def validate_arguments(args):
+    # Raises an ArgumentError for every invalid option, so the library can use the same checks
     if args.file:
         print("Single file flag is set. Patch applying will be executed for a single file!")
         if os.path.isfile(args.original_version_path):
@@ -56,19 +144,18 @@ def check_arguments():
             else:
                 print("A problem occurred while checking the paths of the files!")
                 print("Either the given path does not lead to a file, the file does not exist or the filename is mispelled!")
-                print("Problem occurred while checking the following path: {}".format(args.modified_version_path))
-                exit(1)
+                raise ArgumentError("Problem occurred while checking the following path: {}".format(
+                    args.modified_version_path), 1)
         else:
             print("A problem occurred while checking the paths of the files!")
             print("Either the given path does not lead to a file, the file does not exist or the filename is mispelled!")
-            print("Problem occurred while checking the following path: {}".format(args.original_version_path))
-            exit(1)
+            raise ArgumentError("Problem occurred while checking the following path: {}".format(
+                args.original_version_path), 1)
     else:
         print("Single file flag is NOT set. Patch files are applied for a directory or archive!")
-        if not is_path_valid(args.original_version_path):
-            exit(1)
-        if not is_path_valid(args.modified_version_path):
-            exit(1)
+        for path in [args.original_version_path, args.modified_version_path]:
+            if not is_path_valid(path):
+                raise ArgumentError("The path {} does not exist! Processing stops!".format(path), 1)
 
     if args.compress:
         print("Flag for compression is set. Patch files are stored within an archive.")
@@ -76,67 +163,652 @@ def check_arguments():
         print("Flag for compression is NOT set. Patch files are stored within a directory.")
 
     if args.tool not in supported_tools:
-        print("Chosen tool is not supported by this program! Processing stops!")
-        exit(2)
+        raise ArgumentError("Chosen tool is not supported by this program! Processing stops!", 2)
     else:
         print("{} was chosen as the differential update tool for processing!".format(args.tool))
 
+    if args.jobs < 1:
+        raise ArgumentError("At least one job is needed for applying the patch files! Processing stops!", 2)
+    else:
+        print("Patch files are applied with {} parallel jobs!".format(args.jobs))
+
+    if args.memory_budget is not None and args.memory_budget < 1:
+        raise ArgumentError("The memory budget needs at least 1 MB! Processing stops!", 2)
+
+    if args.dry_run and (args.file or args.rollback):
+        raise ArgumentError("A dry run is only possible for updates of directories! Processing stops!", 2)
+
+    if args.rollback and not os.path.exists(get_resumable_paths(args.original_version_path)[0]):
+        raise ArgumentError("There is no interrupted update of {} which could be rolled back!".format(
+            args.original_version_path), 1)
+
+    if is_patch_route(args.patch_path):
+        if args.file or args.compress:
+            raise ArgumentError("Routes of the patch graph are only applied to directories and are never compressed! "
+                                "Processing stops!", 2)
+        print("{} is a route of the patch graph! Its steps are applied one after another!".format(args.patch_path))
+
+    if is_patch_url(args.patch_path):
+        if args.file or args.compress:
+            raise ArgumentError("Remote patches are only fetched as patch containers for directories! "
+                                "Processing stops!", 2)
+        if args.fetch_connections < 1:
+            raise ArgumentError("At least one connection is needed for fetching the patch! Processing stops!", 2)
+        print("Entries of {} are fetched with {} parallel connections!".format(args.patch_path,
+                                                                             args.fetch_connections))
+
+
+def check_arguments():
+    args = create_argument_parser().parse_args()
+    try:
+        validate_arguments(args)
+    except ArgumentError as error:
+        print(error)
+        exit(error.exit_code)
+
     return args
 
 
-def update_original_directory(modified_files, original_version_path, patch_path, tool):
-    failed_patches = []
+def detect_patch_tool(header):
+    for magic, tool in patch_magics:
+        if header.startswith(magic):
+            return tool
+    return None
+
+
+def read_patch_header(patch_file):
+    with open(patch_file, "rb") as file_handler:
+        return file_handler.read(patch_header_size)
 
-    for file in modified_files:
-        modified_file_path = original_version_path + "/" + file
-        patch_file_path = patch_path + "/" + file
-        
+
+def resolve_patch_tool(tool, header, patch_name):
+    if tool == "text":
+        return "text" if detect_patch_tool(header) == "text" else "bspatch"
+    if tool != "auto":
+        return tool
+    detected_tool = detect_patch_tool(header)
+    if detected_tool is None:
+        print("The tool which created {} could not be recognized!".format(patch_name))
+    return detected_tool
+
+
+def apply_patch_file(original_version_file, patch_file, output_file, tool, timeout=None, output_hash=None):
+    tool = resolve_patch_tool(tool, read_patch_header(patch_file), patch_file)
+    if tool is None:
+        return 1
+
+    with file_span("patch", file=output_file, tool=tool) as patch_span:
+        patch_span.record_size("original_bytes", original_version_file)
+        patch_span.record_size("patch_bytes", patch_file)
         return_value = 0
         if tool == "bspatch":
-            return_value = subprocess.call(["bspatch", modified_file_path, modified_file_path, patch_file_path])
+            return_value = call_process(["bspatch", original_version_file, output_file, patch_file],
+                                        timeout=timeout)
         elif tool == "xdelta":
-            return_value = subprocess.call(["xdelta3", "-fd", "-s",modified_file_path, patch_file_path, modified_file_path])        
-        
-        if return_value > 0:
-            print("Patch failed for the following file: {}".format(modified_file_path))
-            failed_patches.append(modified_file_path)
+            return_value = call_process(["xdelta3", "-fd", "-s", original_version_file, patch_file, output_file],
+                                        timeout=timeout)
+        elif tool == "rsync":
+            # NumPy is only needed by the built-in engines, therefore they are imported on demand
+            from rsync_delta import apply_delta_file
+            try:
+                apply_delta_file(original_version_file, patch_file, output_file, output_hash)
+            except ValueError as error:
+                print("Delta {} could not be applied: {}".format(patch_file, error))
+                return_value = 1
+        elif tool == "cdc":
+            from chunk_store import apply_chunk_patch_file
+            try:
+                return_value = apply_chunk_patch_file(original_version_file, patch_file, output_file, output_hash)
+            except ValueError as error:
+                print("Chunk patch {} could not be applied: {}".format(patch_file, error))
+                return_value = 1
+        elif tool == "text":
+            from line_diff import apply_line_patch_file
+            try:
+                return_value = apply_line_patch_file(original_version_file, patch_file, output_file, output_hash)
+            except ValueError as error:
+                print("Line patch {} could not be applied: {}".format(patch_file, error))
+                return_value = 1
+
+        # External tools write the output on their own, so it has to be read once to get its hash
+        if return_value == 0 and output_hash is not None and tool in ["bspatch", "xdelta"]:
+            update_hash_from_file(output_hash, output_file)
+        patch_span.set(exit_code=return_value)
+        patch_span.record_size("output_bytes", output_file)
+        return return_value
+
+
+def kill_process(process, timed_out):
+    timed_out.set()
+    process.kill()
+
+
+def feed_process(patch_handler, process_input):
+    try:
+        shutil.copyfileobj(patch_handler, process_input, copy_buffer_size)
+    except BrokenPipeError:
+        # The process stopped early, its return code tells why
+        pass
+    finally:
+        process_input.close()
+
+
+def apply_patch_stream(original_version_file, patch_handler, output_file, tool, timeout=None, output_hash=None):
+    # The header is only peeked at, so the tool still reads the patch from its start
+    tool = resolve_patch_tool(tool, patch_handler.peek(patch_header_size)[:patch_header_size], output_file)
+    if tool is None:
+        return 1
+
+    with file_span("patch", file=output_file, tool=tool, streamed=True) as patch_span:
+        patch_span.record_size("original_bytes", original_version_file)
+        return_value = 0
+        if tool == "xdelta":
+            # xdelta3 reads the patch from its stdin and writes the result to its stdout, which passes through
+            # here so that it is hashed on its way into the temporary output of the placement layer
+            with open(output_file, "wb") as output_handler:
+                if output_hash is not None:
+                    output_handler = HashingFileWriter(output_handler, output_hash)
+                process = start_process(["xdelta3", "-d", "-c", "-s", original_version_file],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                feeder = threading.Thread(target=feed_process, args=(patch_handler, process.stdin))
+                feeder.start()
+                timed_out = threading.Event()
+                timer = None
+                if timeout is not None:
+                    timer = threading.Timer(timeout, kill_process, args=(process, timed_out))
+                    timer.start()
+
+                data = process.stdout.read(copy_buffer_size)
+                while data:
+                    output_handler.write(data)
+                    data = process.stdout.read(copy_buffer_size)
+                return_value = wait_for_process(process, patch_span)
+                feeder.join()
+                if timer is not None:
+                    timer.cancel()
+
+            # A cancelled job killed the process, its output is incomplete and removed by the caller
+            finish_process(process)
+            if timed_out.is_set():
+                raise subprocess.TimeoutExpired(process.args, timeout)
+            if return_value != 0:
+                return_value = 1
+        elif tool == "rsync":
+            from rsync_delta import apply_delta_stream_file
+            try:
+                apply_delta_stream_file(original_version_file, patch_handler, output_file, output_hash)
+            except ValueError as error:
+                print("Delta for {} could not be applied: {}".format(output_file, error))
+                return_value = 1
+        elif tool == "cdc":
+            from chunk_store import apply_chunk_patch_stream_file
+            try:
+                return_value = apply_chunk_patch_stream_file(original_version_file, patch_handler, output_file, output_hash)
+            except ValueError as error:
+                print("Chunk patch for {} could not be applied: {}".format(output_file, error))
+                return_value = 1
+        elif tool == "text":
+            from line_diff import apply_line_patch_stream_file
+            try:
+                return_value = apply_line_patch_stream_file(original_version_file, patch_handler, output_file,
+                                                            output_hash)
+            except ValueError as error:
+                print("Line patch for {} could not be applied: {}".format(output_file, error))
+                return_value = 1
+        patch_span.set(exit_code=return_value)
+        patch_span.record_size("output_bytes", output_file)
+        return return_value
+
+
+def is_output_hash_valid(file_path, expected_hash, output_hash):
+    # Files without a hash within the patch are never passed here, the application reports them as unverified
+    if output_hash.hexdigest() != expected_hash:
+        print("The hash of {} does not match the hash within the patch!".format(file_path))
+        return False
+    return True
+
+
+def update_original_file(file, original_version_path, patch_source, tool, timeout=None, source_file=None,
+                         output_path=None):
+    modified_file_path = (output_path or original_version_path) + "/" + file
+    expected_hash = patch_source.target_hash(file)
+    output_hash = hashlib.sha256() if expected_hash else None
+
+    # Derived files are patched from a file at another path of the original version. Staged files are written
+    # into another directory, which is built up here, within the original version the plan created every directory.
+    source_file_path = original_version_path + "/" + (file if source_file is None else source_file)
+    if output_path is not None:
+        os.makedirs(os.path.dirname(modified_file_path), exist_ok=True)
+
+    # The tool never writes onto the file it reads from, the result replaces the destination with a rename
+    # once it was verified, so a failed patch leaves the old file untouched
+    output_file_path = create_output_file(modified_file_path)
+    mode_path = modified_file_path if os.path.exists(modified_file_path) else source_file_path
+    return_value = 1
+    try:
+        # Adaptive and text patches mix tools, and only some of them can read their patch as a stream
+        if tool in detected_tools and patch_source.streams_patches:
+            with patch_source.open_patch(file) as patch_handler:
+                tool = resolve_patch_tool(tool, patch_handler.peek(patch_header_size)[:patch_header_size],
+                                          modified_file_path) or tool
+        if patch_source.streams_patches and tool in streamed_tools:
+            # The entry is read while it is applied, so it never has to be written to disk first
+            with patch_source.open_patch(file) as patch_handler:
+                return_value = apply_patch_stream(original_version_file=source_file_path,
+                                                  patch_handler=patch_handler,
+                                                  output_file=output_file_path,
+                                                  tool=tool,
+                                                  timeout=timeout,
+                                                  output_hash=output_hash)
         else:
-            print("Patch applied for the following file: {}".format(modified_file_path))
+            with patch_source.patch_file(file) as patch_file_path:
+                return_value = apply_patch_file(original_version_file=source_file_path,
+                                                patch_file=patch_file_path,
+                                                output_file=output_file_path,
+                                                tool=tool,
+                                                timeout=timeout,
+                                                output_hash=output_hash)
+        if return_value == 0 and expected_hash is not None and \
+                not is_output_hash_valid(modified_file_path, expected_hash, output_hash):
+            return_value = 1
+    except subprocess.TimeoutExpired:
+        print("Patching {} took longer than {} seconds and was aborted!".format(modified_file_path, timeout))
+        return_value = 1
+    finally:
+        finish_output_file(output_file_path, modified_file_path, return_value == 0, mode_path)
+
+    if return_value > 0:
+        print("Patch failed for the following file: {}".format(modified_file_path))
+    else:
+        print("Patch applied for the following file: {}".format(modified_file_path))
+    return return_value
+
+
+def estimate_patch_memory(memory_budget, tool, original_version_file):
+    if memory_budget is None:
+        return None
+    return memory_budget.estimate(tool, original_version_file)
+
+
+def move_file_within_original_version(file, source_file, original_version_path, keep_source, expected_hash=None):
+    source_file_path = original_version_path + "/" + source_file
+    target_file_path = original_version_path + "/" + file
+
+    with file_span("move", file=target_file_path, copied=keep_source) as move_span:
+        method = place_file(source_file_path, target_file_path, keep_source)
+        if keep_source:
+            print("{} was copied to {} ({})".format(source_file_path, target_file_path, method))
+        else:
+            print("{} was moved to {} ({})".format(source_file_path, target_file_path, method))
+        move_span.set(method=method)
+        move_span.record_size("bytes", target_file_path)
+
+        # Nothing is written while moving, so the file has to be read once to verify it
+        if expected_hash is not None and calculate_file_hash(target_file_path) != expected_hash:
+            print("The hash of {} does not match the hash within the patch!".format(target_file_path))
+            return 1
+    return 0
+
+
+def apply_directory_operation(operation, original_version_path):
+    directory_path = original_version_path + operation.path
+    # An interrupted or repeated run may find the directory as it should be already
+    if operation.operation == "mkdir":
+        try:
+            os.mkdir(directory_path)
+            print("New directory created: {}".format(directory_path))
+        except FileExistsError:
+            # A file at the path means the plan did not clear it, writing into it would fail later on anyway
+            if not os.path.isdir(directory_path):
+                raise
+    elif operation.operation == "rmdir":
+        try:
+            os.rmdir(directory_path)
+            print("The following directory does not exist within the modified version and was deleted: {}".format(
+                directory_path))
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            if error.errno != errno.ENOTEMPTY:
+                raise
+            print("{} still contains files which are not part of the patch and was kept!".format(directory_path))
+
+
+def apply_plan_operation(operation, original_version_path, patch_source, tool, timeout=None):
+    if operation.operation == "remove":
+        remove_file_from_original_version(operation.path, original_version_path)
+        return 0
+    if operation.operation in ("move", "copy"):
+        return move_file_within_original_version(operation.path, operation.source_path, original_version_path,
+                                                 operation.operation == "copy",
+                                                 patch_source.target_hash(operation.path))
+    if operation.operation == "derive":
+        return update_original_file(operation.path, original_version_path, patch_source, tool, timeout,
+                                    operation.source_path)
+    if operation.operation == "patch":
+        return update_original_file(operation.path, original_version_path, patch_source, tool, timeout)
+    return move_file_to_original_version(operation.path, original_version_path, patch_source)
+
+
+def estimate_operation_memory(memory_budget, tool, operation, original_version_path):
+    if operation.operation == "patch":
+        return estimate_patch_memory(memory_budget, tool, original_version_path + "/" + operation.path)
+    if operation.operation == "derive":
+        return estimate_patch_memory(memory_budget, tool, original_version_path + "/" + operation.source_path)
+    return None
+
+
+def run_apply_plan(plan, original_version_path, patch_source, tool, jobs=None, timeout=None, memory_budget=None):
+    # Every step of the plan starts once the step before it finished. Files of one step run in parallel,
+    # directories are created and removed one after another in the order of the plan.
+    failed_patches = []
+
+    for group, operations in group_apply_plan(plan):
+        if group is None:
+            for operation in operations:
+                apply_directory_operation(operation, original_version_path)
+            continue
+
+        results = []
+        with MemoryScheduler(max_workers=jobs or os.cpu_count() or 1, memory_budget=memory_budget) as executor:
+            for operation in operations:
+                results.append((operation, executor.submit(apply_plan_operation, operation, original_version_path,
+                                                           patch_source, tool, timeout,
+                                                           memory=estimate_operation_memory(memory_budget, tool,
+                                                                                            operation,
+                                                                                            original_version_path))))
+
+        # Errors while moving or removing files are raised, failed patches are collected
+        for operation, result in results:
+            if result.result() > 0:
+                failed_patches.append(original_version_path + "/" + operation.path)
     print("Number of files which were not patched successfully: {}".format(len(failed_patches)))
 
+    return failed_patches
+
+
+def get_apply_plan(patch_source, original_version_path, new_files, modified_files, deleted_files, moved_files,
+                   derived_files):
+    apply_plan = patch_source.read_apply_plan()
+    if apply_plan is not None:
+        return apply_plan
+
+    # Patches of older versions carry no plan, it is compiled from their file lists and one scan of the
+    # original version. The I/O volume of such a plan is unknown.
+    print("The patch carries no plan! It is compiled from the file lists and the original version!")
+    created_directories, removed_directories = find_directory_changes_of_update(scan_tree(original_version_path),
+                                                                                new_files, deleted_files,
+                                                                                moved_files, derived_files)
+    return compile_apply_plan(new_files, modified_files, deleted_files, moved_files, derived_files,
+                              created_directories, removed_directories)
+
+
+def stage_file(file, original_version_path, patch_source, tool, staging_path, journal, timeout=None, source_file=None,
+               new_file=False):
+    # Files which an interrupted run already wrote into the staging directory are kept as they are
+    staged_file_path = staging_path + "/" + file
+    record = journal.get("stage:" + file)
+    if record is not None and os.path.exists(staged_file_path) and \
+            calculate_file_hash(staged_file_path) == record["output_hash"]:
+        print("{} was already staged by an earlier run".format(staged_file_path))
+        return 0
+
+    if new_file:
+        return_value = move_file_to_original_version(file, original_version_path, patch_source,
+                                                     output_path=staging_path)
+    else:
+        return_value = update_original_file(file, original_version_path, patch_source, tool, timeout, source_file,
+                                            output_path=staging_path)
+
+    if return_value == 0:
+        output_hash = patch_source.target_hash(file) or calculate_file_hash(staged_file_path)
+        journal.record("stage:" + file, output_hash=output_hash)
+    return return_value
+
+
+def stage_all_changes(new_files, modified_files, derived_files, original_version_path, patch_source, tool,
+                      staging_path, journal, jobs=None, timeout=None, memory_budget=None):
+    # Every file which has to be written is created within the staging directory first,
+    # the original version stays untouched until all of them were created successfully
+    failed_patches = []
+
+    results = {}
+    with MemoryScheduler(max_workers=jobs or os.cpu_count() or 1, memory_budget=memory_budget) as executor:
+        for file in modified_files:
+            results[file] = executor.submit(stage_file, file, original_version_path, patch_source, tool, staging_path,
+                                            journal, timeout,
+                                            memory=estimate_patch_memory(memory_budget, tool,
+                                                                         original_version_path + "/" + file))
+        for file, source_file in derived_files:
+            results[file] = executor.submit(stage_file, file, original_version_path, patch_source, tool, staging_path,
+                                            journal, timeout, source_file,
+                                            memory=estimate_patch_memory(memory_budget, tool,
+                                                                         original_version_path + "/" + source_file))
+        for file in new_files:
+            results[file] = executor.submit(stage_file, file, original_version_path, patch_source, tool, staging_path,
+                                            journal, timeout, None, True)
+
+    for file in modified_files + [file for file, _ in derived_files] + new_files:
+        if results[file].result() > 0:
+            failed_patches.append(original_version_path + "/" + file)
+    print("Number of files which were not staged successfully: {}".format(len(failed_patches)))
+
+    return failed_patches
+
+
+def create_commit_operations(apply_plan):
+    # The commit follows the plan, except that every written file was staged before and only has to be placed
+    commit_kinds = {"move": "move", "copy": "move", "remove": "remove", "derive": "place", "patch": "place",
+                    "new": "place", "mkdir": "mkdir", "rmdir": "rmdir"}
+    operations = []
+    for operation in apply_plan:
+        source_file = operation.source_path if operation.operation in ("move", "copy") else None
+        operations.append((commit_kinds[operation.operation], operation.path, source_file,
+                           operation.operation == "copy"))
+    return operations
+
+
+def back_up_file(file_path, backup_file_path):
+    # Files which are replaced or removed are kept until the whole update was committed
+    if os.path.exists(file_path) and not os.path.exists(backup_file_path):
+        os.makedirs(os.path.dirname(backup_file_path), exist_ok=True)
+        os.replace(file_path, backup_file_path)
+
+
+def commit_operation(operation, original_version_path, staging_path, backup_path):
+    kind, file, source_file, keep_source = operation
+    file_path = original_version_path + "/" + file
+    backup_file_path = backup_path + "/" + file
+
+    # Every operation checks what was already done, so an operation which was interrupted can simply be repeated
+    if kind == "place":
+        staged_file_path = staging_path + "/" + file
+        if os.path.exists(staged_file_path):
+            back_up_file(file_path, backup_file_path)
+            os.replace(staged_file_path, file_path)
+            print("{} was placed at {}".format(staged_file_path, file_path))
+    elif kind == "remove":
+        back_up_file(file_path, backup_file_path)
+        print("{} was removed from the original version".format(file_path))
+    elif kind == "move":
+        source_file_path = original_version_path + "/" + source_file
+        if keep_source or os.path.exists(source_file_path):
+            back_up_file(file_path, backup_file_path)
+            move_file_within_original_version(file, source_file, original_version_path, keep_source)
+    elif kind in ("mkdir", "rmdir"):
+        apply_directory_operation(PlanOperation(kind, file, "", 0, 0), original_version_path)
+
+
+def commit_staged_changes(operations, original_version_path, staging_path, backup_path, journal):
+    journal.record("commit", state="started")
+    for index, operation in enumerate(operations):
+        unit = "operation:{}".format(index)
+        record = journal.get(unit)
+        if record is not None and record["state"] == "done":
+            continue
+
+        file_path = original_version_path + "/" + operation[1]
+        had_target = record["had_target"] if record is not None else os.path.exists(file_path)
+        journal.record(unit, state="started", operation=list(operation), had_target=had_target)
+        commit_operation(operation, original_version_path, staging_path, backup_path)
+        journal.record(unit, state="done", operation=list(operation), had_target=had_target)
+    journal.record("commit", state="done")
+
+
+def roll_back_staged_changes(original_version_path, staging_path, backup_path, journal):
+    # Operations are undone in reverse order, the backups bring back every replaced or removed file
+    operation_units = [unit for unit in journal.records if unit.startswith("operation:")]
+    operation_units.sort(key=lambda unit: int(unit.split(":")[1]), reverse=True)
+    for unit in operation_units:
+        record = journal.get(unit)
+        kind, file, source_file, keep_source = record["operation"]
+        file_path = original_version_path + "/" + file
+        backup_file_path = backup_path + "/" + file
+
+        # Removed directories come back before the files within them, created ones go once they are empty
+        if kind == "rmdir":
+            os.makedirs(file_path, exist_ok=True)
+            print("{} was rolled back".format(file_path))
+            continue
+        if kind == "mkdir":
+            if not record["had_target"] and os.path.isdir(file_path) and not os.listdir(file_path):
+                os.rmdir(file_path)
+            print("{} was rolled back".format(file_path))
+            continue
 
-def get_directory_size(path):
-    size = 0
-    for root, dir, files in os.walk(path):
-        for file in files:
-            size += os.path.getsize(root + "/" + file)
-    return size
+        if kind == "move" and not keep_source:
+            source_file_path = original_version_path + "/" + source_file
+            if os.path.exists(file_path) and not os.path.exists(source_file_path):
+                os.replace(file_path, source_file_path)
+        elif kind in ("move", "place") and not record["had_target"]:
+            if os.path.exists(file_path) and (kind == "move" or not os.path.exists(staging_path + "/" + file)):
+                os.remove(file_path)
 
+        if os.path.exists(backup_file_path):
+            os.replace(backup_file_path, file_path)
+        print("{} was rolled back".format(file_path))
 
-def compare_original_and_modified_directories(original_version_path, modified_version_path):
-    old_version_size = get_directory_size(path=original_version_path)
-    modified_version_size = get_directory_size(path=modified_version_path)
+        # Directories which were only created for this file are removed again
+        directory_path = os.path.dirname(os.path.normpath(file_path))
+        while directory_path != os.path.normpath(original_version_path) and os.path.isdir(directory_path) and \
+                not os.listdir(directory_path):
+            os.rmdir(directory_path)
+            directory_path = os.path.dirname(directory_path)
 
-    if old_version_size != modified_version_size:
+    shutil.rmtree(staging_path, ignore_errors=True)
+    shutil.rmtree(backup_path, ignore_errors=True)
+    journal.remove()
+
+
+def list_directory_files(path):
+    files = {}
+    for root, _, file_names in os.walk(path):
+        for file_name in file_names:
+            file_path = root + "/" + file_name
+            files[os.path.relpath(file_path, path)] = file_path
+    return files
+
+
+def compare_files_by_hash(original_file_path, modified_file_path):
+    if os.path.getsize(original_file_path) != os.path.getsize(modified_file_path):
         return False
-    return True
+    return calculate_mapped_file_hash(original_file_path) == calculate_mapped_file_hash(modified_file_path)
+
+
+def verify_directory_trees(original_version_path, modified_version_path, jobs=None):
+    # Every file of both trees is hashed in parallel, the result lists each file which differs and why
+    original_files = list_directory_files(original_version_path)
+    modified_files = list_directory_files(modified_version_path)
+
+    mismatching_files = []
+    for file in sorted(modified_files.keys() - original_files.keys()):
+        mismatching_files.append("{} is missing".format(file))
+    for file in sorted(original_files.keys() - modified_files.keys()):
+        mismatching_files.append("{} should not exist".format(file))
+
+    common_files = sorted(original_files.keys() & modified_files.keys())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        results = [executor.submit(compare_files_by_hash, original_files[file], modified_files[file])
+                   for file in common_files]
+    for file, result in zip(common_files, results):
+        if not result.result():
+            mismatching_files.append("{} has a different content".format(file))
+
+    return mismatching_files
 
 
 def read_file(file_path):
+    with open(file_path, "r") as file_handler:
+        return parse_file_list(file_handler)
+
+
+def parse_file_list(file_handler):
     return_list = []
 
-    with open(file_path, "r") as file_handler:
+    line = file_handler.readline()
+    while line:
+        name, path = re.split(r" \| ", line)
+        path = path.replace("\n", "")
+
+        return_list.append(path + "/" + name)
         line = file_handler.readline()
-        while line:
-            name, path = re.split(r" \| ", line)
-            path = path.replace("\n", "")
 
-            return_list.append(path + "/" + name)
-            line = file_handler.readline()
+    return return_list
+
+
+def read_file_pairs(file_path):
+    return_list = []
+
+    # Patches of older versions do not contain these lists
+    if not os.path.exists(file_path):
+        return return_list
+
+    with open(file_path, "r") as file_handler:
+        return parse_file_pairs(file_handler)
+
+
+def parse_file_pairs(file_handler):
+    return_list = []
+
+    line = file_handler.readline()
+    while line:
+        name, path, source_name, source_path = re.split(r" \| ", line)
+        source_path = source_path.replace("\n", "")
+
+        return_list.append((path + "/" + name, source_path + "/" + source_name))
+        line = file_handler.readline()
 
     return return_list
 
 
+def read_file_hashes(file_path):
+    # Patches of older versions do not contain any hashes
+    if not os.path.exists(file_path):
+        return {}
+
+    with open(file_path, "r") as file_handler:
+        return parse_file_hashes(file_handler)
+
+
+def parse_file_hashes(file_handler):
+    file_hashes = {}
+
+    line = file_handler.readline()
+    while line:
+        name, path, file_hash = re.split(r" \| ", line)
+        file_hashes[path + "/" + name] = file_hash.replace("\n", "")
+        line = file_handler.readline()
+
+    return file_hashes
+
+
+def create_moved_and_derived_file_lists(patch_path):
+    moved_files = read_file_pairs(patch_path + "/" + "moved_files.txt")
+    derived_files = read_file_pairs(patch_path + "/" + "derived_files.txt")
+
+    return moved_files, derived_files
+
+
 def create_all_file_lists(patch_path):
     deleted_file = read_file(patch_path + "/" + "deleted_files.txt")
     new_files = read_file(patch_path + "/" + "new_files.txt")
@@ -145,139 +817,462 @@ def create_all_file_lists(patch_path):
     return new_files, modified_files, deleted_file
 
 
-def delete_empty_directories_of_original_version(original_version_path):
-    something_changed = True
-    while something_changed:
-        something_changed = False
-        for root, dirs, files in os.walk(original_version_path):
-            for dir in dirs:
-                dir_path = root + "/" + dir
-                if not os.listdir(dir_path):
-                    print("The following directory was empty and therefore deleted: {}".format(dir_path))
-                    something_changed = True
-                    os.rmdir(dir_path)
+class PatchDirectory:
+    # Patch in the layout of a directory: file lists as text files and one patch file or new file per path
+    streams_patches = False
 
+    def __init__(self, patch_path, keep_files=False):
+        self.patch_path = patch_path
+        self.keep_files = keep_files
+        self.target_hashes = read_file_hashes(patch_path + "/" + "target_hashes.txt")
 
-def remove_files_from_original_version(deleted_files, original_version_path):
-    for file in deleted_files:
-        old_version_file = original_version_path + "/" + file
-        os.remove(old_version_file)
-        print("{} was removed from the original version".format(old_version_file))
+    def read_file_lists(self):
+        new_files, modified_files, deleted_files = create_all_file_lists(patch_path=self.patch_path)
+        moved_files, derived_files = create_moved_and_derived_file_lists(patch_path=self.patch_path)
+        return new_files, modified_files, deleted_files, moved_files, derived_files
 
+    def read_apply_plan(self):
+        return read_apply_plan(self.patch_path + "/" + apply_plan_name)
 
-def move_files_to_original_version(new_files, original_version_path, patch_path):
-    for file in new_files:
-        file_path = re.split("/", file)
-        file_path = file_path[:-1]
+    @contextlib.contextmanager
+    def patch_file(self, file):
+        yield self.patch_path + "/" + file
 
-        path = ""
-        for f in file_path:
-            path += f + "/"
+    def target_hash(self, file):
+        return self.target_hashes.get(file)
 
-        new_file_from = patch_path + "/" + file
-        new_file_to = original_version_path + "/" + file
+    def move_new_file(self, file, destination, output_hash=None):
+        new_file_from = self.patch_path + "/" + file
+        # A staged apply may be rolled back, so the patch has to stay complete
+        method = place_file(new_file_from, destination, keep_source=self.keep_files, output_hash=output_hash)
+        return new_file_from, method
 
-        if os.path.exists(original_version_path + "/" + path):
-            shutil.move(src=new_file_from, dst=new_file_to)
-        else:
-            os.makedirs(original_version_path + "/" + path)
-            shutil.move(src=new_file_from, dst=new_file_to)
-        print("{} was moved to {}".format(new_file_from, new_file_to))
+    def close(self):
+        pass
 
 
-def apply_single_patch_file(original_version_path, modified_version_path, patch_path, tool):
-    #TODO: ADD implementation for xdelta3
-    # Subprocess call for xdelta3: xdelta3 -fd -s OLD, PATCHFILE, LOCATION_WHERE_TO_SAVE_FILE(location of old file)
-    subprocess.call([tool, original_version_path, modified_version_path, patch_path])
+class CompressedPatchArchive:
+    # Patch directory which is still stored within its zip archive. Entries are decompressed one at a time
+    # while they are applied, so the patch is never extracted as a whole.
+    streams_patches = True
 
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self.zip_file = zipfile.ZipFile(archive_path, "r")
+        self.members = set(self.zip_file.namelist())
+        self.target_hashes = dict(self.read_member_lines("target_hashes.txt", parse_file_hashes))
 
-if __name__ == "__main__":
-    # Step 1: Check which parameters were set
-    print("Checking which parameters were set for this script!")
-    args = check_arguments()
-    print("Checking of all parameters finished successfully! Processing continues")
+    def member_name(self, file):
+        return os.path.normpath(file).lstrip("/")
+
+    def read_member_lines(self, name, parse_function):
+        # Patches of older versions do not contain every list
+        if name not in self.members:
+            return []
+        with self.zip_file.open(name) as member_handler:
+            return parse_function(io.TextIOWrapper(member_handler))
+
+    def read_file_lists(self):
+        new_files = self.read_member_lines("new_files.txt", parse_file_list)
+        modified_files = self.read_member_lines("modified_files.txt", parse_file_list)
+        deleted_files = self.read_member_lines("deleted_files.txt", parse_file_list)
+        moved_files = self.read_member_lines("moved_files.txt", parse_file_pairs)
+        derived_files = self.read_member_lines("derived_files.txt", parse_file_pairs)
+        return new_files, modified_files, deleted_files, moved_files, derived_files
+
+    def read_apply_plan(self):
+        if apply_plan_name not in self.members:
+            return None
+        return self.read_member_lines(apply_plan_name, parse_apply_plan)
+
+    def open_patch(self, file):
+        return self.zip_file.open(self.member_name(file))
+
+    @contextlib.contextmanager
+    def patch_file(self, file):
+        # Tools which can not read a stream get a temporary file which only holds this single entry
+        file_descriptor, temporary_file = tempfile.mkstemp(prefix="patch_")
+        try:
+            with os.fdopen(file_descriptor, "wb") as file_handler, self.open_patch(file) as member_handler:
+                shutil.copyfileobj(member_handler, file_handler, copy_buffer_size)
+            yield temporary_file
+        finally:
+            os.remove(temporary_file)
+
+    def target_hash(self, file):
+        return self.target_hashes.get(file)
+
+    def move_new_file(self, file, destination, output_hash=None):
+        with self.open_patch(file) as member_handler:
+            method = place_stream(member_handler, destination, output_hash)
+        return self.archive_path + ":" + self.member_name(file), method
 
+    def close(self):
+        self.zip_file.close()
+
+
+def remove_file_from_original_version(file, original_version_path):
+    old_version_file = original_version_path + "/" + file
+    os.remove(old_version_file)
+    print("{} was removed from the original version".format(old_version_file))
+
+
+def move_file_to_original_version(file, original_version_path, patch_source, output_path=None):
+    new_file_to = (output_path or original_version_path) + "/" + file
+    expected_hash = patch_source.target_hash(file)
+    output_hash = hashlib.sha256() if expected_hash else None
+
+    # The plan created every directory of the original version, only the staging directory is built up here.
+    # Other workers may create the same directory at the same time.
+    if output_path is not None:
+        os.makedirs(os.path.dirname(new_file_to), exist_ok=True)
+    with file_span("copy", file=new_file_to) as copy_span:
+        new_file_from, method = patch_source.move_new_file(file, new_file_to, output_hash)
+        copy_span.set(method=method)
+        copy_span.record_size("bytes", new_file_to)
+    print("{} was moved to {} ({})".format(new_file_from, new_file_to, method))
+
+    if expected_hash is not None and not is_output_hash_valid(new_file_to, expected_hash, output_hash):
+        return 1
+    return 0
+
+
+def apply_single_patch_file(original_version_path, modified_version_path, patch_path, tool, jobs=None):
+    # tarfile and gzip are only needed for archives, therefore they are imported on demand
+    from archive_diff import apply_archive_patch_file, is_archive_patch_file
+
+    if is_archive_patch_file(patch_path):
+        # Archive patches rebuild the modified archive member by member
+        return apply_archive_patch_file(original_version_file=original_version_path,
+                                        patch_file=patch_path,
+                                        output_file=modified_version_path,
+                                        apply_function=lambda original_file, patch_file, output_file:
+                                            apply_patch_file(original_file, patch_file, output_file, tool))
+
+    if is_segmented_patch_file(patch_path):
+        # Segmented patch files are reconstructed segment by segment in parallel
+        return apply_segmented_patch_file(original_version_file=original_version_path,
+                                          patch_file=patch_path,
+                                          output_file=modified_version_path,
+                                          apply_function=lambda original_file, patch_file, output_file:
+                                              apply_patch_file(original_file, patch_file, output_file, tool),
+                                          jobs=jobs)
+
+    return apply_patch_file(original_version_file=original_version_path,
+                            patch_file=patch_path,
+                            output_file=modified_version_path,
+                            tool=tool)
+
+
+def locate_compressed_patch(patch_path, single_file_patching=False):
+    # Single patch files and patch containers are the only entry which is needed, so only that one is extracted
+    # next to the archive. Patch directories stay within the archive, their entries are streamed out of it.
+    if patch_path[-1] == "/":
+        patch_path = patch_path[:-1]
+
+    with span("extract_patch"), zipfile.ZipFile(patch_path + ".zip", 'r') as zip_ref:
+        if os.path.basename(patch_path) in zip_ref.namelist():
+            zip_ref.extract(os.path.basename(patch_path), os.path.dirname(patch_path) or ".")
+            return patch_path, None
+        if single_file_patching:
+            raise ArgumentError("{} does not contain the patch file {}! Processing stops!".format(
+                patch_path + ".zip", os.path.basename(patch_path)), 1)
+    return patch_path, patch_path + ".zip"
+
+
+def is_patch_url(patch_path):
+    return patch_path.startswith(("http://", "https://"))
+
+
+def open_patch_source(patch_path, compressed_patch_archive=None, keep_files=False, fetch_connections=4):
+    # Patches are either a single container file or a directory with one file per changed path
+    if is_patch_url(patch_path):
+        # The HTTP client is only needed for remote patches, therefore it is imported on demand
+        from patch_client import RemotePatchContainer
+        print("{} is a remote patch container! Only the needed entries are fetched!".format(patch_path))
+        return RemotePatchContainer(patch_path, fetch_connections)
+    if compressed_patch_archive:
+        print("Patch files are streamed out of {} without extracting it!".format(compressed_patch_archive))
+        return CompressedPatchArchive(compressed_patch_archive)
+    if is_patch_container(patch_path):
+        print("{} is a patch container! Patch files are read without extracting them!".format(patch_path))
+        return PatchContainerReader(patch_path)
+    return PatchDirectory(patch_path, keep_files=keep_files)
+
+
+def print_file_list(message, files):
+    print(message)
+    for file in files:
+        print("    {}".format(file))
+
+
+def apply_route_from_arguments(args):
+    # Every step of a route is a patch container which is applied on top of the result of the step before.
+    # The tree hash of the original version tells which steps are still missing, so an update which stopped
+    # between two steps continues with the next one.
+    original_version_path = args.original_version_path
+    route_path = args.patch_path.rstrip("/")
+    route = read_route(route_path)
+    steps = route["steps"]
+    stats = {"route_of_the_application": {"steps": len(steps), "applied_steps": 0}}
+    print("Steps of the route were created with {} and are applied with {}!".format(route["tool"],
+                                                                                 route["applier_tool"]))
+
+    fingerprint_cache = {}
+    with span("hash_original_version"):
+        tree_hash = scan_tree(original_version_path).tree_hash(fingerprint_cache)
+    source_hashes = [step["source_tree_hash"] for step in steps]
+    if tree_hash == route["target_tree_hash"]:
+        print("{} is already equal to the target of the route!".format(original_version_path))
+        return ApplicationResult(original_version_path, [], [], stats)
+    if tree_hash not in source_hashes:
+        print("{} is not a version on the route {}! Processing stops!".format(original_version_path, route_path))
+        return ApplicationResult(original_version_path, [original_version_path], [], stats)
+
+    first_step = source_hashes.index(tree_hash)
+    for number in range(first_step, len(steps)):
+        print("Step {} of {}: {} is applied".format(number + 1, len(steps), steps[number]["patch_file"]))
+        step_args = copy.copy(args)
+        step_args.patch_path = route_path + "/" + steps[number]["patch_file"]
+        step_args.tool = route["applier_tool"]
+        step_args.verify_tree = args.verify_tree and number == len(steps) - 1
+        result = apply_patch_from_arguments(step_args)
+        stats["step_{}_of_the_application".format(number + 1)] = result.stats
+        if result.failed_files or result.mismatching_files:
+            print("Step {} failed! Start the update again once the problem was solved".format(number + 1))
+            return ApplicationResult(original_version_path, result.failed_files, result.mismatching_files, stats)
+        stats["route_of_the_application"]["applied_steps"] += 1
+
+    if args.dry_run:
+        return ApplicationResult(original_version_path, [], [], stats)
+
+    # Written files were checked against their hashes, all others are covered by the hash of the whole tree
+    with span("hash_patched_version"):
+        tree_hash = scan_tree(original_version_path).tree_hash(fingerprint_cache)
+    if tree_hash != route["target_tree_hash"]:
+        print("The patched version does not match the target of the route!")
+        return ApplicationResult(original_version_path, [], [original_version_path], stats)
+    print("All {} steps of the route were applied!".format(len(steps) - first_step))
+    return ApplicationResult(original_version_path, [], [], stats)
+
+
+def apply_patch_from_arguments(args):
+    # Whole application of a patch. The stats are returned for the JSON-file, files which could not be
+    # patched or differ from the modified version are part of the result.
     original_version_path = args.original_version_path
     modified_version_path = args.modified_version_path
     patch_path = args.patch_path
     diff_tool = args.tool
-    json_path = args.json_path
     single_file_patching = args.file
     compression = args.compress
+    jobs = args.jobs
+    deadline = args.deadline
+    verify_tree = args.verify_tree
+    resumable = args.resumable and not single_file_patching
+    trace_path = args.trace_path
+    dry_run = args.dry_run
+    memory_budget = MemoryBudget(args.memory_budget * 1024 * 1024 if args.memory_budget else get_default_budget())
+    stats = {}
+    reset_placement_stats()
 
-    if compression:
-        if single_file_patching:
-            path_parts = patch_path.split("/")
+    # Without a trace every span is a shared object which does nothing
+    if trace_path:
+        enable_tracing()
+        print("The duration of every phase and every file is recorded!")
 
-            path_parts = path_parts[:-1]
-            path_without_filename = ""
-            for part in path_parts:
-                path_without_filename += part + "/"
+    if memory_budget.budget_bytes is not None:
+        print("Parallel patches may use {} MB of memory together!".format(memory_budget.budget_bytes // (1024 * 1024)))
 
-            with zipfile.ZipFile(patch_path + ".zip", 'r') as zip_ref:
-                zip_ref.extractall(path_without_filename)
+    # Everything which belongs to a resumable update is stored next to the original version
+    journal_path, staging_path, backup_path = get_resumable_paths(original_version_path)
 
-        else:
-            if patch_path[-1] == "/":
-                patch_path = patch_path[:-1]
+    if args.rollback:
+        with span("roll_back_changes"):
+            roll_back_staged_changes(original_version_path=original_version_path,
+                                     staging_path=staging_path,
+                                     backup_path=backup_path,
+                                     journal=Journal(journal_path))
+        print("The interrupted update of {} was rolled back!".format(original_version_path))
+        return ApplicationResult(original_version_path, [], [], stats)
 
-            with zipfile.ZipFile(patch_path + ".zip", 'r') as zip_ref:
-                zip_ref.extractall(patch_path)
+    if not single_file_patching and is_patch_route(patch_path):
+        return apply_route_from_arguments(args)
+
+    compressed_patch_archive = None
+    if compression:
+        patch_path, compressed_patch_archive = locate_compressed_patch(patch_path, single_file_patching)
 
     if single_file_patching:
         print("Single patch file applying starts!")
-        start_time = time.time()
-        apply_single_patch_file(original_version_path=original_version_path,
-                                modified_version_path=modified_version_path,
-                                patch_path=patch_path,
-                                tool=diff_tool)
-        end_time = time.time()
+        start_time = time.perf_counter()
+        with span("apply_single_patch_file"):
+            return_value = apply_single_patch_file(original_version_path=original_version_path,
+                                                   modified_version_path=modified_version_path,
+                                                   patch_path=patch_path,
+                                                   tool=diff_tool,
+                                                   jobs=jobs)
+        end_time = time.perf_counter()
         needed_time = end_time - start_time
         print("Finished single patch file applying")
-    else:
-        # Create list with all new, modified and deleted elements
-        new_files, modified_files, deleted_files = create_all_file_lists(patch_path=patch_path)
 
-        # Remove all files within the original version which are within the deleted_file list
-        remove_files_from_original_version(deleted_files=deleted_files,
-                                           original_version_path=original_version_path)
+        # The patched file replaces the modified version, so there is nothing left to compare it with
+        if verify_tree:
+            print("Single files are written to the path of the modified version and can not be verified against it!")
+        stats["time_needed_to_apply_patch_file"] = "{} seconds".format(int(needed_time))
+        stats["seconds_needed_to_apply_patch_file"] = round(needed_time, 6)
+        save_instrumentation(stats, "instrumentation_of_the_application", trace_path, "patch_file_applier")
+        failed_files = [modified_version_path] if return_value else []
+        return ApplicationResult(original_version_path, failed_files, [], stats)
 
-        # Move all files from the new_files list into the original version
-        move_files_to_original_version(new_files=new_files,
-                                       original_version_path=original_version_path,
-                                       patch_path=patch_path)
+    patch_source = open_patch_source(patch_path, compressed_patch_archive, keep_files=resumable,
+                                     fetch_connections=args.fetch_connections)
 
-        # Update the old version of the directory with all files of the modified_files list
-        # Important note: Time needed will be measured!
-        start_time = time.time()
-        update_original_directory(modified_files=modified_files,
-                                  original_version_path=original_version_path,
-                                  patch_path=patch_path,
-                                  tool=diff_tool)
-        end_time = time.time()
+    # Create list with all new, modified and deleted elements
+    with span("read_file_lists"):
+        new_files, modified_files, deleted_files, moved_files, derived_files = patch_source.read_file_lists()
+        apply_plan = get_apply_plan(patch_source=patch_source,
+                                    original_version_path=original_version_path,
+                                    new_files=new_files,
+                                    modified_files=modified_files,
+                                    deleted_files=deleted_files,
+                                    moved_files=moved_files,
+                                    derived_files=derived_files)
+    stats["apply_plan_of_the_application"] = print_apply_plan_summary(apply_plan)
+    # Patches of older versions carry no hashes, their files are only checked by a verification of the whole tree
+    unverified_files = [original_version_path + "/" + file
+                        for file in new_files + modified_files + [file for file, _ in moved_files + derived_files]
+                        if patch_source.target_hash(file) is None]
 
-        delete_empty_directories_of_original_version(original_version_path)
+    # Nothing was touched so far, a dry run stops right here
+    if dry_run:
+        patch_source.close()
+        print("Dry run finished! The original version was not changed!")
+        return ApplicationResult(original_version_path, [], [], stats)
 
-        needed_time = end_time - start_time
-        print("Time needed for applying all patches: {} seconds".format(int(needed_time)))
+    # Entries of a remote container are fetched in the order of the plan, every entry is patched as soon
+    # as it arrived while the following ones are still on their way
+    if is_patch_url(patch_path):
+        patch_source.prefetch_plan(apply_plan)
+
+    # Remove all deleted files, move all new files into the original version and update all modified files
+    # Important note: Time needed will be measured!
+    start_time = time.perf_counter()
+    if resumable:
+        journal = Journal(journal_path)
+        print("Progress is recorded within {}! {} steps were finished by an earlier run".format(journal_path,
+                                                                                               len(journal)))
 
-        # Check whether the size of the modified directory is equal to the old one after patching
-        result = compare_original_and_modified_directories(original_version_path=original_version_path,
-                                                           modified_version_path=modified_version_path)
-        if result:
-            print("Patching was successfull! Both directories are equal now!")
+        # The original version is only touched once every file was staged successfully
+        failed_patches = []
+        if journal.get("commit") is None:
+            with span("stage_changes"):
+                failed_patches = stage_all_changes(new_files=new_files,
+                                                   modified_files=modified_files,
+                                                   derived_files=derived_files,
+                                                   original_version_path=original_version_path,
+                                                   patch_source=patch_source,
+                                                   tool=diff_tool,
+                                                   staging_path=staging_path,
+                                                   journal=journal,
+                                                   jobs=jobs,
+                                                   timeout=deadline,
+                                                   memory_budget=memory_budget)
+        if failed_patches:
+            print("Staging failed! Start the update again to resume it or roll it back!")
+            journal.close()
         else:
-            print("Something went wrong while patching! Sizes of the directories are not equal!")
-            exit(1)
+            operations = create_commit_operations(apply_plan)
+            with span("commit_changes"):
+                commit_staged_changes(operations=operations,
+                                      original_version_path=original_version_path,
+                                      staging_path=staging_path,
+                                      backup_path=backup_path,
+                                      journal=journal)
+            shutil.rmtree(staging_path, ignore_errors=True)
+            shutil.rmtree(backup_path, ignore_errors=True)
+            journal.remove()
+    else:
+        with span("apply_changes"):
+            failed_patches = run_apply_plan(plan=apply_plan,
+                                            original_version_path=original_version_path,
+                                            patch_source=patch_source,
+                                            tool=diff_tool,
+                                            jobs=jobs,
+                                            timeout=deadline,
+                                            memory_budget=memory_budget)
+    end_time = time.perf_counter()
+    decompressed_bytes, decompression_seconds = 0, 0.0
+    if isinstance(patch_source, PatchContainerReader):
+        decompressed_bytes, decompression_seconds = patch_source.decompression_stats()
+    if is_patch_url(patch_path):
+        stats["fetching_of_the_application"] = patch_source.fetch_stats()
+        print("{} bytes were fetched with {} requests over {} connections".format(
+            stats["fetching_of_the_application"]["fetched_bytes"], stats["fetching_of_the_application"]["requests"],
+            stats["fetching_of_the_application"]["connections"]))
+    patch_source.close()
+
+    needed_time = end_time - start_time
+    print("Time needed for applying all patches: {} seconds".format(int(needed_time)))
+
+    # Every written file was already checked against the hash within the patch
+    if failed_patches:
+        print_file_list("The following files could not be patched or do not match their hash:", failed_patches)
+        return ApplicationResult(original_version_path, failed_patches, [], stats)
+
+    mismatching_files = []
+    if verify_tree:
+        print("Comparing the hashes of all files of the patched and the modified version!")
+        with span("verify_tree"):
+            mismatching_files = verify_directory_trees(original_version_path=original_version_path,
+                                                       modified_version_path=modified_version_path,
+                                                       jobs=jobs)
+        if mismatching_files:
+            print_file_list("Something went wrong while patching! The following files are not equal:",
+                            mismatching_files)
+            return ApplicationResult(original_version_path, [], mismatching_files, stats)
+    if unverified_files and not verify_tree:
+        stats["unverified_files"] = unverified_files
+        print_file_list("Patching finished, but the patch holds no hash for the following files and they were not "
+                        "verified! Use --verify_tree to compare them with the modified version:", unverified_files)
+    else:
+        print("Patching was successfull! All patched files are equal to the modified version now!")
+
+    stats["time_needed_to_apply_patch_file"] = "{} seconds".format(int(needed_time))
+    stats["seconds_needed_to_apply_patch_file"] = round(needed_time, 6)
+    if decompressed_bytes:
+        stats["time_needed_to_decompress"] = "{} seconds".format(round(decompression_seconds, 3))
+        stats["decompression_speed"] = "{} bytes per second".format(
+            int(decompressed_bytes / decompression_seconds) if decompression_seconds else 0)
+    stats["memory_scheduling_of_the_application"] = memory_budget.stats()
+    # Shows for every method how many files and bytes got into place that way
+    stats["file_placement"] = placement_stats()
+    for method, placement in placement_stats().items():
+        print("Files placed with {}: {} ({} bytes)".format(method, placement["files"], placement["bytes"]))
+    save_instrumentation(stats, "instrumentation_of_the_application", trace_path, "patch_file_applier")
+    return ApplicationResult(original_version_path, [], mismatching_files, stats)
+
+
+if __name__ == "__main__":
+    # Step 1: Check which parameters were set
+    print("Checking which parameters were set for this script!")
+    args = check_arguments()
+    print("Checking of all parameters finished successfully! Processing continues")
+
+    result = apply_patch_from_arguments(args)
+    # Rollbacks and dry runs leave the JSON-file as it is
+    if args.rollback or args.dry_run:
+        exit(0)
+    if result.failed_files or result.mismatching_files:
+        exit(1)
 
     print("Starting to update previously saved JSON-file!")
 
     json_file = None
-    with open(json_path, "r") as file_handler:
+    with open(args.json_path, "r") as file_handler:
         json_file = json.load(file_handler)
-    json_file["time_needed_to_apply_patch_file"] = "{} seconds".format(int(needed_time))
+    json_file.update(result.stats)
 
-    with open(json_path, "w") as file_handler:
+    with open(args.json_path, "w") as file_handler:
         json.dump(json_file, file_handler, indent=4, ensure_ascii=True, sort_keys=True)
 
     print("JSON-file successfully updated!")
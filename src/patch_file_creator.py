@@ -1,13 +1,43 @@
 import argparse
+import concurrent.futures
 import json
 import os
 import re
 import shutil
 import subprocess
 import time
+import zipfile
 
+from adaptive_strategy import StrategySelector, copy_strategy, tool_models
+from apply_plan import apply_plan_name, compile_apply_plan, find_directory_changes, print_apply_plan_summary, \
+    save_apply_plan, summarize_apply_plan
+from compression import PatchCompressor, available_codecs, codecs_by_name
+from file_fingerprints import are_files_equal, get_file_fingerprint, load_fingerprint_cache, save_fingerprint_cache
+from instrumentation import call_process, enable_tracing, file_span, save_instrumentation, span, submit_in_context
+from journal import Journal, find_finished_unit, finish_unit
+from memory_scheduler import MemoryBudget, MemoryScheduler, get_default_budget, get_file_size
+from patch_cache import PatchCache
+from patch_container import convert_patch_directory
+from segmented_diff import create_raw_patch_file, create_segmented_patch_file
+from tree_snapshot import get_tree_snapshot, scan_tree, store_tree_snapshot
+from update_api import ArgumentError
 
-supported_tools = ["bsdiff", "xdelta", "rsync"]
+
+supported_tools = ["bsdiff", "xdelta", "rsync", "cdc", "text", "adaptive"]
+
+# Result of a diff which was replaced by a plain copy of the modified file
+copy_result = 3
+
+# Smallest ratio between the smaller and the larger file size for two files with equal names
+# to be treated as versions of each other
+minimum_size_similarity = 0.5
+
+# Tools which diff in-process. Their small files are diffed in batches by the same job, because scheduling
+# each of them would cost more than the diff itself.
+batched_tools = ["text"]
+batched_file_size = 64 * 1024
+maximum_batch_files = 64
+maximum_batch_bytes = 1024 * 1024
 
 
 def save_new_modified_and_deleted_file_lists(new_files, modified_files, deleted_files, patch_path):
@@ -30,26 +60,101 @@ def save_new_modified_and_deleted_file_lists(new_files, modified_files, deleted_
             file_handler.write(row)
 
 
-def calculate_directory_size(dir_path):
-    size = 0
-    for root, _, files in os.walk(dir_path):
-        for file in files:
-            size += os.path.getsize(root + "/" + file)
+def save_moved_and_derived_file_lists(moved_files, derived_files, patch_path):
+    moved_files_path = patch_path + "/" + "moved_files.txt"
+    derived_files_path = patch_path + "/" + "derived_files.txt"
+    with open(moved_files_path, "w") as file_handler:
+        for file, source_file in moved_files:
+            row = file[0] + " | " + file[1] + " | " + source_file[0] + " | " + source_file[1] + "\n"
+            file_handler.write(row)
+
+    with open(derived_files_path, "w") as file_handler:
+        for file, source_file in derived_files:
+            row = file[0] + " | " + file[1] + " | " + source_file[0] + " | " + source_file[1] + "\n"
+            file_handler.write(row)
 
-    return size
 
+def get_file_stat(snapshot, file, file_path):
+    # The stat of a snapshot is used as long as the file is part of it
+    file_stat = snapshot.file_stat(file) if snapshot is not None else None
+    if file_stat is None:
+        file_stat = os.stat(file_path)
+    return file_stat
+
+
+def save_target_hashes(file_list, modified_version_path, patch_path, fingerprint_cache, modified_snapshot=None):
+    # The applier checks every file it writes against these hashes
+    target_hashes_path = patch_path + "/" + "target_hashes.txt"
+    with open(target_hashes_path, "w") as file_handler:
+        for file in file_list:
+            modified_version_file = modified_version_path + "/" + file[1] + "/" + file[0]
+            file_hash = get_file_fingerprint(modified_version_file, fingerprint_cache,
+                                             get_file_stat(modified_snapshot, file, modified_version_file))
+            row = file[0] + " | " + file[1] + " | " + file_hash + "\n"
+            file_handler.write(row)
+
+
+def save_apply_plan_of_patch(new_files, modified_files, deleted_files, moved_files, derived_files, patch_path,
+                             original_snapshot, modified_snapshot):
+    # The applier runs this plan as it is, so it neither sorts the lists nor searches for empty directories
+    def identifier(file):
+        return file[1] + "/" + file[0]
+
+    def size(snapshot, file):
+        return snapshot.file_stat(file).st_size
+
+    def patch_size(file):
+        return os.path.getsize(patch_path + "/" + identifier(file))
+
+    file_sizes = {}
+    for file in new_files:
+        file_sizes[identifier(file)] = (size(modified_snapshot, file), patch_size(file))
+    for file in modified_files:
+        file_sizes[identifier(file)] = (size(modified_snapshot, file), size(original_snapshot, file) + patch_size(file))
+    for file, source_file in moved_files:
+        file_sizes[identifier(file)] = (size(modified_snapshot, file), size(original_snapshot, source_file))
+    for file, source_file in derived_files:
+        file_sizes[identifier(file)] = (size(modified_snapshot, file),
+                                        size(original_snapshot, source_file) + patch_size(file))
+
+    created_directories, removed_directories = find_directory_changes(original_snapshot.directories,
+                                                                      modified_snapshot.directories)
+    plan = compile_apply_plan(new_files=[identifier(file) for file in new_files],
+                              modified_files=[identifier(file) for file in modified_files],
+                              deleted_files=[identifier(file) for file in deleted_files],
+                              moved_files=[(identifier(file), identifier(source_file))
+                                           for file, source_file in moved_files],
+                              derived_files=[(identifier(file), identifier(source_file))
+                                             for file, source_file in derived_files],
+                              created_directories=created_directories,
+                              removed_directories=removed_directories,
+                              file_sizes=file_sizes)
+    save_apply_plan(plan, patch_path + "/" + apply_plan_name)
+    return plan
+
+
+def calculate_directory_size(dir_path):
+    return scan_tree(dir_path).total_size()
 
-def retrieve_needed_information(original_version_path, modified_version_path, patch_path):
+
+def retrieve_needed_information(original_version_path, modified_version_path, patch_path, original_snapshot=None,
+                                modified_snapshot=None):
     original_version_size = 0
     modified_version_size = 0
     patch_version_size = 0
     compressed_version_size = 0
     
     # Step 1: Get original_version_size
-    original_version_size = calculate_directory_size(original_version_path)
+    if original_snapshot is not None:
+        original_version_size = original_snapshot.total_size()
+    else:
+        original_version_size = calculate_directory_size(original_version_path)
 
     # Step 2: Get modified_version_size
-    modified_version_size = calculate_directory_size(modified_version_path)
+    if modified_snapshot is not None:
+        modified_version_size = modified_snapshot.total_size()
+    else:
+        modified_version_size = calculate_directory_size(modified_version_path)
 
     # Step 3: Get patch_version_size
     patch_version_size = calculate_directory_size(patch_path)
@@ -60,54 +165,319 @@ def retrieve_needed_information(original_version_path, modified_version_path, pa
     return original_version_size, modified_version_size, patch_version_size, compressed_version_size, modified_version_vs_patch_version
 
 
-def create_patch_directory_structure(modified_directory, patch_directory):
-    for root, _, _ in os.walk(modified_directory):
-        root = root.replace(modified_directory, "")
+def create_patch_directory_structure(modified_directory, patch_directory, directories=None):
+    # The directories of a snapshot of the modified version save another walk through it
+    if directories is None:
+        directories = scan_tree(modified_directory).directories
+    for root in directories:
         if not os.path.exists(patch_directory + "/" + root):
             path = patch_directory + "/" + root + "/"
             print("New directory created: {}".format(path))
             os.makedirs(path)
 
 
-def copy_new_files_into_patch_directory(from_path, to_path, file_list):
-    for file in file_list:
-        source_path = from_path + "/" + file[1] + "/" + file[0]
-        destination_path = to_path + "/" + file[1] + "/" + file[0]
-        shutil.copy(src=source_path, dst=destination_path)
+def take_over_finished_unit(journal, unit, input_files, output_file, compressor):
+    # Outputs of an interrupted run are reused as long as their inputs did not change in between
+    record = find_finished_unit(journal, unit, input_files, output_file)
+    if record is None:
+        return False
+    if record.get("codec") is not None:
+        if compressor is None or record["codec"] not in codecs_by_name:
+            return False
+        compressor.register_entry(output_file, record["codec"], record["uncompressed_size"])
+    elif compressor is not None:
+        return False
+    return True
+
+
+def copy_new_file_into_patch_directory(source_path, destination_path, compressor=None, journal=None):
+    unit = "new:" + destination_path
+    if take_over_finished_unit(journal, unit, [source_path], destination_path, compressor):
+        print("{} was already copied by an earlier run".format(source_path))
+        return
+
+    if compressor is None:
+        with file_span("copy", file=source_path) as copy_span:
+            shutil.copy(src=source_path, dst=destination_path)
+            copy_span.record_size("bytes", destination_path)
+    else:
+        compressor.compress_file(source_path, destination_path)
+    finish_unit(journal, unit, [source_path], destination_path,
+                **(compressor.entry_record(destination_path) if compressor is not None else {}))
+
+
+def copy_new_files_into_patch_directory(from_path, to_path, file_list, compressor=None, jobs=None, journal=None):
+    if compressor is None and journal is None:
+        for file in file_list:
+            source_path = from_path + "/" + file[1] + "/" + file[0]
+            destination_path = to_path + "/" + file[1] + "/" + file[0]
+            with file_span("copy", file=source_path) as copy_span:
+                shutil.copy(src=source_path, dst=destination_path)
+                copy_span.record_size("bytes", destination_path)
+        return
+
+    # New files are compressed straight from the modified version, several of them at once
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        results = [submit_in_context(executor, copy_new_file_into_patch_directory,
+                                     from_path + "/" + file[1] + "/" + file[0], to_path + "/" + file[1] + "/" + file[0],
+                                     compressor, journal)
+                   for file in file_list]
+    for result in results:
+        result.result()
+
+
+def create_diff_file(original_version_file, modified_version_file, patch_file, diff_tool, selector=None,
+                     timeout=None):
+    if diff_tool == "adaptive":
+        return create_adaptive_diff_file(original_version_file, modified_version_file, patch_file, selector)
+    if diff_tool == "text":
+        # Text files get a line-based patch which is created in-process, every other file is diffed by bsdiff
+        from line_diff import are_text_files
+        if not are_text_files(original_version_file, modified_version_file):
+            diff_tool = "bsdiff"
+
+    result = 0
+    with file_span("diff", file=modified_version_file, tool=diff_tool) as diff_span:
+        diff_span.record_size("original_bytes", original_version_file)
+        diff_span.record_size("modified_bytes", modified_version_file)
+        if diff_tool == "bsdiff":
+            result = call_process(["bsdiff", original_version_file, modified_version_file, patch_file],
+                                  timeout=timeout)
+        elif diff_tool == "xdelta":
+            result = call_process(["xdelta3", "-s", original_version_file, modified_version_file, patch_file],
+                                  timeout=timeout)
+        elif diff_tool == "rsync":
+            # NumPy is only needed by the built-in engines, therefore they are imported on demand
+            from rsync_delta import create_delta_file
+            create_delta_file(original_version_file, modified_version_file, patch_file)
+        elif diff_tool == "cdc":
+            from chunk_store import create_chunk_patch_file
+            result = create_chunk_patch_file(original_version_file, modified_version_file, patch_file)
+        elif diff_tool == "text":
+            from line_diff import create_line_patch_file
+            result = create_line_patch_file(original_version_file, modified_version_file, patch_file)
+        diff_span.set(exit_code=result)
+        diff_span.record_size("patch_bytes", patch_file)
+    return result
+
+
+def create_adaptive_diff_file(original_version_file, modified_version_file, patch_file, selector):
+    decision = selector.choose(original_version_file, modified_version_file)
+    strategy = decision["strategy"]
+    if strategy == copy_strategy:
+        print("{} is stored as a copy, a diff is not expected to be smaller".format(modified_version_file))
+        selector.record(decision, "projected_copy")
+        return copy_result
+
+    # External tools are stopped when they run far longer than expected, the file is copied instead
+    start_time = time.perf_counter()
+    try:
+        result = create_diff_file(original_version_file, modified_version_file, patch_file, strategy,
+                                  timeout=decision["deadline"])
+    except subprocess.TimeoutExpired:
+        result = None
+    seconds = round(time.perf_counter() - start_time, 3)
+
+    if result is None or result > 0:
+        if os.path.exists(patch_file):
+            os.remove(patch_file)
+        selector.record(decision, "timeout" if result is None else "failed", seconds=seconds)
+        return copy_result
+
+    patch_bytes = os.path.getsize(patch_file)
+    stored_bytes = selector.stored_patch_bytes(strategy, patch_bytes, decision["profile"]["compressibility"])
+    if stored_bytes >= decision["copy_bytes"]:
+        print("Diff of {} is not smaller than a copy and is replaced by it".format(modified_version_file))
+        os.remove(patch_file)
+        selector.record(decision, "found_copy", seconds=seconds, patch_bytes=patch_bytes)
+        return copy_result
+
+    selector.record(decision, "diff", seconds=seconds, patch_bytes=patch_bytes)
+    return 0
+
+
+def create_compressed_diff_file(original_version_file, modified_version_file, patch_file, diff_tool, compressor,
+                                journal=None, selector=None, patch_cache=None):
+    unit = "diff:" + patch_file
+    input_files = [original_version_file, modified_version_file]
+    if take_over_finished_unit(journal, unit, input_files, patch_file, compressor):
+        print("Diff for {} was already created by an earlier run".format(modified_version_file))
+        return 0
+
+    # Most files change the same way between nearby versions, so a diff of another pair of versions
+    # with the same two files is reused
+    if patch_cache is not None and patch_cache.fetch_delta(original_version_file, modified_version_file, diff_tool,
+                                                           patch_file):
+        print("Diff for {} was taken from the patch cache".format(modified_version_file))
+        result = 0
+    else:
+        result = create_diff_file(original_version_file, modified_version_file, patch_file, diff_tool, selector)
+        if result == 0 and patch_cache is not None:
+            patch_cache.store_delta(original_version_file, modified_version_file, diff_tool, patch_file)
+
+    # The diff is compressed by the same worker right after it was created
+    if result == 0 and compressor is not None:
+        compressor.compress_file(patch_file)
+    if result == 0:
+        finish_unit(journal, unit, input_files, patch_file,
+                    **(compressor.entry_record(patch_file) if compressor is not None else {}))
+    return result
 
 
-def create_diff_files(file_list, original_version_path, modified_version_path, patch_path, diff_tool):
+def create_diff_batch(batch, diff_tool, compressor=None, journal=None, selector=None, patch_cache=None):
+    return [create_compressed_diff_file(original_version_file, modified_version_file, patch_file, diff_tool,
+                                        compressor, journal, selector, patch_cache)
+            for original_version_file, modified_version_file, patch_file in batch]
+
+
+def create_diff_files(file_list, original_version_path, modified_version_path, patch_path, diff_tool, jobs=None,
+                      source_files=None, compressor=None, journal=None, selector=None, memory_budget=None,
+                      patch_cache=None):
     files_with_failed_patches = []
 
+    # Files can be diffed against an original file at another path, by default the path is the same
+    if source_files is None:
+        source_files = {}
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    # Without a budget every diff may run at once, the estimates still put the largest diffs first
+    if memory_budget is None:
+        memory_budget = MemoryBudget()
+
+    # The scheduler starts the diffs with the largest memory estimate first, so that no single big diff is left
+    # running on its own at the end, and only as many at once as fit into the memory budget
+    results = {}
+    with MemoryScheduler(max_workers=jobs, memory_budget=memory_budget) as executor:
+        def submit_batch(files, batch):
+            # The files of a batch are diffed one after another, the largest of them decides the memory
+            memory = max((memory_budget.estimate(diff_tool, original_version_file, modified_version_file)
+                          for original_version_file, modified_version_file, _ in batch),
+                         key=lambda estimate: estimate["bytes"])
+            future = executor.submit(create_diff_batch, batch, diff_tool, compressor, journal, selector, patch_cache,
+                                     memory=memory)
+            for index, file in enumerate(files):
+                results[file] = (future, index)
+
+        pending_files, pending_batch, pending_bytes = [], [], 0
+        for file in file_list:
+            print("Creating diff for {}".format(file[0]))
+            source_file = source_files.get(file, file)
+            original_version_file = original_version_path + "/" + source_file[1] + "/" + source_file[0]
+            modified_version_file = modified_version_path + "/" + file[1] + "/" + file[0]
+            patch_file = patch_path + "/" + file[1] + "/" + file[0]
+            diff = (original_version_file, modified_version_file, patch_file)
+
+            size = get_file_size(modified_version_file) if diff_tool in batched_tools else None
+            if size is None or size > batched_file_size:
+                submit_batch([file], [diff])
+                continue
+            pending_files.append(file)
+            pending_batch.append(diff)
+            pending_bytes += size
+            if len(pending_batch) >= maximum_batch_files or pending_bytes >= maximum_batch_bytes:
+                submit_batch(pending_files, pending_batch)
+                pending_files, pending_batch, pending_bytes = [], [], 0
+        if pending_batch:
+            submit_batch(pending_files, pending_batch)
+
+    # Results are collected in the order of the given list, independent of the order in which the diffs finished
+    for file in file_list:
+        future, index = results[file]
+        result = future.result()[index]
+        if result == copy_result:
+            print("{} is copied instead of diffed. Adding this file to the list!".format(file[0]))
+            files_with_failed_patches.append(file)
+        elif result > 0:
+            print("Patch for {} failed. Adding this file to the list!".format(file[0]))
+            files_with_failed_patches.append(file)
+
+    return files_with_failed_patches
+
+
+def separate_unchanged_files(file_list, original_version_path, modified_version_path, fingerprint_cache,
+                             original_snapshot=None, modified_snapshot=None):
+    modified_files = []
+    unchanged_files = []
+
     for file in file_list:
-        print("Creating diff for {}".format(file[0]))
         original_version_file = original_version_path + "/" + file[1] + "/" + file[0]
         modified_version_file = modified_version_path + "/" + file[1] + "/" + file[0]
-        patch_file = patch_path + "/" + file[1] + "/" + file[0]
 
-        if diff_tool == "bsdiff":
-            result = subprocess.call(["bsdiff", original_version_file, modified_version_file, patch_file])
-            if result > 0:
-                print("Patch for {} failed. Adding this file to the list!".format(file[0]))
-                files_with_failed_patches.append(file)
-        elif diff_tool == "xdelta":
-            result = subprocess.call(["xdelta3", "-s", original_version_file, modified_version_file, patch_file])
-            if result > 0:
-                print("Patch for {} failed. Adding this file to the list!".format(file[0]))
-                files_with_failed_patches.append(file)
-        elif diff_tool == "rsync":
-            result = subprocess.call(["rsync", "-zvh", original_version_file, modified_version_file])
+        if are_files_equal(original_version_file, modified_version_file, fingerprint_cache,
+                           get_file_stat(original_snapshot, file, original_version_file),
+                           get_file_stat(modified_snapshot, file, modified_version_file)):
+            unchanged_files.append(file)
+        else:
+            modified_files.append(file)
 
-    return files_with_failed_patches
+    return modified_files, unchanged_files
+
+
+def detect_moved_and_derived_files(new_files, deleted_files, original_version_path, modified_version_path,
+                                   fingerprint_cache, original_snapshot=None, modified_snapshot=None):
+    moved_files = []
+    derived_files = []
+    remaining_new_files = []
+
+    deleted_files_by_size = {}
+    deleted_files_by_name = {}
+    for file in deleted_files:
+        size = get_file_stat(original_snapshot, file, original_version_path + "/" + file[1] + "/" + file[0]).st_size
+        deleted_files_by_size.setdefault(size, []).append(file)
+        deleted_files_by_name.setdefault(file[0], []).append((size, file))
+
+    # Only deleted files with the same size as a new file can have the same content, so only those are hashed
+    deleted_files_by_hash = {}
+    hashed_sizes = set()
+
+    for file in new_files:
+        modified_version_file = modified_version_path + "/" + file[1] + "/" + file[0]
+        modified_file_stat = get_file_stat(modified_snapshot, file, modified_version_file)
+        size = modified_file_stat.st_size
+
+        if size in deleted_files_by_size:
+            if size not in hashed_sizes:
+                hashed_sizes.add(size)
+                for deleted_file in deleted_files_by_size[size]:
+                    original_version_file = original_version_path + "/" + deleted_file[1] + "/" + deleted_file[0]
+                    original_file_hash = get_file_fingerprint(original_version_file, fingerprint_cache,
+                                                              get_file_stat(original_snapshot, deleted_file,
+                                                                            original_version_file))
+                    deleted_files_by_hash.setdefault(original_file_hash, deleted_file)
+
+            source_file = deleted_files_by_hash.get(get_file_fingerprint(modified_version_file, fingerprint_cache,
+                                                                         modified_file_stat))
+            if source_file is not None:
+                moved_files.append((file, source_file))
+                continue
+
+        # Near-duplicates: a deleted file with the same name and a similar size is used as the base of a diff
+        candidates = [(abs(size - deleted_size), deleted_file)
+                      for deleted_size, deleted_file in deleted_files_by_name.get(file[0], [])
+                      if min(size, deleted_size) >= minimum_size_similarity * max(size, deleted_size)]
+        if candidates:
+            derived_files.append((file, min(candidates)[1]))
+        else:
+            remaining_new_files.append(file)
+
+    return moved_files, derived_files, remaining_new_files
 
 
 def is_path_valid(path_to_check):
     if os.path.exists(path_to_check):
         print("Path: {} exists".format(path_to_check))
         return True
-    else:
-        print("The path {} does not exist! Processing stops!".format(path_to_check))
-        return False
+    return False
+
+
+def build_file_index(file_list):
+    # Key every entry by its relative path so lookups do not need to scan the whole list
+    file_index = {}
+    for file in file_list:
+        file_index[file[1] + file[0]] = file
+    return file_index
 
 
 def detect_all_new_modified_and_deleted_files(original_version_file_list, modified_version_file_list):
@@ -115,62 +485,67 @@ def detect_all_new_modified_and_deleted_files(original_version_file_list, modifi
     modified_files = []
     deleted_files = []
 
-    for modified_file in modified_version_file_list:
-        modified_file_name = modified_file[0]
-        modified_file_path = modified_file[1]
-
-        found_equal_file = False
-
-        for original_file in original_version_file_list:
-            original_file_name = original_file[0]
-            original_file_path = original_file[1]
-
-            if original_file_name == modified_file_name:
-                if original_file_path == modified_file_path:
-                    modified_files.append(modified_file)
-                    found_equal_file = True
-                    break
+    original_version_index = build_file_index(original_version_file_list)
+    modified_version_index = build_file_index(modified_version_file_list)
 
-        if not found_equal_file:
+    for modified_file in modified_version_file_list:
+        if modified_file[1] + modified_file[0] in original_version_index:
+            modified_files.append(modified_file)
+        else:
             new_files.append(modified_file)
 
     for original_file in original_version_file_list:
-        original_file_name = original_file[0]
-        original_file_path = original_file[1]
-
-        found = False
-
-        for modified_file in modified_version_file_list:
-            modified_file_name = modified_file[0]
-            modified_file_path = modified_file[1]
-
-            if modified_file_name == original_file_name:
-                if modified_file_path == original_file_path:
-                    found = True
-                    break
-        if not found:
+        if original_file[1] + original_file[0] not in modified_version_index:
             deleted_files.append(original_file)
 
     return modified_files, new_files, deleted_files
 
 
 def iterate_through_directory(directory_path):
-    file_list = []
-    for root, _, files in os.walk(directory_path):
-        # Strip away the directory_path which is not needed for reconstructing the directory structure
-        root = root.replace(directory_path, "")
-        for file in files:
-            file_path = root + "/"
-            file_list.append((file, file_path))
-    return file_list
-
-
-def create_single_patch_file(original_version_path, modified_version_path, patch_path, tool):
-    #TODO: Implement patch file creation for all other tools too
-    subprocess.call(["bsdiff", original_version_path, modified_version_path, patch_path])
-
-
-def check_arguments():
+    # Every file as its name and its directory relative to directory_path
+    return scan_tree(directory_path).file_list()
+
+
+def create_single_patch_file(original_version_path, modified_version_path, patch_path, tool, segment_size=None,
+                             jobs=None, archive=False, journal=None, selector=None, patch_cache=None):
+    if archive:
+        # The archive module reuses the tree-diff logic of this script, therefore it is imported on demand
+        from archive_diff import create_archive_patch_file
+        return create_archive_patch_file(original_version_file=original_version_path,
+                                         modified_version_file=modified_version_path,
+                                         patch_file=patch_path,
+                                         diff_function=lambda original_file, modified_file, patch_file:
+                                             create_diff_file(original_file, modified_file, patch_file, tool,
+                                                              selector))
+
+    if segment_size:
+        # Large files are split into segments which are diffed in parallel and packed into one patch file
+        return create_segmented_patch_file(original_version_file=original_version_path,
+                                           modified_version_file=modified_version_path,
+                                           patch_file=patch_path,
+                                           diff_function=lambda original_file, modified_file, patch_file:
+                                               create_diff_file(original_file, modified_file, patch_file, tool,
+                                                                selector),
+                                           segment_size=segment_size,
+                                           jobs=jobs,
+                                           journal=journal)
+
+    # The whole file is a single unit of work, a rerun only skips it if it was finished
+    result = create_compressed_diff_file(original_version_file=original_version_path,
+                                         modified_version_file=modified_version_path,
+                                         patch_file=patch_path,
+                                         diff_tool=tool,
+                                         compressor=None,
+                                         journal=journal,
+                                         selector=selector,
+                                         patch_cache=patch_cache)
+    if result == copy_result:
+        # The applier recognizes a segmented patch file with a single raw segment as a plain copy
+        return create_raw_patch_file(modified_version_file=modified_version_path, patch_file=patch_path)
+    return result
+
+
+def create_argument_parser():
     parser = argparse.ArgumentParser()
 
     # Required Arguments
@@ -196,9 +571,73 @@ def check_arguments():
                         help="Set this flag if the created patch file/directory shall be compressed",
                         action='store_true',
                         default=False)
-
-    args = parser.parse_args()
-
+    parser.add_argument("-k", "--fingerprint_cache",
+                        help="Path of the cache which stores the content fingerprints of already hashed files",
+                        default=os.environ["HOME"] + "/.cache/diff_updater/fingerprints.json")
+    parser.add_argument("-n", "--jobs",
+                        help="Number of diff-files which are created in parallel. Default is the number of CPU cores",
+                        type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument("-s", "--segment_size",
+                        help="Split a single file into segments of this many megabytes which are diffed in parallel",
+                        type=int,
+                        default=None)
+    parser.add_argument("-a", "--archive",
+                        help="Set this flag if the given files are tar.gz or zip archives whose members shall be diffed",
+                        action='store_true',
+                        default=False)
+    parser.add_argument("-b", "--container",
+                        help="Set this flag if the patch of a directory shall be stored as a single container file",
+                        action='store_true',
+                        default=False)
+    parser.add_argument("-z", "--codec",
+                        help="Compress every entry of a patch container while it is created. "
+                             "'auto' picks the codec per entry. Available: {}".format(", ".join(available_codecs)),
+                        choices=["auto"] + available_codecs,
+                        default=None)
+    parser.add_argument("-r", "--resumable",
+                        help="Set this flag to record finished diffs within a journal, so that an interrupted run can be "
+                             "continued by starting it again with the same arguments",
+                        action='store_true',
+                        default=False)
+    parser.add_argument("-l", "--compression_level",
+                        help="Compression level of the codec. Default is the usual level of each codec",
+                        type=int,
+                        default=None)
+    parser.add_argument("-D", "--decision_log",
+                        help="Path of the log in which the adaptive tool records why it chose a tool or a copy "
+                             "for every file. Default is next to the JSON-file",
+                        default=None)
+    parser.add_argument("-T", "--trace_path",
+                        help="Record the duration of every phase and every file and save them as a Chrome trace "
+                             "within this path. The summary is added to the JSON-file as well",
+                        default=None)
+    parser.add_argument("-S", "--snapshot_directory",
+                        help="Directory in which a snapshot of the original and the modified version is stored. "
+                             "A stored snapshot replaces scanning a version again as long as none of its directories "
+                             "changed. Files which are rewritten in place are not noticed, so it is meant for "
+                             "releases whose files do not change anymore",
+                        default=None)
+    parser.add_argument("-P", "--patch_cache",
+                        help="Directory of a patch cache. Diffs of files which were already diffed for another pair "
+                             "of versions are taken from it, new diffs are added to it",
+                        default=None)
+    parser.add_argument("-C", "--patch_cache_size",
+                        help="Size limit of the patch cache in MB. The least recently used diffs are removed "
+                             "once the cache is larger. Default is no limit",
+                        type=int,
+                        default=None)
+    parser.add_argument("-M", "--memory_budget",
+                        help="Memory in MB which all parallel diffs may use together. "
+                             "Default is 80 percent of the memory which is available right now",
+                        type=int,
+                        default=None)
+
+    return parser
+
+
+def validate_arguments(args):
+    # Raises an ArgumentError for every invalid option, so the library can use the same checks
     if args.file:
         print("Flag for single file patching was set!")
         if os.path.isfile(args.original_version_path):
@@ -208,20 +647,37 @@ def check_arguments():
             else:
                 print("A problem occurred while checking the paths of the files!")
                 print("Either the given path does not lead to a file, the file does not exist or the filename is mispelled!")
-                print("Problem occurred while checking the following path: {}".format(args.modified_version_path))
-                exit(1)
+                raise ArgumentError("Problem occurred while checking the following path: {}".format(
+                    args.modified_version_path), 1)
         else:
             print("A problem occurred while checking the paths of the files!")
             print("Either the given path does not lead to a file, the file does not exist or the filename is mispelled!")
-            print("Problem occurred while checking the following path: {}".format(args.original_version_path))
-            exit(1)
+            raise ArgumentError("Problem occurred while checking the following path: {}".format(
+                args.original_version_path), 1)
     else:
         print("Flag for single file patching was NOT set. Therefore a whole directory is patched!")
         # If this case is executed, it is not requested to update a single file!
-        if not is_path_valid(args.original_version_path):
-            exit(1)
-        if not is_path_valid(args.modified_version_path):
-            exit(1)
+        for path in [args.original_version_path, args.modified_version_path]:
+            if not is_path_valid(path):
+                raise ArgumentError("The path {} does not exist! Processing stops!".format(path), 1)
+
+    if args.archive:
+        if not args.file:
+            raise ArgumentError("Flag for archives can only be used together with the flag for single file "
+                                "patching! Processing stops!", 2)
+        print("Flag for archives was set! Members of the archives will be diffed instead of the compressed data!")
+
+    if args.container:
+        if args.file:
+            raise ArgumentError("Flag for containers can not be used together with the flag for single file "
+                                "patching! Processing stops!", 2)
+        print("Flag for containers was set! The patch will be stored within a single container file!")
+
+    if args.codec:
+        if not args.container:
+            raise ArgumentError("Compressing single entries needs a patch container! Set the flag for containers! "
+                                "Processing stops!", 2)
+        print("Entries of the container are compressed with the codec: {}".format(args.codec))
 
     if args.compress:
         print("Flag for compressing was set! Created patch file/directory will be compressed!")
@@ -229,20 +685,48 @@ def check_arguments():
         print("Flag for compressing was NOT set! Created patch file/directory won't be compressed!")
 
     if args.tool not in supported_tools:
-        print("Chosen tool is not supported by this program! Processing stops!")
-        exit(2)
+        raise ArgumentError("Chosen tool is not supported by this program! Processing stops!", 2)
+    elif args.tool == "adaptive":
+        print("The differential update tool is chosen for every file on its own out of: {}".format(
+            ", ".join(tool_models)))
     else:
         print("{} was chosen as the differential update tool for processing!".format(args.tool))
 
-    return args
+    if args.jobs < 1:
+        raise ArgumentError("At least one job is needed for creating the diff-files! Processing stops!", 2)
+    else:
+        print("Diff-files are created with {} parallel jobs!".format(args.jobs))
 
+    if args.memory_budget is not None and args.memory_budget < 1:
+        raise ArgumentError("The memory budget needs at least 1 MB! Processing stops!", 2)
+
+    if args.patch_cache_size is not None and args.patch_cache_size < 1:
+        raise ArgumentError("The patch cache needs at least 1 MB! Processing stops!", 2)
+
+    if args.patch_cache_size is not None and not args.patch_cache:
+        raise ArgumentError("A size limit needs a patch cache! Set the path of the patch cache! "
+                            "Processing stops!", 2)
+
+    if args.patch_cache:
+        if args.archive or args.segment_size:
+            raise ArgumentError("Archives and segmented files are not diffed through the patch cache! "
+                                "Processing stops!", 2)
+        print("Diffs are reused from and stored within the patch cache {}".format(args.patch_cache))
+
+
+def check_arguments():
+    args = create_argument_parser().parse_args()
+    try:
+        validate_arguments(args)
+    except ArgumentError as error:
+        print(error)
+        exit(error.exit_code)
+
+    return args
 
-if __name__ == "__main__":
-    # Step 1: Check if all paths and arguments are valid
-    print("Checking which parameters were set for this script!")
-    args = check_arguments()
-    print("Checking of all parameters finished successfully! Processing continues")
 
+def create_patch_from_arguments(args):
+    # Whole creation of a patch, the stats are returned instead of being saved
     original_version_path = args.original_version_path
     modified_version_path = args.modified_version_path
     patch_path = args.patch_path
@@ -250,22 +734,73 @@ if __name__ == "__main__":
     json_path = args.json_path
     single_file_patching = args.file
     compression = args.compress
-
+    fingerprint_cache_path = args.fingerprint_cache
+    jobs = args.jobs
+    segment_size = args.segment_size * 1024 * 1024 if args.segment_size else None
+    archive = args.archive
+    container = args.container
+    compressor = PatchCompressor(args.codec, args.compression_level) if args.codec else None
+    resumable = args.resumable
+    trace_path = args.trace_path
+    snapshot_directory = args.snapshot_directory
+    patch_cache_path = args.patch_cache
+    patch_cache_size = args.patch_cache_size * 1024 * 1024 if args.patch_cache_size else None
+    patch_cache = None
+    memory_budget = MemoryBudget(args.memory_budget * 1024 * 1024 if args.memory_budget else get_default_budget())
+
+    # Without a trace every span is a shared object which does nothing
+    if trace_path:
+        enable_tracing()
+        print("The duration of every phase and every file is recorded!")
+
+    selector = None
+    if diff_tool == "adaptive":
+        decision_log_path = args.decision_log or os.path.splitext(json_path)[0] + "_decisions.jsonl"
+        selector = StrategySelector(compressed_patches=compression or compressor is not None,
+                                    jobs=jobs,
+                                    decision_log_path=decision_log_path)
+        print("Tools available for the adaptive choice: {}".format(", ".join(selector.tools)))
+        print("Every decision is recorded within {}".format(decision_log_path))
+
+    if memory_budget.budget_bytes is not None:
+        print("Parallel diffs may use {} MB of memory together!".format(memory_budget.budget_bytes // (1024 * 1024)))
 
     original_version_size = 0
     modified_version_size = 0
     patch_version_size = 0 
     modified_vs_patch_size = 0
     needed_time = 0
+    unchanged_files = []
+    number_of_segments = 1
+    moved_files = []
+    derived_files = []
+    apply_plan = None
+    compression_stats = None
+    journal = None
 
     if single_file_patching:
+        if resumable:
+            journal = Journal(patch_path + ".journal")
+            print("Finished work is recorded within {}! {} units were finished by an earlier run".format(
+                journal.journal_path, len(journal)))
+
+        if patch_cache_path:
+            patch_cache = PatchCache(patch_cache_path, patch_cache_size)
+
         print("Single patch file creation starts!")
-        start_time = time.time()
-        create_single_patch_file(original_version_path=original_version_path,
-                                 modified_version_path=modified_version_path,
-                                 patch_path=patch_path,
-                                 tool=diff_tool)
-        end_time = time.time()
+        start_time = time.perf_counter()
+        with span("create_single_patch_file"):
+            create_single_patch_file(original_version_path=original_version_path,
+                                     modified_version_path=modified_version_path,
+                                     patch_path=patch_path,
+                                     tool=diff_tool,
+                                     segment_size=segment_size,
+                                     jobs=jobs,
+                                     archive=archive,
+                                     journal=journal,
+                                     selector=selector,
+                                     patch_cache=patch_cache)
+        end_time = time.perf_counter()
         needed_time = end_time - start_time
         print("Finished single patch file creation")
 
@@ -274,23 +809,42 @@ if __name__ == "__main__":
         modified_version_size = os.path.getsize(modified_version_path)
         patch_version_size = os.path.getsize(patch_path)
         modified_vs_patch_size = "{} / {} = {}".format(modified_version_size, patch_version_size, modified_version_size / patch_version_size)
+        if segment_size and not archive:
+            number_of_segments = -(-modified_version_size // segment_size)
         print("Successfully gathered all needed information.")
     else:
         # Step 2: Iterate through the original and modified directories and search for all differences
         #         Note: Files with their corresponding paths will be saved
         print("Starting to iterate through the original version!")
-        original_version_file_list = iterate_through_directory(directory_path=original_version_path)
+        with span("scan", path=original_version_path):
+            original_snapshot = get_tree_snapshot(original_version_path, snapshot_directory)
+            original_version_file_list = original_snapshot.file_list()
         print("Number of files within the original version: {}".format(len(original_version_file_list)))
         print("=======================================================================")
 
         print("Starting to iterate through the modified version!")
-        modified_version_file_list = iterate_through_directory(directory_path=modified_version_path)
+        with span("scan", path=modified_version_path):
+            modified_snapshot = get_tree_snapshot(modified_version_path, snapshot_directory)
+            modified_version_file_list = modified_snapshot.file_list()
         print("Number of files within the modified version: {}".format(len(modified_version_file_list)))
         print("=======================================================================")
 
+        # A container is assembled from a staging directory which is removed afterwards
+        container_path = None
+        if container:
+            container_path = patch_path.rstrip("/")
+            patch_path = container_path + ".staging"
+
+        if resumable:
+            journal = Journal(patch_path.rstrip("/") + ".journal")
+            print("Finished work is recorded within {}! {} units were finished by an earlier run".format(
+                journal.journal_path, len(journal)))
+
         # Step 3: Create structure of the patch-directory
         print("Starting to create patch directory structure!")
-        create_patch_directory_structure(modified_directory=modified_version_path, patch_directory=patch_path)
+        with span("create_directories"):
+            create_patch_directory_structure(modified_directory=modified_version_path, patch_directory=patch_path,
+                                             directories=modified_snapshot.directories)
         print("Finished creating patch directory structure!")
 
         # Step 4: Go through destination list and create a patch file for each file in this list
@@ -298,21 +852,60 @@ if __name__ == "__main__":
         #         Note: This time it is necessary to measure the time which is needed 
         #               to create the diff for all files
         print("Starting to detect all new and modified files!")
-        modified_files, new_files, deleted_files = detect_all_new_modified_and_deleted_files(original_version_file_list=original_version_file_list,
-                                                                                            modified_version_file_list=modified_version_file_list)
+        with span("detect_changes"):
+            modified_files, new_files, deleted_files = detect_all_new_modified_and_deleted_files(original_version_file_list=original_version_file_list,
+                                                                                                modified_version_file_list=modified_version_file_list)
 
         print("Number of files which were added within the modified version: {}".format(len(new_files)))
         print("Number of files which were modified within the modified version: {}".format(len(modified_files)))
         print("Number of files which were deleted within the modified version: {}".format(len(deleted_files)))
 
+        # Files which are byte-identical in both versions do not need a diff at all
+        print("Starting to sort out all unchanged files!")
+        fingerprint_cache = load_fingerprint_cache(fingerprint_cache_path)
+        original_snapshot.seed_fingerprint_cache(fingerprint_cache)
+        modified_snapshot.seed_fingerprint_cache(fingerprint_cache)
+        with span("detect_unchanged_files"):
+            modified_files, unchanged_files = separate_unchanged_files(file_list=modified_files,
+                                                                       original_version_path=original_version_path,
+                                                                       modified_version_path=modified_version_path,
+                                                                       fingerprint_cache=fingerprint_cache,
+                                                                       original_snapshot=original_snapshot,
+                                                                       modified_snapshot=modified_snapshot)
+        print("Number of files which are unchanged within the modified version: {}".format(len(unchanged_files)))
+        print("Number of files which really need a diff: {}".format(len(modified_files)))
+
+        # New files which only moved or were renamed are rebuilt from the deleted files of the original version
+        print("Starting to detect all moved and renamed files!")
+        with span("detect_moved_files"):
+            moved_files, derived_files, new_files = detect_moved_and_derived_files(new_files=new_files,
+                                                                                   deleted_files=deleted_files,
+                                                                                   original_version_path=original_version_path,
+                                                                                   modified_version_path=modified_version_path,
+                                                                                   fingerprint_cache=fingerprint_cache,
+                                                                                   original_snapshot=original_snapshot,
+                                                                                   modified_snapshot=modified_snapshot)
+        print("Number of files which were moved without any change: {}".format(len(moved_files)))
+        if patch_cache_path:
+            patch_cache = PatchCache(patch_cache_path, patch_cache_size, fingerprint_cache)
+        print("Number of files which are diffed against a deleted file: {}".format(len(derived_files)))
+
         print("Creating diff-files for all modified files!")
-        start_time = time.time()
-        files_with_failed_patches = create_diff_files(file_list=modified_files, 
-                                                    original_version_path=original_version_path,
-                                                    modified_version_path=modified_version_path,
-                                                    patch_path=patch_path,
-                                                    diff_tool=diff_tool)
-        end_time = time.time()
+        start_time = time.perf_counter()
+        with span("create_diff_files"):
+            files_with_failed_patches = create_diff_files(file_list=modified_files + [file for file, _ in derived_files],
+                                                        original_version_path=original_version_path,
+                                                        modified_version_path=modified_version_path,
+                                                        patch_path=patch_path,
+                                                        diff_tool=diff_tool,
+                                                        jobs=jobs,
+                                                        source_files=dict(derived_files),
+                                                        compressor=compressor,
+                                                        journal=journal,
+                                                        selector=selector,
+                                                        memory_budget=memory_budget,
+                                                        patch_cache=patch_cache)
+        end_time = time.perf_counter()
         print("All diff-files were created and stored within the patch directory!")
         # Calculates time which was needed to create all diff-files
         needed_time = end_time - start_time
@@ -325,13 +918,19 @@ if __name__ == "__main__":
             if file in modified_files:
                 print("Removing {} out of the modified_files list!".format(file))
                 modified_files.remove(file)
+            derived_files = [(derived_file, source_file) for derived_file, source_file in derived_files
+                             if derived_file != file]
 
         # Step 5: Move all new files into their corresponding
         #           location within the patch-directory
         print("Copying all new files from the modified version into the patch directory!")
-        copy_new_files_into_patch_directory(from_path=modified_version_path,
-                                            to_path=patch_path,
-                                            file_list=new_files)
+        with span("copy_new_files"):
+            copy_new_files_into_patch_directory(from_path=modified_version_path,
+                                                to_path=patch_path,
+                                                file_list=new_files,
+                                                compressor=compressor,
+                                                jobs=jobs,
+                                                journal=journal)
         print("Finished copying process!")
 
         # Step 6: Retrieve the following details which are necessary for the JSON-file:
@@ -341,55 +940,145 @@ if __name__ == "__main__":
         #           - Size of the compressed version
         #           - Modified version size vs. patch size
 
-        original_version_size, modified_version_size, \
-        patch_version_size, compressed_version_size, \
-        modified_vs_patch_size = retrieve_needed_information(original_version_path=original_version_path, 
-                                                            modified_version_path=modified_version_path,
-                                                            patch_path=patch_path)
+        with span("measure_sizes"):
+            original_version_size, modified_version_size, \
+            patch_version_size, compressed_version_size, \
+            modified_vs_patch_size = retrieve_needed_information(original_version_path=original_version_path,
+                                                                modified_version_path=modified_version_path,
+                                                                patch_path=patch_path,
+                                                                original_snapshot=original_snapshot,
+                                                                modified_snapshot=modified_snapshot)
 
         # Step 7: Create files which list all modified, new and deleted files
         print("Creating files which contain information about all new files, all modified files and all deleted files")
-        save_new_modified_and_deleted_file_lists(new_files=new_files, 
-                                                modified_files=modified_files,
-                                                deleted_files=deleted_files,
-                                                patch_path=patch_path)
+        with span("save_file_lists"):
+            save_new_modified_and_deleted_file_lists(new_files=new_files,
+                                                    modified_files=modified_files,
+                                                    deleted_files=deleted_files,
+                                                    patch_path=patch_path)
+            save_moved_and_derived_file_lists(moved_files=moved_files,
+                                              derived_files=derived_files,
+                                              patch_path=patch_path)
+            save_target_hashes(file_list=new_files + modified_files + [file for file, _ in moved_files + derived_files],
+                               modified_version_path=modified_version_path,
+                               patch_path=patch_path,
+                               fingerprint_cache=fingerprint_cache,
+                               modified_snapshot=modified_snapshot)
+            apply_plan = save_apply_plan_of_patch(new_files=new_files,
+                                                  modified_files=modified_files,
+                                                  deleted_files=deleted_files,
+                                                  moved_files=moved_files,
+                                                  derived_files=derived_files,
+                                                  patch_path=patch_path,
+                                                  original_snapshot=original_snapshot,
+                                                  modified_snapshot=modified_snapshot)
+            print_apply_plan_summary(apply_plan)
+            # Saved once per run, after the target hashes added the last fingerprints
+            save_fingerprint_cache(fingerprint_cache, fingerprint_cache_path)
+            # The modified version is the original version of the next patch, so both snapshots are kept
+            store_tree_snapshot(original_snapshot, snapshot_directory, fingerprint_cache)
+            store_tree_snapshot(modified_snapshot, snapshot_directory, fingerprint_cache)
         print("Successfully created all file lists!")
 
+        if container:
+            print("Storing the patch within the container {}!".format(container_path))
+            with span("create_container"):
+                number_of_entries = convert_patch_directory(patch_directory=patch_path,
+                                                            container_path=container_path,
+                                                            compressor=compressor)
+            if compressor is not None:
+                compression_stats = compressor.stats()
+            shutil.rmtree(patch_path)
+            patch_path = container_path
+            patch_version_size = os.path.getsize(patch_path)
+            modified_vs_patch_size = "{} / {} = {}".format(modified_version_size, patch_version_size,
+                                                           modified_version_size / patch_version_size)
+            print("Container with {} entries was created!".format(number_of_entries))
+
+    # Everything was finished, so nothing is left to resume
+    if journal is not None:
+        journal.remove()
+
     compressed_version_size = 0
     if compression:
-        if single_file_patching:
-            path_parts = patch_path.split("/")
-            filename = path_parts[-1]
-
-            path_parts = path_parts[:-1]
-            path_without_filename = ""
-            for part in path_parts:
-                path_without_filename += part + "/"
-
-            shutil.make_archive(patch_path, 'zip', path_without_filename)
-            compressed_version_size = os.path.getsize(path_without_filename + "/" + filename + ".zip")
-        else:
-            if patch_path[-1] == "/":
-                patch_path = patch_path[:-1]
+        with span("compress_patch"):
+            if container:
+                # Only the container itself is stored within the archive
+                with zipfile.ZipFile(patch_path + ".zip", "w", zipfile.ZIP_DEFLATED) as zip_ref:
+                    zip_ref.write(patch_path, os.path.basename(patch_path))
+                compressed_version_size = os.path.getsize(patch_path + ".zip")
+            elif single_file_patching:
+                path_parts = patch_path.split("/")
+                filename = path_parts[-1]
+
+                path_parts = path_parts[:-1]
+                path_without_filename = ""
+                for part in path_parts:
+                    path_without_filename += part + "/"
+
+                shutil.make_archive(patch_path, 'zip', path_without_filename)
+                compressed_version_size = os.path.getsize(path_without_filename + "/" + filename + ".zip")
+            else:
+                if patch_path[-1] == "/":
+                    patch_path = patch_path[:-1]
 
-            shutil.make_archive(patch_path, 'zip', patch_path)
-            compressed_version_size = os.path.getsize(patch_path + ".zip")
+                shutil.make_archive(patch_path, 'zip', patch_path)
+                compressed_version_size = os.path.getsize(patch_path + ".zip")
 
-    # Create JSON file and save all measurable stats within it
-    print("Saving JSON-file with all relevant information as: stats.json")
+    # Collect all measurable stats, the caller saves them within the JSON-file
     stats = {
         "time_needed_to_create_patch_file": "{} seconds".format(int(needed_time)),
+        "seconds_needed_to_create_patch_file": round(needed_time, 6),
         "time_needed_to_apply_patch_file": "",
         "size_of_the_original_version": "{} bytes".format(original_version_size),
         "size_of_the_modified_version": "{} bytes".format(modified_version_size),
         "size_of_the_patch_version": "{} bytes".format(patch_version_size),
         "size_of_the_compressed_version": "{} bytes".format(compressed_version_size),
-        "modified_size_vs_patch_size": "{}".format(modified_vs_patch_size)
+        "modified_size_vs_patch_size": "{}".format(modified_vs_patch_size),
+        "number_of_unchanged_files": len(unchanged_files),
+        "unchanged_files": [file[1] + file[0] for file in unchanged_files],
+        "number_of_segments": number_of_segments,
+        "number_of_moved_files": len(moved_files),
+        "number_of_derived_files": len(derived_files),
+        "segment_size": "{} bytes".format(segment_size or 0)
     }
 
-    with open(json_path, "w") as file_handler:
+    if compression_stats is not None:
+        stats["compression_of_the_entries"] = compression_stats
+
+    if apply_plan is not None:
+        stats["apply_plan"] = summarize_apply_plan(apply_plan)
+
+    if selector is not None:
+        selector.close()
+        stats["adaptive_strategy"] = selector.stats()
+
+    if patch_cache is not None:
+        patch_cache.close()
+        stats["patch_cache"] = patch_cache.stats()
+        print("{} diffs were taken from the patch cache, {} were added to it".format(patch_cache.reused_deltas,
+                                                                                    patch_cache.stored_deltas))
+
+    if not single_file_patching:
+        stats["memory_scheduling_of_the_creation"] = memory_budget.stats()
+
+    save_instrumentation(stats, "instrumentation_of_the_creation", trace_path, "patch_file_creator")
+    return stats
+
+
+if __name__ == "__main__":
+    # Step 1: Check if all paths and arguments are valid
+    print("Checking which parameters were set for this script!")
+    args = check_arguments()
+    print("Checking of all parameters finished successfully! Processing continues")
+
+    stats = create_patch_from_arguments(args)
+
+    # Create JSON file and save all measurable stats within it
+    print("Saving JSON-file with all relevant information as: stats.json")
+    with open(args.json_path, "w") as file_handler:
         json.dump(stats, file_handler, indent=4, sort_keys=True, ensure_ascii=True)
     print("JSON-file successfully saved!")
 
 
-    print("Finished processing!")
\ No newline at end of file
+    print("Finished processing!")
@@ -0,0 +1,290 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import zlib
+
+from file_fingerprints import get_file_fingerprint, load_fingerprint_cache, save_fingerprint_cache
+from patch_cache import PatchCache, get_tree_patch_key
+from tree_snapshot import get_tree_snapshot, store_tree_snapshot
+
+
+script_directory = os.path.dirname(os.path.abspath(__file__))
+creator_script = script_directory + "/patch_file_creator.py"
+
+supported_tools = ["bsdiff", "xdelta", "rsync", "cdc", "text", "adaptive"]
+# Every creator tool is applied by its counterpart, patches which mix tools are recognized file by file
+applier_tools = {"bsdiff": "bspatch", "xdelta": "xdelta", "rsync": "rsync", "cdc": "cdc", "text": "text",
+                 "adaptive": "auto"}
+# Models of the adaptive creator which estimate the size of a direct patch. The text tool leaves every file
+# which is not text to bsdiff, the adaptive creator picks the best tool for every file.
+estimate_models = {"bsdiff": ["bsdiff"], "xdelta": ["xdelta"], "rsync": ["rsync"], "cdc": ["cdc"],
+                   "text": ["bsdiff"], "adaptive": ["bsdiff", "xdelta", "rsync", "cdc"]}
+
+# A chain saves creating a new patch, so it may hold a bit more than the direct patch is estimated at
+maximum_chain_overhead = 1.25
+
+# Every route directory holds its steps and this description, the applier takes the directory as its patch
+route_file_name = "route.json"
+
+
+def is_path_valid(path_to_check):
+    if os.path.isdir(path_to_check):
+        print("Path: {} exists".format(path_to_check))
+        return True
+    else:
+        print("The directory {} does not exist! Processing stops!".format(path_to_check))
+        return False
+
+
+def calculate_version_hash(version_path, snapshot_directory, fingerprint_cache):
+    snapshot = get_tree_snapshot(version_path, snapshot_directory)
+    snapshot.seed_fingerprint_cache(fingerprint_cache)
+    tree_hash = snapshot.tree_hash(fingerprint_cache)
+    store_tree_snapshot(snapshot, snapshot_directory, fingerprint_cache)
+    return tree_hash
+
+
+def create_direct_patch(source_version_path, target_version_path, work_path, tool, jobs, cache_path,
+                        cache_size, snapshot_directory, fingerprint_cache_path):
+    # The creator shares the cache, so every diff of a file pair which was seen before is reused
+    patch_file = work_path + "/patch.dupatch"
+    command = [sys.executable, creator_script,
+               "-o", source_version_path,
+               "-m", target_version_path,
+               "-p", patch_file,
+               "-t", tool,
+               "-j", work_path + "/stats.json",
+               "-b",
+               "-n", str(jobs),
+               "-k", fingerprint_cache_path,
+               "-S", snapshot_directory,
+               "-P", cache_path]
+    if cache_size:
+        command += ["-C", str(cache_size)]
+
+    with open(work_path + "/creator.log", "w") as log_handler:
+        return_value = subprocess.call(command, stdout=log_handler, stderr=subprocess.STDOUT)
+    if return_value != 0:
+        print("Creating the patch from {} failed, see {}".format(source_version_path, work_path + "/creator.log"))
+        return None
+    return patch_file
+
+
+def is_patch_route(patch_path):
+    return os.path.isfile(patch_path.rstrip("/") + "/" + route_file_name)
+
+
+def read_route(route_path):
+    with open(route_path.rstrip("/") + "/" + route_file_name, "r") as file_handler:
+        return json.load(file_handler)
+
+
+def estimate_direct_patch_size(source_version_path, target_version_path, snapshot_directory, fingerprint_cache,
+                               tool):
+    # Files whose content exists anywhere within the source version cost nothing, new files are stored
+    # compressed and changed files are estimated with the cost models of the adaptive creator. A changed file
+    # rewrites at least one match of the tool, however similar it looks.
+    from adaptive_strategy import estimate_tool, profile_files, read_samples, tool_models
+
+    source_snapshot = get_tree_snapshot(source_version_path, snapshot_directory)
+    target_snapshot = get_tree_snapshot(target_version_path, snapshot_directory)
+    source_hashes = set()
+    for file in source_snapshot.file_list():
+        index = source_snapshot.find_file(file)
+        source_hashes.add(get_file_fingerprint(source_snapshot.file_path(index), fingerprint_cache,
+                                               source_snapshot.file_stat(file)))
+
+    estimated_size = 0
+    for file in target_snapshot.file_list():
+        index = target_snapshot.find_file(file)
+        target_file = target_snapshot.file_path(index)
+        if get_file_fingerprint(target_file, fingerprint_cache, target_snapshot.file_stat(file)) in source_hashes:
+            continue
+        size = target_snapshot.file_stat(file).st_size
+        if source_snapshot.find_file(file) is None or size == 0:
+            sample = read_samples(target_file, size)
+            estimated_size += int(size * min(1.0, len(zlib.compress(sample, 1)) / len(sample))) if sample else 0
+            continue
+        profile = profile_files(source_snapshot.file_path(source_snapshot.find_file(file)), target_file)
+        estimated_size += min(max(estimate_tool(tool_models[model], profile, True)[0],
+                                  min(size, tool_models[model].granularity(size)))
+                              for model in estimate_models[tool])
+    return estimated_size
+
+
+def export_route(patch_cache, route, route_path, source_version_path, target_version_path, source_hash,
+                 target_hash, tool):
+    # Every step is a patch container which is applied on top of the result of the step before
+    if os.path.exists(route_path):
+        shutil.rmtree(route_path)
+    os.makedirs(route_path)
+
+    steps = []
+    for number, key in enumerate(route, 1):
+        entry = patch_cache.tree_patch_entry(key)
+        step_file = "step_{}.dupatch".format(number)
+        patch_cache.fetch_tree_patch(entry["source"], entry["target"], tool, route_path + "/" + step_file)
+        steps.append({"patch_file": step_file, "source_tree_hash": entry["source"],
+                      "target_tree_hash": entry["target"], "size": entry["size"]})
+
+    with open(route_path + "/" + route_file_name, "w") as file_handler:
+        json.dump({"source_version_path": source_version_path,
+                   "target_version_path": target_version_path,
+                   "source_tree_hash": source_hash,
+                   "target_tree_hash": target_hash,
+                   "tool": tool,
+                   "applier_tool": applier_tools[tool],
+                   "steps": steps}, file_handler, indent=4, sort_keys=True)
+    return sum(step["size"] for step in steps)
+
+
+def check_arguments():
+    parser = argparse.ArgumentParser()
+
+    # Required Arguments
+    parser.add_argument("-o", "--original_version_paths", required=True, nargs="+",
+                        help="Directories of all old versions which have to be updated to the modified version")
+    parser.add_argument("-m", "--modified_version_path", required=True,
+                        help="Directory of the version all old versions are updated to")
+    parser.add_argument("-p", "--patch_path", required=True,
+                        help="Directory in which the patches are stored, one directory per old version")
+    parser.add_argument("-c", "--cache_path", required=True,
+                        help="Directory of the patch cache which is shared by all runs")
+
+    # Optional Arguments
+    parser.add_argument("-t", "--tool",
+                        help="Differential update tool, one of: {}".format(", ".join(supported_tools)),
+                        default="bsdiff")
+    parser.add_argument("-n", "--jobs",
+                        help="Number of diffs which are created in parallel",
+                        type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument("-C", "--cache_size",
+                        help="Size limit of the patch cache in MB. Default is no limit",
+                        type=int,
+                        default=None)
+    parser.add_argument("-d", "--direct",
+                        help="Set this flag to always create a direct patch instead of chaining cached patches",
+                        action='store_true',
+                        default=False)
+    parser.add_argument("-j", "--json_path",
+                        help="Path of the JSON-file which lists the route of every old version",
+                        default=None)
+
+    args = parser.parse_args()
+
+    for path in args.original_version_paths + [args.modified_version_path]:
+        if not is_path_valid(path):
+            exit(1)
+
+    if args.tool not in supported_tools:
+        print("Chosen tool is not supported by this program! Processing stops!")
+        exit(2)
+
+    if args.jobs < 1:
+        print("At least one job is needed for creating the patches! Processing stops!")
+        exit(2)
+
+    if args.cache_size is not None and args.cache_size < 1:
+        print("The patch cache needs at least 1 MB! Processing stops!")
+        exit(2)
+
+    if args.direct:
+        print("Flag for direct patches was set! Cached patches are never chained!")
+
+    return args
+
+
+if __name__ == "__main__":
+    print("Checking which parameters were set for this script!")
+    args = check_arguments()
+    print("Checking of all parameters finished successfully! Processing continues")
+
+    cache_path = args.cache_path.rstrip("/")
+    patch_path = args.patch_path.rstrip("/")
+    tool = args.tool
+    snapshot_directory = cache_path + "/snapshots"
+    fingerprint_cache_path = cache_path + "/fingerprints.json"
+    cache_size = args.cache_size * 1024 * 1024 if args.cache_size else None
+    os.makedirs(patch_path, exist_ok=True)
+
+    # Versions are identified by the content of their files, wherever they are stored
+    fingerprint_cache = load_fingerprint_cache(fingerprint_cache_path)
+    target_hash = calculate_version_hash(args.modified_version_path, snapshot_directory, fingerprint_cache)
+    print("Tree hash of the modified version: {}".format(target_hash))
+
+    routes = {}
+    for source_version_path in args.original_version_paths:
+        print("=======================================================================")
+        source_hash = calculate_version_hash(source_version_path, snapshot_directory, fingerprint_cache)
+        save_fingerprint_cache(fingerprint_cache, fingerprint_cache_path)
+        route_path = patch_path + "/" + os.path.basename(source_version_path.rstrip("/"))
+        print("Tree hash of {}: {}".format(source_version_path, source_hash))
+
+        if source_hash == target_hash:
+            print("{} is already equal to the modified version!".format(source_version_path))
+            routes[source_version_path] = {"kind": "equal", "steps": 0, "size": 0}
+            continue
+
+        patch_cache = PatchCache(cache_path, cache_size)
+        route = None
+        estimated_size = None
+        direct_key = get_tree_patch_key(source_hash, target_hash, tool)
+        if patch_cache.has_object(direct_key):
+            route = [direct_key]
+            kind = "cached"
+        elif not args.direct:
+            # A chain of cached patches saves creating a direct patch, but it is only used as long as the
+            # clients do not have to fetch more than the direct patch would hold
+            chain, chain_size = patch_cache.find_patch_chain(source_hash, target_hash, tool)
+            if chain is not None:
+                estimated_size = estimate_direct_patch_size(source_version_path, args.modified_version_path,
+                                                            snapshot_directory, fingerprint_cache, tool)
+                print("Cached chain with {} steps holds {} bytes, a direct patch is estimated at {} bytes".format(
+                    len(chain), chain_size, estimated_size))
+                if chain_size <= estimated_size * maximum_chain_overhead:
+                    route = chain
+                    kind = "chain"
+
+        if route is None:
+            print("No cached patch leads from {} to the modified version at a lower size, a direct patch is "
+                  "created!".format(source_version_path))
+            # The creator uses the cache on its own, so the index is written before it starts
+            patch_cache.close()
+            work_path = route_path + ".work"
+            os.makedirs(work_path, exist_ok=True)
+            patch_file = create_direct_patch(source_version_path, args.modified_version_path, work_path, tool,
+                                             args.jobs, cache_path, args.cache_size, snapshot_directory,
+                                             fingerprint_cache_path)
+            # The creator added the hashes of the files it diffed
+            fingerprint_cache = load_fingerprint_cache(fingerprint_cache_path)
+            patch_cache = PatchCache(cache_path, cache_size)
+            if patch_file is None:
+                patch_cache.close()
+                routes[source_version_path] = {"kind": "failed", "steps": 0, "size": 0}
+                continue
+            route = [patch_cache.store_tree_patch(source_hash, target_hash, tool, patch_file)]
+            shutil.rmtree(work_path)
+            kind = "created"
+
+        size = export_route(patch_cache, route, route_path, source_version_path, args.modified_version_path,
+                            source_hash, target_hash, tool)
+        patch_cache.close()
+        routes[source_version_path] = {"kind": kind, "steps": len(route), "size": size,
+                                       "estimated_direct_size": estimated_size}
+        print("Route from {} with {} steps and {} bytes ({}) was stored within {}".format(
+            source_version_path, len(route), size, kind, route_path))
+
+    print("=======================================================================")
+    for source_version_path, route in routes.items():
+        print("{}: {}, {} steps, {} bytes".format(source_version_path, route["kind"], route["steps"], route["size"]))
+
+    if args.json_path:
+        with open(args.json_path, "w") as file_handler:
+            json.dump({"target_tree_hash": target_hash, "routes": routes}, file_handler, indent=4, sort_keys=True)
+
+    if any(route["kind"] == "failed" for route in routes.values()):
+        exit(1)
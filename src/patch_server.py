@@ -0,0 +1,203 @@
+import argparse
+import email.utils
+import http.server
+import os
+import re
+import threading
+import urllib.parse
+
+from compression import codecs_by_name
+from file_fingerprints import get_file_fingerprint
+from patch_container import PatchContainerReader, is_patch_container
+
+
+# Every file below the served directory is sent as it is. A path below a patch container names one of its
+# entries, e.g. /update.dupatch/dir/file, whose stored payload is sent together with its codec.
+codec_names = {codec.identifier: name for name, codec in codecs_by_name.items()}
+
+
+def parse_range(header, size):
+    # Only single ranges are served, everything else is answered with the whole file as RFC 9110 allows.
+    # Returns (start, end) with end exclusive, None for the whole file or False if nothing can be served.
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", (header or "").strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        # The last n bytes
+        length = int(match.group(2))
+        if length == 0:
+            return False
+        return max(0, size - length), size
+    start = int(match.group(1))
+    end = size if match.group(2) == "" else min(size, int(match.group(2)) + 1)
+    if start >= size or end <= start:
+        return False
+    return start, end
+
+
+class PatchRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Persistent connections let a client send all its range requests through the same few sockets
+    protocol_version = "HTTP/1.1"
+    server_version = "PatchServer/1.0"
+
+    def resolve(self):
+        # Returns the file, the offset and the size of what the path names and the headers which describe it
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        parts = [part for part in path.split("/") if part]
+        if any(part in (".", "..") for part in parts):
+            return None
+
+        file_path = self.server.directory
+        for index, part in enumerate(parts):
+            file_path += "/" + part
+            if os.path.isfile(file_path):
+                break
+        else:
+            return None
+
+        file_stat = os.stat(file_path)
+        etag = '"{}"'.format(self.server.fingerprint(file_path, file_stat))
+        headers = {"Last-Modified": email.utils.formatdate(file_stat.st_mtime, usegmt=True)}
+        entry_path = "/".join(parts[index + 1:])
+        if not entry_path:
+            return file_path, 0, file_stat.st_size, etag, headers
+        if not is_patch_container(file_path):
+            return None
+
+        container, entries = self.server.container_index(file_path, etag)
+        entry = entries.get(entry_path)
+        if entry is None:
+            return None
+        headers["X-Patch-Codec"] = codec_names.get(entry.codec, str(entry.codec))
+        headers["X-Patch-Uncompressed-Size"] = str(entry.uncompressed_size)
+        target_hash = container.target_hash(entry.path)
+        if target_hash:
+            headers["X-Patch-Target-Hash"] = target_hash
+        # An entry changes whenever its container does
+        return file_path, entry.offset, entry.size, '"{}:{}"'.format(etag.strip('"'), entry.offset), headers
+
+    def send_file(self, send_body):
+        resolved = self.resolve()
+        if resolved is None:
+            self.send_error(404, "No such file or entry")
+            return
+        file_path, offset, size, etag, headers = resolved
+
+        if self.headers.get("If-None-Match") in (etag, "*"):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        # A range of another version of the file is worthless, the client gets the whole file instead
+        byte_range = None
+        if self.headers.get("If-Range") in (None, etag):
+            byte_range = parse_range(self.headers.get("Range"), size)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{}".format(size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start, end = byte_range or (0, size)
+        self.send_response(206 if byte_range else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if byte_range:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, size))
+        self.end_headers()
+
+        if send_body and end > start:
+            # The kernel copies the file straight into the socket
+            with open(file_path, "rb") as file_handler:
+                self.wfile.flush()
+                self.connection.sendfile(file_handler, offset + start, end - start)
+
+    def do_GET(self):
+        self.send_file(send_body=True)
+
+    def do_HEAD(self):
+        self.send_file(send_body=False)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class PatchServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, directory, verbose=False):
+        super().__init__(address, PatchRequestHandler)
+        self.directory = os.path.abspath(directory)
+        self.verbose = verbose
+        self.fingerprint_cache = {}
+        self.fingerprint_locks = {}
+        self.container_indexes = {}
+        self.lock = threading.Lock()
+        self.container_lock = threading.Lock()
+
+    def fingerprint(self, file_path, file_stat):
+        # The hash of a file is calculated once and reused as long as the file is unchanged. Only requests for
+        # the same file wait while it is hashed, all others are served in the meantime.
+        with self.lock:
+            file_lock = self.fingerprint_locks.setdefault(file_path, threading.Lock())
+        with file_lock:
+            return get_file_fingerprint(file_path, self.fingerprint_cache, file_stat)
+
+    def container_index(self, file_path, etag):
+        # Paths within a container may hold empty parts like "/dir//file", a URL names the entry without them
+        with self.container_lock:
+            cached = self.container_indexes.get(file_path)
+            if cached is None or cached[0] != etag:
+                if cached is not None:
+                    cached[1].close()
+                container = PatchContainerReader(file_path)
+                entries = {"/".join(part for part in entry.path.split("/") if part): entry
+                           for entry in container.entries}
+                cached = (etag, container, entries)
+                self.container_indexes[file_path] = cached
+            return cached[1], cached[2]
+
+    def server_close(self):
+        super().server_close()
+        for _, container, _ in self.container_indexes.values():
+            container.close()
+
+
+def check_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d", "--directory", required=True,
+                        help="Directory with the patch containers and files which are served")
+    parser.add_argument("-b", "--bind", default="127.0.0.1",
+                        help="Address the server listens on. Default is localhost only")
+    parser.add_argument("-P", "--port", type=int, default=8000,
+                        help="Port the server listens on, 0 picks a free port")
+    parser.add_argument("-v", "--verbose", action='store_true', default=False,
+                        help="Log every request")
+
+    args = parser.parse_args()
+    if not os.path.isdir(args.directory):
+        print("The path {} is not a directory! Processing stops!".format(args.directory))
+        exit(1)
+
+    return args
+
+
+if __name__ == "__main__":
+    args = check_arguments()
+
+    server = PatchServer((args.bind, args.port), args.directory, args.verbose)
+    print("Serving {} on http://{}:{}/".format(server.directory, *server.server_address[:2]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Server stopped!")
+    finally:
+        server.server_close()
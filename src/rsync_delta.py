@@ -0,0 +1,258 @@
+import bisect
+import hashlib
+import math
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from file_fingerprints import HashingFileWriter
+
+
+# Layout of a delta file:
+#   header:  magic | block size | size of the modified file
+#   copy:    b"C" | index of the first block | number of consecutive blocks
+#   literal: b"L" | length | data
+delta_magic = b"RSDELTA1"
+header_format = ">8sIQ"
+copy_format = ">QI"
+literal_format = ">I"
+
+minimum_block_size = 700
+maximum_block_size = 128 * 1024
+# Checksums are computed window by window, every window needs a few arrays of 4 bytes per position
+scan_segment_size = 1024 * 1024
+maximum_literal_size = 64 * 1024 * 1024
+# Repetitive data shares weak checksums among many blocks, only the first ones are confirmed by their strong hash
+maximum_candidates_per_checksum = 16
+
+
+def choose_block_size(file_size):
+    # Same rule of thumb as rsync: roughly the square root of the file size
+    block_size = int(math.sqrt(file_size)) & ~7
+    return max(minimum_block_size, min(maximum_block_size, block_size))
+
+
+def map_file(file_path):
+    # Empty files can not be memory-mapped, they are represented by an empty buffer instead
+    with open(file_path, "rb") as file_handler:
+        if os.fstat(file_handler.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(file_handler.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def calculate_strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def calculate_block_checksums(data, block_size):
+    # Weak checksums of all complete blocks, computed block-wise on the whole array at once. Only the lower
+    # 16 bits of both sums are kept, so they are computed modulo 2^32 without any wider temporaries.
+    number_of_blocks = len(data) // block_size
+    blocks = np.frombuffer(data, dtype=np.uint8, count=number_of_blocks * block_size)
+    blocks = blocks.reshape(number_of_blocks, block_size).astype(np.uint32)
+    weights = np.arange(block_size, 0, -1, dtype=np.uint32)
+
+    a = blocks.sum(axis=1, dtype=np.uint32) & 0xFFFF
+    b = (blocks * weights).sum(axis=1, dtype=np.uint32) & 0xFFFF
+    return a | (b << 16)
+
+
+def create_signature(original_data, block_size):
+    # Maps every weak checksum to the indices of all blocks of the original which share it
+    signature = {}
+    blocks_per_step = max(1, scan_segment_size // block_size)
+    number_of_blocks = len(original_data) // block_size
+
+    for first_block in range(0, number_of_blocks, blocks_per_step):
+        last_block = min(number_of_blocks, first_block + blocks_per_step)
+        chunk = original_data[first_block * block_size:last_block * block_size]
+        checksums = calculate_block_checksums(chunk, block_size)
+        for index, checksum in enumerate(checksums.tolist()):
+            blocks = signature.setdefault(checksum, [])
+            if len(blocks) < maximum_candidates_per_checksum:
+                blocks.append(first_block + index)
+
+    return signature
+
+
+def calculate_rolling_checksums(data, block_size):
+    # Weak checksums of every window of block_size bytes, based on prefix sums:
+    #   a(k) = S(k + B) - S(k)
+    #   b(k) = (k + B) * a(k) - (T(k + B) - T(k))   with T being the prefix sum of i * x(i)
+    # Wrapping around at 2^32 leaves the lower 16 bits of both sums intact
+    values = np.frombuffer(data, dtype=np.uint8).astype(np.uint32)
+    s = np.zeros(len(values) + 1, dtype=np.uint32)
+    t = np.zeros(len(values) + 1, dtype=np.uint32)
+    np.cumsum(values, out=s[1:])
+    values *= np.arange(len(values), dtype=np.uint32)
+    np.cumsum(values, out=t[1:])
+    del values
+
+    a = s[block_size:] - s[:-block_size]
+    b = np.arange(block_size, len(s), dtype=np.uint32) * a
+    b -= t[block_size:] - t[:-block_size]
+    return (a & 0xFFFF) | ((b & 0xFFFF) << 16)
+
+
+def find_candidate_positions(modified_data, signature, block_size):
+    # Positions and weak checksums of all windows whose checksum is known, one sorted list per segment
+    known_checksums = np.fromiter(signature.keys(), dtype=np.uint32, count=len(signature))
+    last_position = len(modified_data) - block_size
+
+    for segment_start in range(0, last_position + 1, scan_segment_size):
+        segment_end = min(last_position + 1, segment_start + scan_segment_size)
+        window = modified_data[segment_start:segment_end + block_size - 1]
+        checksums = calculate_rolling_checksums(window, block_size)
+        matches = np.nonzero(np.isin(checksums, known_checksums))[0]
+        yield (matches + segment_start).tolist(), checksums[matches].tolist()
+
+
+class DeltaWriter:
+    def __init__(self, file_handler, modified_data):
+        self.file_handler = file_handler
+        self.modified_data = modified_data
+        self.pending_copy = None
+
+    def flush_copy(self):
+        if self.pending_copy is not None:
+            self.file_handler.write(b"C" + struct.pack(copy_format, *self.pending_copy))
+            self.pending_copy = None
+
+    def write_copy(self, block_index):
+        if self.pending_copy is not None and self.pending_copy[0] + self.pending_copy[1] == block_index:
+            self.pending_copy = (self.pending_copy[0], self.pending_copy[1] + 1)
+        else:
+            self.flush_copy()
+            self.pending_copy = (block_index, 1)
+
+    def write_literal(self, start, end):
+        if start >= end:
+            return
+        self.flush_copy()
+        for chunk_start in range(start, end, maximum_literal_size):
+            chunk_end = min(end, chunk_start + maximum_literal_size)
+            self.file_handler.write(b"L" + struct.pack(literal_format, chunk_end - chunk_start))
+            self.file_handler.write(self.modified_data[chunk_start:chunk_end])
+
+
+def create_delta(original_data, modified_data, file_handler, block_size=None):
+    if block_size is None:
+        block_size = choose_block_size(len(original_data))
+
+    file_handler.write(struct.pack(header_format, delta_magic, block_size, len(modified_data)))
+    writer = DeltaWriter(file_handler, modified_data)
+
+    literal_start = 0
+    if len(original_data) >= block_size and len(modified_data) >= block_size:
+        signature = create_signature(original_data, block_size)
+        number_of_blocks = len(original_data) // block_size
+        strong_hashes = {}
+        expected_block = None
+
+        for positions, checksums in find_candidate_positions(modified_data, signature, block_size):
+            index = bisect.bisect_left(positions, literal_start)
+            while index < len(positions):
+                position = positions[index]
+                modified_hash = calculate_strong_hash(modified_data[position:position + block_size])
+                candidates = signature[checksums[index]]
+                # Continuing the previous run of blocks keeps the copy instructions merged
+                if position == literal_start and expected_block is not None and expected_block < number_of_blocks:
+                    candidates = [expected_block] + candidates
+
+                matching_block = None
+                for block_index in candidates:
+                    if block_index not in strong_hashes:
+                        block_data = original_data[block_index * block_size:(block_index + 1) * block_size]
+                        strong_hashes[block_index] = calculate_strong_hash(block_data)
+                    if strong_hashes[block_index] == modified_hash:
+                        matching_block = block_index
+                        break
+
+                if matching_block is None:
+                    index += 1
+                    continue
+                writer.write_literal(literal_start, position)
+                writer.write_copy(matching_block)
+                literal_start = position + block_size
+                expected_block = matching_block + 1
+                # Hits within the copied block are skipped at once instead of one by one
+                index = bisect.bisect_left(positions, literal_start, index)
+
+    writer.write_literal(literal_start, len(modified_data))
+    writer.flush_copy()
+
+
+def create_delta_file(original_version_file, modified_version_file, patch_file, block_size=None):
+    original_data = map_file(original_version_file)
+    modified_data = map_file(modified_version_file)
+    try:
+        with open(patch_file, "wb") as file_handler:
+            create_delta(original_data, modified_data, file_handler, block_size)
+    finally:
+        for data in (original_data, modified_data):
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+def read_exactly(patch_handler, length):
+    data = patch_handler.read(length)
+    if len(data) != length:
+        raise ValueError("Delta ends unexpectedly")
+    return data
+
+
+def apply_delta_stream(original_data, patch_handler, file_handler):
+    # The delta is read front to back, so it may come straight out of a container or an archive
+    magic, block_size, modified_size = struct.unpack(header_format,
+                                                     read_exactly(patch_handler, struct.calcsize(header_format)))
+    if magic != delta_magic:
+        raise ValueError("Given data is not a delta created by the rsync engine")
+
+    written = 0
+    instruction = patch_handler.read(1)
+    while instruction:
+        if instruction == b"C":
+            first_block, number_of_blocks = struct.unpack(copy_format,
+                                                          read_exactly(patch_handler, struct.calcsize(copy_format)))
+            start = first_block * block_size
+            end = start + number_of_blocks * block_size
+            if end > len(original_data):
+                raise ValueError("Delta references data beyond the end of the original file")
+            file_handler.write(original_data[start:end])
+            written += end - start
+        elif instruction == b"L":
+            length, = struct.unpack(literal_format, read_exactly(patch_handler, struct.calcsize(literal_format)))
+            remaining = length
+            while remaining > 0:
+                data = read_exactly(patch_handler, min(scan_segment_size, remaining))
+                file_handler.write(data)
+                remaining -= len(data)
+            written += length
+        else:
+            raise ValueError("Unknown instruction {} within the delta".format(instruction))
+        instruction = patch_handler.read(1)
+
+    if written != modified_size:
+        raise ValueError("Delta produced {} bytes instead of {} bytes".format(written, modified_size))
+
+
+def apply_delta_file(original_version_file, patch_file, output_file, output_hash=None):
+    with open(patch_file, "rb") as patch_handler:
+        apply_delta_stream_file(original_version_file, patch_handler, output_file, output_hash)
+
+
+def apply_delta_stream_file(original_version_file, patch_handler, output_file, output_hash=None):
+    # The applier passes a temporary output of the placement layer, which replaces the destination once the
+    # result was verified and is removed if the patch fails, so the result is written straight into it
+    original_data = map_file(original_version_file)
+    try:
+        with open(output_file, "wb") as file_handler:
+            # The hash of the result is calculated while it is written
+            if output_hash is not None:
+                file_handler = HashingFileWriter(file_handler, output_hash)
+            apply_delta_stream(original_data, patch_handler, file_handler)
+    finally:
+        if isinstance(original_data, mmap.mmap):
+            original_data.close()
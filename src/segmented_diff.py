@@ -0,0 +1,222 @@
+import concurrent.futures
+import os
+import shutil
+import struct
+import tempfile
+
+from instrumentation import submit_in_context
+from journal import find_finished_unit, finish_unit
+
+
+# Layout of a segmented patch file:
+#   header:  magic | number of segments | size of the modified file
+#   table:   one row per segment (kind | original offset | original length | modified length | patch length)
+#   payload: the patches of all segments in the order of the table
+segmented_magic = b"SEGPATCH"
+header_format = ">8sIQ"
+segment_format = ">BQQQQ"
+
+segment_kind_delta = 0
+segment_kind_raw = 1
+
+segment_alignment = 4096
+copy_buffer_size = 1024 * 1024
+
+
+def is_segmented_patch_file(patch_file):
+    with open(patch_file, "rb") as file_handler:
+        return file_handler.read(len(segmented_magic)) == segmented_magic
+
+
+def align_down(offset):
+    return offset - offset % segment_alignment
+
+
+def calculate_segments(original_size, modified_size, segment_size, overlap):
+    # Every window of the modified file is matched with the proportional region of the original,
+    # widened by the overlap on both sides so that shifted content is still found
+    segments = []
+    ratio = original_size / modified_size if modified_size else 0
+    for modified_offset in range(0, modified_size, segment_size):
+        modified_length = min(segment_size, modified_size - modified_offset)
+        original_start = align_down(max(0, int(modified_offset * ratio) - overlap))
+        original_end = min(original_size, int((modified_offset + modified_length) * ratio) + overlap)
+        segments.append((modified_offset, modified_length, original_start, max(0, original_end - original_start)))
+    return segments
+
+
+def copy_range(source_file, offset, length, destination_file):
+    with open(source_file, "rb") as source_handler, open(destination_file, "wb") as destination_handler:
+        source_handler.seek(offset)
+        while length > 0:
+            chunk = source_handler.read(min(copy_buffer_size, length))
+            if not chunk:
+                break
+            destination_handler.write(chunk)
+            length -= len(chunk)
+
+
+def create_segment_patch(original_version_file, modified_version_file, segment, work_directory, index, diff_function,
+                         journal=None):
+    modified_offset, modified_length, original_offset, original_length = segment
+    original_segment_file = "{}/{}.original".format(work_directory, index)
+    modified_segment_file = "{}/{}.modified".format(work_directory, index)
+    patch_segment_file = "{}/{}.patch".format(work_directory, index)
+
+    # Segments which were finished by an interrupted run are taken over as they are
+    unit = "segment:{}".format(index)
+    record = find_finished_unit(journal, unit, [original_version_file, modified_version_file], patch_segment_file)
+    if record is not None and record["segment"] == list(segment):
+        print("Segment {} was already created by an earlier run!".format(index))
+        return record["kind"], patch_segment_file
+
+    copy_range(original_version_file, original_offset, original_length, original_segment_file)
+    copy_range(modified_version_file, modified_offset, modified_length, modified_segment_file)
+
+    result = diff_function(original_segment_file, modified_segment_file, patch_segment_file)
+    os.remove(original_segment_file)
+
+    # A segment which can not be diffed or does not get smaller is stored as it is
+    if result > 0 or not os.path.exists(patch_segment_file) or os.path.getsize(patch_segment_file) >= modified_length:
+        print("Segment {} is stored without a diff!".format(index))
+        if os.path.exists(patch_segment_file):
+            os.remove(patch_segment_file)
+        os.rename(modified_segment_file, patch_segment_file)
+        finish_unit(journal, unit, [original_version_file, modified_version_file], patch_segment_file,
+                    segment=list(segment), kind=segment_kind_raw)
+        return segment_kind_raw, patch_segment_file
+
+    os.remove(modified_segment_file)
+    finish_unit(journal, unit, [original_version_file, modified_version_file], patch_segment_file,
+                segment=list(segment), kind=segment_kind_delta)
+    return segment_kind_delta, patch_segment_file
+
+
+def create_segmented_patch_file(original_version_file, modified_version_file, patch_file, diff_function,
+                                segment_size, overlap=None, jobs=None, journal=None):
+    original_size = os.path.getsize(original_version_file)
+    modified_size = os.path.getsize(modified_version_file)
+    if overlap is None:
+        overlap = segment_size // 8
+
+    segments = calculate_segments(original_size, modified_size, segment_size, overlap)
+    print("The modified file is split into {} segments of up to {} bytes".format(len(segments), segment_size))
+
+    # With a journal the segments are kept at a fixed place, so that a rerun finds the finished ones
+    if journal is not None:
+        work_directory = patch_file + ".segments"
+        os.makedirs(work_directory, exist_ok=True)
+    else:
+        work_directory = tempfile.mkdtemp(prefix="segments_", dir=os.path.dirname(os.path.abspath(patch_file)))
+    finished = False
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            results = [submit_in_context(executor, create_segment_patch, original_version_file,
+                                         modified_version_file, segment, work_directory, index, diff_function,
+                                         journal)
+                       for index, segment in enumerate(segments)]
+            segment_patches = [result.result() for result in results]
+
+        with open(patch_file, "wb") as file_handler:
+            file_handler.write(struct.pack(header_format, segmented_magic, len(segments), modified_size))
+            for segment, (kind, segment_patch_file) in zip(segments, segment_patches):
+                modified_offset, modified_length, original_offset, original_length = segment
+                file_handler.write(struct.pack(segment_format, kind, original_offset, original_length,
+                                               modified_length, os.path.getsize(segment_patch_file)))
+            for _, segment_patch_file in segment_patches:
+                with open(segment_patch_file, "rb") as segment_handler:
+                    shutil.copyfileobj(segment_handler, file_handler, copy_buffer_size)
+        finished = True
+    finally:
+        if finished or journal is None:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    return 0
+
+
+def create_raw_patch_file(modified_version_file, patch_file):
+    # A single raw segment, for files which are cheaper to store as they are than to diff
+    modified_size = os.path.getsize(modified_version_file)
+    with open(patch_file, "wb") as file_handler:
+        file_handler.write(struct.pack(header_format, segmented_magic, 1, modified_size))
+        file_handler.write(struct.pack(segment_format, segment_kind_raw, 0, 0, modified_size, modified_size))
+        with open(modified_version_file, "rb") as modified_handler:
+            shutil.copyfileobj(modified_handler, file_handler, copy_buffer_size)
+    return 0
+
+
+def read_segment_table(patch_file):
+    segments = []
+    with open(patch_file, "rb") as file_handler:
+        magic, number_of_segments, modified_size = struct.unpack(header_format,
+                                                                 file_handler.read(struct.calcsize(header_format)))
+        if magic != segmented_magic:
+            raise ValueError("{} is not a segmented patch file".format(patch_file))
+
+        payload_offset = struct.calcsize(header_format) + number_of_segments * struct.calcsize(segment_format)
+        modified_offset = 0
+        for _ in range(number_of_segments):
+            kind, original_offset, original_length, modified_length, patch_length = \
+                struct.unpack(segment_format, file_handler.read(struct.calcsize(segment_format)))
+            segments.append((kind, original_offset, original_length, modified_offset, modified_length,
+                             payload_offset, patch_length))
+            modified_offset += modified_length
+            payload_offset += patch_length
+
+    return modified_size, segments
+
+
+def apply_segment_patch(original_version_file, patch_file, output_file, segment, work_directory, index,
+                        apply_function):
+    kind, original_offset, original_length, modified_offset, modified_length, payload_offset, patch_length = segment
+    patch_segment_file = "{}/{}.patch".format(work_directory, index)
+    output_segment_file = "{}/{}.output".format(work_directory, index)
+    copy_range(patch_file, payload_offset, patch_length, patch_segment_file)
+
+    if kind == segment_kind_raw:
+        os.rename(patch_segment_file, output_segment_file)
+    else:
+        original_segment_file = "{}/{}.original".format(work_directory, index)
+        copy_range(original_version_file, original_offset, original_length, original_segment_file)
+        result = apply_function(original_segment_file, patch_segment_file, output_segment_file)
+        os.remove(original_segment_file)
+        os.remove(patch_segment_file)
+        if result > 0:
+            return result
+
+    if os.path.getsize(output_segment_file) != modified_length:
+        print("Segment {} has the wrong size after patching!".format(index))
+        return 1
+
+    # Every segment is written straight to its final position within the output file
+    with open(output_segment_file, "rb") as segment_handler, open(output_file, "r+b") as output_handler:
+        output_handler.seek(modified_offset)
+        shutil.copyfileobj(segment_handler, output_handler, copy_buffer_size)
+    os.remove(output_segment_file)
+    return 0
+
+
+def apply_segmented_patch_file(original_version_file, patch_file, output_file, apply_function, jobs=None):
+    modified_size, segments = read_segment_table(patch_file)
+
+    temporary_output_file = output_file + ".segments.tmp"
+    with open(temporary_output_file, "wb") as file_handler:
+        file_handler.truncate(modified_size)
+
+    work_directory = tempfile.mkdtemp(prefix="segments_", dir=os.path.dirname(os.path.abspath(output_file)))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            results = [submit_in_context(executor, apply_segment_patch, original_version_file, patch_file,
+                                         temporary_output_file, segment, work_directory, index, apply_function)
+                       for index, segment in enumerate(segments)]
+            failed_segments = [index for index, result in enumerate(results) if result.result() > 0]
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    if failed_segments:
+        print("The following segments could not be patched: {}".format(failed_segments))
+        os.remove(temporary_output_file)
+        return 1
+
+    os.replace(temporary_output_file, output_file)
+    return 0
@@ -0,0 +1,96 @@
+import argparse
+import random
+import time
+
+from patch_file_creator import detect_all_new_modified_and_deleted_files
+
+
+default_sizes = [1000, 10000, 100000, 1000000]
+
+
+def create_synthetic_file_lists(number_of_files, change_rate, seed):
+    # Builds two file lists in the format of iterate_through_directory where a share of the
+    # files was added and deleted between both versions
+    generator = random.Random(seed)
+    original_version_file_list = []
+    modified_version_file_list = []
+
+    for index in range(number_of_files):
+        file = ("file_{}.bin".format(index), "/dir_{}/sub_{}/".format(index % 97, index % 13))
+        original_version_file_list.append(file)
+        if generator.random() >= change_rate:
+            modified_version_file_list.append(file)
+        else:
+            modified_version_file_list.append(("added_{}.bin".format(index), file[1]))
+
+    generator.shuffle(modified_version_file_list)
+    return original_version_file_list, modified_version_file_list
+
+
+def legacy_detect_all_new_modified_and_deleted_files(original_version_file_list, modified_version_file_list):
+    # Former nested loop implementation, kept for comparing the timings
+    new_files = []
+    modified_files = []
+    deleted_files = []
+
+    for modified_file in modified_version_file_list:
+        if modified_file in original_version_file_list:
+            modified_files.append(modified_file)
+        else:
+            new_files.append(modified_file)
+
+    for original_file in original_version_file_list:
+        if original_file not in modified_version_file_list:
+            deleted_files.append(original_file)
+
+    return modified_files, new_files, deleted_files
+
+
+def check_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-s", "--sizes",
+                        help="Numbers of synthetic entries which shall be compared",
+                        nargs="+",
+                        type=int,
+                        default=default_sizes)
+    parser.add_argument("-r", "--change_rate",
+                        help="Share of the files which are replaced by new files within the modified version",
+                        type=float,
+                        default=0.1)
+    parser.add_argument("-l", "--legacy_limit",
+                        help="Largest number of entries for which the former quadratic implementation is measured",
+                        type=int,
+                        default=10000)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = check_arguments()
+
+    print("{:>10} | {:>12} | {:>12} | {:>8} | {:>8} | {:>8}".format("entries", "indexed [s]", "legacy [s]",
+                                                                   "modified", "new", "deleted"))
+    for number_of_files in args.sizes:
+        original_version_file_list, modified_version_file_list = create_synthetic_file_lists(number_of_files=number_of_files,
+                                                                                             change_rate=args.change_rate,
+                                                                                             seed=number_of_files)
+
+        start_time = time.perf_counter()
+        modified_files, new_files, deleted_files = detect_all_new_modified_and_deleted_files(original_version_file_list=original_version_file_list,
+                                                                                            modified_version_file_list=modified_version_file_list)
+        indexed_time = time.perf_counter() - start_time
+
+        legacy_time = "skipped"
+        if number_of_files <= args.legacy_limit:
+            start_time = time.perf_counter()
+            legacy_result = legacy_detect_all_new_modified_and_deleted_files(original_version_file_list=original_version_file_list,
+                                                                            modified_version_file_list=modified_version_file_list)
+            legacy_time = "{:.4f}".format(time.perf_counter() - start_time)
+            if legacy_result != (modified_files, new_files, deleted_files):
+                print("Results of the indexed and the legacy implementation differ for {} entries!".format(number_of_files))
+                exit(1)
+
+        print("{:>10} | {:>12.4f} | {:>12} | {:>8} | {:>8} | {:>8}".format(number_of_files, indexed_time, legacy_time,
+                                                                          len(modified_files), len(new_files),
+                                                                          len(deleted_files)))
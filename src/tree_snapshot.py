@@ -0,0 +1,261 @@
+import array
+import collections
+import hashlib
+import json
+import os
+import struct
+import sys
+
+from file_fingerprints import get_file_fingerprint
+
+
+snapshot_magic = b"DUSNAP02"
+header_length_format = "<I"
+digest_size = hashlib.sha256().digest_size
+no_digest = bytes(digest_size)
+
+# Every column of a snapshot is one array, so a tree with millions of files is loaded with a few reads
+snapshot_columns = [("directory_indices", "I"), ("sizes", "q"), ("mtimes", "q"), ("inodes", "Q"), ("devices", "Q"),
+                    ("modes", "I")]
+# Adding, removing or renaming an entry changes the mtime of its directory, so the inode and mtime of every
+# directory tell whether the files of a tree are still the ones of the snapshot
+directory_columns = [("directory_inodes", "Q"), ("directory_mtimes", "q")]
+
+# Looks like the result of os.stat, so it can be used wherever the fingerprint functions expect one
+FileStat = collections.namedtuple("FileStat", ["st_size", "st_mtime_ns", "st_ino", "st_dev", "st_mode"])
+
+
+class TreeSnapshot:
+    # Path, size, mtime, inode and mode of every file of a tree together with the hashes which are known.
+    # Directories are stored relative to the root like "" or "/sub/dir", files point to their directory.
+    def __init__(self, root_path, directories, names, columns=None, digests=None):
+        self.root_path = root_path
+        self.directories = directories
+        self.names = names
+        if columns is None:
+            columns = dict((name, array.array(type_code)) for name, type_code in snapshot_columns + directory_columns)
+        self.columns = columns
+        if digests is None:
+            digests = bytearray(digest_size * len(names))
+        self.digests = digests
+        self.file_index = None
+        self.changed = False
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_directory(self, directory, directory_stat):
+        self.directories.append(directory)
+        self.columns["directory_inodes"].append(directory_stat.st_ino)
+        self.columns["directory_mtimes"].append(directory_stat.st_mtime_ns)
+        return len(self.directories) - 1
+
+    def is_current(self):
+        # A directory which is gone, was replaced or got other entries makes the whole snapshot stale.
+        # Files which were rewritten in place keep the mtime of their directory and are not noticed.
+        for index, directory in enumerate(self.directories):
+            try:
+                directory_stat = os.stat(self.root_path + directory)
+            except OSError:
+                return False
+            if directory_stat.st_ino != self.columns["directory_inodes"][index] or \
+                    directory_stat.st_mtime_ns != self.columns["directory_mtimes"][index]:
+                return False
+        return True
+
+    def add_file(self, directory_index, name, file_stat):
+        self.names.append(name)
+        self.columns["directory_indices"].append(directory_index)
+        self.columns["sizes"].append(file_stat.st_size)
+        self.columns["mtimes"].append(file_stat.st_mtime_ns)
+        self.columns["inodes"].append(file_stat.st_ino)
+        self.columns["devices"].append(file_stat.st_dev)
+        self.columns["modes"].append(file_stat.st_mode)
+        self.digests += no_digest
+
+    def file_list(self):
+        # Same entries as iterate_through_directory of the creator: the name and the directory with a slash
+        directory_indices = self.columns["directory_indices"]
+        return [(name, self.directories[directory_indices[index]] + "/") for index, name in enumerate(self.names)]
+
+    def find_file(self, file):
+        if self.file_index is None:
+            self.file_index = dict((entry, index) for index, entry in enumerate(self.file_list()))
+        return self.file_index.get(file)
+
+    def file_stat(self, file):
+        index = self.find_file(file)
+        if index is None:
+            return None
+        return FileStat(*(self.columns[name][index] for name in ["sizes", "mtimes", "inodes", "devices", "modes"]))
+
+    def total_size(self):
+        return sum(self.columns["sizes"])
+
+    def file_path(self, index):
+        return self.root_path + self.directories[self.columns["directory_indices"][index]] + "/" + self.names[index]
+
+    def stat_key(self, index):
+        return [self.columns["sizes"][index], self.columns["mtimes"][index], self.columns["inodes"][index]]
+
+    def record_hashes(self, fingerprint_cache):
+        # Hashes the fingerprint cache knows for an unchanged file are kept within the snapshot
+        for index in range(len(self.names)):
+            cached_entry = fingerprint_cache.get(os.path.abspath(self.file_path(index)))
+            if cached_entry is None or cached_entry[:3] != self.stat_key(index):
+                continue
+            digest = bytes.fromhex(cached_entry[3])
+            if self.digests[index * digest_size:(index + 1) * digest_size] != digest:
+                self.digests[index * digest_size:(index + 1) * digest_size] = digest
+                self.changed = True
+
+    def tree_hash(self, fingerprint_cache):
+        # Hash over the path and the content of every file, two trees with equal files have the same hash
+        # wherever they are stored. Files without a stored hash are hashed once and kept within the cache.
+        tree_hash = hashlib.sha256()
+        for file in sorted(self.file_list(), key=lambda entry: entry[1] + entry[0]):
+            index = self.find_file(file)
+            file_hash = get_file_fingerprint(self.file_path(index), fingerprint_cache, self.file_stat(file))
+            tree_hash.update((file[1] + file[0] + "\0" + file_hash + "\0").encode("utf-8", "surrogateescape"))
+        return tree_hash.hexdigest()
+
+    def seed_fingerprint_cache(self, fingerprint_cache):
+        # Files which were hashed while the snapshot was taken do not have to be read again
+        for index in range(len(self.names)):
+            digest = bytes(self.digests[index * digest_size:(index + 1) * digest_size])
+            if digest == no_digest:
+                continue
+            fingerprint_cache.setdefault(os.path.abspath(self.file_path(index)), self.stat_key(index) + [digest.hex()])
+
+
+def scan_tree(root_path):
+    # Single pass with os.scandir. Directories are walked in sorted order, so two scans of the same
+    # tree give the same snapshot. Links to directories are listed like os.walk does, but not followed.
+    root_path = root_path.rstrip("/") or "/"
+    snapshot = TreeSnapshot(root_path, [], [])
+
+    pending_directories = [("", os.stat(root_path))]
+    while pending_directories:
+        directory, directory_stat = pending_directories.pop()
+        directory_index = snapshot.add_directory(directory, directory_stat)
+
+        with os.scandir(root_path + directory) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    subdirectories.append((directory + "/" + entry.name, entry.stat()))
+                continue
+            snapshot.add_file(directory_index, entry.name, entry.stat())
+        pending_directories.extend(reversed(subdirectories))
+
+    return snapshot
+
+
+def save_tree_snapshot(snapshot, snapshot_path):
+    names_blob = "\0".join(snapshot.names).encode("utf-8", "surrogateescape")
+    directories_blob = "\0".join(snapshot.directories).encode("utf-8", "surrogateescape")
+    header = json.dumps({
+        "root": os.path.abspath(snapshot.root_path),
+        "files": len(snapshot.names),
+        "directories": len(snapshot.directories),
+        "names_length": len(names_blob),
+        "directories_length": len(directories_blob),
+        "byte_order": sys.byteorder,
+    }).encode("utf-8")
+
+    snapshot_directory = os.path.dirname(snapshot_path)
+    if snapshot_directory and not os.path.exists(snapshot_directory):
+        os.makedirs(snapshot_directory)
+
+    # Write into a temporary file first so an interrupted run never leaves a truncated snapshot behind
+    temporary_path = snapshot_path + ".tmp"
+    with open(temporary_path, "wb") as file_handler:
+        file_handler.write(snapshot_magic + struct.pack(header_length_format, len(header)) + header)
+        for name, _ in snapshot_columns + directory_columns:
+            snapshot.columns[name].tofile(file_handler)
+        file_handler.write(names_blob)
+        file_handler.write(directories_blob)
+        file_handler.write(snapshot.digests)
+    os.replace(temporary_path, snapshot_path)
+    snapshot.changed = False
+
+
+def load_tree_snapshot(root_path, snapshot_path):
+    # Returns None if there is no snapshot, it belongs to another tree or a directory of the tree changed
+    if not os.path.isfile(snapshot_path):
+        return None
+
+    with open(snapshot_path, "rb") as file_handler:
+        data = file_handler.read()
+    # Snapshots of an older version lack the directory columns, they are rebuilt without a warning
+    if data.startswith(snapshot_magic[:-2]) and not data.startswith(snapshot_magic):
+        return None
+    if not data.startswith(snapshot_magic):
+        print("Snapshot {} is damaged and will be rebuilt!".format(snapshot_path))
+        return None
+
+    offset = len(snapshot_magic)
+    header_length, = struct.unpack_from(header_length_format, data, offset)
+    offset += struct.calcsize(header_length_format)
+    header = json.loads(data[offset:offset + header_length].decode("utf-8"))
+    offset += header_length
+
+    root_path = root_path.rstrip("/") or "/"
+    if header["root"] != os.path.abspath(root_path):
+        return None
+
+    columns = {}
+    for name, type_code in snapshot_columns + directory_columns:
+        column = array.array(type_code)
+        length = (header["files"] if (name, type_code) in snapshot_columns else header["directories"]) * \
+            column.itemsize
+        column.frombytes(data[offset:offset + length])
+        if header["byte_order"] != sys.byteorder:
+            column.byteswap()
+        columns[name] = column
+        offset += length
+
+    names = data[offset:offset + header["names_length"]].decode("utf-8", "surrogateescape").split("\0")
+    offset += header["names_length"]
+    directories = data[offset:offset + header["directories_length"]].decode("utf-8", "surrogateescape").split("\0")
+    offset += header["directories_length"]
+    digests = bytearray(data[offset:offset + digest_size * header["files"]])
+
+    if not header["files"]:
+        names = []
+    snapshot = TreeSnapshot(root_path, directories, names, columns, digests)
+    if not snapshot.is_current():
+        return None
+    return snapshot
+
+
+def get_snapshot_path(snapshot_directory, root_path):
+    # Every tree gets its own snapshot, named after its absolute path
+    root_hash = hashlib.sha256(os.path.abspath(root_path.rstrip("/") or "/").encode("utf-8", "surrogateescape"))
+    return snapshot_directory + "/" + root_hash.hexdigest()[:16] + ".snapshot"
+
+
+def get_tree_snapshot(root_path, snapshot_directory=None):
+    # A stored snapshot replaces the scan of a tree, which pays off for a release that is the base of many patches
+    if snapshot_directory:
+        snapshot = load_tree_snapshot(root_path, get_snapshot_path(snapshot_directory, root_path))
+        if snapshot is not None:
+            print("Snapshot of {} with {} files was loaded instead of scanning it!".format(root_path, len(snapshot)))
+            return snapshot
+
+    snapshot = scan_tree(root_path)
+    snapshot.changed = True
+    return snapshot
+
+
+def store_tree_snapshot(snapshot, snapshot_directory, fingerprint_cache=None):
+    if not snapshot_directory:
+        return
+    if fingerprint_cache is not None:
+        snapshot.record_hashes(fingerprint_cache)
+    if snapshot.changed:
+        snapshot_path = get_snapshot_path(snapshot_directory, snapshot.root_path)
+        save_tree_snapshot(snapshot, snapshot_path)
+        print("Snapshot of {} was saved as {}".format(snapshot.root_path, snapshot_path))
@@ -0,0 +1,159 @@
+import collections
+import contextlib
+import contextvars
+import io
+import os
+import sys
+
+
+# Importing this module stays cheap: the creator, the applier and everything they need are only loaded
+# once a patch is created or applied. "python update_api.py" measures what importing every module costs.
+library_modules = ["update_api", "patch_file_creator", "patch_file_applier", "async_engine"]
+
+logger_name = "diff_updater"
+
+CreationResult = collections.namedtuple("CreationResult", ["patch_path", "stats"])
+ApplicationResult = collections.namedtuple("ApplicationResult", ["original_version_path", "failed_files",
+                                                                 "mismatching_files", "stats"])
+
+# Where the output of the job the current code runs for goes, None is the real standard output
+job_output = contextvars.ContextVar("job_output", default=None)
+
+
+class ArgumentError(ValueError):
+    # Invalid options of the creator or the applier. The scripts print the message and exit with the code,
+    # callers of the library get the exception.
+    def __init__(self, message, exit_code=2):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+
+class PatchFailed(Exception):
+    def __init__(self, message, result):
+        super().__init__(message)
+        self.result = result
+
+
+class OutputRouter(io.TextIOBase):
+    # Stands in for sys.stdout. Everything the scripts print goes to the output of the job it belongs to,
+    # so jobs which run side by side within one process do not mix their output.
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        return (job_output.get() or self.stdout).write(text)
+
+    def flush(self):
+        (job_output.get() or self.stdout).flush()
+
+
+class LogWriter(io.TextIOBase):
+    # Every complete line becomes one record of the logger
+    def __init__(self, logger, level):
+        self.logger = logger
+        self.level = level
+        self.pending_text = ""
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        lines = (self.pending_text + text).split("\n")
+        self.pending_text = lines.pop()
+        for line in lines:
+            self.logger.log(self.level, line)
+        return len(text)
+
+    def close(self):
+        if self.pending_text:
+            self.logger.log(self.level, self.pending_text)
+            self.pending_text = ""
+        super().close()
+
+
+def install_output_router():
+    if not isinstance(sys.stdout, OutputRouter):
+        sys.stdout = OutputRouter(sys.stdout)
+    return sys.stdout
+
+
+@contextlib.contextmanager
+def routed_output(output=None):
+    # Without an output every line is logged at INFO level by the logger "diff_updater"
+    router = install_output_router()
+    log_writer = None
+    if output is None:
+        import logging
+        output = log_writer = LogWriter(logging.getLogger(logger_name), logging.INFO)
+    elif output is router:
+        output = router.stdout
+    token = job_output.set(output)
+    try:
+        yield output
+    finally:
+        job_output.reset(token)
+        if log_writer is not None:
+            log_writer.close()
+
+
+def build_arguments(parser, required_arguments, options):
+    # The arguments of the command line are the single source of every default
+    args = parser.parse_args(required_arguments)
+    for name, value in options.items():
+        if not hasattr(args, name):
+            raise TypeError("Unknown option: {}".format(name))
+        setattr(args, name, value)
+    return args
+
+
+def create_patch(original_version_path, modified_version_path, patch_path, output=None, **options):
+    # Options are named like the long options of patch_file_creator.py and use the same units
+    import patch_file_creator
+
+    with routed_output(output):
+        args = build_arguments(patch_file_creator.create_argument_parser(),
+                               ["-o", original_version_path, "-m", modified_version_path, "-p", patch_path],
+                               options)
+        patch_file_creator.validate_arguments(args)
+        stats = patch_file_creator.create_patch_from_arguments(args)
+    return CreationResult(patch_path, stats)
+
+
+def apply_patch(original_version_path, modified_version_path, patch_path, output=None, check=True, **options):
+    # Options are named like the long options of patch_file_applier.py. Files which could not be patched are
+    # raised as PatchFailed unless check is False, the result is returned either way.
+    import patch_file_applier
+
+    with routed_output(output):
+        args = build_arguments(patch_file_applier.create_argument_parser(),
+                               ["-o", original_version_path, "-m", modified_version_path, "-p", patch_path],
+                               options)
+        patch_file_applier.validate_arguments(args)
+        result = patch_file_applier.apply_patch_from_arguments(args)
+
+    if check and (result.failed_files or result.mismatching_files):
+        raise PatchFailed("{} files could not be patched and {} files differ from the modified version".format(
+            len(result.failed_files), len(result.mismatching_files)), result)
+    return result
+
+
+def measure_import_time(module, repetitions=5):
+    # Every import runs within a new interpreter, the fastest run is the one with the least noise
+    import subprocess
+
+    cumulative_microseconds = []
+    for _ in range(repetitions):
+        completed = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                                   check=True)
+        last_line = completed.stderr.strip().splitlines()[-1]
+        cumulative_microseconds.append(int(last_line.split("|")[1]))
+    return min(cumulative_microseconds)
+
+
+if __name__ == "__main__":
+    for module in library_modules:
+        print("Importing {} takes {:.1f} ms".format(module, measure_import_time(module) / 1000))
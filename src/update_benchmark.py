@@ -0,0 +1,530 @@
+import argparse
+import collections
+import csv
+import gzip
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import time
+
+from file_fingerprints import calculate_file_hash
+from line_diff import is_text_data
+
+
+script_directory = os.path.dirname(os.path.abspath(__file__))
+creator_script = script_directory + "/patch_file_creator.py"
+applier_script = script_directory + "/patch_file_applier.py"
+
+# Every creator tool is applied by its counterpart, external tools are only benchmarked if they are installed
+applier_tools = {"bsdiff": "bspatch", "xdelta": "xdelta", "rsync": "rsync", "cdc": "cdc", "text": "text",
+                 "adaptive": "auto"}
+required_programs = {"bsdiff": ["bsdiff", "bspatch"], "xdelta": ["xdelta3"], "rsync": [], "cdc": [],
+                     "text": ["bsdiff", "bspatch"], "adaptive": []}
+
+# Flags of the creator and the applier for every compression mode. Containers only exist for directories.
+compression_modes = {
+    "none": ([], []),
+    "zip": (["-c"], ["-c"]),
+    "container": (["-b"], []),
+    "container_auto": (["-b", "-z", "auto"], []),
+    "container_zip": (["-b", "-c"], ["-c"]),
+}
+container_modes = ["container", "container_auto", "container_zip"]
+
+Corpus = collections.namedtuple("Corpus", ["name", "kind", "number_of_files", "median_size", "size_spread",
+                                           "maximum_size", "text_share"])
+
+# Sizes are given in bytes and are multiplied by the scale of the run. The spread is the sigma of the
+# lognormal distribution of the file sizes, a single file has no spread.
+corpora = {
+    "directory": Corpus("directory", "directory", 300, 16 * 1024, 1.5, 4 * 1024 * 1024, 0.6),
+    "text_file": Corpus("text_file", "file", 1, 8 * 1024 * 1024, 0.0, 8 * 1024 * 1024, 1.0),
+    # Thousands of small text files like a tree of sources or configuration files
+    "source_tree": Corpus("source_tree", "directory", 3000, 4 * 1024, 1.0, 256 * 1024, 1.0),
+    "binary_file": Corpus("binary_file", "file", 1, 16 * 1024 * 1024, 0.0, 16 * 1024 * 1024, 0.0),
+    "archive": Corpus("archive", "archive", 100, 16 * 1024, 1.5, 2 * 1024 * 1024, 0.6),
+}
+
+result_columns = ["label", "corpus", "tool", "compression", "trial", "phase", "exit_code", "verified",
+                  "wall_seconds", "cpu_seconds", "user_seconds", "system_seconds", "peak_rss_bytes",
+                  "read_bytes", "written_bytes", "patch_bytes"]
+# Columns which are compared against the baseline, higher values are worse for all of them
+compared_columns = ["wall_seconds", "cpu_seconds", "peak_rss_bytes", "patch_bytes"]
+
+Measurement = collections.namedtuple("Measurement", ["exit_code", "wall_seconds", "cpu_seconds", "user_seconds",
+                                                     "system_seconds", "peak_rss_bytes", "read_bytes",
+                                                     "written_bytes"])
+
+word_list_size = 4096
+binary_block_size = 4096
+average_edit_length = 64
+# Stored within the description of every corpus, corpora of an older generator are generated again
+corpus_generator_version = 2
+
+
+def create_word_list(generator):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(generator.choice(letters) for _ in range(generator.randint(2, 10)))
+            for _ in range(word_list_size)]
+
+
+def create_text_content(generator, word_list, size):
+    # Words of a small vocabulary give text which compresses about as well as source code or logs
+    words = generator.choices(word_list, k=size // 5 + 1)
+    for index in range(11, len(words), 12):
+        words[index] += "\n"
+    return " ".join(words).encode("ascii")[:size]
+
+
+def create_binary_content(generator, size):
+    # Half of the blocks repeat an earlier block, just like the sections of real executables do
+    blocks = []
+    for _ in range(size // binary_block_size + 1):
+        if blocks and generator.random() < 0.5:
+            blocks.append(generator.choice(blocks))
+        else:
+            blocks.append(generator.randbytes(binary_block_size))
+    return b"".join(blocks)[:size]
+
+
+def create_file_content(generator, word_list, size, text_share):
+    if generator.random() < text_share:
+        return create_text_content(generator, word_list, size)
+    return create_binary_content(generator, size)
+
+
+def mutate_content(generator, data, edit_rate, word_list=None):
+    # Spreads inserts, overwrites and deletions over the whole file until about edit_rate of its bytes changed.
+    # The positions are sorted first, so the new content is assembled within a single pass.
+    # Text gets words from the word list instead of random bytes, so it stays text.
+    number_of_edits = max(1, int(len(data) * edit_rate / average_edit_length))
+    positions = sorted(generator.randrange(len(data) + 1) for _ in range(number_of_edits))
+
+    parts = []
+    position = 0
+    for edit_position in positions:
+        if edit_position < position:
+            continue
+        parts.append(data[position:edit_position])
+        length = generator.randint(1, 2 * average_edit_length)
+        operation = generator.choice(["insert", "overwrite", "delete"])
+        if operation != "delete":
+            if word_list is None:
+                parts.append(generator.randbytes(length))
+            else:
+                parts.append(create_text_content(generator, word_list, length))
+        position = edit_position if operation == "insert" else min(len(data), edit_position + length)
+    parts.append(data[position:])
+    return b"".join(parts)
+
+
+def draw_file_size(generator, corpus, scale):
+    median_size = corpus.median_size * scale
+    maximum_size = corpus.maximum_size * scale
+    if corpus.size_spread == 0:
+        return max(1, int(median_size))
+    return max(1, int(min(maximum_size, generator.lognormvariate(0, corpus.size_spread) * median_size)))
+
+
+def write_file(file_path, data):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "wb") as file_handler:
+        file_handler.write(data)
+
+
+def create_directory_versions(generator, corpus, parameters, original_version_path, modified_version_path):
+    word_list = create_word_list(generator)
+    number_of_files = max(1, int(corpus.number_of_files * parameters["file_scale"]))
+
+    files = []
+    for index in range(number_of_files):
+        extension = "txt" if generator.random() < corpus.text_share else "bin"
+        files.append("dir_{}/sub_{}/file_{}.{}".format(index % 17, index % 5, index, extension))
+
+    for file in files:
+        data = create_file_content(generator, word_list, draw_file_size(generator, corpus, parameters["scale"]),
+                                   corpus.text_share)
+        write_file(original_version_path + "/" + file, data)
+
+        # Every file either stays, is deleted, is renamed or is changed. Renamed files keep their content.
+        draw = generator.random()
+        if draw < parameters["delete_rate"]:
+            continue
+        draw -= parameters["delete_rate"]
+        if draw < parameters["rename_rate"]:
+            write_file(modified_version_path + "/renamed/" + file.replace("/", "_"), data)
+            continue
+        draw -= parameters["rename_rate"]
+        if draw < parameters["change_rate"]:
+            data = mutate_content(generator, data, parameters["edit_rate"], word_list if is_text_data(data) else None)
+        write_file(modified_version_path + "/" + file, data)
+
+    for index in range(int(number_of_files * parameters["new_rate"])):
+        data = create_file_content(generator, word_list, draw_file_size(generator, corpus, parameters["scale"]),
+                                   corpus.text_share)
+        write_file(modified_version_path + "/added/file_{}.bin".format(index), data)
+
+
+def create_archive(source_directory, archive_path):
+    # Members are sorted and carry no timestamps, so equal seeds give byte-identical archives
+    def reset_member(tar_info):
+        tar_info.mtime = 0
+        tar_info.uid = tar_info.gid = 0
+        tar_info.uname = tar_info.gname = ""
+        return tar_info
+
+    with gzip.GzipFile(archive_path, "wb", mtime=0) as gzip_handler:
+        with tarfile.open(fileobj=gzip_handler, mode="w") as tar_handler:
+            for root, directories, files in os.walk(source_directory):
+                directories.sort()
+                for file in sorted(files):
+                    file_path = root + "/" + file
+                    tar_handler.add(file_path, os.path.relpath(file_path, source_directory), filter=reset_member)
+
+
+def create_corpus(corpus, parameters, corpus_path):
+    # Corpora are generated once per set of parameters and reused by all later runs
+    description_path = corpus_path + "/corpus.json"
+    description = dict(parameters, corpus=corpus._asdict(), generator_version=corpus_generator_version)
+    if os.path.isfile(description_path):
+        with open(description_path, "r") as file_handler:
+            if json.load(file_handler) == description:
+                return
+    if os.path.exists(corpus_path):
+        shutil.rmtree(corpus_path)
+
+    print("Generating the corpus {} within {}!".format(corpus.name, corpus_path))
+    generator = random.Random("{}:{}".format(parameters["seed"], corpus.name))
+    if corpus.kind == "file":
+        word_list = create_word_list(generator)
+        data = create_file_content(generator, word_list, draw_file_size(generator, corpus, parameters["scale"]),
+                                   corpus.text_share)
+        write_file(corpus_path + "/original", data)
+        write_file(corpus_path + "/modified", mutate_content(generator, data, parameters["edit_rate"],
+                                                            word_list if is_text_data(data) else None))
+    elif corpus.kind == "archive":
+        create_directory_versions(generator, corpus, parameters, corpus_path + "/original_members",
+                                  corpus_path + "/modified_members")
+        create_archive(corpus_path + "/original_members", corpus_path + "/original")
+        create_archive(corpus_path + "/modified_members", corpus_path + "/modified")
+        shutil.rmtree(corpus_path + "/original_members")
+        shutil.rmtree(corpus_path + "/modified_members")
+    else:
+        create_directory_versions(generator, corpus, parameters, corpus_path + "/original",
+                                  corpus_path + "/modified")
+
+    # The description is written last, an interrupted generation is started again by the next run
+    with open(description_path, "w") as file_handler:
+        json.dump(description, file_handler, indent=4, sort_keys=True)
+
+
+def run_measured(command, log_path):
+    # wait4 returns the resource usage of the child including all processes it waited for,
+    # so external diff tools which are started by the scripts are measured as well
+    with open(log_path, "ab") as log_handler:
+        log_handler.write(("$ " + " ".join(command) + "\n").encode("utf-8"))
+        log_handler.flush()
+        start_time = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log_handler, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_seconds = time.perf_counter() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is given in kilobytes on Linux and in bytes on macOS, blocks are always 512 bytes
+    peak_rss_bytes = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return Measurement(exit_code=process.returncode,
+                       wall_seconds=wall_seconds,
+                       cpu_seconds=usage.ru_utime + usage.ru_stime,
+                       user_seconds=usage.ru_utime,
+                       system_seconds=usage.ru_stime,
+                       peak_rss_bytes=peak_rss_bytes,
+                       read_bytes=usage.ru_inblock * 512,
+                       written_bytes=usage.ru_oublock * 512)
+
+
+def get_path_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            size += os.path.getsize(root + "/" + file)
+    return size
+
+
+def is_combination_valid(corpus, compression):
+    return corpus.kind == "directory" or compression not in container_modes
+
+
+def run_trial(corpus, corpus_path, tool, compression, trial, run_path, jobs, label):
+    # Directories are patched in place, therefore every trial works on its own copy of the original version.
+    # Single files are written to the path of the modified version, which has to exist already, so the trial
+    # gets its own output file which is overwritten.
+    if os.path.exists(run_path):
+        shutil.rmtree(run_path)
+    os.makedirs(run_path)
+    if corpus.kind == "directory":
+        target_path = run_path + "/target"
+        shutil.copytree(corpus_path + "/original", target_path)
+        applier_paths = ["-o", target_path, "-m", corpus_path + "/modified"]
+        patch_path = run_path + "/patch"
+    else:
+        target_path = run_path + "/output"
+        shutil.copy2(corpus_path + "/original", target_path)
+        applier_paths = ["-o", corpus_path + "/original", "-m", target_path]
+        # A compressed single patch file is zipped together with its directory, so it gets its own one
+        os.makedirs(run_path + "/patch")
+        patch_path = run_path + "/patch/patch"
+
+    creator_flags, applier_flags = compression_modes[compression]
+    if corpus.kind != "directory":
+        creator_flags = creator_flags + ["-f"] + (["-a"] if corpus.kind == "archive" else [])
+        applier_flags = applier_flags + ["-f"]
+    else:
+        applier_flags = applier_flags + ["-v"]
+
+    json_path = run_path + "/stats.json"
+    log_path = run_path + "/output.log"
+    # Every trial starts with a fingerprint cache of its own, a cache of earlier trials would hide the hashing
+    creation = run_measured([sys.executable, creator_script, "-o", corpus_path + "/original",
+                             "-m", corpus_path + "/modified", "-p", patch_path, "-t", tool, "-j", json_path,
+                             "-k", run_path + "/fingerprints.json", "-n", str(jobs)] + creator_flags, log_path)
+
+    patch_bytes = 0
+    if creation.exit_code == 0:
+        patch_bytes = get_path_size(patch_path + ".zip" if "-c" in creator_flags else patch_path)
+        application = run_measured([sys.executable, applier_script] + applier_paths +
+                                   ["-p", patch_path, "-t", applier_tools[tool], "-j", json_path, "-n", str(jobs)] +
+                                   applier_flags, log_path)
+    else:
+        application = Measurement(None, 0, 0, 0, 0, 0, 0, 0)
+
+    # Directories are verified by the applier itself, single files are compared here
+    verified = application.exit_code == 0
+    if verified and corpus.kind != "directory":
+        verified = calculate_file_hash(target_path) == calculate_file_hash(corpus_path + "/modified")
+
+    rows = []
+    for phase, measurement in [("create", creation), ("apply", application)]:
+        row = dict(measurement._asdict(), label=label, corpus=corpus.name, tool=tool, compression=compression,
+                   trial=trial, phase=phase, verified=verified, patch_bytes=patch_bytes)
+        row["wall_seconds"] = round(row["wall_seconds"], 4)
+        row["cpu_seconds"] = round(row["cpu_seconds"], 4)
+        row["user_seconds"] = round(row["user_seconds"], 4)
+        row["system_seconds"] = round(row["system_seconds"], 4)
+        rows.append(row)
+    return rows
+
+
+def read_result_table(table_path):
+    with open(table_path, "r", newline="") as file_handler:
+        return list(csv.DictReader(file_handler))
+
+
+def write_result_table(rows, table_path):
+    # Results of earlier releases are kept, so a single table holds the whole history
+    write_header = not os.path.isfile(table_path)
+    with open(table_path, "a", newline="") as file_handler:
+        writer = csv.DictWriter(file_handler, fieldnames=result_columns)
+        if write_header:
+            writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+
+def summarize_rows(rows):
+    # Medians of all successful trials of every cell of the matrix
+    cells = collections.OrderedDict()
+    for row in rows:
+        key = (row["corpus"], row["tool"], row["compression"], row["phase"])
+        cells.setdefault(key, []).append(row)
+
+    summary = collections.OrderedDict()
+    for key, cell_rows in cells.items():
+        successful_rows = [row for row in cell_rows if str(row["verified"]) == "True"]
+        medians = {"trials": len(cell_rows), "verified": len(successful_rows)}
+        for column in compared_columns + ["read_bytes", "written_bytes"]:
+            values = [float(row[column]) for row in successful_rows]
+            medians[column] = statistics.median(values) if values else None
+        summary[key] = medians
+    return summary
+
+
+def print_summary(summary):
+    print("{:<12} | {:<7} | {:<14} | {:<6} | {:>6} | {:>9} | {:>9} | {:>9} | {:>9} | {:>9} | {:>11}".format(
+        "corpus", "tool", "compression", "phase", "ok", "wall [s]", "cpu [s]", "rss [MB]", "read [MB]",
+        "write [MB]", "patch [KB]"))
+    for (corpus, tool, compression, phase), medians in summary.items():
+        if medians["wall_seconds"] is None:
+            print("{:<12} | {:<7} | {:<14} | {:<6} | {:>6} | no successful trial".format(
+                corpus, tool, compression, phase, "0/{}".format(medians["trials"])))
+            continue
+        print("{:<12} | {:<7} | {:<14} | {:<6} | {:>6} | {:>9.3f} | {:>9.3f} | {:>9.1f} | {:>9.1f} | {:>9.1f} | "
+              "{:>11.1f}".format(corpus, tool, compression, phase,
+                                 "{}/{}".format(medians["verified"], medians["trials"]),
+                                 medians["wall_seconds"], medians["cpu_seconds"],
+                                 medians["peak_rss_bytes"] / 1024 / 1024, medians["read_bytes"] / 1024 / 1024,
+                                 medians["written_bytes"] / 1024 / 1024, medians["patch_bytes"] / 1024))
+
+
+def find_regressions(summary, baseline_summary, threshold):
+    regressions = []
+    for key, medians in summary.items():
+        if key not in baseline_summary:
+            continue
+        baseline_medians = baseline_summary[key]
+        if medians["verified"] < medians["trials"] and baseline_medians["verified"] == baseline_medians["trials"]:
+            regressions.append((key, "verified", baseline_medians["verified"], medians["verified"]))
+        for column in compared_columns:
+            value = medians[column]
+            baseline_value = baseline_medians[column]
+            if value is None or not baseline_value:
+                continue
+            if value > baseline_value * (1 + threshold):
+                regressions.append((key, column, baseline_value, value))
+    return regressions
+
+
+def check_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-w", "--work_path", required=True,
+                        help="Directory which holds the generated corpora and the files of every trial")
+    parser.add_argument("-o", "--table_path", default=None,
+                        help="CSV table to which the results are appended. Default is results.csv within the work path")
+    parser.add_argument("-L", "--label", default=None,
+                        help="Label of this run within the result table, e.g. the release. Default is the git revision")
+    parser.add_argument("-C", "--corpora", nargs="+", choices=sorted(corpora), default=sorted(corpora),
+                        help="Synthetic corpora which are benchmarked")
+    parser.add_argument("-t", "--tools", nargs="+", choices=sorted(applier_tools), default=sorted(applier_tools),
+                        help="Differential update tools which are benchmarked")
+    parser.add_argument("-z", "--compressions", nargs="+", choices=sorted(compression_modes),
+                        default=["none", "zip", "container_auto"],
+                        help="Compression modes which are benchmarked. Containers are only used for directories")
+    parser.add_argument("-r", "--trials", type=int, default=3,
+                        help="Number of repeated trials of every combination")
+    parser.add_argument("-n", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of parallel jobs of the creator and the applier")
+    parser.add_argument("-s", "--seed", type=int, default=1,
+                        help="Seed of the corpus generator. Equal seeds and rates give identical corpora")
+    parser.add_argument("-x", "--scale", type=float, default=1.0,
+                        help="Factor for the sizes of all generated files")
+    parser.add_argument("--file_scale", type=float, default=1.0,
+                        help="Factor for the number of files of directory and archive corpora")
+    parser.add_argument("--change_rate", type=float, default=0.3,
+                        help="Share of the files which are changed within the modified version")
+    parser.add_argument("--edit_rate", type=float, default=0.02,
+                        help="Share of the bytes which are edited within a changed file")
+    parser.add_argument("--rename_rate", type=float, default=0.05,
+                        help="Share of the files which are renamed without any change")
+    parser.add_argument("--new_rate", type=float, default=0.05,
+                        help="Number of new files as a share of the files of the original version")
+    parser.add_argument("--delete_rate", type=float, default=0.05,
+                        help="Share of the files which are deleted within the modified version")
+    parser.add_argument("-b", "--baseline_path", default=None,
+                        help="Result table of an earlier run whose medians are compared with this run")
+    parser.add_argument("-B", "--baseline_label", default=None,
+                        help="Only compare with the rows of this label within the baseline table")
+    parser.add_argument("-T", "--threshold", type=float, default=0.1,
+                        help="Relative increase of a median above which it is reported as a regression")
+    parser.add_argument("-k", "--keep_runs", action="store_true", default=False,
+                        help="Keep the patches and patched versions of every trial")
+
+    args = parser.parse_args()
+
+    if args.trials < 1 or args.jobs < 1:
+        print("At least one trial and one job are needed! Processing stops!")
+        exit(2)
+    if args.change_rate + args.rename_rate + args.delete_rate > 1:
+        print("Changed, renamed and deleted files can not exceed all files together! Processing stops!")
+        exit(2)
+    if args.baseline_path and not os.path.isfile(args.baseline_path):
+        print("The baseline table {} does not exist! Processing stops!".format(args.baseline_path))
+        exit(1)
+
+    return args
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=script_directory,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unlabelled"
+
+
+if __name__ == "__main__":
+    args = check_arguments()
+
+    work_path = os.path.abspath(args.work_path)
+    table_path = args.table_path or work_path + "/results.csv"
+    label = args.label or get_revision()
+    parameters = {
+        "seed": args.seed,
+        "scale": args.scale,
+        "file_scale": args.file_scale,
+        "change_rate": args.change_rate,
+        "edit_rate": args.edit_rate,
+        "rename_rate": args.rename_rate,
+        "new_rate": args.new_rate,
+        "delete_rate": args.delete_rate,
+    }
+
+    tools = []
+    for tool in args.tools:
+        missing_programs = [program for program in required_programs[tool] if shutil.which(program) is None]
+        if missing_programs:
+            print("{} is skipped because {} is not installed!".format(tool, ", ".join(missing_programs)))
+        else:
+            tools.append(tool)
+
+    print("Benchmarking {} on {} with Python {}".format(label, platform.platform(), platform.python_version()))
+    rows = []
+    for corpus_name in args.corpora:
+        corpus = corpora[corpus_name]
+        corpus_path = work_path + "/corpora/" + corpus_name
+        create_corpus(corpus, parameters, corpus_path)
+
+        for tool in tools:
+            for compression in args.compressions:
+                if not is_combination_valid(corpus, compression):
+                    continue
+                for trial in range(1, args.trials + 1):
+                    print("Running {} with {} and compression {}, trial {} of {}".format(
+                        corpus_name, tool, compression, trial, args.trials))
+                    run_path = "{}/runs/{}/{}/{}/{}".format(work_path, corpus_name, tool, compression, trial)
+                    trial_rows = run_trial(corpus, corpus_path, tool, compression, trial, run_path, args.jobs, label)
+                    if not trial_rows[0]["verified"]:
+                        print("Trial failed, see {}/output.log".format(run_path))
+                    elif not args.keep_runs:
+                        shutil.rmtree(run_path)
+                    rows.extend(trial_rows)
+
+    # The baseline is read before this run is appended, because both may share the same table
+    baseline_rows = []
+    if args.baseline_path:
+        baseline_rows = [row for row in read_result_table(args.baseline_path) if row["label"] != label]
+        if args.baseline_label:
+            baseline_rows = [row for row in baseline_rows if row["label"] == args.baseline_label]
+
+    write_result_table(rows, table_path)
+    print("Results of {} trials were appended to {}".format(len(rows) // 2, table_path))
+
+    summary = summarize_rows(rows)
+    print_summary(summary)
+
+    if args.baseline_path:
+        regressions = find_regressions(summary, summarize_rows(baseline_rows), args.threshold)
+        if regressions:
+            print("Regressions compared with the baseline:")
+            for (corpus, tool, compression, phase), column, baseline_value, value in regressions:
+                print("    {} {} {} {}: {} went from {} to {}".format(corpus, tool, compression, phase, column,
+                                                                     baseline_value, value))
+            exit(1)
+        print("No regressions above {}% compared with the baseline!".format(args.threshold * 100))
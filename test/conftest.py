@@ -0,0 +1,7 @@
+import os
+import sys
+
+
+# The scripts within src import each other by their module names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
@@ -0,0 +1,96 @@
+import json
+
+import numpy as np
+
+import adaptive_strategy
+from adaptive_strategy import StrategySelector, copy_strategy, estimate_similarity
+from tree_helpers import read_tree, run_script, write_tree
+
+
+def random_bytes(seed, size):
+    return np.random.default_rng(seed).integers(0, 256, size, dtype=np.uint8).tobytes()
+
+
+def write_versions(tmp_path, original_data, modified_data):
+    (tmp_path / "original").write_bytes(original_data)
+    (tmp_path / "modified").write_bytes(modified_data)
+    return str(tmp_path / "original"), str(tmp_path / "modified")
+
+
+def test_similarity(tmp_path):
+    data = random_bytes(1, 200000)
+    assert estimate_similarity(*write_versions(tmp_path, data, data), len(data), len(data)) == 1.0
+    assert estimate_similarity(*write_versions(tmp_path, data, random_bytes(2, 200000)), len(data), 200000) == 0.0
+    edited_data = data[:100000] + random_bytes(3, 50000) + data[150000:]
+    assert 0.6 < estimate_similarity(*write_versions(tmp_path, data, edited_data), len(data), len(data)) < 0.9
+    # Windows without information are left out, a file which only has those counts as half similar
+    assert estimate_similarity(*write_versions(tmp_path, data, b"\0" * 10000), len(data), 10000) == 0.5
+
+
+def test_similarity_of_sampled_windows(tmp_path, monkeypatch):
+    # Only every 32nd window of the original is kept, regions of the modified file are long enough to meet them
+    monkeypatch.setattr(adaptive_strategy, "maximum_window_samples", 200)
+    data = random_bytes(10, 200000)
+    assert adaptive_strategy.get_sample_step(len(data)) == 32
+    # Inserted bytes move everything behind them off the grid of the original windows
+    shifted_data = data[:1001] + b"inserted" + data[1001:]
+    assert estimate_similarity(*write_versions(tmp_path, data, shifted_data), len(data), len(shifted_data)) > 0.9
+    assert estimate_similarity(*write_versions(tmp_path, data, random_bytes(11, 200000)), len(data), 200000) == 0.0
+    edited_data = data[:100000] + random_bytes(12, 50000) + data[150000:]
+    assert 0.6 < estimate_similarity(*write_versions(tmp_path, data, edited_data), len(data), len(data)) < 0.9
+
+
+def test_choose(tmp_path):
+    selector = StrategySelector(tools=["rsync", "cdc"])
+    data = random_bytes(4, 500000)
+    decision = selector.choose(*write_versions(tmp_path, data, data[:200000] + b"edit" + data[200000:]))
+    assert decision["strategy"] in ["rsync", "cdc"] and decision["deadline"] >= 30
+    assert sorted(decision["candidates"]) == ["cdc", "rsync"]
+    assert decision["profile"]["similarity"] > 0.9
+
+    # Random data without any similarity can not be diffed into anything smaller than itself
+    decision = selector.choose(*write_versions(tmp_path, data, random_bytes(5, 500000)))
+    assert decision["strategy"] == copy_strategy and decision["deadline"] is None
+
+    # Tools which would not fit into the memory of a job are not considered at all
+    selector.memory_per_job = 1000
+    decision = selector.choose(*write_versions(tmp_path, data, data))
+    assert decision["candidates"] == {} and decision["strategy"] == copy_strategy
+
+
+def test_record(tmp_path):
+    selector = StrategySelector(tools=["rsync"], decision_log_path=str(tmp_path / "decisions.jsonl"))
+    data = random_bytes(6, 100000)
+    decision = selector.choose(*write_versions(tmp_path, data, data[:50000] + b"edit" + data[50000:]))
+    selector.record(decision, "delta", patch_bytes=1234)
+    selector.record(dict(decision, strategy=copy_strategy), "copy")
+    selector.close()
+
+    with open(str(tmp_path / "decisions.jsonl")) as file_handler:
+        records = [json.loads(line) for line in file_handler]
+    assert [(record["strategy"], record["outcome"]) for record in records] == [("rsync", "delta"), ("copy", "copy")]
+    assert records[0]["patch_bytes"] == 1234 and records[0]["profile"] == decision["profile"]
+    assert selector.stats() == {"tools": ["rsync"], "chosen_strategies": {"rsync": 1, "copy": 1},
+                                "outcomes": {"delta": 1, "copy": 1}, "decision_log": str(tmp_path / "decisions.jsonl")}
+
+
+def test_adaptive_round_trip(tmp_path):
+    data = random_bytes(7, 300000)
+    original_files = {"edited.bin": data, "replaced.bin": random_bytes(8, 50000), "text.txt": b"line\n" * 5000}
+    modified_files = {"edited.bin": data[:100000] + b"edit" + data[100000:], "replaced.bin": random_bytes(9, 50000),
+                      "text.txt": b"line\n" * 2500 + b"changed\n" + b"line\n" * 2500}
+    write_tree(tmp_path / "original", original_files)
+    write_tree(tmp_path / "modified", modified_files)
+    arguments = ["-o", tmp_path / "original", "-m", tmp_path / "modified", "-p", tmp_path / "patch",
+                 "-j", tmp_path / "stats.json"]
+    exit_code, output = run_script("patch_file_creator.py", *arguments, "-k", tmp_path / "fingerprints.json",
+                                   "-t", "adaptive", "-D", tmp_path / "decisions.jsonl")
+    assert exit_code == 0, output
+    with open(str(tmp_path / "decisions.jsonl")) as file_handler:
+        records = [json.loads(line) for line in file_handler]
+    strategies = dict((record["file"].split("/")[-1], record["strategy"]) for record in records)
+    assert strategies["replaced.bin"] == copy_strategy and strategies["edited.bin"] != copy_strategy
+
+    exit_code, output = run_script("patch_file_applier.py", *arguments, "-t", "auto")
+    assert exit_code == 0, output
+    assert read_tree(tmp_path / "original") == modified_files
@@ -0,0 +1,115 @@
+import io
+
+import pytest
+
+from apply_plan import PlanOperation, compile_apply_plan, group_apply_plan, parse_apply_plan, save_apply_plan
+from patch_file_applier import apply_directory_operation
+from tree_helpers import read_tree, write_tree
+from update_api import apply_patch, create_patch
+
+
+def step_of(steps, operation, path):
+    for index, (_, operations) in enumerate(steps):
+        if any(step_operation.operation == operation and step_operation.path == path
+               for step_operation in operations):
+            return index
+    raise KeyError((operation, path))
+
+
+def test_disjoint_removes_and_renames_run_with_the_writes():
+    plan = compile_apply_plan(new_files=["/new//a"], modified_files=["/keep//b"], deleted_files=["/gone//c", "/x//old"],
+                              moved_files=[("/y//renamed", "/x//old")], derived_files=[],
+                              created_directories=["/y"], removed_directories=["/gone", "/x"])
+    steps = group_apply_plan(plan)
+    write_step = step_of(steps, "new", "/new//a")
+    assert step_of(steps, "patch", "/keep//b") == write_step
+    assert step_of(steps, "remove", "/gone//c") == write_step
+    assert step_of(steps, "move", "/y//renamed", ) == write_step
+    assert step_of(steps, "mkdir", "/y") < write_step < step_of(steps, "rmdir", "/gone")
+
+
+def test_conflicting_removes_run_before_the_directories_change():
+    # "/f" turns into a directory, "/d" is replaced by a file and "/s" is read by a copy before it goes away
+    plan = compile_apply_plan(new_files=["/f//inner", "//d"], modified_files=["//s"], deleted_files=["//f", "/d//x"],
+                              moved_files=[("//copy", "//s")], derived_files=[],
+                              created_directories=["/f"], removed_directories=["/d"])
+    steps = group_apply_plan(plan)
+    assert step_of(steps, "remove", "//f") < step_of(steps, "mkdir", "/f")
+    assert step_of(steps, "remove", "/d//x") < step_of(steps, "rmdir", "/d") < step_of(steps, "new", "//d")
+    assert step_of(steps, "copy", "//copy") < step_of(steps, "patch", "//s")
+
+
+def test_files_renamed_away_from_a_new_directory_move_before_its_mkdir():
+    # "/f" is renamed into another new directory and turns into a directory itself
+    plan = compile_apply_plan(new_files=["/f//inner"], modified_files=[], deleted_files=["//f"],
+                              moved_files=[("/t/u//f", "//f")], derived_files=[],
+                              created_directories=["/f", "/t", "/t/u"], removed_directories=[])
+    assert [(operation.operation, operation.path) for operation in plan] == [
+        ("mkdir", "/t"), ("mkdir", "/t/u"), ("move", "/t/u//f"), ("mkdir", "/f"), ("new", "/f//inner")]
+
+
+def test_written_paths_are_cleared_before_the_writes():
+    # "//a" is deleted and added again, "//b" is renamed away while a new file takes its path and
+    # "//c" is read by two copies before a new file replaces it
+    plan = compile_apply_plan(new_files=["//a", "//b", "//c", "//other"], modified_files=[],
+                              deleted_files=["//a", "//b", "//c"],
+                              moved_files=[("//renamed", "//b"), ("//copy", "//c"), ("//second", "//c")],
+                              derived_files=[],
+                              created_directories=[], removed_directories=[])
+    steps = group_apply_plan(plan)
+    assert step_of(steps, "remove", "//a") < step_of(steps, "new", "//a")
+    assert step_of(steps, "move", "//renamed") < step_of(steps, "new", "//b")
+    assert step_of(steps, "copy", "//copy") < step_of(steps, "remove", "//c") < step_of(steps, "new", "//c")
+    # Everything else still runs in parallel, both copies read their source at the same time
+    assert step_of(steps, "copy", "//copy") == step_of(steps, "copy", "//second")
+    assert step_of(steps, "remove", "//a") == step_of(steps, "move", "//renamed") == step_of(steps, "remove", "//c")
+    assert step_of(steps, "new", "//other") == step_of(steps, "new", "//a")
+
+
+def test_directories_are_not_created_over_files(tmp_path):
+    (tmp_path / "f").write_bytes(b"file")
+    (tmp_path / "d").mkdir()
+    # An existing directory is fine for a repeated run, a file which was left at the path is not
+    apply_directory_operation(PlanOperation("mkdir", "/d", "", 0, 0), str(tmp_path))
+    with pytest.raises(FileExistsError):
+        apply_directory_operation(PlanOperation("mkdir", "/f", "", 0, 0), str(tmp_path))
+
+
+def test_plan_file_round_trip(tmp_path):
+    plan = compile_apply_plan(["/a//b"], ["//c"], ["//d"], [("//e", "//f")], [("//g", "//c")], ["/a"], [],
+                              {"/a//b": (10, 0), "//c": (5, 20)})
+    save_apply_plan(plan, str(tmp_path / "plan.txt"))
+    with open(tmp_path / "plan.txt") as file_handler:
+        assert parse_apply_plan(file_handler) == plan
+
+
+def test_apply_restructured_tree(tmp_path):
+    original_files = {
+        "turns_into_directory": b"file\n",
+        "vacated": b"renamed away from a new directory\n" * 20,
+        "replaced/inner.txt": b"inside a directory\n",
+        "renamed/source.txt": b"renamed content\n" * 20,
+        "copied.txt": b"copied content\n" * 20,
+        "removed/old.txt": b"old\n",
+        "patched.txt": b"version 1\n" * 50,
+    }
+    modified_files = {
+        "turns_into_directory/file.txt": b"now a directory\n",
+        "vacated/file.txt": b"within the vacated path\n",
+        "elsewhere/vacated": b"renamed away from a new directory\n" * 20,
+        "replaced": b"now a file\n",
+        "target/renamed.txt": b"renamed content\n" * 20,
+        "copied.txt": b"copied content\n" * 20,
+        "copy/of_copied.txt": b"copied content\n" * 20,
+        "patched.txt": b"version 1\n" * 25 + b"version 2\n" + b"version 1\n" * 25,
+    }
+    write_tree(tmp_path / "original", original_files)
+    write_tree(tmp_path / "modified", modified_files)
+
+    create_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "patch"),
+                 output=io.StringIO(), tool="cdc", fingerprint_cache=str(tmp_path / "fingerprints.json"))
+    result = apply_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "patch"),
+                         output=io.StringIO(), tool="cdc", jobs=4)
+
+    assert result.failed_files == []
+    assert read_tree(tmp_path / "original") == modified_files
@@ -0,0 +1,142 @@
+import gzip
+import io
+import random
+import tarfile
+import zipfile
+
+import archive_diff
+from archive_diff import (ForwardSource, apply_archive_patch_file, create_archive_patch_file, is_archive_patch_file,
+                          read_original_tar, read_tar_gz_layout)
+from patch_file_applier import apply_patch_file
+from patch_file_creator import create_diff_file
+
+
+def random_bytes(generator, size):
+    return bytes(generator.randrange(256) for _ in range(size))
+
+
+def create_members(seed):
+    generator = random.Random(seed)
+    original_members = dict(("member_{}.bin".format(number), random_bytes(generator, 20000)) for number in range(6))
+    modified_members = dict(original_members)
+    modified_members["member_1.bin"] = original_members["member_1.bin"][:9000] + b"changed" + \
+        original_members["member_1.bin"][9000:]
+    modified_members["member_4.bin"] = original_members["member_4.bin"][5000:]
+    del modified_members["member_2.bin"]
+    modified_members["added.txt"] = b"added\n" * 50
+    return original_members, modified_members
+
+
+def write_tar_gz(path, members, names):
+    with open(path, "wb") as file_handler:
+        with gzip.GzipFile(fileobj=file_handler, mode="wb", mtime=0) as gzip_handler, \
+                tarfile.open(fileobj=gzip_handler, mode="w", format=tarfile.GNU_FORMAT) as tar_handler:
+            for name in names:
+                info = tarfile.TarInfo(name)
+                info.size = len(members[name])
+                tar_handler.addfile(info, io.BytesIO(members[name]))
+
+
+def write_zip(path, members, names):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_handler:
+        for name in names:
+            zip_handler.writestr(zipfile.ZipInfo(name, (2020, 1, 1, 0, 0, 0)), members[name],
+                                 compress_type=zipfile.ZIP_DEFLATED)
+
+
+def round_trip(tmp_path, suffix):
+    original_file = str(tmp_path / ("original" + suffix))
+    modified_file = str(tmp_path / ("modified" + suffix))
+    patch_file = str(tmp_path / "archive.patch")
+    output_file = str(tmp_path / ("output" + suffix))
+
+    assert create_archive_patch_file(original_file, modified_file, patch_file, lambda original, modified, patch:
+                                     create_diff_file(original, modified, patch, "rsync")) == 0
+    assert is_archive_patch_file(patch_file)
+    assert apply_archive_patch_file(original_file, patch_file, output_file, lambda original, patch, output:
+                                    apply_patch_file(original, patch, output, "rsync")) == 0
+    with open(output_file, "rb") as output_handler, open(modified_file, "rb") as modified_handler:
+        assert output_handler.read() == modified_handler.read()
+    return patch_file
+
+
+def test_tar_gz_with_reordered_members(tmp_path, monkeypatch):
+    original_members, modified_members = create_members(9)
+    write_tar_gz(tmp_path / "original.tar.gz", original_members, sorted(original_members))
+    # Members are read from the original in the reverse order, every one lies before the one read before
+    write_tar_gz(tmp_path / "modified.tar.gz", modified_members, sorted(modified_members, reverse=True))
+
+    backward_seeks = []
+    gzip_seek = gzip.GzipFile.seek
+
+    def recording_seek(self, offset, whence=0):
+        if whence == 0 and offset < self.tell():
+            backward_seeks.append(offset)
+        return gzip_seek(self, offset, whence)
+
+    # Seeking a gzip stream backwards decompresses it again from its start
+    monkeypatch.setattr(gzip.GzipFile, "seek", recording_seek)
+    gzip_open = gzip.open
+    opened_files = []
+
+    def recording_open(file_path, *args):
+        opened_files.append(file_path.rpartition("/")[2])
+        return gzip_open(file_path, *args)
+
+    monkeypatch.setattr(archive_diff.gzip, "open", recording_open)
+    patch_file = round_trip(tmp_path, ".tar.gz")
+
+    assert backward_seeks == []
+    # The original is decompressed once while creating and once while applying the patch, the modified version
+    # is decompressed once more after it was indexed together with the search for its compression level
+    assert sorted(opened_files) == ["modified.tar.gz", "original.tar.gz", "original.tar.gz"]
+    with open(patch_file, "rb") as patch_handler:
+        assert len(patch_handler.read()) < sum(len(data) for data in modified_members.values()) // 2
+
+
+def test_tar_gz_unchanged(tmp_path):
+    original_members, _ = create_members(3)
+    write_tar_gz(tmp_path / "original.tar.gz", original_members, sorted(original_members))
+    write_tar_gz(tmp_path / "modified.tar.gz", original_members, sorted(original_members))
+    round_trip(tmp_path, ".tar.gz")
+
+
+def test_zip_with_reordered_members(tmp_path):
+    original_members, modified_members = create_members(11)
+    write_zip(tmp_path / "original.zip", original_members, sorted(original_members))
+    write_zip(tmp_path / "modified.zip", modified_members, sorted(modified_members, reverse=True))
+    round_trip(tmp_path, ".zip")
+
+
+def test_only_changed_members_are_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive_diff, "copy_buffer_size", 4096)
+    original_members, modified_members = create_members(13)
+    write_tar_gz(tmp_path / "original.tar.gz", original_members, sorted(original_members))
+    write_tar_gz(tmp_path / "modified.tar.gz", modified_members, sorted(modified_members))
+
+    _, _, level, members = read_tar_gz_layout(str(tmp_path / "modified.tar.gz"))
+    assert level is not None and len(members) == len(modified_members)
+    (tmp_path / "work").mkdir()
+    _, spilled_members = read_original_tar(str(tmp_path / "original.tar.gz"),
+                                           dict((member[0], member) for member in members), str(tmp_path / "work"))
+    # member_1.bin differs from byte 9000 on, its first two blocks are taken from the modified member
+    assert sorted(spilled_members) == ["member_1.bin", "member_4.bin"]
+    assert spilled_members["member_1.bin"][0] == 8192
+    assert sum(entry.stat().st_size for entry in (tmp_path / "work").iterdir()) == 20000 - 8192 + 20000
+    round_trip(tmp_path, ".tar.gz")
+
+
+def test_forward_source_spills_only_ranges_out_of_order(tmp_path):
+    data = bytes(range(256)) * 40
+    ranges = [(0, 100), (5000, 1000), (200, 300), (6000, 10), (5500, 1000), (7000, 0)]
+    source = ForwardSource(io.BytesIO(data), ranges, str(tmp_path / "spill"))
+    try:
+        for offset, length in ranges:
+            assert b"".join(source.iterate_range(offset, length)) == data[offset:offset + length]
+    finally:
+        source.close()
+    # 200-500 lies behind 6000 and 5500-6010 was read before, only 6010-6500 is read from the stream
+    assert source.spill_size == (tmp_path / "spill").stat().st_size == 300 + 510
+
+    ForwardSource(io.BytesIO(data), [(0, 100), (100, 50), (4000, 10)], str(tmp_path / "unused")).close()
+    assert not (tmp_path / "unused").exists()
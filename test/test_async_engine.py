@@ -0,0 +1,117 @@
+import asyncio
+import io
+import shutil
+import sys
+
+import pytest
+
+from async_engine import AsyncPatchEngine, apply_patches
+from instrumentation import JobCancelled, call_process
+from tree_helpers import read_tree, write_tree
+from update_api import ArgumentError, create_patch
+
+sleeping_command = [sys.executable, "-c", "import time; time.sleep(30)"]
+
+
+def test_apply_patches(tmp_path):
+    original_files = {"a.txt": b"".join(b"line %d\n" % number for number in range(3000)), "gone.txt": b"gone\n"}
+    modified_files = {"a.txt": b"".join(b"line %d\n" % (number * 3) for number in range(3000)), "b/new.txt": b"new\n"}
+    write_tree(tmp_path / "original", original_files)
+    write_tree(tmp_path / "modified", modified_files)
+    create_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "update.dupatch"),
+                 output=io.StringIO(), tool="cdc", container=True,
+                 fingerprint_cache=str(tmp_path / "fingerprints.json"))
+    shutil.copytree(tmp_path / "original", tmp_path / "copy")
+
+    results = asyncio.run(apply_patches([str(tmp_path / "original"), str(tmp_path / "copy")],
+                                        [str(tmp_path / "update.dupatch")] * 2, tool="cdc",
+                                        modified_version_path=str(tmp_path / "modified"), output=io.StringIO()))
+    for result in results:
+        assert result.failed_files == [] and result.mismatching_files == []
+        assert read_tree(result.original_version_path) == modified_files
+
+
+def test_resumable_updates_run_within_the_applier(tmp_path):
+    original_files = {"a.txt": b"".join(b"line %d\n" % number for number in range(3000)), "gone.txt": b"gone\n"}
+    modified_files = {"a.txt": b"".join(b"line %d\n" % (number * 3) for number in range(3000)), "b/new.txt": b"new\n"}
+    write_tree(tmp_path / "original", original_files)
+    write_tree(tmp_path / "modified", modified_files)
+    create_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "update.dupatch"),
+                 output=io.StringIO(), tool="cdc", container=True,
+                 fingerprint_cache=str(tmp_path / "fingerprints.json"))
+
+    engine = AsyncPatchEngine()
+    output = io.StringIO()
+    result = asyncio.run(engine.apply_patch(str(tmp_path / "original"), str(tmp_path / "update.dupatch"), tool="cdc",
+                                            modified_version_path=str(tmp_path / "modified"), output=output,
+                                            resumable=True))
+    assert result.failed_files == [] and result.mismatching_files == []
+    assert read_tree(tmp_path / "original") == modified_files
+    assert "Progress is recorded within" in output.getvalue()
+
+    # Without the modified version the applier can not be called
+    with pytest.raises(ArgumentError) as error:
+        asyncio.run(engine.apply_patch(str(tmp_path / "original"), str(tmp_path / "update.dupatch"), tool="cdc",
+                                       resumable=True))
+    assert error.value.exit_code == 2
+
+
+def test_cancelled_processes_are_killed():
+    async def run():
+        engine = AsyncPatchEngine()
+        task = asyncio.ensure_future(engine.run_process(sleeping_command))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return engine.stats()
+
+    assert asyncio.run(run()) == {"started_processes": 1, "killed_processes": 1, "cancelled_jobs": 0}
+
+
+def test_cancelled_jobs_stop_their_processes():
+    errors = []
+
+    def job():
+        # Runs within a thread of the engine like a creation or an application of the library
+        try:
+            call_process(sleeping_command)
+        except JobCancelled as error:
+            errors.append(error)
+        try:
+            call_process(sleeping_command)
+        except JobCancelled as error:
+            errors.append(error)
+
+    async def run():
+        engine = AsyncPatchEngine()
+        task = asyncio.ensure_future(engine.run_job(job))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return engine.stats()
+
+    assert asyncio.run(run())["cancelled_jobs"] == 1
+    # The running process was killed and the next one was not even started
+    assert len(errors) == 2 and "while" in str(errors[0]) and "before" in str(errors[1])
+
+
+def test_pending_jobs_are_limited():
+    async def run():
+        engine = AsyncPatchEngine(max_pending=2)
+        release = asyncio.Event()
+
+        async def job():
+            await release.wait()
+
+        first_tasks = [await engine.submit(job()) for _ in range(2)]
+        # The third job waits until one of the others finished
+        third_submit = asyncio.ensure_future(engine.submit(job()))
+        await asyncio.sleep(0.1)
+        assert not third_submit.done()
+        release.set()
+        third_task = await asyncio.wait_for(third_submit, 5)
+        await asyncio.gather(third_task, *first_tasks)
+
+    asyncio.run(run())
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from chunk_store import apply_chunk_patch_file, create_chunk_patch_file, iterate_chunks, maximum_chunk_size
+
+
+def random_bytes(seed, size):
+    return np.random.default_rng(seed).integers(0, 256, size, dtype=np.uint8).tobytes()
+
+
+def create_and_apply(tmp_path, original_data, modified_data):
+    (tmp_path / "original").write_bytes(original_data)
+    (tmp_path / "modified").write_bytes(modified_data)
+    assert create_chunk_patch_file(str(tmp_path / "original"), str(tmp_path / "modified"),
+                                   str(tmp_path / "patch")) == 0
+    assert apply_chunk_patch_file(str(tmp_path / "original"), str(tmp_path / "patch"), str(tmp_path / "output")) == 0
+    assert (tmp_path / "output").read_bytes() == modified_data
+    return (tmp_path / "patch").stat().st_size
+
+
+def test_chunks_cover_the_file(tmp_path):
+    data = random_bytes(1, 500000)
+    (tmp_path / "file").write_bytes(data)
+    chunks = list(iterate_chunks(str(tmp_path / "file")))
+    assert chunks[0][0] == 0
+    assert all(offset + length == next_offset for (offset, length, _), (next_offset, _, _) in zip(chunks, chunks[1:]))
+    assert chunks[-1][0] + chunks[-1][1] == len(data)
+    assert max(length for _, length, _ in chunks) <= maximum_chunk_size
+
+
+def test_insertion_keeps_the_following_chunks(tmp_path):
+    original_data = random_bytes(2, 1000000)
+    modified_data = original_data[:400000] + b"inserted" * 100 + original_data[400000:]
+    # Content-defined boundaries resynchronize after the insertion, only the chunks around it are new
+    assert create_and_apply(tmp_path, original_data, modified_data) < 100000
+
+
+@pytest.mark.parametrize("original_size, modified_size", [(0, 0), (0, 5000), (5000, 0), (100, 100)])
+def test_small_and_empty_files(tmp_path, original_size, modified_size):
+    create_and_apply(tmp_path, random_bytes(3, original_size), random_bytes(4, modified_size))
+
+
+def test_repeated_chunks_within_the_modified_file(tmp_path):
+    block = random_bytes(5, 200000)
+    # Chunks which occur a second time are referenced within the rebuilt output
+    assert create_and_apply(tmp_path, b"", block + block + block) < len(block) + 50000
@@ -0,0 +1,54 @@
+import os
+
+import file_fingerprints
+from file_fingerprints import are_files_equal, load_fingerprint_cache, save_fingerprint_cache
+
+
+def count_hashes(monkeypatch):
+    hashed_files = []
+    calculate_file_hash = file_fingerprints.calculate_file_hash
+
+    def counting_calculate_file_hash(file_path):
+        hashed_files.append(file_path)
+        return calculate_file_hash(file_path)
+
+    monkeypatch.setattr(file_fingerprints, "calculate_file_hash", counting_calculate_file_hash)
+    return hashed_files
+
+
+def test_cached_fingerprints_are_reused(tmp_path, monkeypatch):
+    hashed_files = count_hashes(monkeypatch)
+    (tmp_path / "a").write_bytes(b"content" * 1000)
+    (tmp_path / "b").write_bytes(b"content" * 1000)
+    (tmp_path / "c").write_bytes(b"CONTENT" * 1000)
+
+    fingerprint_cache = {}
+    assert are_files_equal(str(tmp_path / "a"), str(tmp_path / "b"), fingerprint_cache)
+    assert not are_files_equal(str(tmp_path / "a"), str(tmp_path / "c"), fingerprint_cache)
+    assert len(hashed_files) == 3
+
+    # The cache survives the run, unchanged files are not read again
+    save_fingerprint_cache(fingerprint_cache, str(tmp_path / "cache" / "fingerprints.json"))
+    fingerprint_cache = load_fingerprint_cache(str(tmp_path / "cache" / "fingerprints.json"))
+    assert are_files_equal(str(tmp_path / "a"), str(tmp_path / "b"), fingerprint_cache)
+    assert len(hashed_files) == 3
+
+    # A file which was rewritten gets a new mtime and is hashed again
+    (tmp_path / "b").write_bytes(b"CONTENT" * 1000)
+    os.utime(str(tmp_path / "b"), ns=(1, 1))
+    assert not are_files_equal(str(tmp_path / "a"), str(tmp_path / "b"), fingerprint_cache)
+    assert hashed_files[3:] == [str(tmp_path / "b")]
+
+
+def test_files_of_different_sizes_are_not_hashed(tmp_path, monkeypatch):
+    hashed_files = count_hashes(monkeypatch)
+    (tmp_path / "a").write_bytes(b"short")
+    (tmp_path / "b").write_bytes(b"longer")
+    assert not are_files_equal(str(tmp_path / "a"), str(tmp_path / "b"), {})
+    assert hashed_files == []
+
+
+def test_damaged_cache_is_rebuilt(tmp_path):
+    (tmp_path / "fingerprints.json").write_text("{broken")
+    assert load_fingerprint_cache(str(tmp_path / "fingerprints.json")) == {}
+    assert load_fingerprint_cache(str(tmp_path / "missing.json")) == {}
@@ -0,0 +1,138 @@
+import errno
+import hashlib
+import io
+import os
+
+import pytest
+
+import file_placement
+from file_placement import (create_output_file, finish_output_file, place_file, place_stream, placement_stats,
+                            reset_placement_stats)
+from tree_helpers import read_tree, write_tree
+from update_api import apply_patch, create_patch
+
+
+@pytest.fixture(autouse=True)
+def fresh_counters():
+    reset_placement_stats()
+
+
+def unsupported(*args):
+    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+
+def failing_reflink(*args):
+    raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+
+
+@pytest.fixture
+def files(tmp_path):
+    (tmp_path / "source").write_bytes(b"source content\n" * 1000)
+    (tmp_path / "destination").write_bytes(b"old destination\n")
+    os.chmod(tmp_path / "source", 0o640)
+    return str(tmp_path / "source"), str(tmp_path / "destination")
+
+
+def test_rename(files):
+    source_path, destination_path = files
+    assert place_file(source_path, destination_path) == "rename"
+    assert not os.path.exists(source_path)
+    assert placement_stats() == {"rename": {"files": 1, "bytes": 15000}}
+
+
+@pytest.mark.parametrize("failing, expected_method", [
+    ([], None),
+    (["reflink"], "copy_file_range"),
+    (["reflink", "copy_file_range"], "copy"),
+])
+def test_fallback_chain(files, monkeypatch, failing, expected_method):
+    source_path, destination_path = files
+    # A rename across file systems is the first method which fails
+    monkeypatch.setattr(file_placement.os, "rename", unsupported)
+    if "reflink" in failing:
+        monkeypatch.setattr(file_placement.fcntl, "ioctl", failing_reflink)
+    if "copy_file_range" in failing:
+        monkeypatch.setattr(file_placement.os, "copy_file_range", unsupported)
+
+    output_hash = hashlib.sha256()
+    method = place_file(source_path, destination_path, output_hash=output_hash)
+    # Whether reflinks work depends on the file system the test runs on
+    assert method == expected_method if expected_method else method in ("reflink", "copy_file_range", "copy")
+    with open(destination_path, "rb") as file_handler:
+        assert file_handler.read() == b"source content\n" * 1000
+    assert output_hash.hexdigest() == hashlib.sha256(b"source content\n" * 1000).hexdigest()
+    assert not os.path.exists(source_path)
+    assert os.stat(destination_path).st_mode & 0o777 == 0o640
+    assert placement_stats() == {method: {"files": 1, "bytes": 15000}}
+    assert os.listdir(os.path.dirname(destination_path)) == ["destination"]
+
+
+def test_kept_source(files):
+    source_path, destination_path = files
+    assert place_file(source_path, destination_path, keep_source=True) != "rename"
+    assert open(source_path, "rb").read() == open(destination_path, "rb").read()
+
+
+def test_other_errors_are_raised(files, monkeypatch):
+    source_path, destination_path = files
+    monkeypatch.setattr(file_placement.os, "rename", unsupported)
+
+    def failing_ioctl(*args):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    monkeypatch.setattr(file_placement.fcntl, "ioctl", failing_ioctl)
+    with pytest.raises(OSError):
+        place_file(source_path, destination_path)
+    # The destination stays intact and no temporary file is left behind
+    assert open(destination_path, "rb").read() == b"old destination\n"
+    assert sorted(os.listdir(os.path.dirname(destination_path))) == ["destination", "source"]
+
+
+def test_stream(tmp_path):
+    output_hash = hashlib.sha256()
+    assert place_stream(io.BytesIO(b"streamed\n" * 100), str(tmp_path / "file"), output_hash) == "stream"
+    assert (tmp_path / "file").read_bytes() == b"streamed\n" * 100
+    assert output_hash.hexdigest() == hashlib.sha256(b"streamed\n" * 100).hexdigest()
+    assert placement_stats() == {"stream": {"files": 1, "bytes": 900}}
+
+
+def test_output_files(files):
+    source_path, destination_path = files
+    output_file = create_output_file(destination_path)
+    with open(output_file, "wb") as file_handler:
+        file_handler.write(b"broken")
+    # A failed patch leaves the destination untouched
+    finish_output_file(output_file, destination_path, False)
+    assert not os.path.exists(output_file)
+    assert open(destination_path, "rb").read() == b"old destination\n"
+
+    output_file = create_output_file(destination_path)
+    with open(output_file, "wb") as file_handler:
+        file_handler.write(b"patched")
+    finish_output_file(output_file, destination_path, True, mode_path=source_path)
+    assert open(destination_path, "rb").read() == b"patched"
+    assert os.stat(destination_path).st_mode & 0o777 == 0o640
+    assert placement_stats() == {"patched": {"files": 1, "bytes": 7}}
+
+
+@pytest.mark.parametrize("tool", ["rsync", "cdc"])
+def test_every_application_counts_its_own_placements(tmp_path, tool):
+    original_files = {"changed.bin": bytes(range(256)) * 400, "removed.txt": b"removed\n"}
+    modified_files = {"changed.bin": bytes(range(256)) * 200 + b"changed" + bytes(range(256)) * 200,
+                      "new.txt": b"new\n" * 50}
+    write_tree(tmp_path / "original", original_files)
+    write_tree(tmp_path / "modified", modified_files)
+
+    placements = []
+    for name in ["first", "second"]:
+        # New files are renamed out of the patch, so every application gets a patch of its own
+        create_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / name / "patch"),
+                     output=io.StringIO(), tool=tool, fingerprint_cache=str(tmp_path / "fingerprints.json"))
+        write_tree(tmp_path / name / "tree", original_files)
+        result = apply_patch(str(tmp_path / name / "tree"), str(tmp_path / "modified"), str(tmp_path / name / "patch"),
+                             output=io.StringIO(), tool=tool)
+        # The engines write into the temporary output they were given, nothing else is left next to it
+        assert read_tree(tmp_path / name / "tree") == modified_files
+        placements.append(result.stats["file_placement"])
+    assert placements[0] == placements[1]
+    assert placements[0]["patched"] == {"files": 1, "bytes": len(modified_files["changed.bin"])}
@@ -0,0 +1,76 @@
+import json
+import sys
+
+import pytest
+
+import instrumentation
+from instrumentation import call_process, enable_tracing, file_span, null_span, span
+from tree_helpers import run_script, write_tree
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    # The tracer is global, every test gets a fresh one which is removed again afterwards
+    monkeypatch.setattr(instrumentation, "tracer", None)
+    return enable_tracing()
+
+
+def test_spans_without_tracing(monkeypatch):
+    monkeypatch.setattr(instrumentation, "tracer", None)
+    assert span("phase") is null_span and file_span("diff", file="a") is null_span
+    assert call_process([sys.executable, "-c", "import sys; sys.exit(3)"]) == 3
+
+
+def test_phases_and_files(tracer, tmp_path):
+    (tmp_path / "file").write_bytes(b"x" * 1234)
+    for _ in range(2):
+        with span("scan", path="original"):
+            with file_span("diff", file="file", tool="rsync") as diff_span:
+                diff_span.record_size("patch_size", str(tmp_path / "file"))
+                diff_span.record_size("missing_size", str(tmp_path / "missing"))
+    with pytest.raises(ValueError):
+        with span("failing"):
+            raise ValueError()
+
+    stats = tracer.stats()
+    assert stats["schema_version"] == instrumentation.stats_schema_version
+    assert list(stats["phases"]) == ["scan", "failing"] and stats["phases"]["scan"]["count"] == 2
+    assert stats["phases"]["scan"]["seconds"] >= 0
+    assert [(file["operation"], file["tool"], file["patch_size"]) for file in stats["files"]] == \
+        [("diff", "rsync", 1234)] * 2
+    assert "missing_size" not in stats["files"][0]
+    assert tracer.events[-1][5] == {"error": "ValueError"}
+
+
+def test_processes_are_measured(tracer):
+    assert call_process([sys.executable, "-c", "data = bytearray(64 * 1024 * 1024)"]) == 0
+    process = tracer.stats()["processes"][0]
+    assert process["exit_code"] == 0 and process["command"].startswith(sys.executable)
+    assert process["peak_rss_bytes"] >= 64 * 1024 * 1024 and process["cpu_seconds"] > 0
+
+
+def test_chrome_trace(tmp_path):
+    write_tree(tmp_path / "original", {"a.txt": b"a" * 5000, "b.txt": b"b\n" * 3000})
+    write_tree(tmp_path / "modified", {"a.txt": b"a" * 4000 + b"b" * 1000, "c.txt": b"c\n" * 3000})
+    arguments = ["-o", tmp_path / "original", "-m", tmp_path / "modified", "-p", tmp_path / "patch",
+                 "-j", tmp_path / "stats.json", "-t", "rsync"]
+    assert run_script("patch_file_creator.py", *arguments, "-k", tmp_path / "fingerprints.json",
+                      "-T", tmp_path / "create.trace")[0] == 0
+    assert run_script("patch_file_applier.py", *arguments, "-T", tmp_path / "apply.trace")[0] == 0
+
+    with open(str(tmp_path / "create.trace")) as file_handler:
+        events = json.load(file_handler)["traceEvents"]
+    # Every span is a complete event with its times in microseconds, the names of the threads are metadata
+    assert events[0] == {"name": "process_name", "ph": "M", "pid": events[0]["pid"],
+                         "args": {"name": "patch_file_creator"}}
+    assert any(event["ph"] == "M" and event["name"] == "thread_name" for event in events)
+    complete_events = [event for event in events if event["ph"] == "X"]
+    assert all(event["dur"] >= 0 and event["ts"] >= 0 for event in complete_events)
+    assert {"scan", "detect_changes", "create_diff_files"} <= set(event["name"] for event in complete_events)
+    assert [event["args"]["file"] for event in complete_events if event["name"] == "diff"] == \
+        [str(tmp_path / "modified") + "///a.txt"]
+
+    with open(str(tmp_path / "stats.json")) as file_handler:
+        stats = json.load(file_handler)
+    assert stats["instrumentation_of_the_creation"]["phases"]["scan"]["count"] == 2
+    assert {"read_file_lists", "apply_changes"} <= set(stats["instrumentation_of_the_application"]["phases"])
@@ -0,0 +1,119 @@
+import os
+
+import pytest
+
+import patch_file_applier
+from journal import Journal, find_finished_unit, finish_unit
+from patch_file_applier import (PatchDirectory, commit_staged_changes, create_commit_operations, get_apply_plan,
+                                roll_back_staged_changes, stage_all_changes)
+from tree_helpers import read_tree, run_script, write_tree
+
+
+def test_records_survive_a_torn_line(tmp_path):
+    journal_path = str(tmp_path / "journal")
+    journal = Journal(journal_path)
+    journal.record("first", state="started")
+    journal.record("second", state="done")
+    journal.record("first", state="done")
+    journal.close()
+    with open(journal_path, "a") as file_handler:
+        file_handler.write('{"unit": "third", "sta')
+
+    journal = Journal(journal_path)
+    assert len(journal) == 2
+    assert journal.get("first")["state"] == "done"
+    assert journal.get("third") is None
+    journal.remove()
+    assert not os.path.exists(journal_path)
+
+
+def test_finished_units_depend_on_their_inputs(tmp_path):
+    (tmp_path / "input").write_bytes(b"input")
+    (tmp_path / "output").write_bytes(b"output")
+    journal = Journal(str(tmp_path / "journal"))
+    finish_unit(journal, "unit", [str(tmp_path / "input")], str(tmp_path / "output"), size=6)
+    assert find_finished_unit(journal, "unit", [str(tmp_path / "input")], str(tmp_path / "output"))["size"] == 6
+
+    (tmp_path / "output").write_bytes(b"broken")
+    assert find_finished_unit(journal, "unit", [str(tmp_path / "input")], str(tmp_path / "output")) is None
+    (tmp_path / "output").write_bytes(b"output")
+    (tmp_path / "input").write_bytes(b"changed input")
+    assert find_finished_unit(journal, "unit", [str(tmp_path / "input")], str(tmp_path / "output")) is None
+    journal.close()
+
+
+@pytest.fixture
+def interrupted_update(tmp_path, monkeypatch):
+    original_files = {
+        "keep.txt": b"keep\n" * 100,
+        "changed.txt": b"".join(b"line %d\n" % number for number in range(3000)),
+        "removed.txt": b"removed\n",
+        "renamed/from.txt": b"renamed content\n" * 200,
+        "replaced": b"a file which turns into a directory\n",
+    }
+    modified_files = {
+        "keep.txt": b"keep\n" * 100,
+        "changed.txt": b"".join(b"line %d\n" % (number + 1 if number % 50 == 0 else number)
+                                for number in range(3000)),
+        "renamed_to/to.txt": b"renamed content\n" * 200,
+        "replaced/inner.txt": b"a file within the new directory\n",
+        "new/added.txt": b"added\n" * 400,
+    }
+    write_tree(tmp_path / "original", original_files)
+    write_tree(tmp_path / "modified", modified_files)
+    assert run_script("patch_file_creator.py", "-o", tmp_path / "original", "-m", tmp_path / "modified",
+                      "-p", tmp_path / "patch", "-j", tmp_path / "stats.json", "-k", tmp_path / "fingerprints.json",
+                      "-t", "cdc")[0] == 0
+
+    paths = dict((name, str(tmp_path / name)) for name in ["original", "patch", "staging", "backup", "journal"])
+    patch_source = PatchDirectory(paths["patch"], keep_files=True)
+    new_files, modified_files_list, deleted_files, moved_files, derived_files = patch_source.read_file_lists()
+    journal = Journal(paths["journal"])
+    assert stage_all_changes(new_files, modified_files_list, derived_files, paths["original"], patch_source, "cdc",
+                             paths["staging"], journal) == []
+    # Nothing within the original version changes while the files are staged
+    assert read_tree(tmp_path / "original") == original_files
+    apply_plan = get_apply_plan(patch_source, paths["original"], new_files, modified_files_list, deleted_files,
+                                moved_files, derived_files)
+    operations = create_commit_operations(apply_plan)
+
+    # The commit breaks off after a few of its operations, like a process which is killed
+    commit_operation = patch_file_applier.commit_operation
+    calls = []
+
+    def breaking_commit_operation(*args):
+        calls.append(args[0])
+        if len(calls) == 4:
+            raise KeyboardInterrupt()
+        return commit_operation(*args)
+
+    monkeypatch.setattr(patch_file_applier, "commit_operation", breaking_commit_operation)
+    with pytest.raises(KeyboardInterrupt):
+        commit_staged_changes(operations, paths["original"], paths["staging"], paths["backup"], journal)
+    monkeypatch.setattr(patch_file_applier, "commit_operation", commit_operation)
+    journal.close()
+
+    assert read_tree(tmp_path / "original") != original_files
+    return paths, operations, original_files, modified_files
+
+
+def test_interrupted_update_is_rolled_back(interrupted_update):
+    paths, _, original_files, _ = interrupted_update
+    roll_back_staged_changes(paths["original"], paths["staging"], paths["backup"], Journal(paths["journal"]))
+
+    assert read_tree(paths["original"]) == original_files
+    assert sorted(os.listdir(paths["original"])) == ["changed.txt", "keep.txt", "removed.txt", "renamed", "replaced"]
+    for name in ["staging", "backup", "journal"]:
+        assert not os.path.exists(paths[name])
+
+
+def test_interrupted_update_is_resumed(interrupted_update):
+    paths, operations, _, modified_files = interrupted_update
+    journal = Journal(paths["journal"])
+    # Operations which were done before the interruption are not repeated
+    assert journal.get("operation:2")["state"] == "done" and journal.get("operation:3")["state"] == "started"
+    commit_staged_changes(operations, paths["original"], paths["staging"], paths["backup"], journal)
+    journal.close()
+
+    assert read_tree(paths["original"]) == modified_files
+    assert journal.get("commit")["state"] == "done"
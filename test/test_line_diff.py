@@ -0,0 +1,116 @@
+import io
+import random
+
+import pytest
+
+from line_diff import apply_line_patch, apply_line_patch_file, create_line_patch, create_line_patch_file
+from tree_helpers import read_tree, requires_programs, write_tree
+from update_api import apply_patch, create_patch
+
+
+def line_round_trip(original_data, modified_data):
+    original_lines = original_data.splitlines(keepends=True)
+    modified_lines = modified_data.splitlines(keepends=True)
+    patch = io.BytesIO()
+    create_line_patch(original_lines, modified_lines, len(original_data), len(modified_data), patch)
+    patch.seek(0)
+    output = io.BytesIO()
+    apply_line_patch(original_data, patch, output)
+    return output.getvalue()
+
+
+@pytest.mark.parametrize("original_data, modified_data", [
+    (b"", b""),
+    (b"", b"new\nfile"),
+    (b"a\nb\nc\n", b""),
+    (b"a\nb\nc\n", b"a\nx\nc\n"),
+    (b"a\r\nb\r\nc", b"a\r\nb\nc\r\nd"),
+    (b"same\n" * 100, b"same\n" * 50 + b"other\n" + b"same\n" * 51),
+    (b"no newline at the end", b"no newline at the end\n"),
+])
+def test_line_patch_round_trip(original_data, modified_data):
+    assert line_round_trip(original_data, modified_data) == modified_data
+
+
+def test_line_patch_round_trip_random_edits():
+    generator = random.Random(24)
+    words = [b"alpha", b"beta", b"gamma", b"delta", b"epsilon"]
+    lines = [b" ".join(generator.choices(words, k=4)) + b"\n" for _ in range(2000)]
+    modified_lines = list(lines)
+    for _ in range(200):
+        position = generator.randrange(len(modified_lines))
+        edit = generator.choice(["insert", "delete", "replace"])
+        if edit == "insert":
+            modified_lines.insert(position, generator.choice(words) + b"\n")
+        elif edit == "delete":
+            del modified_lines[position]
+        else:
+            modified_lines[position] = generator.choice(words) + b"\r\n"
+    original_data = b"".join(lines)
+    modified_data = b"".join(modified_lines)
+    assert line_round_trip(original_data, modified_data) == modified_data
+
+
+def test_line_patch_rejects_another_original():
+    patch = io.BytesIO()
+    create_line_patch([b"a\n", b"b\n"], [b"a\n", b"c\n"], 4, 4, patch)
+    patch.seek(0)
+    with pytest.raises(ValueError):
+        apply_line_patch(b"x\ny\nz\n", patch, io.BytesIO())
+
+
+def test_line_patch_file_writes_only_the_given_output(tmp_path):
+    write_tree(tmp_path, {"original": b"a\nb\n", "modified": b"a\nc\nb\n"})
+    create_line_patch_file(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "patch"))
+    assert apply_line_patch_file(str(tmp_path / "original"), str(tmp_path / "patch"), str(tmp_path / "output")) == 0
+    assert read_tree(tmp_path) == {"original": b"a\nb\n", "modified": b"a\nc\nb\n",
+                                   "patch": (tmp_path / "patch").read_bytes(), "output": b"a\nc\nb\n"}
+
+
+def test_text_tool_on_text_tree(tmp_path):
+    original_files = {"a.txt": b"line\n" * 300, "dir/b.cfg": b"key = value\r\n" * 50, "gone.txt": b"gone\n"}
+    modified_files = {"a.txt": b"line\n" * 150 + b"changed\n" + b"line\n" * 150,
+                      "dir/b.cfg": b"key = other\r\n" + b"key = value\r\n" * 49, "new.txt": b"new\n"}
+    write_tree(tmp_path / "original", original_files)
+    write_tree(tmp_path / "modified", modified_files)
+
+    create_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "patch"),
+                 output=io.StringIO(), tool="text", fingerprint_cache=str(tmp_path / "fingerprints.json"))
+    # Line patches are a fraction of the files they change
+    assert (tmp_path / "patch" / "a.txt").stat().st_size < 200
+    result = apply_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "patch"),
+                         output=io.StringIO(), tool="text", verify_tree=True)
+
+    assert result.failed_files == [] and result.mismatching_files == []
+    assert read_tree(tmp_path / "original") == modified_files
+
+
+@requires_programs("bsdiff", "bspatch")
+@pytest.mark.parametrize("options", [{}, {"container": True}])
+def test_text_tool_on_mixed_tree(tmp_path, options):
+    # Binary files are diffed by bsdiff, the applier has to recognize their patches with -t text as well
+    generator = random.Random(5)
+    binary_data = bytes(generator.randrange(256) for _ in range(20000))
+    original_files = {
+        "text/a.txt": b"line\n" * 300,
+        "text/b.cfg": b"key = value\r\n" * 50,
+        "binary/data.bin": binary_data,
+        "binary/image.png": b"\x89PNG\0" + binary_data[:5000],
+    }
+    modified_files = {
+        "text/a.txt": b"line\n" * 150 + b"changed\n" + b"line\n" * 150,
+        "text/b.cfg": b"key = other\r\n" + b"key = value\r\n" * 49,
+        "binary/data.bin": binary_data[:10000] + b"\0\1\2" + binary_data[10000:],
+        "binary/image.png": b"\x89PNG\0" + binary_data[100:5100],
+    }
+    write_tree(tmp_path / "original", original_files)
+    write_tree(tmp_path / "modified", modified_files)
+
+    patch_path = str(tmp_path / "patch")
+    create_patch(str(tmp_path / "original"), str(tmp_path / "modified"), patch_path, output=io.StringIO(),
+                 tool="text", fingerprint_cache=str(tmp_path / "fingerprints.json"), **options)
+    result = apply_patch(str(tmp_path / "original"), str(tmp_path / "modified"), patch_path, output=io.StringIO(),
+                         tool="text")
+
+    assert result.failed_files == []
+    assert read_tree(tmp_path / "original") == modified_files
@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+
+import instrumentation
+import memory_scheduler
+from memory_scheduler import MemoryBudget, MemoryScheduler, job_context, minimum_learning_size, process_memory
+
+
+@pytest.fixture(autouse=True)
+def process_observers(monkeypatch):
+    # Every pool with a budget registers an observer, the tests keep them away from the global list
+    observers = []
+    monkeypatch.setattr(instrumentation, "process_observers", observers)
+    return observers
+
+
+def memory(size):
+    return {"bytes": size, "original_size": size, "modified_size": size}
+
+
+def run_jobs(scheduler, sizes, durations=None):
+    started_jobs = []
+    lock = threading.Lock()
+
+    def job(size):
+        with lock:
+            started_jobs.append(size)
+        time.sleep((durations or {}).get(size, 0))
+        return size
+
+    with scheduler:
+        futures = [scheduler.submit(job, size, memory=memory(size)) for size in sizes]
+    assert [future.result() for future in futures] == sizes
+    return started_jobs
+
+
+def test_largest_jobs_first():
+    # Jobs are held back until all of them are known, then they start largest first
+    assert run_jobs(MemoryScheduler(max_workers=1), [10, 300, 20, 300, 5]) == [300, 300, 20, 10, 5]
+
+
+def test_smaller_jobs_fill_the_budget():
+    budget = MemoryBudget(100)
+    # The job of 50 does not fit next to the running one of 60, the one of 30 does
+    assert run_jobs(MemoryScheduler(max_workers=2, memory_budget=budget), [30, 50, 60], {60: 0.2}) == [60, 30, 50]
+    assert budget.jobs == 3 and budget.delayed_jobs == 1 and budget.peak_reserved_bytes == 90
+    assert budget.oversized_jobs == 0
+
+
+def test_oversized_jobs_run_alone():
+    budget = MemoryBudget(100)
+    assert run_jobs(MemoryScheduler(max_workers=4, memory_budget=budget), [150, 10], {150: 0.1}) == [150, 10]
+    assert budget.oversized_jobs == 1 and budget.peak_reserved_bytes == 150
+
+
+def test_largest_job_is_only_bypassed_a_few_times(monkeypatch):
+    monkeypatch.setattr(memory_scheduler, "maximum_bypasses", 1)
+    # 50 waits for 60. It lets 10 and 11 pass once, afterwards 9 has to wait until 50 got its memory.
+    assert run_jobs(MemoryScheduler(max_workers=3, memory_budget=MemoryBudget(100)), [60, 50, 11, 10, 9],
+                    {60: 0.3}) == [60, 11, 10, 50, 9]
+
+    monkeypatch.setattr(memory_scheduler, "maximum_bypasses", 8)
+    assert run_jobs(MemoryScheduler(max_workers=3, memory_budget=MemoryBudget(100)), [60, 50, 11, 10, 9],
+                    {60: 0.3}) == [60, 11, 10, 9, 50]
+
+
+def test_budgets_observe_processes_while_their_pool_runs(process_observers):
+    budget = MemoryBudget(None)
+    assert process_observers == []
+    observed = []
+    with pytest.raises(ValueError):
+        with MemoryScheduler(max_workers=1, memory_budget=budget) as scheduler:
+            scheduler.submit(lambda: observed.append(list(process_observers)))
+            raise ValueError()
+    # The jobs still ran when the pool was left, the observer is gone afterwards
+    assert observed == [[budget.observe_process]] and process_observers == []
+
+
+def test_estimates_are_corrected_by_measured_processes(tmp_path):
+    (tmp_path / "original").write_bytes(b"o" * minimum_learning_size)
+    (tmp_path / "modified").write_bytes(b"m" * minimum_learning_size)
+    budget = MemoryBudget(None)
+    estimate = budget.estimate("bsdiff", str(tmp_path / "original"), str(tmp_path / "modified"))
+    assert estimate["bytes"] == process_memory + 18 * minimum_learning_size
+    # Without a modified file the original stands in for it, the automatic tool takes the largest model
+    assert budget.estimate("auto", str(tmp_path / "original"))["bytes"] == estimate["bytes"]
+
+    class Job:
+        pass
+
+    job_context.job = Job()
+    job_context.job.estimate = estimate
+    try:
+        # Jobs of another run at the same time do not correct this budget
+        job_context.job.memory_budget = MemoryBudget(None)
+        budget.observe_process(["/usr/bin/bsdiff", "a", "b", "c"], estimate["bytes"] * 4)
+        job_context.job.memory_budget = budget
+        budget.observe_process(["/usr/bin/bsdiff", "a", "b", "c"], estimate["bytes"] * 2)
+        budget.observe_process(["/usr/bin/bsdiff", "a", "b", "c"], estimate["bytes"])
+        budget.observe_process(["/usr/bin/unknown"], estimate["bytes"] * 10)
+    finally:
+        job_context.job = None
+    # The largest ratio is kept, a single swapping job costs more than a few jobs waiting too long
+    assert budget.stats()["corrections"] == {"bsdiff": 2.0} and budget.stats()["observations"] == {"bsdiff": 2}
+    assert budget.estimate("bsdiff", str(tmp_path / "original"), str(tmp_path / "modified"))["bytes"] == \
+        2 * estimate["bytes"]
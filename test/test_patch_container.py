@@ -0,0 +1,123 @@
+import os
+import struct
+
+import pytest
+
+from compression import available_codecs, codecs_by_name, compress_stream
+from patch_container import (PatchContainerReader, PatchContainerWriter, empty_hash, header_format,
+                             is_patch_container, legacy_container_magic, legacy_entry_format, operation_deleted,
+                             operation_modified, operation_moved, operation_new)
+from tree_helpers import read_tree, requires_programs, run_script, write_tree
+
+
+def test_write_and_read(tmp_path):
+    (tmp_path / "new.bin").write_bytes(b"new content" * 100)
+    (tmp_path / "patch.bin").write_bytes(b"patch content")
+    container_path = str(tmp_path / "update.dupatch")
+    writer = PatchContainerWriter(container_path)
+    writer.add_entry(operation_new, "/dir//new.bin", data_file=str(tmp_path / "new.bin"), target_hash="ab" * 32)
+    writer.add_entry(operation_modified, "/file.txt", data_file=str(tmp_path / "patch.bin"))
+    writer.add_entry(operation_deleted, "/old.txt")
+    writer.add_entry(operation_moved, "/moved.txt", source_path="/dir//source.txt")
+    writer.finish()
+
+    assert is_patch_container(container_path)
+    assert not is_patch_container(str(tmp_path / "new.bin"))
+    reader = PatchContainerReader(container_path)
+    try:
+        assert reader.read_file_lists() == (["/dir//new.bin"], ["/file.txt"], ["/old.txt"],
+                                            [("/moved.txt", "/dir//source.txt")], [])
+        assert bytes(reader.payload(reader.entry("/dir//new.bin"))) == b"new content" * 100
+        assert reader.entry("/dir//new.bin").target_hash == bytes.fromhex("ab" * 32)
+        with reader.open_patch("/file.txt") as patch_handler:
+            assert patch_handler.read() == b"patch content"
+        with reader.patch_file("/file.txt") as patch_file:
+            with open(patch_file, "rb") as patch_handler:
+                assert patch_handler.read() == b"patch content"
+        reader.move_new_file("/dir//new.bin", str(tmp_path / "moved_out.bin"))
+        assert (tmp_path / "moved_out.bin").read_bytes() == b"new content" * 100
+    finally:
+        reader.close()
+
+
+@pytest.mark.parametrize("codec_name", [codec_name for codec_name in available_codecs if codec_name != "none"])
+def test_compressed_entries(tmp_path, codec_name):
+    codec = codecs_by_name[codec_name]
+    data = b"".join(b"line %d of the entry\n" % number for number in range(20000))
+    (tmp_path / "entry").write_bytes(data)
+    with open(tmp_path / "entry", "rb") as source_handler, open(tmp_path / "entry.compressed", "wb") as output:
+        compress_stream(codec, source_handler, output)
+
+    container_path = str(tmp_path / "update.dupatch")
+    writer = PatchContainerWriter(container_path)
+    writer.add_entry(operation_new, "/a.txt", data_file=str(tmp_path / "entry.compressed"), codec=codec,
+                     uncompressed_size=len(data))
+    writer.add_entry(operation_new, "/b.txt", data_file=str(tmp_path / "entry.compressed"), codec=codec,
+                     uncompressed_size=len(data))
+    writer.finish()
+
+    reader = PatchContainerReader(container_path)
+    try:
+        entry = reader.entry("/a.txt")
+        assert entry.codec == codec.identifier and entry.uncompressed_size == len(data)
+        assert entry.size == os.path.getsize(tmp_path / "entry.compressed")
+        reader.move_new_file("/a.txt", str(tmp_path / "a.txt"))
+        with reader.open_patch("/b.txt") as patch_handler:
+            assert patch_handler.read() == data
+        assert (tmp_path / "a.txt").read_bytes() == data
+        # Both entries were counted
+        assert reader.decompression_stats()[0] == 2 * len(data)
+    finally:
+        reader.close()
+
+
+def test_legacy_container(tmp_path):
+    # Containers of the first version have neither a codec nor a size after decompression
+    payload = b"legacy payload"
+    path = "/file.txt".encode("utf-8")
+    index_offset = struct.calcsize(header_format) + len(payload)
+    index = struct.pack(legacy_entry_format, operation_new, len(path), 0, struct.calcsize(header_format),
+                        len(payload), empty_hash) + path
+    container_path = str(tmp_path / "legacy.dupatch")
+    with open(container_path, "wb") as file_handler:
+        file_handler.write(struct.pack(header_format, legacy_container_magic, 1, index_offset, len(index)))
+        file_handler.write(payload + index)
+
+    reader = PatchContainerReader(container_path)
+    try:
+        entry = reader.entry("/file.txt")
+        assert entry.uncompressed_size == len(payload) and entry.codec == codecs_by_name["none"].identifier
+        with reader.open_patch("/file.txt") as patch_handler:
+            assert patch_handler.read() == payload
+    finally:
+        reader.close()
+
+
+@requires_programs("bsdiff", "bspatch")
+@pytest.mark.parametrize("codec_name", [None, "auto"])
+def test_tree_round_trip(tmp_path, codec_name):
+    original_files = {
+        "same.txt": b"same\n" * 1000,
+        "changed.txt": b"".join(b"line %d\n" % number for number in range(5000)),
+        "removed.txt": b"removed\n",
+        "dir/moved_from.txt": b"moved content\n" * 300,
+    }
+    modified_files = {
+        "same.txt": b"same\n" * 1000,
+        "changed.txt": b"".join(b"line %d\n" % (number * 2 if number % 100 == 0 else number)
+                                for number in range(5000)),
+        "other/moved_to.txt": b"moved content\n" * 300,
+        "new.txt": b"new\n" * 2000,
+    }
+    write_tree(tmp_path / "original", original_files)
+    write_tree(tmp_path / "modified", modified_files)
+    arguments = ["-o", tmp_path / "original", "-m", tmp_path / "modified", "-p", tmp_path / "update.dupatch",
+                 "-j", tmp_path / "stats.json"]
+    codec_arguments = ["-z", codec_name] if codec_name is not None else []
+    assert run_script("patch_file_creator.py", *arguments, "-k", tmp_path / "fingerprints.json", "-b",
+                      *codec_arguments)[0] == 0
+
+    assert is_patch_container(str(tmp_path / "update.dupatch"))
+    exit_code, output = run_script("patch_file_applier.py", *arguments)
+    assert exit_code == 0, output
+    assert read_tree(tmp_path / "original") == modified_files
@@ -0,0 +1,143 @@
+import json
+import shutil
+import subprocess
+
+import pytest
+
+import patch_file_applier
+from apply_plan import compile_apply_plan
+from patch_file_applier import PatchDirectory, run_apply_plan
+from tree_helpers import read_tree, requires_programs, run_script, write_tree
+
+
+def create_patch(tmp_path, original_files, modified_files, *arguments):
+    write_tree(tmp_path / "original", original_files)
+    write_tree(tmp_path / "modified", modified_files)
+    assert run_script("patch_file_creator.py", "-o", tmp_path / "original", "-m", tmp_path / "modified",
+                      "-p", tmp_path / "patch", "-j", tmp_path / "stats.json",
+                      "-k", tmp_path / "fingerprints.json", *arguments)[0] == 0
+
+
+def apply_patch(tmp_path, *arguments):
+    return run_script("patch_file_applier.py", "-o", tmp_path / "original", "-m", tmp_path / "modified",
+                      "-p", tmp_path / "patch", "-j", tmp_path / "stats.json", *arguments)
+
+
+original_tree = {
+    "same.txt": b"same\n" * 100,
+    "dir/changed.bin": bytes(range(256)) * 40,
+    "dir/removed.txt": b"removed\n",
+    "other/changed.txt": b"".join(b"line %d\n" % number for number in range(2000)),
+}
+modified_tree = {
+    "same.txt": b"same\n" * 100,
+    "dir/changed.bin": bytes(range(256)) * 20 + b"inserted" + bytes(range(256)) * 20,
+    "other/changed.txt": b"".join(b"line %d\n" % (number * 3) for number in range(2000)),
+    "new/added.txt": b"added\n" * 50,
+}
+
+
+@requires_programs("bsdiff", "bspatch")
+def test_concurrent_apply(tmp_path):
+    create_patch(tmp_path, original_tree, modified_tree)
+    exit_code, output = apply_patch(tmp_path, "-n", "4")
+    assert exit_code == 0, output
+    assert read_tree(tmp_path / "original") == modified_tree
+
+
+@requires_programs("bsdiff", "bspatch")
+def test_moved_copied_and_derived_files(tmp_path):
+    original_files = {"a/moved.bin": bytes(range(256)) * 100, "a/config.txt": b"setting = 1\n" * 100,
+                      "a/removed.txt": b"removed"}
+    modified_files = {"b/renamed.bin": bytes(range(256)) * 100, "c/copy.bin": bytes(range(256)) * 100,
+                      "b/config.txt": b"setting = 2\n" * 120}
+    create_patch(tmp_path, original_files, modified_files)
+    # Neither the moved nor the copied file is stored within the patch
+    assert not (tmp_path / "patch" / "b" / "renamed.bin").exists()
+    assert not (tmp_path / "patch" / "c" / "copy.bin").exists()
+    assert (tmp_path / "patch" / "b" / "config.txt").stat().st_size < 1000
+
+    exit_code, output = apply_patch(tmp_path, "-n", "4")
+    assert exit_code == 0, output
+    assert read_tree(tmp_path / "original") == modified_files
+
+
+@pytest.mark.parametrize("tool", ["rsync", "cdc"])
+def test_compressed_patch_is_not_extracted(tmp_path, tool):
+    create_patch(tmp_path, original_tree, modified_tree, "-t", tool, "-c")
+    # Only the archive is left, the applier reads every entry straight out of it
+    shutil.rmtree(str(tmp_path / "patch"))
+    exit_code, output = apply_patch(tmp_path, "-t", tool, "-c")
+    assert exit_code == 0, output
+    assert read_tree(tmp_path / "original") == modified_tree
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["fingerprints.json", "modified", "original",
+                                                                "patch.zip", "stats.json"]
+
+
+def test_patched_files_are_verified(tmp_path):
+    create_patch(tmp_path, original_tree, modified_tree, "-t", "rsync")
+    assert "changed.bin" in (tmp_path / "patch" / "target_hashes.txt").read_text()
+    # The delta copies from a damaged original, the output has the right size but another content
+    damaged_data = bytearray(original_tree["dir/changed.bin"])
+    damaged_data[100] ^= 0xff
+    (tmp_path / "original" / "dir" / "changed.bin").write_bytes(bytes(damaged_data))
+
+    exit_code, output = apply_patch(tmp_path, "-t", "rsync")
+    assert exit_code == 1
+    failed_files = output.split("do not match their hash:")[1].split()
+    assert [failed_file for failed_file in failed_files if "changed" in failed_file] == \
+        [str(tmp_path / "original") + "//dir//changed.bin"]
+
+
+def test_whole_tree_is_verified(tmp_path):
+    create_patch(tmp_path, original_tree, modified_tree, "-t", "rsync")
+    (tmp_path / "original" / "stray.txt").write_bytes(b"not part of any version")
+    exit_code, output = apply_patch(tmp_path, "-t", "rsync", "-v")
+    assert exit_code == 1
+    # Every other file was patched correctly and does not show up
+    mismatching_files = output.split("The following files are not equal:")[1].splitlines()
+    assert mismatching_files == ["", "    stray.txt should not exist"]
+
+
+def test_patches_without_hashes_are_applied(tmp_path):
+    # Patches of older versions have no target hashes, their files are applied but reported as unverified
+    create_patch(tmp_path, original_tree, modified_tree, "-t", "rsync")
+    (tmp_path / "patch" / "target_hashes.txt").unlink()
+    shutil.copytree(tmp_path / "original", tmp_path / "copy")
+    shutil.copytree(tmp_path / "patch", tmp_path / "patch_copy")
+    shutil.copy(tmp_path / "stats.json", tmp_path / "verified.json")
+    exit_code, output = apply_patch(tmp_path, "-t", "rsync")
+    assert exit_code == 0, output
+    assert read_tree(tmp_path / "original") == modified_tree
+    assert "Patching was successfull" not in output and "were not verified" in output
+    assert sorted(json.loads((tmp_path / "stats.json").read_text())["unverified_files"]) == [
+        str(tmp_path / "original") + "/" + file for file in ["/dir//changed.bin", "/new//added.txt",
+                                                             "/other//changed.txt"]]
+
+    # A verification of the whole tree checks them after all
+    exit_code, output = run_script("patch_file_applier.py", "-o", tmp_path / "copy", "-m", tmp_path / "modified",
+                                   "-p", tmp_path / "patch_copy", "-j", tmp_path / "verified.json", "-t", "rsync", "-v")
+    assert exit_code == 0, output
+    assert "Patching was successfull" in output
+    assert "unverified_files" not in json.loads((tmp_path / "verified.json").read_text())
+
+
+def test_patches_over_the_deadline_fail(tmp_path, monkeypatch):
+    def expiring_call(command, timeout=None):
+        raise subprocess.TimeoutExpired(command, timeout)
+
+    monkeypatch.setattr(patch_file_applier.subprocess, "call", expiring_call)
+    write_tree(tmp_path / "patch", {"a": b"BSDIFF40" + bytes(32), "b": b"BSDIFF40" + bytes(32)})
+    plan = compile_apply_plan([], ["/a", "/b"], [], [], [], [], [])
+    assert run_apply_plan(plan, str(tmp_path), PatchDirectory(str(tmp_path / "patch")), "bspatch", jobs=2,
+                          timeout=0.1) == [str(tmp_path) + "//a", str(tmp_path) + "//b"]
+
+
+def test_shared_paths_are_applied_phase_by_phase(tmp_path):
+    # A file which is deleted and added again must be removed before the new one is moved into place
+    write_tree(tmp_path / "original", {"file.txt": b"old"})
+    write_tree(tmp_path / "patch", {"file.txt": b"new"})
+    plan = compile_apply_plan(["/file.txt"], [], ["/file.txt"], [], [], [], [])
+    assert run_apply_plan(plan, str(tmp_path / "original"), PatchDirectory(str(tmp_path / "patch")), "bspatch",
+                          jobs=4) == []
+    assert read_tree(tmp_path / "original") == {"file.txt": b"new"}
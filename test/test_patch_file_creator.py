@@ -0,0 +1,126 @@
+import io
+import json
+
+import file_fingerprints
+import patch_file_creator
+from memory_scheduler import MemoryBudget
+from patch_file_creator import (create_diff_files, detect_all_new_modified_and_deleted_files,
+                                detect_moved_and_derived_files, iterate_through_directory)
+from tree_diff_benchmark import create_synthetic_file_lists, legacy_detect_all_new_modified_and_deleted_files
+from tree_helpers import requires_programs, run_script, write_tree
+from update_api import create_patch
+
+
+def test_detects_new_modified_and_deleted_files(tmp_path):
+    write_tree(tmp_path / "original", {"same.txt": b"a", "dir/changed.txt": b"b", "dir/removed.txt": b"c"})
+    write_tree(tmp_path / "modified", {"same.txt": b"a", "dir/changed.txt": b"B", "other/removed.txt": b"c"})
+    modified_files, new_files, deleted_files = detect_all_new_modified_and_deleted_files(
+        iterate_through_directory(str(tmp_path / "original")), iterate_through_directory(str(tmp_path / "modified")))
+
+    # Files are matched by their relative path, a file of the same name within another directory is new
+    assert sorted(modified_files) == [("changed.txt", "/dir/"), ("same.txt", "/")]
+    assert new_files == [("removed.txt", "/other/")]
+    assert deleted_files == [("removed.txt", "/dir/")]
+
+
+def test_matches_the_legacy_implementation():
+    original_version_file_list, modified_version_file_list = create_synthetic_file_lists(2000, 0.2, 1)
+    assert detect_all_new_modified_and_deleted_files(original_version_file_list, modified_version_file_list) == \
+        legacy_detect_all_new_modified_and_deleted_files(original_version_file_list, modified_version_file_list)
+
+
+@requires_programs("bsdiff")
+def test_unchanged_files_get_no_diff(tmp_path):
+    write_tree(tmp_path / "original", {"same.bin": b"same" * 5000, "changed.bin": b"old" * 5000})
+    write_tree(tmp_path / "modified", {"same.bin": b"same" * 5000, "changed.bin": b"new" * 5000})
+    arguments = ["-o", tmp_path / "original", "-m", tmp_path / "modified", "-p", tmp_path / "patch",
+                 "-j", tmp_path / "stats.json", "-k", tmp_path / "fingerprints.json"]
+    assert run_script("patch_file_creator.py", *arguments)[0] == 0
+
+    stats = json.loads((tmp_path / "stats.json").read_text())
+    assert stats["number_of_unchanged_files"] == 1 and stats["unchanged_files"] == ["/same.bin"]
+    assert (tmp_path / "patch" / "changed.bin").exists()
+    assert not (tmp_path / "patch" / "same.bin").exists()
+    assert "same.bin" not in (tmp_path / "patch" / "modified_files.txt").read_text()
+    assert len(json.loads((tmp_path / "fingerprints.json").read_text())) == 4
+
+
+def test_fingerprints_of_unchanged_files_are_reused(tmp_path, monkeypatch):
+    write_tree(tmp_path / "original", {"same.bin": b"same" * 5000, "gone.bin": b"gone" * 5000, "changed.bin": b"old"})
+    write_tree(tmp_path / "modified", {"same.bin": b"same" * 5000, "gone.bin": b"gone" * 5000, "changed.bin": b"new!"})
+    cache_path = tmp_path / "fingerprints.json"
+    create_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "first"),
+                 output=io.StringIO(), tool="cdc", fingerprint_cache=str(cache_path))
+    assert len(json.loads(cache_path.read_text())) == 5
+
+    # Files whose size, mtime and inode did not change are not read again
+    hashed_files = []
+    calculate_file_hash = file_fingerprints.calculate_file_hash
+    monkeypatch.setattr(file_fingerprints, "calculate_file_hash",
+                        lambda file_path: hashed_files.append(file_path) or calculate_file_hash(file_path))
+    saved_caches = []
+    save_fingerprint_cache = patch_file_creator.save_fingerprint_cache
+    monkeypatch.setattr(patch_file_creator, "save_fingerprint_cache",
+                        lambda *args: saved_caches.append(args) or save_fingerprint_cache(*args))
+    (tmp_path / "original" / "gone.bin").unlink()
+    (tmp_path / "modified" / "gone.bin").unlink()
+    creation = create_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "second"),
+                            output=io.StringIO(), tool="cdc", fingerprint_cache=str(cache_path))
+    assert creation.stats["unchanged_files"] == ["/same.bin"] and hashed_files == []
+    # The cache is saved once and forgets the deleted files
+    assert len(saved_caches) == 1
+    assert sorted(json.loads(cache_path.read_text())) == [str(tmp_path / "modified" / "changed.bin"),
+                                                         str(tmp_path / "modified" / "same.bin"),
+                                                         str(tmp_path / "original" / "same.bin")]
+
+
+def test_diff_files_are_created_largest_first(tmp_path, monkeypatch):
+    sizes = {"small.bin": 10, "large.bin": 3000, "medium.bin": 500, "failing.bin": 200}
+    write_tree(tmp_path / "modified", dict((name, b"x" * size) for name, size in sizes.items()))
+    created_files = []
+
+    def recording_create_diff_file(original_version_file, modified_version_file, patch_file, diff_tool, selector=None):
+        created_files.append(modified_version_file.split("/")[-1])
+        return 1 if "failing" in patch_file else 0
+
+    monkeypatch.setattr(patch_file_creator, "create_diff_file", recording_create_diff_file)
+    file_list = [(name, "/") for name in sizes]
+    assert create_diff_files(file_list, str(tmp_path / "original"), str(tmp_path / "modified"),
+                             str(tmp_path / "patch"), "bsdiff", jobs=1) == [("failing.bin", "/")]
+    assert created_files == ["large.bin", "medium.bin", "failing.bin", "small.bin"]
+
+    # Failed files are reported in the order of the given list, whatever order the jobs finished in.
+    # With a budget the order is the same, it only holds back diffs which do not fit.
+    created_files.clear()
+    file_list.append(("failing_too.bin", "/"))
+    (tmp_path / "modified" / "failing_too.bin").write_bytes(b"x" * 5000)
+    assert create_diff_files(file_list, str(tmp_path / "original"), str(tmp_path / "modified"),
+                             str(tmp_path / "patch"), "bsdiff", jobs=4, memory_budget=MemoryBudget()) == \
+        [("failing.bin", "/"), ("failing_too.bin", "/")]
+    assert sorted(created_files) == sorted(name for name, _ in file_list)
+
+
+def test_at_least_one_job_is_needed(tmp_path):
+    write_tree(tmp_path / "original", {"file": b"a"})
+    write_tree(tmp_path / "modified", {"file": b"b"})
+    assert run_script("patch_file_creator.py", "-o", tmp_path / "original", "-m", tmp_path / "modified",
+                      "-p", tmp_path / "patch", "-j", tmp_path / "stats.json", "-n", "0")[0] == 2
+
+
+def test_detects_moved_and_derived_files(tmp_path):
+    write_tree(tmp_path / "original", {"a/moved.bin": b"moved" * 1000, "a/config.txt": b"setting = 1\n" * 100,
+                                       "a/gone.txt": b"gone", "a/other.bin": b"other" * 1000})
+    write_tree(tmp_path / "modified", {"b/renamed.bin": b"moved" * 1000, "c/copy.bin": b"moved" * 1000,
+                                       "b/config.txt": b"setting = 2\n" * 120, "b/new.txt": b"new" * 1000,
+                                       "b/gone.txt": b"a file of the same name, but much larger" * 100})
+    new_files = [("renamed.bin", "/b/"), ("copy.bin", "/c/"), ("config.txt", "/b/"), ("new.txt", "/b/"),
+                 ("gone.txt", "/b/")]
+    deleted_files = [("moved.bin", "/a/"), ("config.txt", "/a/"), ("gone.txt", "/a/"), ("other.bin", "/a/")]
+    moved_files, derived_files, remaining_new_files = detect_moved_and_derived_files(
+        new_files, deleted_files, str(tmp_path / "original"), str(tmp_path / "modified"), {})
+
+    # Files with the same content are moved or copied whatever their name, a file of the same size is not enough
+    assert moved_files == [(("renamed.bin", "/b/"), ("moved.bin", "/a/")), (("copy.bin", "/c/"), ("moved.bin", "/a/"))]
+    # Files of the same name and a similar size are diffed against the deleted file
+    assert derived_files == [(("config.txt", "/b/"), ("config.txt", "/a/"))]
+    assert remaining_new_files == [("new.txt", "/b/"), ("gone.txt", "/b/")]
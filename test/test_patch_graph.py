@@ -0,0 +1,69 @@
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+
+from patch_cache import PatchCache
+from patch_graph import read_route
+from tree_helpers import read_tree, write_tree
+from update_api import apply_patch
+
+
+graph_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "patch_graph.py")
+
+
+def test_patch_chain_prefers_the_smaller_route(tmp_path):
+    patch_cache = PatchCache(str(tmp_path / "cache"))
+    for source, target, size in [("a", "b", 10), ("b", "c", 10), ("a", "c", 50), ("c", "d", 5)]:
+        write_tree(tmp_path, {"patch": b"x" * size})
+        patch_cache.store_tree_patch(source, target, "cdc", str(tmp_path / "patch"))
+
+    chain, size = patch_cache.find_patch_chain("a", "d", "cdc")
+    assert [patch_cache.tree_patch_entry(key)["target"] for key in chain] == ["b", "c", "d"]
+    assert size == 25
+    assert patch_cache.find_patch_chain("d", "a", "cdc") == (None, 0)
+    assert patch_cache.fetch_tree_patch("a", "b", "cdc", str(tmp_path / "fetched"))
+    assert (tmp_path / "fetched").read_bytes() == b"x" * 10
+    assert not patch_cache.fetch_tree_patch("a", "b", "rsync", str(tmp_path / "fetched"))
+    patch_cache.close()
+
+
+def run_graph(tmp_path, original_version, modified_version, route_name):
+    completed = subprocess.run([sys.executable, graph_script, "-o", str(tmp_path / original_version),
+                                "-m", str(tmp_path / modified_version), "-p", str(tmp_path / route_name),
+                                "-c", str(tmp_path / "cache"), "-t", "cdc", "-j", str(tmp_path / "routes.json")],
+                               capture_output=True, text=True)
+    assert completed.returncode == 0, completed.stdout
+    with open(tmp_path / "routes.json") as file_handler:
+        return json.load(file_handler)["routes"][str(tmp_path / original_version)]
+
+
+def test_apply_chained_route(tmp_path):
+    generator = random.Random(20)
+    base_files = {"f{}.bin".format(index): bytes(generator.randrange(256) for _ in range(20000))
+                  for index in range(4)}
+    version_2 = dict(base_files, **{"f2.bin": bytes(generator.randrange(256) for _ in range(30000))})
+    version_3 = dict(version_2, **{"new.txt": b"hello\n" * 100})
+    for name, files in [("v1", base_files), ("v2", version_2), ("v3", version_3)]:
+        write_tree(tmp_path / name, files)
+
+    run_graph(tmp_path, "v1", "v2", "routes_12")
+    run_graph(tmp_path, "v2", "v3", "routes_23")
+    # The cached chain is hardly larger than a direct patch would be, so it is used
+    route = run_graph(tmp_path, "v1", "v3", "routes_13")
+    assert route["kind"] == "chain" and route["steps"] == 2
+    assert len(read_route(str(tmp_path / "routes_13/v1"))["steps"]) == 2
+
+    result = apply_patch(str(tmp_path / "v1"), str(tmp_path / "v3"), str(tmp_path / "routes_13/v1"),
+                         output=io.StringIO(), verify_tree=True)
+    assert result.failed_files == [] and result.mismatching_files == []
+    assert result.stats["route_of_the_application"]["applied_steps"] == 2
+    assert read_tree(tmp_path / "v1") == version_3
+
+    # A version in the middle of the route only gets the missing steps
+    result = apply_patch(str(tmp_path / "v2"), str(tmp_path / "v3"), str(tmp_path / "routes_13/v1"),
+                         output=io.StringIO())
+    assert result.stats["route_of_the_application"]["applied_steps"] == 1
+    assert read_tree(tmp_path / "v2") == version_3
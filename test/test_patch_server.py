@@ -0,0 +1,268 @@
+import functools
+import http.client
+import http.server
+import io
+import os
+import random
+import shutil
+import threading
+import time
+
+import pytest
+
+import patch_client
+from patch_client import RemotePatchContainer
+from patch_server import PatchRequestHandler, PatchServer, parse_range
+from tree_helpers import read_tree, write_tree
+from update_api import apply_patch, create_patch
+
+
+def random_bytes(generator, size):
+    return bytes(generator.randrange(256) for _ in range(size))
+
+
+@pytest.fixture
+def versions(tmp_path):
+    # Random new files are stored as they are, so the container is large enough for several range requests
+    generator = random.Random(25)
+    shared_data = random_bytes(generator, 50000)
+    original_files = {
+        "keep/same.bin": shared_data,
+        "changed/data.bin": shared_data + random_bytes(generator, 20000),
+        "removed/old.txt": b"old\n" * 100,
+    }
+    modified_files = {
+        "keep/same.bin": shared_data,
+        "changed/data.bin": shared_data[:30000] + random_bytes(generator, 5000) + shared_data[30000:],
+        "new/large.bin": random_bytes(generator, 600000),
+        "new/small.txt": b"small\n",
+    }
+    write_tree(tmp_path / "original", original_files)
+    write_tree(tmp_path / "modified", modified_files)
+    os.mkdir(tmp_path / "served")
+    create_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "served/update.dupatch"),
+                 output=io.StringIO(), tool="cdc", container=True,
+                 fingerprint_cache=str(tmp_path / "fingerprints.json"))
+    return tmp_path, modified_files
+
+
+def start_server(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return "http://{}:{}".format(*server.server_address[:2])
+
+
+@pytest.fixture
+def patch_server(versions):
+    tmp_path, _ = versions
+    server = PatchServer(("127.0.0.1", 0), str(tmp_path / "served"))
+    yield start_server(server), server
+    server.shutdown()
+    server.server_close()
+
+
+def find_entry(container, path):
+    # Paths within a container may hold empty parts like "/new//small.txt"
+    for entry in container.entries:
+        if "/".join(part for part in entry.path.split("/") if part) == path:
+            return entry
+    raise KeyError(path)
+
+
+def request(base_url, path, method="GET", headers=None):
+    connection = http.client.HTTPConnection(base_url[len("http://"):], timeout=10)
+    connection.request(method, path, headers=headers or {})
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response, body
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-9", 100) == (0, 10)
+    assert parse_range("bytes=90-", 100) == (90, 100)
+    assert parse_range("bytes=-5", 100) == (95, 100)
+    assert parse_range("bytes=50-500", 100) == (50, 100)
+    assert parse_range("bytes=100-", 100) is False
+    assert parse_range("bytes=0-1,5-6", 100) is None
+    assert parse_range(None, 100) is None
+
+
+def test_range_responses(versions, patch_server):
+    tmp_path, _ = versions
+    base_url, _ = patch_server
+    container_data = (tmp_path / "served/update.dupatch").read_bytes()
+
+    response, body = request(base_url, "/update.dupatch")
+    assert response.status == 200 and body == container_data
+    etag = response.getheader("ETag")
+
+    response, body = request(base_url, "/update.dupatch", headers={"Range": "bytes=10-19"})
+    assert response.status == 206
+    assert body == container_data[10:20]
+    assert response.getheader("Content-Range") == "bytes 10-19/{}".format(len(container_data))
+
+    response, body = request(base_url, "/update.dupatch", headers={"Range": "bytes=10-19", "If-Range": etag})
+    assert response.status == 206 and body == container_data[10:20]
+
+    response, _ = request(base_url, "/update.dupatch", headers={"Range": "bytes={}-".format(len(container_data))})
+    assert response.status == 416
+    assert response.getheader("Content-Range") == "bytes */{}".format(len(container_data))
+
+    # A range of a stale version is answered with the whole current file
+    response, body = request(base_url, "/update.dupatch", headers={"Range": "bytes=10-19", "If-Range": '"stale"'})
+    assert response.status == 200 and body == container_data
+
+    response, body = request(base_url, "/update.dupatch", headers={"If-None-Match": etag})
+    assert response.status == 304 and body == b""
+
+    response, body = request(base_url, "/update.dupatch", method="HEAD")
+    assert response.status == 200 and body == b""
+    assert response.getheader("Content-Length") == str(len(container_data))
+
+    assert request(base_url, "/../served/update.dupatch")[0].status == 404
+    assert request(base_url, "/missing.dupatch")[0].status == 404
+
+
+def test_entry_endpoint(versions, patch_server):
+    base_url, _ = patch_server
+    container = RemotePatchContainer(base_url + "/update.dupatch")
+    try:
+        entry = find_entry(container, "new/small.txt")
+        response, body = request(base_url, "/update.dupatch/new/small.txt")
+        assert response.status == 200
+        assert body == bytes(container.payload(entry))
+        assert response.getheader("X-Patch-Uncompressed-Size") == str(entry.uncompressed_size)
+    finally:
+        container.close()
+
+
+def test_remote_apply(versions, patch_server):
+    tmp_path, modified_files = versions
+    base_url, _ = patch_server
+    result = apply_patch(str(tmp_path / "original"), str(tmp_path / "modified"), base_url + "/update.dupatch",
+                         output=io.StringIO(), tool="cdc", fetch_connections=3)
+
+    assert result.failed_files == [] and result.mismatching_files == []
+    assert read_tree(tmp_path / "original") == modified_files
+    fetch_stats = result.stats["fetching_of_the_application"]
+    assert 0 < fetch_stats["fetched_bytes"] <= os.path.getsize(tmp_path / "served/update.dupatch")
+
+
+class RecordingRequestHandler(PatchRequestHandler):
+    requested_ranges = []
+
+    def do_GET(self):
+        self.requested_ranges.append(self.headers.get("Range"))
+        super().do_GET()
+
+
+def start_recording_server(tmp_path, request_handler):
+    server = PatchServer(("127.0.0.1", 0), str(tmp_path / "served"))
+    server.RequestHandlerClass = request_handler
+    request_handler.requested_ranges = []
+    return start_server(server), server
+
+
+def test_dry_run_fetches_only_the_index_and_the_plan(versions):
+    tmp_path, _ = versions
+    base_url, server = start_recording_server(tmp_path, RecordingRequestHandler)
+    before = read_tree(tmp_path / "original")
+    try:
+        apply_patch(str(tmp_path / "original"), str(tmp_path / "modified"), base_url + "/update.dupatch",
+                    output=io.StringIO(), tool="cdc", dry_run=True, check=False)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert read_tree(tmp_path / "original") == before
+    # Header, index and the entry with the apply plan
+    assert len(RecordingRequestHandler.requested_ranges) == 3
+
+
+class QuietFileRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def test_server_without_range_support(versions):
+    tmp_path, modified_files = versions
+    # http.server answers every request with the whole file
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(
+        QuietFileRequestHandler, directory=str(tmp_path / "served")))
+    base_url = start_server(server)
+    try:
+        result = apply_patch(str(tmp_path / "original"), str(tmp_path / "modified"), base_url + "/update.dupatch",
+                             output=io.StringIO(), tool="cdc")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert read_tree(tmp_path / "original") == modified_files
+    fetch_stats = result.stats["fetching_of_the_application"]
+    assert fetch_stats["requests"] == 1
+    assert fetch_stats["fetched_bytes"] == os.path.getsize(tmp_path / "served/update.dupatch")
+
+
+def test_container_changed_on_the_server(versions, patch_server):
+    tmp_path, _ = versions
+    base_url, _ = patch_server
+    container = RemotePatchContainer(base_url + "/update.dupatch")
+    try:
+        # Another version of the container replaces the one whose index was fetched
+        changed_container = tmp_path / "changed.dupatch"
+        shutil.copyfile(tmp_path / "served/update.dupatch", changed_container)
+        with open(changed_container, "ab") as file_handler:
+            file_handler.write(b"another version")
+        os.replace(changed_container, tmp_path / "served/update.dupatch")
+
+        with pytest.raises(ValueError, match="changed on the server"):
+            container.payload(find_entry(container, "new/large.bin"))
+    finally:
+        container.close()
+
+
+class BreakingRequestHandler(RecordingRequestHandler):
+    # The first large range stalls halfway, like a connection which breaks down, until the client gives up
+    def do_GET(self):
+        self.requested_ranges.append(self.headers.get("Range"))
+        file_path, offset, size, etag, _ = self.resolve()
+        byte_range = parse_range(self.headers.get("Range"), size)
+        if len(self.requested_ranges) == 3 and byte_range and byte_range[1] - byte_range[0] > 200000:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Length", str(end - start))
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, size))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            with open(file_path, "rb") as file_handler:
+                file_handler.seek(offset + start)
+                self.wfile.write(file_handler.read((end - start) // 2))
+            self.wfile.flush()
+            time.sleep(2)
+            self.close_connection = True
+            return
+        PatchRequestHandler.do_GET(self)
+
+
+def test_broken_range_is_resumed(versions, monkeypatch):
+    tmp_path, _ = versions
+    monkeypatch.setattr(patch_client, "connection_timeout", 0.5)
+    base_url, server = start_recording_server(tmp_path, BreakingRequestHandler)
+    try:
+        container = RemotePatchContainer(base_url + "/update.dupatch", connections=1)
+        try:
+            entry = find_entry(container, "new/large.bin")
+            payload = bytes(container.payload(entry))
+        finally:
+            container.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    data = (tmp_path / "served/update.dupatch").read_bytes()
+    assert payload == data[entry.offset:entry.offset + entry.size]
+    # Header, index, the broken range and only the rest of it
+    assert len(BreakingRequestHandler.requested_ranges) == 4
+    resumed_start = int(BreakingRequestHandler.requested_ranges[3].split("=")[1].split("-")[0])
+    assert entry.offset < resumed_start <= entry.offset + entry.size // 2
@@ -0,0 +1,79 @@
+import io
+import random
+
+import numpy as np
+import pytest
+
+import rsync_delta
+from rsync_delta import (apply_delta_file, apply_delta_stream, calculate_block_checksums,
+                         calculate_rolling_checksums, create_delta, create_delta_file)
+
+
+def random_bytes(seed, size):
+    return np.random.default_rng(seed).integers(0, 256, size, dtype=np.uint8).tobytes()
+
+
+def create_and_apply(original_data, modified_data, block_size=None):
+    patch_handler = io.BytesIO()
+    create_delta(original_data, modified_data, patch_handler, block_size)
+    patch_handler.seek(0)
+    output_handler = io.BytesIO()
+    apply_delta_stream(original_data, patch_handler, output_handler)
+    assert output_handler.getvalue() == modified_data
+    return len(patch_handler.getvalue())
+
+
+def test_rolling_checksums_match_block_checksums():
+    data = random_bytes(1, 70000)
+    block_size = 700
+    rolling = calculate_rolling_checksums(data, block_size)
+    assert len(rolling) == len(data) - block_size + 1
+    assert np.array_equal(rolling[::block_size], calculate_block_checksums(data, block_size))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_edits(seed):
+    generator = random.Random(seed)
+    original_data = random_bytes(seed, generator.randrange(10000, 300000))
+    modified_data = original_data
+    for _ in range(generator.randrange(1, 6)):
+        position = generator.randrange(len(modified_data))
+        if generator.random() < 0.5:
+            modified_data = modified_data[:position] + random_bytes(seed + 100, generator.randrange(1, 3000)) + \
+                modified_data[position:]
+        else:
+            modified_data = modified_data[:position] + modified_data[position + generator.randrange(1, 3000):]
+    assert create_and_apply(original_data, modified_data) < len(modified_data) // 2
+
+
+def test_edge_cases():
+    data = random_bytes(7, 5000)
+    create_and_apply(b"", b"")
+    create_and_apply(b"", data)
+    create_and_apply(data, b"")
+    create_and_apply(data[:100], data)
+    create_and_apply(data, data[:100])
+    assert create_and_apply(data, data) < 500
+
+
+def test_windows_across_segments(monkeypatch):
+    # Blocks which span the border of two scanned segments are found as well
+    monkeypatch.setattr(rsync_delta, "scan_segment_size", 4096)
+    original_data = random_bytes(3, 100000)
+    modified_data = b"prefix" + original_data[:50000] + b"gap" + original_data[50000:]
+    assert create_and_apply(original_data, modified_data, block_size=1000) < 5000
+
+
+def test_repetitive_data():
+    assert create_and_apply(b"\0" * 3000000, b"\0" * 1500000 + b"edit" + b"\0" * 1500000) < 5000
+    assert create_and_apply(b"abcdefgh" * 200000, b"abcdefgh" * 100000 + b"Z" + b"abcdefgh" * 100000) < 5000
+
+
+def test_files(tmp_path):
+    original_data = random_bytes(11, 200000)
+    modified_data = original_data[:120000] + b"changed" + original_data[120000:]
+    (tmp_path / "original").write_bytes(original_data)
+    (tmp_path / "modified").write_bytes(modified_data)
+    create_delta_file(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "patch"))
+    apply_delta_file(str(tmp_path / "original"), str(tmp_path / "patch"), str(tmp_path / "output"))
+    assert (tmp_path / "output").read_bytes() == modified_data
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from patch_file_applier import apply_patch_file
+from patch_file_creator import create_diff_file
+from segmented_diff import (apply_segmented_patch_file, calculate_segments, create_segmented_patch_file,
+                            is_segmented_patch_file, read_segment_table)
+
+
+def random_bytes(seed, size):
+    return np.random.default_rng(seed).integers(0, 256, size, dtype=np.uint8).tobytes()
+
+
+def test_segments_cover_the_modified_file():
+    segments = calculate_segments(1000000, 800000, 100000, 12500)
+    assert sum(segment[1] for segment in segments) == 800000
+    for modified_offset, modified_length, original_offset, original_length in segments:
+        assert original_offset % 4096 == 0
+        assert original_offset + original_length <= 1000000
+    assert calculate_segments(1000, 0, 100, 10) == []
+
+
+@pytest.mark.parametrize("tool", ["rsync", "cdc"])
+def test_round_trip(tmp_path, tool):
+    original_data = random_bytes(1, 1500000)
+    modified_data = original_data[:300000] + random_bytes(2, 20000) + original_data[300000:1200000] + \
+        original_data[1250000:]
+    (tmp_path / "original").write_bytes(original_data)
+    (tmp_path / "modified").write_bytes(modified_data)
+
+    assert create_segmented_patch_file(str(tmp_path / "original"), str(tmp_path / "modified"),
+                                       str(tmp_path / "patch"),
+                                       lambda original, modified, patch: create_diff_file(original, modified, patch,
+                                                                                          tool),
+                                       segment_size=256 * 1024, jobs=4) == 0
+    assert is_segmented_patch_file(str(tmp_path / "patch"))
+    modified_size, segments = read_segment_table(str(tmp_path / "patch"))
+    assert modified_size == len(modified_data) and len(segments) == 6
+    assert (tmp_path / "patch").stat().st_size < len(modified_data) // 4
+
+    assert apply_segmented_patch_file(str(tmp_path / "original"), str(tmp_path / "patch"), str(tmp_path / "output"),
+                                      lambda original, patch, output: apply_patch_file(original, patch, output, tool),
+                                      jobs=4) == 0
+    assert (tmp_path / "output").read_bytes() == modified_data
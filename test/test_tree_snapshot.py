@@ -0,0 +1,105 @@
+import os
+
+from file_fingerprints import get_file_fingerprint
+from patch_file_creator import iterate_through_directory
+from tree_helpers import run_script, write_tree
+from tree_snapshot import (directory_columns, get_snapshot_path, get_tree_snapshot, load_tree_snapshot,
+                           save_tree_snapshot, scan_tree, snapshot_columns, store_tree_snapshot)
+
+tree_files = {"top.txt": b"top", "b/second.bin": b"2" * 2000, "a/first.txt": b"1" * 100, "a/deep/inner.txt": b"i",
+              "empty/.keep": b""}
+
+
+def test_scan_matches_the_directory_walk(tmp_path):
+    write_tree(tmp_path / "tree", tree_files)
+    snapshot = scan_tree(str(tmp_path / "tree"))
+    assert sorted(snapshot.file_list()) == sorted(iterate_through_directory(str(tmp_path / "tree")))
+    # Directories are walked in sorted order, so every scan of the same tree gives the same snapshot
+    assert snapshot.file_list() == scan_tree(str(tmp_path / "tree") + "/").file_list()
+    assert snapshot.total_size() == sum(len(data) for data in tree_files.values())
+    file_stat = os.stat(str(tmp_path / "tree" / "b" / "second.bin"))
+    assert snapshot.file_stat(("second.bin", "/b/")) == (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino,
+                                                       file_stat.st_dev, file_stat.st_mode)
+    assert snapshot.file_stat(("missing.txt", "/")) is None
+
+
+def test_save_and_load(tmp_path):
+    write_tree(tmp_path / "tree", tree_files)
+    snapshot = scan_tree(str(tmp_path / "tree"))
+    fingerprint_cache = {}
+    expected_hash = get_file_fingerprint(str(tmp_path / "tree" / "a" / "first.txt"), fingerprint_cache)
+    snapshot.record_hashes(fingerprint_cache)
+    assert snapshot.changed
+
+    snapshot_path = get_snapshot_path(str(tmp_path / "snapshots"), str(tmp_path / "tree"))
+    save_tree_snapshot(snapshot, snapshot_path)
+    loaded_snapshot = load_tree_snapshot(str(tmp_path / "tree"), snapshot_path)
+    assert loaded_snapshot.file_list() == snapshot.file_list()
+    assert loaded_snapshot.directories == snapshot.directories
+    for name, _ in snapshot_columns + directory_columns:
+        assert loaded_snapshot.columns[name] == snapshot.columns[name]
+    assert list(snapshot.columns["directory_mtimes"]) == [os.stat(str(tmp_path / "tree") + directory).st_mtime_ns
+                                                          for directory in snapshot.directories]
+
+    # Hashes of the snapshot spare reading the file again in the next run
+    seeded_cache = {}
+    loaded_snapshot.seed_fingerprint_cache(seeded_cache)
+    assert seeded_cache == fingerprint_cache
+    assert get_file_fingerprint(str(tmp_path / "tree" / "a" / "first.txt"), seeded_cache) == expected_hash
+
+
+def test_snapshots_of_changed_trees_are_not_loaded(tmp_path):
+    write_tree(tmp_path / "tree", tree_files)
+    snapshot_directory = str(tmp_path / "snapshots")
+    snapshot = get_tree_snapshot(str(tmp_path / "tree"), snapshot_directory)
+    store_tree_snapshot(snapshot, snapshot_directory)
+    assert len(get_tree_snapshot(str(tmp_path / "tree"), snapshot_directory)) == len(tree_files)
+    assert not get_tree_snapshot(str(tmp_path / "tree"), snapshot_directory).changed
+
+    # Another tree never gets the snapshot, a file added at the top changes the mtime of the root
+    write_tree(tmp_path / "other", tree_files)
+    assert load_tree_snapshot(str(tmp_path / "other"), get_snapshot_path(snapshot_directory,
+                                                                         str(tmp_path / "tree"))) is None
+    (tmp_path / "tree" / "added.txt").write_bytes(b"added")
+    os.utime(str(tmp_path / "tree"), ns=(1, 1))
+    snapshot = get_tree_snapshot(str(tmp_path / "tree"), snapshot_directory)
+    assert snapshot.changed and len(snapshot) == len(tree_files) + 1
+
+    store_tree_snapshot(snapshot, snapshot_directory)
+    assert not get_tree_snapshot(str(tmp_path / "tree"), snapshot_directory).changed
+
+    # Changes deep within the tree leave the root alone, the mtime of their own directory changes
+    root_stat = os.stat(str(tmp_path / "tree"))
+    (tmp_path / "tree" / "a" / "deep" / "inner.txt").rename(tmp_path / "tree" / "a" / "deep" / "renamed.txt")
+    assert os.stat(str(tmp_path / "tree")).st_mtime_ns == root_stat.st_mtime_ns
+    snapshot = get_tree_snapshot(str(tmp_path / "tree"), snapshot_directory)
+    assert snapshot.changed and ("renamed.txt", "/a/deep/") in snapshot.file_list()
+    store_tree_snapshot(snapshot, snapshot_directory)
+    # A removed directory is noticed even though the mtime of the root is set back
+    (tmp_path / "tree" / "empty" / ".keep").unlink()
+    (tmp_path / "tree" / "empty").rmdir()
+    os.utime(str(tmp_path / "tree"), ns=(root_stat.st_atime_ns, root_stat.st_mtime_ns))
+    assert load_tree_snapshot(str(tmp_path / "tree"), get_snapshot_path(snapshot_directory,
+                                                                        str(tmp_path / "tree"))) is None
+
+    with open(get_snapshot_path(snapshot_directory, str(tmp_path / "tree")), "wb") as file_handler:
+        file_handler.write(b"damaged")
+    assert load_tree_snapshot(str(tmp_path / "tree"), get_snapshot_path(snapshot_directory,
+                                                                        str(tmp_path / "tree"))) is None
+
+
+def test_creator_reuses_the_snapshot(tmp_path):
+    write_tree(tmp_path / "original", tree_files)
+    write_tree(tmp_path / "modified", dict(tree_files, **{"top.txt": b"changed top"}))
+    for run in range(2):
+        exit_code, output = run_script("patch_file_creator.py", "-o", tmp_path / "original",
+                                       "-m", tmp_path / "modified", "-p", tmp_path / "patch_{}".format(run),
+                                       "-j", tmp_path / "stats.json", "-k", tmp_path / "fingerprints.json",
+                                       "-t", "rsync", "-S", tmp_path / "snapshots")
+        assert exit_code == 0, output
+        if run == 0:
+            # The modified version is worked on after its snapshot was stored
+            (tmp_path / "modified" / "b" / "added.bin").write_bytes(b"added")
+    assert "Snapshot of {} with 5 files was loaded instead of scanning it!".format(tmp_path / "original") in output
+    assert "Snapshot of {} with".format(tmp_path / "modified") not in output
+    assert "added.bin" in (tmp_path / "patch_1" / "new_files.txt").read_text()
@@ -0,0 +1,95 @@
+import io
+import threading
+
+import pytest
+
+from tree_helpers import read_tree, run_script, write_tree
+from update_api import ArgumentError, PatchFailed, apply_patch, create_patch
+
+original_tree = {
+    "same.txt": b"same\n" * 100,
+    "dir/changed.bin": bytes(range(256)) * 400,
+    "removed.txt": b"removed\n",
+}
+modified_tree = {
+    "same.txt": b"same\n" * 100,
+    "dir/changed.bin": bytes(range(256)) * 200 + b"changed" + bytes(range(256)) * 200,
+    "new.txt": b"new\n" * 50,
+}
+
+
+def test_library_round_trip(tmp_path, capsys):
+    write_tree(tmp_path / "original", original_tree)
+    write_tree(tmp_path / "modified", modified_tree)
+    creation_output = io.StringIO()
+    creation = create_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "patch"),
+                            output=creation_output, tool="cdc", fingerprint_cache=str(tmp_path / "fingerprints.json"))
+    assert creation.patch_path == str(tmp_path / "patch")
+    assert creation.stats["number_of_unchanged_files"] == 1
+
+    application_output = io.StringIO()
+    result = apply_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "patch"),
+                         output=application_output, tool="cdc", verify_tree=True)
+    assert result.failed_files == [] and result.mismatching_files == []
+    assert read_tree(tmp_path / "original") == modified_tree
+    # Everything the scripts print goes to the given outputs
+    assert "Patch applied" in application_output.getvalue() and creation_output.getvalue()
+    assert capsys.readouterr().out == ""
+
+
+def test_failed_patches_are_raised(tmp_path):
+    write_tree(tmp_path / "original", original_tree)
+    write_tree(tmp_path / "modified", modified_tree)
+    create_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "patch"),
+                 output=io.StringIO(), tool="rsync", fingerprint_cache=str(tmp_path / "fingerprints.json"))
+    (tmp_path / "original" / "dir" / "changed.bin").write_bytes(bytes(102400))
+
+    with pytest.raises(PatchFailed) as error:
+        apply_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "patch"),
+                    output=io.StringIO(), tool="rsync")
+    assert error.value.result.failed_files == [str(tmp_path / "original") + "//dir//changed.bin"]
+
+
+def test_invalid_options(tmp_path):
+    write_tree(tmp_path / "original", original_tree)
+    write_tree(tmp_path / "modified", modified_tree)
+    with pytest.raises(ArgumentError) as error:
+        create_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "patch"),
+                     output=io.StringIO(), jobs=0)
+    assert error.value.exit_code == 2
+    with pytest.raises(ArgumentError) as error:
+        apply_patch(str(tmp_path / "missing"), str(tmp_path / "modified"), str(tmp_path / "patch"),
+                    output=io.StringIO())
+    assert error.value.exit_code == 1
+    with pytest.raises(TypeError):
+        create_patch(str(tmp_path / "original"), str(tmp_path / "modified"), str(tmp_path / "patch"),
+                     output=io.StringIO(), unknown_option=True)
+
+    # The scripts exit with the code of the error
+    exit_code, output = run_script("patch_file_applier.py", "-o", tmp_path / "missing", "-m", tmp_path / "modified",
+                                   "-p", tmp_path / "patch")
+    assert exit_code == 1 and "does not exist" in output
+    exit_code, output = run_script("patch_file_applier.py", "-o", tmp_path / "original", "-m", tmp_path / "modified",
+                                   "-p", tmp_path / "patch", "-t", "unknown")
+    assert exit_code == 2 and "not supported" in output
+
+
+def test_output_of_parallel_jobs_is_kept_apart(tmp_path):
+    outputs = {}
+
+    def create(name):
+        write_tree(tmp_path / name / "original", original_tree)
+        write_tree(tmp_path / name / "modified", modified_tree)
+        outputs[name] = io.StringIO()
+        create_patch(str(tmp_path / name / "original"), str(tmp_path / name / "modified"),
+                     str(tmp_path / name / "patch"), output=outputs[name], tool="cdc",
+                     fingerprint_cache=str(tmp_path / name / "fingerprints.json"))
+
+    threads = [threading.Thread(target=create, args=(name,)) for name in ["first", "second"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert str(tmp_path / "first") in outputs["first"].getvalue()
+    assert str(tmp_path / "second") not in outputs["first"].getvalue()
+    assert str(tmp_path / "first") not in outputs["second"].getvalue()
@@ -0,0 +1,42 @@
+import csv
+
+from tree_helpers import read_tree, run_script
+from update_benchmark import corpora, create_corpus, find_regressions, summarize_rows
+
+parameters = {"seed": 3, "scale": 0.02, "file_scale": 0.02, "change_rate": 0.3, "edit_rate": 0.02, "rename_rate": 0.05,
+              "new_rate": 0.05, "delete_rate": 0.05}
+
+
+def test_corpora_are_reproducible(tmp_path):
+    create_corpus(corpora["directory"], parameters, str(tmp_path / "first"))
+    create_corpus(corpora["directory"], parameters, str(tmp_path / "second"))
+    first_files = read_tree(tmp_path / "first")
+    assert first_files == read_tree(tmp_path / "second")
+    assert first_files["corpus.json"] and len(first_files) > 2
+
+    create_corpus(corpora["directory"], dict(parameters, seed=4), str(tmp_path / "second"))
+    assert first_files != read_tree(tmp_path / "second")
+
+
+def test_regressions_against_a_baseline():
+    def row(label, trial, wall_seconds, verified=True):
+        return {"label": label, "corpus": "directory", "tool": "rsync", "compression": "none", "trial": trial,
+                "phase": "create", "verified": verified, "wall_seconds": wall_seconds, "cpu_seconds": 1,
+                "peak_rss_bytes": 100, "patch_bytes": 10, "read_bytes": 0, "written_bytes": 0}
+
+    baseline_summary = summarize_rows([row("old", 1, 1.0), row("old", 2, 1.2), row("old", 3, 9.0)])
+    assert baseline_summary[("directory", "rsync", "none", "create")]["wall_seconds"] == 1.2
+    assert find_regressions(summarize_rows([row("new", 1, 1.3)]), baseline_summary, 0.1) == []
+    assert find_regressions(summarize_rows([row("new", 1, 1.5), row("new", 2, 1.0, False)]), baseline_summary,
+                            0.1) == [(("directory", "rsync", "none", "create"), "verified", 3, 1),
+                                     (("directory", "rsync", "none", "create"), "wall_seconds", 1.2, 1.5)]
+
+
+def test_benchmark_run(tmp_path):
+    exit_code, output = run_script("update_benchmark.py", "-w", tmp_path, "-C", "directory", "-t", "rsync", "cdc",
+                                   "-z", "none", "container", "-r", "1", "-x", "0.02", "-L", "test")
+    assert exit_code == 0, output
+    with open(str(tmp_path / "results.csv")) as file_handler:
+        rows = list(csv.DictReader(file_handler))
+    assert len(rows) == 8
+    assert all(row["verified"] == "True" and row["label"] == "test" for row in rows)
@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+
+source_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+
+
+def write_tree(root, files):
+    # files maps relative paths to their content
+    for path, data in files.items():
+        file_path = os.path.join(str(root), path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as file_handler:
+            file_handler.write(data)
+
+
+def read_tree(root):
+    files = {}
+    for directory, _, file_names in os.walk(str(root)):
+        for file_name in file_names:
+            file_path = os.path.join(directory, file_name)
+            with open(file_path, "rb") as file_handler:
+                files[os.path.relpath(file_path, str(root))] = file_handler.read()
+    return files
+
+
+def requires_programs(*programs):
+    # External diff tools are not part of the repository, tests which need them are skipped without them
+    import shutil
+
+    import pytest
+
+    missing_programs = [program for program in programs if shutil.which(program) is None]
+    return pytest.mark.skipif(bool(missing_programs), reason="{} not installed".format(", ".join(missing_programs)))
+
+
+def run_script(script_name, *arguments):
+    # Runs one of the scripts within src like from the command line and returns its exit code and output
+    result = subprocess.run([sys.executable, os.path.join(source_directory, script_name)] +
+                            [str(argument) for argument in arguments],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    return result.returncode, result.stdout